@@ -0,0 +1,729 @@
+# src/cover_builder/cover_engine.py
+
+"""
+cover_engine.py — Cover Builder: обложка из слоёв (фон, вырезанный герой, заголовок).
+
+Каждая правка ("обложку сделать светлее", "ребёнка крупнее") раньше означала бы сборку
+обложки заново в 300 DPI. Здесь обложка — стопка слоёв, и каждый слой кэшируется отдельно:
+
+    background  — фон: кадрирование под формат + размытие (bg_blur);
+    cutout      — герой с альфа-маской в разрешении исходника (не зависит от размера обложки);
+    hero        — вырезанный герой в масштабе обложки (hero_scale);
+    title       — растр заголовка с тенью (title_color; кегль — наибольший до title_size, при
+                  котором заголовок влезает в полосу без героя: над ним или под ним — utils.text_fit);
+    композиция  — наложение слоёв по позициям (hero_x/hero_y, title_y) + цветокоррекция
+                  (brightness / contrast / saturation / warmth) таблицами по каналам.
+
+Ключ слоя — хэш ровно тех параметров, от которых слой зависит, плюс размер холста. Правка
+"светлее" не трогает ни один слой (только композиция), "крупнее" — перерисовывает hero (и
+заголовок — только если ему стало тесно: в ключе заголовка результат подбора кегля, а не сдвиг героя).
+Кэш слоёв — в памяти процесса (LRU по байтам, COVER_CACHE_MB): печатная обложка из готовых
+слоёв собирается быстрее, чем читались бы PNG-слои из хранилища, поэтому слои не сохраняются.
+
+Прогрессивная выдача:
+- proof(): превью COVER_PROOF_SIDE по длинной стороне (JPEG) — за доли секунды, сразу в Telegram;
+- печатная версия (A5 + вылеты, 300 DPI, JPEG q95 — ReportLab кладёт её в PDF без
+  перекодирования) — лениво, в фоновом потоке; если за это время пришла следующая правка,
+  устаревшая ревизия не рендерится.
+
+Спека обложки — документ covers/<book_id>: источники (hero_url, background_url), заголовок,
+параметры, ревизия, proof_url / print_url. Герой — только отдельный кадр героя (setup,
+/cover?hero_url=...), не иллюстрация сцены: иначе сцена легла бы поверх своей же размытой копии.
+Без героя обложка — фон + заголовок (по умолчанию фон — отдельный фон первой сцены или её
+иллюстрация целиком), а правки героя не применяются (unsupported); без фона — герой на ровном
+фоне цвета рамки своего кадра.
+
+Герой для обложки рисуется на ровном фоне: маска — по расстоянию в LAB до цвета рамки кадра
+(с растушёвкой). PNG с альфа-каналом используется как есть.
+
+Бенчмарк:
+    python src/cover_builder/cover_engine.py
+"""
+
+from typing import Optional, Dict, Any, List, Sequence, Tuple
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    from PIL import Image, ImageColor, ImageDraw, ImageFilter, ImageFont, ImageOps
+except Exception:
+    Image = ImageColor = ImageDraw = ImageFilter = ImageFont = ImageOps = None
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/cover_builder
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from style_engine.style_corrector import rgb_to_lab
+from utils.metrics import REGISTRY
+from utils.text_fit import Fit, FontMetrics
+
+
+COVER_PROOF_SIDE = int(os.getenv("COVER_PROOF_SIDE", "720"))
+COVER_CACHE_MB = int(os.getenv("COVER_CACHE_MB", "256"))
+COVER_FONT = os.getenv("COVER_FONT", "")
+COVER_JPEG_QUALITY = 95
+PROOF_JPEG_QUALITY = 85
+
+# A5 148 x 210 мм + вылеты по 3 мм, 300 DPI
+COVER_DPI = 300
+TRIM_MM = (148, 210)
+BLEED_MM = 3
+
+
+def _mm(mm: float) -> int:
+    return int(round(mm / 25.4 * COVER_DPI))
+
+
+PRINT_SIZE = (_mm(TRIM_MM[0] + 2 * BLEED_MM), _mm(TRIM_MM[1] + 2 * BLEED_MM))
+
+COLLECTION = "covers"
+JOB_TYPE = "cover"
+
+FONT_CANDIDATES = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/noto/NotoSans-Bold.ttf",
+    "/Library/Fonts/Arial Bold.ttf",
+    "C:/Windows/Fonts/arialbd.ttf",
+]
+
+DEFAULT_PARAMS: Dict[str, Any] = {
+    "brightness": 0.0,      # -0.5..0.5: гамма яркости
+    "contrast": 1.0,
+    "saturation": 1.0,
+    "warmth": 0.0,          # +теплее / -холоднее
+    "bg_blur": 0.0,         # радиус размытия фона, доля ширины
+    "hero_scale": 0.62,     # высота героя, доля высоты обложки
+    "hero_x": 0.5,          # центр героя по горизонтали
+    "hero_y": 0.96,         # нижняя кромка героя
+    "title_size": 0.07,     # кегль, доля высоты
+    "title_color": "#FFFFFF",
+    "title_y": 0.07,        # верх заголовка
+}
+
+PARAM_RANGES = {
+    "brightness": (-0.5, 0.5), "contrast": (0.5, 1.8), "saturation": (0.0, 2.0), "warmth": (-0.3, 0.3),
+    "bg_blur": (0.0, 0.03), "hero_scale": (0.2, 0.95), "hero_x": (0.1, 0.9), "hero_y": (0.4, 1.0),
+    "title_size": (0.03, 0.14), "title_y": (0.02, 0.5),
+}
+
+# от каких параметров зависит каждый слой (остальное — композиция)
+LAYER_PARAMS = {
+    "background": ("bg_blur",),
+    "hero": ("hero_scale",),
+    "title": ("title_color",),      # + кегль и полоса из подбора (fit_title)
+}
+# параметры, которые без слоя героя ничего не меняют: правка героя без hero_url — не ревизия
+HERO_PARAMS = ("hero_scale", "hero_x", "hero_y")
+
+# заголовок: поля по ширине, кегль не меньше доли высоты, межстрочный как в render_title
+TITLE_WIDTH = 0.86
+TITLE_MIN_SIZE = 0.03
+TITLE_LEADING = 1.2
+
+# правки словами: часть фразы -> цель -> сдвиг (+/-) или значение (=). Цель — то, о чём часть
+# фразы (заголовок / фон / герой); без цели — обложка целиком. Тон и цвет (brightness ...)
+# применяются ко всей обложке, поэтому "фон светлее" не угадывается, а уходит человеку
+FEEDBACK_RULES: List[Tuple[Tuple[str, ...], Dict[str, Dict[str, Tuple[str, Any]]]]] = [
+    (("крупнее", "покрупнее", "больше", "побольше", "bigger", "larger"),
+     {"title": {"title_size": ("+", 0.01)}, "hero": {"hero_scale": ("+", 0.06)}}),
+    (("мельче", "помельче", "меньше", "поменьше", "smaller"),
+     {"title": {"title_size": ("+", -0.01)}, "hero": {"hero_scale": ("+", -0.06)}}),
+    (("размыть", "размыт", "размытый", "blur", "blurred"),
+     {"background": {"bg_blur": ("+", 0.004)}, "cover": {"bg_blur": ("+", 0.004)}}),
+    (("четче", "sharper"), {"background": {"bg_blur": ("=", 0.0)}}),
+    (("по центру", "centered", "in the center"),
+     {"hero": {"hero_x": ("=", 0.5)}, "cover": {"hero_x": ("=", 0.5)}}),
+    (("светлее", "lighter"), {"cover": {"brightness": ("+", 0.08)}}),
+    (("темнее", "darker"), {"cover": {"brightness": ("+", -0.08)}}),
+    (("ярче", "brighter", "more vivid"), {"cover": {"saturation": ("+", 0.12), "brightness": ("+", 0.03)}}),
+    (("насыщеннее", "more colorful"), {"cover": {"saturation": ("+", 0.15)}}),
+    (("бледнее", "спокойнее", "muted", "less saturated"), {"cover": {"saturation": ("+", -0.15)}}),
+    (("контрастнее", "more contrast"), {"cover": {"contrast": ("+", 0.1)}}),
+    (("мягче", "less contrast"), {"cover": {"contrast": ("+", -0.1)}}),
+    (("теплее", "warmer"), {"cover": {"warmth": ("+", 0.05)}}),
+    (("холоднее", "cooler"), {"cover": {"warmth": ("+", -0.05)}}),
+]
+
+
+def _words_re(words: Sequence[str]) -> "re.Pattern":
+    return re.compile(r"(?<![a-zа-я])(?:" + "|".join(re.escape(w) for w in words) + r")(?![a-zа-я])")
+
+
+_FEEDBACK_RES = [(_words_re(phrases), effects) for phrases, effects in FEEDBACK_RULES]
+FEEDBACK_TARGETS = {
+    "title": re.compile(r"заголов|назван|надпис|текст|(?<![a-z])(?:title|text)(?![a-z])"),
+    "background": re.compile(r"(?<![а-я])фон(?:а|у|ом|е)?(?![а-я])|(?<![a-z])background(?![a-z])"),
+    "hero": re.compile(r"ребен|геро|малыш|персонаж|фигур|(?<![a-z])(?:hero|child|kid|boy|girl)(?![a-z])"),
+    "cover": re.compile(r"обложк|картинк|(?<![a-z])(?:cover|picture)(?![a-z])"),
+}
+# "не надо светлее", "без размытия", "don't make it darker" — эта часть фразы не правка
+FEEDBACK_NEGATION = re.compile(r"(?<![а-я])(?:не|нет|ни|без)(?![а-я])|(?<![a-z])(?:don'?t|do not|not|no|without)(?![a-z])")
+FEEDBACK_CLAUSES = re.compile(r"[,;.!?]|\s(?:и|а|но|and|but)\s")
+
+COVER_SECONDS = REGISTRY.histogram("booksoul_cover_seconds", "Cover render time by kind (proof / print)")
+LAYER_LOOKUPS = REGISTRY.counter("booksoul_cover_layer_total", "Cover layer cache lookups by layer and outcome")
+
+
+# ---------------------------------------------------------------------------------
+# ПАРАМЕТРЫ И ПРАВКИ
+# ---------------------------------------------------------------------------------
+
+def merge_params(params: Optional[Dict[str, Any]], changes: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Параметры обложки с умолчаниями и правкой; числа — в допустимых пределах."""
+    out = dict(DEFAULT_PARAMS)
+    out.update(params or {})
+    out.update(changes or {})
+    for key, (lo, hi) in PARAM_RANGES.items():
+        out[key] = round(min(hi, max(lo, float(out[key]))), 4)
+    return out
+
+
+def feedback_to_changes(text: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    "обложку сделать светлее и ребёнка крупнее" -> {"brightness": .., "hero_scale": ..}.
+    Фраза режется на части (запятые, "и", "а", "но"); у части своя цель или цель предыдущей:
+    "ребёнка крупнее и по центру". Часть с отрицанием пропускается. Неизвестная правка или
+    слово без подходящей цели ("заголовок темнее", "больше золотого цвета") -> {}
+    (уходит человеку, как и раньше).
+    """
+    changes: Dict[str, Any] = {}
+    carry: set = set()      # цели предыдущей части с правкой
+    bare: set = set()       # цели частей без правки: "заголовок и ребёнка крупнее"
+    for clause in FEEDBACK_CLAUSES.split(" " + (text or "").lower().replace("ё", "е") + " "):
+        hits = [effects for rule, effects in _FEEDBACK_RES if rule.search(clause)]
+        targets = {name for name, rule in FEEDBACK_TARGETS.items() if rule.search(clause)}
+        if not hits:
+            bare |= targets
+            continue
+        targets = (targets | bare) or carry or {"cover"}
+        if len(targets) > 1:
+            targets.discard("cover")    # "на обложке ребёнка крупнее" — о герое
+        carry, bare = targets, set()
+        if FEEDBACK_NEGATION.search(clause):
+            continue
+        for effects in hits:
+            for target in targets:
+                effect = effects.get(target)
+                if effect is None:
+                    return {}
+                for key, (op, value) in effect.items():
+                    base = changes.get(key, params.get(key, DEFAULT_PARAMS[key]))
+                    changes[key] = value if op == "=" else round(float(base) + value, 4)
+    return changes
+
+
+def layer_key(layer: str, source: str, params: Dict[str, Any], size: Tuple[int, int], extra: str = "") -> str:
+    deps = {k: params[k] for k in LAYER_PARAMS.get(layer, ())}
+    src = json.dumps([layer, source, deps, list(size), extra], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(src.encode("utf-8")).hexdigest()
+
+
+def proof_size(side: int = COVER_PROOF_SIDE) -> Tuple[int, int]:
+    w, h = PRINT_SIZE
+    return (max(1, round(w * side / h)), side)
+
+
+# ---------------------------------------------------------------------------------
+# СЛОИ
+# ---------------------------------------------------------------------------------
+
+def _open(data: bytes, size_hint: Optional[Tuple[int, int]] = None) -> "Image.Image":
+    img = Image.open(io.BytesIO(data))
+    if size_hint:
+        img.draft("RGB", size_hint)     # JPEG: декодирование сразу в уменьшенном масштабе
+    return img
+
+
+def render_background(data: bytes, size: Tuple[int, int], params: Dict[str, Any]) -> "Image.Image":
+    img = _open(data, size).convert("RGB")
+    img = ImageOps.fit(img, size, Image.BICUBIC)
+    if params["bg_blur"] > 0:
+        img = img.filter(ImageFilter.GaussianBlur(params["bg_blur"] * size[0]))
+    return img
+
+
+def frame_color(rgb: np.ndarray) -> np.ndarray:
+    """Медианный цвет рамки кадра — ровный фон, на котором нарисован герой."""
+    h, w = rgb.shape[:2]
+    b = max(2, min(h, w) // 50)
+    border = np.concatenate([rgb[:b].reshape(-1, 3), rgb[-b:].reshape(-1, 3),
+                             rgb[:, :b].reshape(-1, 3), rgb[:, -b:].reshape(-1, 3)])
+    return np.median(border, axis=0).astype(np.uint8)
+
+
+def render_plain(data: bytes, size: Tuple[int, int]) -> "Image.Image":
+    """Фон обложки без отдельного источника фона: ровный цвет рамки кадра героя."""
+    img = _open(data, (256, 256)).convert("RGB")
+    img.thumbnail((256, 256))
+    return Image.new("RGB", size, tuple(int(c) for c in frame_color(np.asarray(img))))
+
+
+def hero_cutout(data: bytes) -> "Image.Image":
+    """
+    Герой -> RGBA. Есть альфа — как есть; иначе маска по расстоянию в LAB до цвета рамки кадра.
+    """
+    img = _open(data)
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        return img.convert("RGBA")
+    rgb = np.asarray(img.convert("RGB"))
+    w = rgb.shape[1]
+    bg = rgb_to_lab(frame_color(rgb)[None])[0]
+    dist = np.linalg.norm(rgb_to_lab(rgb) - bg, axis=-1)
+    alpha = np.clip((dist - 8.0) / 14.0, 0, 1)
+    mask = Image.fromarray((alpha * 255).astype(np.uint8)).filter(ImageFilter.GaussianBlur(max(1.0, w / 600)))
+    out = Image.fromarray(rgb).convert("RGBA")
+    out.putalpha(mask)
+    return out
+
+
+def render_hero(cutout: "Image.Image", size: Tuple[int, int], params: Dict[str, Any]) -> "Image.Image":
+    target_h = max(1, round(size[1] * params["hero_scale"]))
+    target_w = max(1, round(cutout.width * target_h / cutout.height))
+    # альфа в premultiplied при ресайзе: без тёмной/светлой каймы по краю маски
+    return cutout.convert("RGBa").resize((target_w, target_h), Image.LANCZOS).convert("RGBA")
+
+
+_fonts: Dict[Tuple[str, int], Any] = {}
+
+
+def find_font() -> str:
+    if COVER_FONT:
+        return COVER_FONT
+    return next((p for p in FONT_CANDIDATES if os.path.exists(p)), "")
+
+
+def _font(path: str, px: int):
+    key = (path, px)
+    if key not in _fonts:
+        try:
+            _fonts[key] = ImageFont.truetype(path, px) if path else ImageFont.load_default(px)
+        except Exception as e:
+            print(f"[CoverEngine] font {path or 'default'} failed: {e!r}")
+            _fonts[key] = ImageFont.load_default(px)
+    return _fonts[key]
+
+
+_title_metrics: Dict[str, FontMetrics] = {}
+
+
+def title_metrics(font_path: str) -> FontMetrics:
+    """Метрики шрифта заголовка — из Pillow (как и рисуется), одни на процесс."""
+    if font_path not in _title_metrics:
+        _title_metrics[font_path] = FontMetrics(f"pil:{font_path or 'default'}", _font(font_path, 1000).getlength)
+    return _title_metrics[font_path]
+
+
+def fit_title(text: str, size: Tuple[int, int], params: Dict[str, Any], font_path: str,
+              hero: bool = True) -> Fit:
+    """
+    Кегль и строки заголовка: наибольший кегль до title_size (доля высоты), при котором заголовок
+    влезает в полосу без героя — от title_y до макушки героя, иначе под героем.
+    """
+    w, h = size
+    max_px = max(8, round(h * params["title_size"]))
+    min_px = min(max_px, max(8, round(h * TITLE_MIN_SIZE)))
+    x, rw = w * (1 - TITLE_WIDTH) / 2, w * TITLE_WIDTH
+    top = params["title_y"] * h
+    pad = min_px // 4                   # верхнее поле полосы render_title (нижнее — прозрачное)
+    if hero:
+        hero_top = (params["hero_y"] - params["hero_scale"]) * h
+        hero_bottom = params["hero_y"] * h
+        rects = [(x, top, rw, hero_top - top - pad), (x, hero_bottom, rw, h * 0.97 - hero_bottom - pad)]
+    else:
+        rects = [(x, top, rw, h * 0.97 - top - pad)]
+    return title_metrics(font_path).fit(text, rects, max_px, min_px, TITLE_LEADING, 1)
+
+
+def render_title(text: str, size: Tuple[int, int], params: Dict[str, Any], font_path: str,
+                 fit: Optional[Fit] = None) -> "Image.Image":
+    """Полоса шириной с обложку: заголовок по центру, перенос по словам, мягкая тень."""
+    w, h = size
+    fit = fit or fit_title(text, size, params, font_path)
+    px = int(fit.size)
+    font = _font(font_path, px)
+    lines = fit.lines
+    line_h = round(px * TITLE_LEADING)
+    pad = max(2, px // 4)
+    strip_h = line_h * len(lines) + 2 * pad
+    glyphs = Image.new("L", (w, strip_h), 0)
+    draw = ImageDraw.Draw(glyphs)
+    for i, line in enumerate(lines):
+        draw.text((w / 2, pad + i * line_h), line, font=font, fill=255, anchor="ma")
+    shadow = glyphs.filter(ImageFilter.GaussianBlur(max(1, px // 12)))
+    off = max(1, px // 20)
+    out = Image.new("RGBA", (w, strip_h), (0, 0, 0, 0))
+    out.paste(Image.new("RGBA", (w, strip_h), (0, 0, 0, 150)), (off, off), shadow)
+    out.paste(Image.new("RGBA", (w, strip_h), ImageColor.getrgb(params["title_color"])[:3] + (255,)), (0, 0), glyphs)
+    return out
+
+
+def grade(img: "Image.Image", params: Dict[str, Any]) -> "Image.Image":
+    """
+    Цветокоррекция всей обложки: яркость (гамма), контраст, теплота — таблица на канал,
+    насыщенность — смешивание с яркостью. Нейтральные параметры — без прохода по пикселям.
+    """
+    b, c, s, t = params["brightness"], params["contrast"], params["saturation"], params["warmth"]
+    if b == 0 and c == 1 and s == 1 and t == 0:
+        return img
+    x = np.arange(256, dtype=np.float32) / 255
+    x = x ** np.exp(-1.5 * b)
+    x = 0.5 + (x - 0.5) * c
+    luts = [np.clip(x * g * 255 + 0.5, 0, 255).astype(np.uint8) for g in (1 + t, 1.0, 1 - t)]
+    rgb = np.asarray(img.convert("RGB"))
+    out = np.stack([luts[ch][rgb[..., ch]] for ch in range(3)], axis=-1)
+    if s != 1:
+        f = out.astype(np.float32)
+        luma = f @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+        out = np.clip(luma[..., None] + (f - luma[..., None]) * s + 0.5, 0, 255).astype(np.uint8)
+    return Image.fromarray(out)
+
+
+def compose(background: "Image.Image", hero: Optional["Image.Image"], title: Optional["Image.Image"],
+            params: Dict[str, Any], title_y: Optional[int] = None) -> "Image.Image":
+    w, h = background.size
+    canvas = background.convert("RGBA")
+    if hero is not None:
+        x = round(w * params["hero_x"] - hero.width / 2)
+        y = round(h * params["hero_y"] - hero.height)
+        # герой за левым/верхним краем: PIL принимает только неотрицательный dest — режем источник
+        canvas.alpha_composite(hero, (max(0, x), max(0, y)), source=(max(0, -x), max(0, -y)))
+    if title is not None:
+        canvas.alpha_composite(title, (0, round(h * params["title_y"]) if title_y is None else title_y))
+    return grade(canvas.convert("RGB"), params)
+
+
+# ---------------------------------------------------------------------------------
+# КЭШ СЛОЁВ
+# ---------------------------------------------------------------------------------
+
+class _LayerCache:
+    """LRU слоёв по байтам (PIL Image: w * h * каналы)."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _size(img) -> int:
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, key: str):
+        with self._lock:
+            img = self._data.get(key)
+            if img is not None:
+                self._data.move_to_end(key)
+            return img
+
+    def put(self, key: str, img) -> None:
+        with self._lock:
+            if key in self._data:
+                return
+            self._data[key] = img
+            self.bytes += self._size(img)
+            while self.bytes > self.max_bytes and len(self._data) > 1:
+                _, old = self._data.popitem(last=False)
+                self.bytes -= self._size(old)
+
+
+# ---------------------------------------------------------------------------------
+# ОБЛОЖКА КНИГИ
+# ---------------------------------------------------------------------------------
+
+class CoverEngine:
+    """
+    CoverEngine — спека обложки, слои с кэшем, превью сразу и печатная версия в фоне.
+    """
+
+    def __init__(self, storage, blobs, font_path: Optional[str] = None,
+                 cache_bytes: int = COVER_CACHE_MB * 1024 * 1024):
+        self.fs = storage
+        self.blobs = blobs
+        self.font_path = find_font() if font_path is None else font_path
+        self.layers = _LayerCache(cache_bytes)
+        self._sources: "OrderedDict[str, bytes]" = OrderedDict()
+        self._print_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cover-print")
+        self._print: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    # --- спека ---
+
+    def spec(self, book_id: str) -> Dict[str, Any]:
+        """
+        covers/<book_id>; нет — по книге: заголовок книги и фон из первой нарисованной сцены
+        (её отдельный фон, иначе иллюстрация целиком). Героя по умолчанию нет — вырезанный
+        герой задаётся через setup(hero_url=...), пока его нет, обложка — фон + заголовок.
+        """
+        doc = self.fs.get_doc(COLLECTION, book_id)
+        if doc:
+            return doc
+        book = self.fs.get_book(book_id) or {}
+        drawn = [s for s in self.fs.list_scenes(book_id) if s.get("image_url")]
+        first = drawn[0] if drawn else {}
+        doc = {
+            "book_id": book_id,
+            "title": book.get("title") or "",
+            "hero_url": "",
+            "background_url": first.get("background_url") or first.get("image_url", ""),
+            "params": dict(DEFAULT_PARAMS),
+            "revision": 0,
+            "status": "draft",          # draft / awaiting_approval / approved / redo
+            "proof_url": "",
+            "print_url": "",
+        }
+        self.fs.set_doc(COLLECTION, book_id, doc)
+        return doc
+
+    def setup(self, book_id: str, **fields) -> Dict[str, Any]:
+        """
+        Источники/заголовок обложки (hero_url, background_url, title, chat_id). Сменился источник
+        или заголовок — следующее превью будет новой ревизией, даже без правки параметров.
+        """
+        doc = self.spec(book_id)
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if any(doc.get(k) != fields[k] for k in ("hero_url", "background_url", "title") if k in fields):
+            doc["proof_url"] = ""
+        doc.update(fields)
+        self.fs.set_doc(COLLECTION, book_id, doc)
+        return doc
+
+    # --- слои ---
+
+    def _source(self, url: str) -> bytes:
+        with self._lock:
+            data = self._sources.get(url)
+            if data is not None:
+                self._sources.move_to_end(url)
+                return data
+        data = self.blobs.get_bytes(self._path(url))
+        with self._lock:
+            self._sources[url] = data
+            while len(self._sources) > 32:
+                self._sources.popitem(last=False)
+        return data
+
+    def _layer(self, name: str, key: str, build, stats: Dict[str, str]):
+        img = self.layers.get(key)
+        stats[name] = "hit" if img is not None else "miss"
+        LAYER_LOOKUPS.inc(layer=name, outcome=stats[name])
+        if img is None:
+            img = build()
+            self.layers.put(key, img)
+        return img
+
+    @staticmethod
+    def hero_source(spec: Dict[str, Any]) -> str:
+        """hero_url слоя героя; "" — слоя нет (героя не задали или это та же картинка, что фон)."""
+        hero_url = spec.get("hero_url") or ""
+        # одна картинка и фоном, и героем — это сцена, а не вырезанный герой
+        return "" if hero_url == (spec.get("background_url") or "") else hero_url
+
+    def render(self, spec: Dict[str, Any], size: Tuple[int, int]) -> Tuple["Image.Image", Dict[str, str]]:
+        """Спека -> картинка обложки размера size + какие слои взяты из кэша."""
+        params = merge_params(spec.get("params"))
+        stats: Dict[str, str] = {}
+        bg_url = spec.get("background_url") or ""
+        hero_url = self.hero_source(spec)
+        if bg_url:
+            background = self._layer(
+                "background", layer_key("background", bg_url, params, size),
+                lambda: render_background(self._source(bg_url), size, params), stats)
+        elif hero_url:
+            background = self._layer(
+                "background", layer_key("plain", hero_url, {}, size),
+                lambda: render_plain(self._source(hero_url), size), stats)
+        else:
+            raise ValueError(f"[CoverEngine] {spec.get('book_id', '')}: нет ни фона, ни героя для обложки")
+        hero = None
+        if hero_url:
+            cutout = self._layer("cutout", layer_key("cutout", hero_url, {}, (0, 0)),
+                                 lambda: hero_cutout(self._source(hero_url)), stats)
+            hero = self._layer("hero", layer_key("hero", hero_url, params, size),
+                               lambda: render_hero(cutout, size, params), stats)
+        title, title_y = None, None
+        if spec.get("title"):
+            fit = fit_title(spec["title"], size, params, self.font_path, hero=hero is not None)
+            title_y = round(fit.rect[1])
+            title = self._layer("title", layer_key("title", spec["title"], params, size,
+                                                   f"{self.font_path}|{fit.size}"),
+                                lambda: render_title(spec["title"], size, params, self.font_path, fit), stats)
+        return compose(background, hero, title, params, title_y), stats
+
+    # --- превью и печать ---
+
+    def proof(self, book_id: str, feedback: str = "", changes: Optional[Dict[str, Any]] = None,
+              schedule_print: bool = True) -> Dict[str, Any]:
+        """
+        Правка -> новая ревизия -> превью (JPEG, для Telegram) сейчас, печатная версия — в фоне.
+        Правка героя, когда слоя героя нет (hero_url не задан), не применяется — она в
+        "unsupported". Если больше править нечего, ревизии нет и превью не рисуется: proof=None.
+        """
+        t0 = time.perf_counter()
+        spec = self.spec(book_id)
+        params = merge_params(spec.get("params"))
+        applied = feedback_to_changes(feedback, params) if feedback else {}
+        applied.update(changes or {})
+        unsupported: List[str] = []
+        if not self.hero_source(spec):
+            unsupported = sorted(k for k in applied if k in HERO_PARAMS)
+            applied = {k: v for k, v in applied.items() if k not in HERO_PARAMS}
+        if unsupported and not applied and spec.get("proof_url"):
+            return {"book_id": book_id, "revision": int(spec.get("revision", 0)), "changes": {},
+                    "unsupported": unsupported, "layers": {}, "proof_url": spec["proof_url"], "proof": None,
+                    "seconds": round(time.perf_counter() - t0, 3)}
+        if applied or not spec.get("proof_url"):
+            spec["params"] = merge_params(params, applied)
+            spec["revision"] = int(spec.get("revision", 0)) + 1
+        rev = spec["revision"]
+
+        img, stats = self.render(spec, proof_size())
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=PROOF_JPEG_QUALITY)
+        jpeg = buf.getvalue()
+        url = self.blobs.put_bytes(f"books/{book_id}/cover/proof.jpg", jpeg, "image/jpeg")
+        spec.update({"proof_url": url, "status": "awaiting_approval", "updated_at": self.fs.server_timestamp()})
+        self.fs.set_doc(COLLECTION, book_id, spec)
+        seconds = time.perf_counter() - t0
+        COVER_SECONDS.observe(seconds, kind="proof")
+
+        if schedule_print:
+            with self._lock:
+                self._print[book_id] = self._print_pool.submit(self._render_print, book_id, rev)
+        return {"book_id": book_id, "revision": rev, "changes": applied, "unsupported": unsupported,
+                "layers": stats, "proof_url": url, "proof": jpeg, "seconds": round(seconds, 3)}
+
+    def _render_print(self, book_id: str, rev: int) -> Optional[Dict[str, Any]]:
+        spec = self.spec(book_id)
+        if int(spec.get("revision", 0)) != rev:
+            return None                 # пришла следующая правка — эту ревизию не печатаем
+        t0 = time.perf_counter()
+        job_id = self.fs.create_job(book_id, JOB_TYPE, status="running")
+        try:
+            img, stats = self.render(spec, PRINT_SIZE)
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=COVER_JPEG_QUALITY, subsampling=0, dpi=(COVER_DPI, COVER_DPI))
+            url = self.blobs.put_bytes(f"books/{book_id}/cover/cover.jpg", buf.getvalue(), "image/jpeg")
+        except Exception as e:
+            print(f"[CoverEngine] print render failed for {book_id} r{rev}: {e!r}")
+            self.fs.update_job_status(job_id, "error", job_type=JOB_TYPE)
+            return None
+        latest = self.fs.get_doc(COLLECTION, book_id) or {}
+        if int(latest.get("revision", 0)) == rev:
+            self.fs.update_doc(COLLECTION, book_id, {"print_url": url, "print_revision": rev})
+            self.fs.attach_cover_url(book_id, url)
+        self.fs.update_job_status(job_id, "done", result_url=url, job_type=JOB_TYPE)
+        seconds = time.perf_counter() - t0
+        COVER_SECONDS.observe(seconds, kind="print")
+        return {"revision": rev, "print_url": url, "layers": stats, "seconds": round(seconds, 3)}
+
+    def wait_print(self, book_id: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            fut = self._print.get(book_id)
+        return fut.result(timeout) if fut else None
+
+    def _path(self, url: str) -> str:
+        """URL из спеки -> путь в хранилище файлов."""
+        if url.startswith("gs://"):
+            return url.split("/", 3)[3]
+        if url.startswith("file://"):
+            return os.path.relpath(url[len("file://"):], self.blobs.root_dir).replace(os.sep, "/")
+        return url
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+def _bench_sources(seed: int = 0) -> Tuple[bytes, bytes]:
+    """Герой на ровном фоне (PNG 1024) и фон сцены (PNG 1024x1536) — как от генератора."""
+    r = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:1024, 0:1024] / 1024
+    hero = np.empty((1024, 1024, 3), dtype=np.float32)
+    hero[:] = (0.93, 0.93, 0.90)
+    body = ((xx - 0.5) / 0.22) ** 2 + ((yy - 0.68) / 0.3) ** 2 < 1
+    head = ((xx - 0.5) / 0.12) ** 2 + ((yy - 0.3) / 0.12) ** 2 < 1
+    hero[body] = (0.85, 0.35, 0.30)
+    hero[head] = (0.95, 0.78, 0.65)
+    yy, xx = np.mgrid[0:1536, 0:1024] / 1024
+    bg = np.stack([0.35 + 0.3 * yy / 1.5, 0.55 + 0.2 * np.sin(xx * 6), 0.8 - 0.3 * yy / 1.5], axis=-1)
+    out = []
+    for arr in (hero, bg):
+        arr = np.clip(arr * 255 + r.integers(-4, 5, arr.shape), 0, 255).astype(np.uint8)
+        buf = io.BytesIO()
+        Image.fromarray(arr).save(buf, format="PNG")
+        out.append(buf.getvalue())
+    return out[0], out[1]
+
+
+if __name__ == "__main__":
+    from data_layer.memory_storage import MemoryStorage
+    from data_layer.gcs_client import LocalBlobStore
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="BookSoul cover engine benchmark")
+    parser.parse_args()
+
+    fs = MemoryStorage()
+    blobs = LocalBlobStore(tempfile.mkdtemp(prefix="booksoul_cover_"))
+    book_id = "BKS-20251201-000001"
+    fs.create_book(book_id, child_name="Лейла", theme="сад", status="cover", title="Лейла и золотой кот")
+    hero, bg = _bench_sources()
+    hero_url = blobs.put_bytes(f"books/{book_id}/cover/hero.png", hero, "image/png")
+    bg_url = blobs.put_bytes(f"books/{book_id}/cover/background.png", bg, "image/png")
+
+    print(f"печать {PRINT_SIZE[0]}x{PRINT_SIZE[1]} (A5 + вылеты, {COVER_DPI} DPI), превью {proof_size()}, "
+          f"шрифт: {find_font() or 'встроенный Pillow (без кириллицы — задайте COVER_FONT)'}")
+
+    # как было бы без слоёв: каждая правка — полная сборка в 300 DPI
+    spec = {"title": "Лейла и золотой кот", "hero_url": hero_url, "background_url": bg_url, "params": {}}
+    cold = CoverEngine(fs, blobs)
+    t0 = time.perf_counter()
+    img, _ = cold.render(spec, PRINT_SIZE)
+    img.save(io.BytesIO(), format="JPEG", quality=COVER_JPEG_QUALITY, subsampling=0)
+    full = time.perf_counter() - t0
+    print(f"полная сборка 300 DPI с нуля: {full:.2f} с на каждую правку")
+
+    engine = CoverEngine(fs, blobs)
+    engine.setup(book_id, hero_url=hero_url, background_url=bg_url)
+    rounds = ["", "обложку сделать светлее", "ребёнка крупнее и по центру", "заголовок крупнее",
+              "make the cover warmer", "размыть фон"]
+    for text in rounds:
+        res = engine.proof(book_id, feedback=text)
+        t0 = time.perf_counter()
+        printed = engine.wait_print(book_id)
+        print(f"{text or 'первое превью':30s} превью {res['seconds']:.3f} с  {res['layers']}  "
+              f"печать в фоне {printed['seconds']:.2f} с  {printed['layers']}")
+        assert res["seconds"] < 1.0
+
+    # без героя правка героя — не ревизия: превью не рисуется, правка в unsupported
+    plain_id = "BKS-20251201-000002"
+    fs.create_book(plain_id, child_name="Мила", theme="море", status="cover", title="Мила и кит")
+    engine.setup(plain_id, background_url=bg_url)
+    first = engine.proof(plain_id, schedule_print=False)
+    res = engine.proof(plain_id, feedback="ребёнка крупнее", schedule_print=False)
+    print(f"без героя, 'ребёнка крупнее': ревизия {first['revision']} -> {res['revision']}, "
+          f"unsupported {res['unsupported']}, превью {'нет' if res['proof'] is None else 'есть'}")
+    assert res["revision"] == first["revision"] and res["proof"] is None
+
+    # правки подряд быстрее печати: устаревшие ревизии не печатаются
+    for text in ("светлее", "светлее", "светлее"):
+        engine.proof(book_id, feedback=text)
+    last = engine.wait_print(book_id)
+    doc = fs.get_doc(COLLECTION, book_id)
+    print(f"3 правки подряд: ревизия {doc['revision']}, напечатана {doc.get('print_revision')}, "
+          f"params {json.dumps({k: doc['params'][k] for k in ('brightness', 'hero_scale', 'warmth')})}")
+    print(f"кэш слоёв: {engine.layers.bytes / 2 ** 20:.0f} МБ, обложка книги: {fs.get_book(book_id)['cover_url']}")
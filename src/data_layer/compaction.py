@@ -0,0 +1,329 @@
+# src/data_layer/compaction.py
+
+"""
+compaction.py — ретенция inbox / events / outbox.
+
+Документы старше N дней выгружаются в сжатые дневные архивы JSONL (zstd, без zstandard — gzip)
+в GCS (или локальную папку), затем удаляются из хранилища пачками.
+Каждый архив попадает в manifest.json: по нему архивы можно найти, прочитать и переиграть.
+
+Раскладка:
+    archives/manifest.json
+    archives/{collection}/{YYYY-MM-DD}/part-{run_id}.jsonl.zst
+
+Запуск:
+    python src/data_layer/compaction.py --days 30
+    BOOKSOUL_BLOB_DIR=./archives_local python src/data_layer/compaction.py --days 7 --dry-run
+"""
+
+from datetime import datetime, timedelta, timezone, date
+from typing import Optional, Dict, Any, List, Iterator, Callable, Tuple
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import uuid
+
+try:
+    import zstandard
+except Exception:
+    zstandard = None
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/data_layer
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend, utcnow
+
+
+# коллекция -> поле времени, по которому считаем возраст документа
+COMPACTION_POLICIES: Dict[str, str] = {
+    "inbox": "created_at",
+    "events": "created_at",
+    "outbox": "sent_at",
+}
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "30"))
+ARCHIVE_PREFIX = os.getenv("ARCHIVE_PREFIX", "archives")
+PAGE_SIZE = 1000
+
+MANIFEST_NAME = "manifest.json"
+
+
+# ---------------------------------------------------------------------------------
+# КОДЕК
+# ---------------------------------------------------------------------------------
+
+def _codec() -> Tuple[str, str]:
+    """(имя кодека, расширение файла)"""
+    return ("zstd", ".jsonl.zst") if zstandard is not None else ("gzip", ".jsonl.gz")
+
+
+def _compress(raw: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(raw)
+    return gzip.compress(raw, compresslevel=9)
+
+
+def _decompress(blob: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("архив в zstd, а пакет zstandard не установлен")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(blob)
+    return gzip.decompress(blob)
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.hex()
+    return str(value)
+
+
+def _as_datetime(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str):
+        try:
+            return _as_datetime(datetime.fromisoformat(value))
+        except ValueError:
+            return None
+    return None
+
+
+# ---------------------------------------------------------------------------------
+# МАНИФЕСТ
+# ---------------------------------------------------------------------------------
+
+class ArchiveManifest:
+    """
+    manifest.json: список всех архивов с диапазонами, количеством и контрольной суммой.
+    Пишет его один компактор (cron), читают все.
+    """
+
+    def __init__(self, blobs, prefix: str = ARCHIVE_PREFIX):
+        self.blobs = blobs
+        self.prefix = prefix.strip("/")
+        self.path = f"{self.prefix}/{MANIFEST_NAME}"
+
+    def load(self) -> Dict[str, Any]:
+        if not self.blobs.exists(self.path):
+            return {"version": 1, "archives": []}
+        return json.loads(self.blobs.get_bytes(self.path).decode("utf-8"))
+
+    def save(self, manifest: Dict[str, Any]) -> None:
+        raw = json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8")
+        self.blobs.put_bytes(self.path, raw, content_type="application/json")
+
+    def append(self, entries: List[Dict[str, Any]]) -> None:
+        manifest = self.load()
+        manifest["archives"].extend(entries)
+        manifest["updated_at"] = utcnow().isoformat()
+        self.save(manifest)
+
+
+# ---------------------------------------------------------------------------------
+# КОМПАКТОР
+# ---------------------------------------------------------------------------------
+
+class CompactionJob:
+    """
+    CompactionJob — выгружает старые документы в архивы и удаляет их из хранилища.
+    Порядок всегда: архив записан -> манифест обновлён -> только потом удаление.
+    """
+
+    def __init__(self,
+                 storage: StorageBackend,
+                 blobs,
+                 retention_days: int = RETENTION_DAYS,
+                 prefix: str = ARCHIVE_PREFIX,
+                 page_size: int = PAGE_SIZE,
+                 policies: Optional[Dict[str, str]] = None):
+        self.storage = storage
+        self.blobs = blobs
+        self.retention_days = retention_days
+        self.prefix = prefix.strip("/")
+        self.page_size = page_size
+        self.policies = policies or COMPACTION_POLICIES
+        self.manifest = ArchiveManifest(blobs, self.prefix)
+
+    def run(self, now: Optional[datetime] = None, dry_run: bool = False) -> Dict[str, Any]:
+        """
+        Один проход по всем коллекциям. Возвращает сводку: сколько заархивировано/удалено.
+        """
+        now = now or utcnow()
+        cutoff = now - timedelta(days=self.retention_days)
+        run_id = now.strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        summary: Dict[str, Any] = {"cutoff": cutoff.isoformat(), "run_id": run_id, "collections": {}}
+
+        for collection, ts_field in self.policies.items():
+            archived = deleted = 0
+            archives: List[Dict[str, Any]] = []
+            page = 0
+            while True:
+                docs = self.storage.query_docs(
+                    collection,
+                    where=[(ts_field, "<", cutoff)],
+                    order_by=ts_field,
+                    limit=self.page_size,
+                )
+                if not docs:
+                    break
+
+                entries = self._write_archives(collection, ts_field, docs, f"{run_id}-{page}", dry_run)
+                archives.extend(entries)
+                archived += len(docs)
+                if dry_run:
+                    break
+
+                self.manifest.append(entries)
+                deleted += self.storage.delete_docs(collection, [d["id"] for d in docs])
+                page += 1
+                if len(docs) < self.page_size:
+                    break
+
+            summary["collections"][collection] = {
+                "archived": archived,
+                "deleted": deleted,
+                "archives": [a["path"] for a in archives],
+            }
+
+        return summary
+
+    def _write_archives(
+        self,
+        collection: str,
+        ts_field: str,
+        docs: List[Dict[str, Any]],
+        part: str,
+        dry_run: bool,
+    ) -> List[Dict[str, Any]]:
+        """
+        Раскладывает страницу документов по дням и пишет по архиву на день.
+        """
+        codec, ext = _codec()
+        by_day: Dict[str, List[Dict[str, Any]]] = {}
+        for d in docs:
+            ts = _as_datetime(d.get(ts_field))
+            day = ts.date().isoformat() if ts else "unknown"
+            by_day.setdefault(day, []).append(d)
+
+        entries = []
+        for day, items in sorted(by_day.items()):
+            lines = [json.dumps(d, ensure_ascii=False, default=_json_default, sort_keys=True) for d in items]
+            raw = ("\n".join(lines) + "\n").encode("utf-8")
+            blob = _compress(raw, codec)
+            path = f"{self.prefix}/{collection}/{day}/part-{part}{ext}"
+            stamps = [_as_datetime(d.get(ts_field)) for d in items]
+            stamps = [s for s in stamps if s is not None]
+
+            url = "" if dry_run else self.blobs.put_bytes(path, blob, content_type="application/octet-stream")
+            entries.append({
+                "collection": collection,
+                "day": day,
+                "path": path,
+                "url": url,
+                "codec": codec,
+                "count": len(items),
+                "raw_bytes": len(raw),
+                "bytes": len(blob),
+                "sha256": hashlib.sha256(blob).hexdigest(),
+                "min_ts": min(stamps).isoformat() if stamps else None,
+                "max_ts": max(stamps).isoformat() if stamps else None,
+                "ts_field": ts_field,
+                "created_at": utcnow().isoformat(),
+            })
+        return entries
+
+
+# ---------------------------------------------------------------------------------
+# ЧТЕНИЕ / REPLAY
+# ---------------------------------------------------------------------------------
+
+class ArchiveReader:
+    """
+    ArchiveReader — поиск и чтение архивов по манифесту (аналитика, разбор инцидентов, replay).
+    """
+
+    def __init__(self, blobs, prefix: str = ARCHIVE_PREFIX):
+        self.blobs = blobs
+        self.manifest = ArchiveManifest(blobs, prefix)
+
+    def list_archives(
+        self,
+        collection: str,
+        day_from: Optional[date] = None,
+        day_to: Optional[date] = None,
+    ) -> List[Dict[str, Any]]:
+        out = []
+        for entry in self.manifest.load().get("archives", []):
+            if entry["collection"] != collection:
+                continue
+            if day_from and entry["day"] < day_from.isoformat():
+                continue
+            if day_to and entry["day"] > day_to.isoformat():
+                continue
+            out.append(entry)
+        return sorted(out, key=lambda e: (e["day"], e["path"]))
+
+    def iter_docs(
+        self,
+        collection: str,
+        day_from: Optional[date] = None,
+        day_to: Optional[date] = None,
+        where: Optional[Callable[[Dict[str, Any]], bool]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Документы из архивов в порядке дней; where — фильтр на Python.
+        Контрольная сумма проверяется до распаковки.
+        """
+        for entry in self.list_archives(collection, day_from, day_to):
+            blob = self.blobs.get_bytes(entry["path"])
+            if hashlib.sha256(blob).hexdigest() != entry["sha256"]:
+                raise RuntimeError(f"архив повреждён: {entry['path']}")
+            for line in io.StringIO(_decompress(blob, entry["codec"]).decode("utf-8")):
+                line = line.strip()
+                if not line:
+                    continue
+                doc = json.loads(line)
+                if where is None or where(doc):
+                    yield doc
+
+    def replay(
+        self,
+        collection: str,
+        handler: Callable[[Dict[str, Any]], None],
+        day_from: Optional[date] = None,
+        day_to: Optional[date] = None,
+    ) -> int:
+        """
+        Переигрывает архивные документы через handler (например, обратно в хранилище).
+        """
+        count = 0
+        for doc in self.iter_docs(collection, day_from, day_to):
+            handler(doc)
+            count += 1
+        return count
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ ЗАПУСК
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    from data_layer.gcs_client import get_blob_store
+    from data_layer.storage import get_storage
+
+    parser = argparse.ArgumentParser(description="BookSoul inbox/events/outbox compaction")
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    job = CompactionJob(get_storage(), get_blob_store(), retention_days=args.days)
+    print(json.dumps(job.run(dry_run=args.dry_run), ensure_ascii=False, indent=2))
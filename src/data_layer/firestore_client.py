@@ -1,18 +1,36 @@
 # src/data_layer/firestore_client.py
 
-from typing import Optional, Dict, Any, List
-from google.cloud import firestore
+from typing import Optional, Dict, Any, List, Sequence
+import os
+import sys
+
+from google.api_core import exceptions as gexc
 from google.auth import default
-from datetime import datetime
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/data_layer
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend, DocumentNotFound, IncrementOp, Where, nest_paths
 
 
 # Важно:
 # - этот модуль — это "официальный канал" общения с Firestore
-# - все другие части фабрики (бот, Router, Layout Engine) должны использовать именно его,
-#   а не дергать Firestore напрямую, чтобы логика статусов была одинаковой
+# - все другие части фабрики (бот, Router, Layout Engine) должны использовать именно его
+#   (через StorageBackend / get_storage), а не дергать Firestore напрямую,
+#   чтобы логика статусов была одинаковой
+# - доменные методы (create_book, add_scene, create_job, ...) живут в StorageBackend,
+#   здесь только примитивы поверх firestore.Client
 
+# лимит Firestore на число операций в одном батче
+BATCH_LIMIT = 500
 
-class FirestoreClient:
+
+class FirestoreClient(StorageBackend):
     """
     FirestoreClient — обёртка вокруг Firestore для фабрики BookSoul.
     Здесь мы работаем с книгами, сценами, статусами, комментариями.
@@ -20,263 +38,103 @@ class FirestoreClient:
 
     def __init__(self,
                  project_id: Optional[str] = "booksoulv2",
-                 root_collection: str = "books"):
-        # ADC авторизация без JSON-ключа
-        creds, adc_project = default()
-        self.project_id = project_id or adc_project
-        if not self.project_id:
-            raise RuntimeError("FirestoreClient: project_id не определён (ни в аргументе, ни в ADC).")
+                 root_collection: str = "books",
+                 db: Optional[firestore.Client] = None):
+        if db is not None:
+            self.db = db
+            self.project_id = db.project
+        elif os.getenv("FIRESTORE_EMULATOR_HOST"):
+            # эмулятор: ADC не нужны
+            self.project_id = project_id or os.getenv("GOOGLE_CLOUD_PROJECT") or "booksoul-local"
+            self.db = firestore.Client(project=self.project_id, credentials=AnonymousCredentials())
+        else:
+            # ADC авторизация без JSON-ключа
+            creds, adc_project = default()
+            self.project_id = project_id or adc_project
+            if not self.project_id:
+                raise RuntimeError("FirestoreClient: project_id не определён (ни в аргументе, ни в ADC).")
+            self.db = firestore.Client(project=self.project_id, credentials=creds)
 
-        self.db = firestore.Client(project=self.project_id, credentials=creds)
         self.root_collection = root_collection  # обычно "books"
 
     # ---------------------------------------------------------------------------------
-    # КНИГА
+    # ПРИМИТИВЫ
     # ---------------------------------------------------------------------------------
 
-    def create_book(
-        self,
-        book_id: str,
-        child_name: str,
-        theme: str,
-        language: str = "ru",
-        status: str = "draft",
-        title: Optional[str] = None,
-    ) -> None:
-        """
-        Создаёт запись о книге в коллекции books/{book_id}.
-        Используется сразу после того, как пользователь в Telegram дал тему сказки.
-        """
-        if title is None:
-            title = f"История для {child_name}"
-
-        doc_ref = self.db.collection(self.root_collection).document(book_id)
-        doc_ref.set({
-            "child_name": child_name,
-            "title": title,
-            "theme": theme,
-            "language": language,
-            "status": status,  # draft / writing / drawing / styling / cover / layout / approval / ready
-            "pdf_url": "",
-            "cover_url": "",
-            "created_at": firestore.SERVER_TIMESTAMP,
-            "updated_at": firestore.SERVER_TIMESTAMP,
-        }, merge=True)
-
-    def update_book_status(
-        self,
-        book_id: str,
-        status: str,
-    ) -> None:
-        """
-        Меняет статус книги (например 'writing' -> 'drawing' -> 'styling' ...).
-        Вызывается Router-GPT после завершения этапа.
-        """
-        doc_ref = self.db.collection(self.root_collection).document(book_id)
-        doc_ref.update({
-            "status": status,
-            "updated_at": firestore.SERVER_TIMESTAMP
-        })
-
-    def attach_cover_url(
-        self,
-        book_id: str,
-        cover_url: str,
-    ) -> None:
-        """
-        Сохраняет ссылку на финальную обложку.
-        """
-        doc_ref = self.db.collection(self.root_collection).document(book_id)
-        doc_ref.update({
-            "cover_url": cover_url,
-            "updated_at": firestore.SERVER_TIMESTAMP
-        })
+    def server_timestamp(self) -> Any:
+        return firestore.SERVER_TIMESTAMP
 
-    def attach_pdf_url(
-        self,
-        book_id: str,
-        pdf_url: str,
-    ) -> None:
-        """
-        Сохраняет ссылку на финальный PDF.
-        """
-        doc_ref = self.db.collection(self.root_collection).document(book_id)
-        doc_ref.update({
-            "pdf_url": pdf_url,
-            "updated_at": firestore.SERVER_TIMESTAMP
-        })
-
-    def get_book(self, book_id: str) -> Optional[Dict[str, Any]]:
-        """
-        Получает всю инфу по книге (для Telegram: показать статус, ссылки, прогресс).
-        """
-        doc_ref = self.db.collection(self.root_collection).document(book_id).get()
-        if not doc_ref.exists:
+    def get_doc(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        snap = self.db.collection(collection).document(doc_id).get()
+        if not snap.exists:
             return None
-        data = doc_ref.to_dict()
-        data["id"] = book_id
-        return data
-
-    # ---------------------------------------------------------------------------------
-    # СЦЕНЫ
-    # ---------------------------------------------------------------------------------
-
-    def add_scene(
-        self,
-        book_id: str,
-        scene_id: str,
-        page_number: int,
-        text: str,
-        prompt_main: str,
-        prompt_background: str,
-        status: str = "pending",
-        image_url: str = "",
-    ) -> None:
-        """
-        Добавляет сцену (страницу книги) в подколлекцию books/{book_id}/scenes/{scene_id}.
-        StoryWriter будет вызывать это для каждой сцены.
-        """
-        scene_ref = (
-            self.db.collection(self.root_collection)
-            .document(book_id)
-            .collection("scenes")
-            .document(scene_id)
-        )
-        scene_ref.set({
-            "page": page_number,
-            "text": text,
-            "image_prompt_main": prompt_main,
-            "image_prompt_background": prompt_background,
-            "status": status,       # pending / approved / redo
-            "image_url": image_url, # GCS URL после генерации иллюстрации
-            "updated_at": firestore.SERVER_TIMESTAMP,
-        }, merge=True)
-
-    def update_scene_image_url(
+        return snap.to_dict() or {}
+
+    def set_doc(self, collection: str, doc_id: str, data: Dict[str, Any], merge: bool = False) -> None:
+        self.db.collection(collection).document(doc_id).set(data, merge=merge)
+
+    def update_doc(self, collection: str, doc_id: str, fields: Dict[str, Any]) -> None:
+        try:
+            self.db.collection(collection).document(doc_id).update(fields)
+        except gexc.NotFound as e:
+            raise DocumentNotFound(f"{collection}/{doc_id}") from e
+
+    def add_doc(self, collection: str, data: Dict[str, Any]) -> str:
+        doc_ref = self.db.collection(collection).document()
+        doc_ref.set(data)
+        return doc_ref.id
+
+    def create_doc_once(self, collection: str, doc_id: str, data: Dict[str, Any]) -> bool:
+        # create() падает с AlreadyExists, если документ есть: одна запись вместо транзакции
+        try:
+            self.db.collection(collection).document(doc_id).create(data)
+            return True
+        except gexc.Conflict:
+            return False
+
+    def query_docs(
         self,
-        book_id: str,
-        scene_id: str,
-        image_url: str,
-        status: Optional[str] = None,
-    ) -> None:
-        """
-        Сохраняет ссылку на сгенерированную картинку для сцены.
-        Может также обновлять статус сцены.
-        """
-        scene_ref = (
-            self.db.collection(self.root_collection)
-            .document(book_id)
-            .collection("scenes")
-            .document(scene_id)
-        )
-        payload = {
-            "image_url": image_url,
-            "updated_at": firestore.SERVER_TIMESTAMP,
-        }
-        if status:
-            payload["status"] = status
-        scene_ref.update(payload)
-
-    def list_scenes(self, book_id: str) -> List[Dict[str, Any]]:
-        """
-        Возвращает список сцен книги отсортированных по page.
-        Нужно Layout Engine для сборки PDF.
-        """
-        scenes_ref = (
-            self.db.collection(self.root_collection)
-            .document(book_id)
-            .collection("scenes")
-        )
-
-        snapshots = scenes_ref.stream()
-        scenes = []
-        for snap in snapshots:
-            d = snap.to_dict()
+        collection: str,
+        where: Sequence[Where] = (),
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        query = self.db.collection(collection)
+        for field, op, value in where:
+            query = query.where(field, op, value)
+        if order_by:
+            direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+            query = query.order_by(order_by, direction=direction)
+        if limit is not None:
+            query = query.limit(limit)
+
+        docs = []
+        for snap in query.stream():
+            d = snap.to_dict() or {}
             d["id"] = snap.id
-            scenes.append(d)
-
-        # сортируем по page
-        scenes.sort(key=lambda x: x.get("page", 0))
-        return scenes
-
-    # ---------------------------------------------------------------------------------
-    # ОБРАТНАЯ СВЯЗЬ / КОММЕНТАРИИ
-    # ---------------------------------------------------------------------------------
-
-    def add_feedback(
-        self,
-        book_id: str,
-        comment_text: str,
-        source: str = "user",
-    ) -> None:
-        """
-        Сохраняет комментарий (правку) от тебя.
-        Это будет дублироваться и в Google Sheets.
-        """
-        feedback_ref = self.db.collection("feedback").document()
-        feedback_ref.set({
-            "book_id": book_id,
-            "comment": comment_text,
-            "source": source,  # user / router / style_engine / layout_engine
-            "created_at": firestore.SERVER_TIMESTAMP,
-        })
-
-    # ---------------------------------------------------------------------------------
-    # JOBS (таски фабрики)
-    # ---------------------------------------------------------------------------------
-
-    def create_job(
-        self,
-        book_id: str,
-        job_type: str,
-        status: str = "pending",
-        result_url: str = "",
-    ) -> str:
-        """
-        Создаёт задачу для фабрики (например 'scene_generation', 'cover', 'layout').
-        Возвращает ID задачи.
-        """
-        job_ref = self.db.collection("jobs").document()
-        job_ref.set({
-            "book_id": book_id,
-            "type": job_type,        # scene_generation / style_pass / cover / layout
-            "status": status,        # pending / running / done / error
-            "result_url": result_url,
-            "created_at": firestore.SERVER_TIMESTAMP,
-            "updated_at": firestore.SERVER_TIMESTAMP,
-        })
-        return job_ref.id
-
-    def update_job_status(
-        self,
-        job_id: str,
-        status: str,
-        result_url: Optional[str] = None,
-    ) -> None:
-        """
-        Обновляет статус задачи фабрики.
-        Например когда обложка готова или PDF собран.
-        """
-        job_ref = self.db.collection("jobs").document(job_id)
-        payload = {
-            "status": status,
-            "updated_at": firestore.SERVER_TIMESTAMP,
-        }
-        if result_url is not None:
-            payload["result_url"] = result_url
-        job_ref.update(payload)
-
-    # ---------------------------------------------------------------------------------
-    # УТИЛИТНЫЕ ШТУКИ
-    # ---------------------------------------------------------------------------------
-
-    def make_trace_id(self) -> str:
-        """
-        Генератор ID книги формата BKS-YYYYMMDD-HHMMSS.
-        Вызывается при создании новой книги.
-        """
-        now = datetime.utcnow()
-        return "BKS-" + now.strftime("%Y%m%d-%H%M%S")
+            docs.append(d)
+        return docs
+
+    def delete_docs(self, collection: str, doc_ids: Sequence[str]) -> int:
+        col = self.db.collection(collection)
+        deleted = 0
+        for start in range(0, len(doc_ids), BATCH_LIMIT):
+            batch = self.db.batch()
+            chunk = doc_ids[start:start + BATCH_LIMIT]
+            for doc_id in chunk:
+                batch.delete(col.document(doc_id))
+            batch.commit()
+            deleted += len(chunk)
+        return deleted
+
+    def increment_docs(self, ops: Sequence[IncrementOp]) -> None:
+        batch = self.db.batch()
+        for collection, doc_id, deltas, extra in ops:
+            payload = dict(extra or {})
+            payload.update(nest_paths({k: firestore.Increment(v) for k, v in deltas.items()}))
+            batch.set(self.db.collection(collection).document(doc_id), payload, merge=True)
+        batch.commit()
 
 
 # Быстрый линейный тест (локально)
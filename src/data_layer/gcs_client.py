@@ -0,0 +1,227 @@
+# src/data_layer/gcs_client.py
+
+from typing import Optional, List, IO
+import os
+import shutil
+
+try:
+    from google.cloud import storage as gcs
+except Exception:
+    gcs = None
+
+
+# Важно:
+# - единый канал к бинарным файлам фабрики: картинки сцен, обложки, PDF, архивы
+# - GCSClient — прод (бакет GCS_BUCKET), LocalBlobStore — локальная папка с тем же API
+#   (тесты, бенчмарки, single-node)
+# - выбор: BOOKSOUL_BLOB_DIR задан -> LocalBlobStore, иначе GCS
+# - путь внутри хранилища всегда относительный: "books/BKS-.../scene_001.png"
+# - open_write — потоковая запись кусками (картинка от провайдера идёт в хранилище, не копясь
+#   в памяти); пишется во временный "<path>.part", close() публикует, abort() выбрасывает
+
+# порог, после которого upload_file идёт resumable-загрузкой кусками
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class GCSClient:
+    """
+    GCSClient — обёртка над Google Cloud Storage для фабрики BookSoul.
+    """
+
+    def __init__(self, bucket_name: Optional[str] = None, project_id: Optional[str] = None):
+        if gcs is None:
+            raise RuntimeError("GCSClient: google-cloud-storage не установлен.")
+        self.bucket_name = bucket_name or os.getenv("GCS_BUCKET", "")
+        if not self.bucket_name:
+            raise RuntimeError("GCSClient: GCS_BUCKET не задан.")
+        self.client = gcs.Client(project=project_id)
+        self.bucket = self.client.bucket(self.bucket_name)
+
+    def url(self, path: str) -> str:
+        return f"gs://{self.bucket_name}/{path}"
+
+    def put_bytes(self, path: str, data: bytes, content_type: str = "application/octet-stream") -> str:
+        self.bucket.blob(path).upload_from_string(data, content_type=content_type)
+        return self.url(path)
+
+    def put_file(self, path: str, file_obj: IO[bytes], content_type: str = "application/octet-stream") -> str:
+        """
+        Загрузка из файла/потока. chunk_size включает resumable upload:
+        большой PDF переживает обрыв соединения и не держится в памяти целиком.
+        """
+        blob = self.bucket.blob(path, chunk_size=RESUMABLE_CHUNK_SIZE)
+        blob.upload_from_file(file_obj, rewind=True, content_type=content_type)
+        return self.url(path)
+
+    def open_write(self, path: str, content_type: str = "application/octet-stream",
+                   chunk_size: int = RESUMABLE_CHUNK_SIZE) -> "_GCSWriter":
+        """
+        Потоковая resumable-загрузка: каждые chunk_size байт уходят в GCS сразу.
+        chunk_size — кратно 256 KiB (требование GCS).
+        """
+        return _GCSWriter(self, path, content_type, chunk_size)
+
+    def get_bytes(self, path: str) -> bytes:
+        return self.bucket.blob(path).download_as_bytes()
+
+    def get_file(self, path: str, file_obj: IO[bytes]) -> None:
+        self.bucket.blob(path).download_to_file(file_obj)
+
+    def copy(self, src_path: str, dst_path: str) -> str:
+        """Серверное копирование внутри бакета — байты не проходят через процесс."""
+        self.bucket.copy_blob(self.bucket.blob(src_path), self.bucket, dst_path)
+        return self.url(dst_path)
+
+    def exists(self, path: str) -> bool:
+        return self.bucket.blob(path).exists()
+
+    def delete(self, path: str) -> None:
+        self.bucket.blob(path).delete()
+
+    def list(self, prefix: str = "") -> List[str]:
+        return [b.name for b in self.client.list_blobs(self.bucket_name, prefix=prefix)]
+
+
+class _GCSWriter:
+    """
+    Запись в "<path>.part" через blob.open("wb"); close() переименовывает в path.
+    Недописанный поток не финализируется под финальным именем.
+    """
+
+    def __init__(self, client: GCSClient, path: str, content_type: str, chunk_size: int):
+        self.client = client
+        self.path = path
+        self.tmp = path + ".part"
+        self._blob = client.bucket.blob(self.tmp, chunk_size=chunk_size)
+        self._f = self._blob.open("wb", content_type=content_type)
+
+    def write(self, data: bytes) -> int:
+        return self._f.write(data)
+
+    def close(self) -> str:
+        self._f.close()
+        self.client.bucket.rename_blob(self._blob, self.path)
+        return self.client.url(self.path)
+
+    def abort(self) -> None:
+        try:
+            self._f.close()
+            self._blob.delete()
+        except Exception:
+            pass
+
+
+class _LocalWriter:
+    def __init__(self, store: "LocalBlobStore", path: str):
+        self.store = store
+        self.path = path
+        self.full = store._abs(path)
+        os.makedirs(os.path.dirname(self.full), exist_ok=True)
+        self.tmp = self.full + ".part"
+        self._f = open(self.tmp, "wb")
+
+    def write(self, data: bytes) -> int:
+        return self._f.write(data)
+
+    def close(self) -> str:
+        self._f.close()
+        os.replace(self.tmp, self.full)
+        return self.store.url(self.path)
+
+    def abort(self) -> None:
+        self._f.close()
+        try:
+            os.remove(self.tmp)
+        except FileNotFoundError:
+            pass
+
+
+class LocalBlobStore:
+    """
+    LocalBlobStore — то же API поверх локальной папки (stand-in для GCS).
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = os.path.abspath(root_dir)
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _abs(self, path: str) -> str:
+        full = os.path.abspath(os.path.join(self.root_dir, path))
+        if not full.startswith(self.root_dir + os.sep):
+            raise ValueError(f"path outside blob store: {path}")
+        return full
+
+    def url(self, path: str) -> str:
+        return "file://" + self._abs(path)
+
+    def put_bytes(self, path: str, data: bytes, content_type: str = "application/octet-stream") -> str:
+        full = self._abs(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = full + ".part"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, full)
+        return self.url(path)
+
+    def put_file(self, path: str, file_obj: IO[bytes], content_type: str = "application/octet-stream") -> str:
+        full = self._abs(path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        file_obj.seek(0)
+        tmp = full + ".part"
+        with open(tmp, "wb") as f:
+            shutil.copyfileobj(file_obj, f, RESUMABLE_CHUNK_SIZE)
+        os.replace(tmp, full)
+        return self.url(path)
+
+    def open_write(self, path: str, content_type: str = "application/octet-stream",
+                   chunk_size: int = RESUMABLE_CHUNK_SIZE) -> _LocalWriter:
+        return _LocalWriter(self, path)
+
+    def get_bytes(self, path: str) -> bytes:
+        with open(self._abs(path), "rb") as f:
+            return f.read()
+
+    def get_file(self, path: str, file_obj: IO[bytes]) -> None:
+        with open(self._abs(path), "rb") as f:
+            shutil.copyfileobj(f, file_obj, RESUMABLE_CHUNK_SIZE)
+
+    def copy(self, src_path: str, dst_path: str) -> str:
+        src = self._abs(src_path)
+        full = self._abs(dst_path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = full + ".part"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, full)
+        return self.url(dst_path)
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(self._abs(path))
+
+    def delete(self, path: str) -> None:
+        try:
+            os.remove(self._abs(path))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix: str = "") -> List[str]:
+        out = []
+        for dirpath, _, files in os.walk(self.root_dir):
+            for name in files:
+                rel = os.path.relpath(os.path.join(dirpath, name), self.root_dir).replace(os.sep, "/")
+                if rel.startswith(prefix) and not rel.endswith(".part"):
+                    out.append(rel)
+        return sorted(out)
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    """
+    Хранилище файлов процесса: BOOKSOUL_BLOB_DIR -> локальная папка, иначе GCS_BUCKET.
+    """
+    global _blob_store
+    if _blob_store is None:
+        local_dir = os.getenv("BOOKSOUL_BLOB_DIR", "")
+        _blob_store = LocalBlobStore(local_dir) if local_dir else GCSClient()
+    return _blob_store
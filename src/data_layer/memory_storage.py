@@ -0,0 +1,116 @@
+# src/data_layer/memory_storage.py
+
+from typing import Optional, Dict, Any, List, Sequence
+import copy
+import threading
+import uuid
+
+from data_layer.storage import (
+    StorageBackend,
+    DocumentNotFound,
+    IncrementOp,
+    Where,
+    matches,
+    merge_into,
+    update_into,
+    increment_into,
+    sort_docs,
+)
+
+
+# Важно:
+# - хранилище в памяти процесса: для тестов, бенчмарков и нагрузочного стенда
+# - семантика та же, что у Firestore (merge, пути в update, create-once), проверяется
+#   общим набором storage_conformance
+# - считает операции чтения/записи — стенд показывает "операций на апдейт"
+
+
+class MemoryStorage(StorageBackend):
+    """
+    MemoryStorage — словарь коллекций под одним замком.
+    """
+
+    def __init__(self, root_collection: str = "books"):
+        self.root_collection = root_collection
+        self._data: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.RLock()
+        self.ops = {"reads": 0, "writes": 0}
+
+    def _col(self, collection: str) -> Dict[str, Dict[str, Any]]:
+        return self._data.setdefault(collection, {})
+
+    # ---------------------------------------------------------------------------------
+    # ПРИМИТИВЫ
+    # ---------------------------------------------------------------------------------
+
+    def get_doc(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self.ops["reads"] += 1
+            doc = self._col(collection).get(doc_id)
+            return copy.deepcopy(doc) if doc is not None else None
+
+    def set_doc(self, collection: str, doc_id: str, data: Dict[str, Any], merge: bool = False) -> None:
+        with self._lock:
+            self.ops["writes"] += 1
+            col = self._col(collection)
+            if merge and doc_id in col:
+                merge_into(col[doc_id], data)
+            else:
+                col[doc_id] = copy.deepcopy(data)
+
+    def update_doc(self, collection: str, doc_id: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            self.ops["writes"] += 1
+            col = self._col(collection)
+            if doc_id not in col:
+                raise DocumentNotFound(f"{collection}/{doc_id}")
+            update_into(col[doc_id], fields)
+
+    def add_doc(self, collection: str, data: Dict[str, Any]) -> str:
+        doc_id = uuid.uuid4().hex[:20]
+        self.set_doc(collection, doc_id, data)
+        return doc_id
+
+    def create_doc_once(self, collection: str, doc_id: str, data: Dict[str, Any]) -> bool:
+        with self._lock:
+            self.ops["writes"] += 1
+            col = self._col(collection)
+            if doc_id in col:
+                return False
+            col[doc_id] = copy.deepcopy(data)
+            return True
+
+    def query_docs(
+        self,
+        collection: str,
+        where: Sequence[Where] = (),
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        with self._lock:
+            docs = [
+                dict(copy.deepcopy(d), id=doc_id)
+                for doc_id, d in self._col(collection).items()
+                if matches(d, where)
+            ]
+            docs = sort_docs(docs, order_by, descending)
+            if limit is not None:
+                docs = docs[:limit]
+            # как в Firestore: каждый возвращённый документ — чтение, пустой ответ — тоже одно
+            self.ops["reads"] += max(1, len(docs))
+            return docs
+
+    def delete_docs(self, collection: str, doc_ids: Sequence[str]) -> int:
+        with self._lock:
+            col = self._col(collection)
+            self.ops["writes"] += len(doc_ids)
+            return sum(1 for doc_id in doc_ids if col.pop(doc_id, None) is not None)
+
+    def increment_docs(self, ops: Sequence[IncrementOp]) -> None:
+        with self._lock:
+            self.ops["writes"] += len(ops)
+            for collection, doc_id, deltas, extra in ops:
+                doc = self._col(collection).setdefault(doc_id, {})
+                merge_into(doc, extra or {})
+                increment_into(doc, deltas)
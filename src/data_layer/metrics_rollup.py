@@ -0,0 +1,210 @@
+# src/data_layer/metrics_rollup.py
+
+from typing import Optional, Dict, Any, List, Iterable, TYPE_CHECKING
+from datetime import datetime, timedelta, timezone
+import os
+import random
+import sys
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/data_layer
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+if TYPE_CHECKING:
+    from data_layer.storage import StorageBackend
+
+
+# Важно:
+# - этот модуль отвечает на вопросы "сколько книг/сообщений в час", не сканируя
+#   сырые коллекции events / jobs / books
+# - счётчики шардированы: каждый инкремент пишет в случайный шард, чтобы не упираться
+#   в лимит ~1 запись/сек на один документ Firestore
+# - роллапы тоже шардированы, читатель сам суммирует шарды одного бакета
+# - работает поверх любого StorageBackend (Firestore / memory / sqlite)
+#
+# Структура:
+#   metrics_counters/{metric}/shards/{0..N-1}   {"count": n}
+#   metrics_minute/{YYYYMMDDHHMM}_{shard}       {"bucket", "bucket_start", "counts": {...}}
+#   metrics_hour/{YYYYMMDDHH}_{shard}           {"bucket", "bucket_start", "counts": {...}}
+#
+# Имена метрик: "messages", "books_created", "errors", "jobs_completed.<type>".
+# Точка в имени превращается во вложенную карту: counts.jobs_completed.scene_generation
+
+METRICS_SHARDS = int(os.getenv("METRICS_SHARDS", "10"))
+METRICS_ROLLUP_SHARDS = int(os.getenv("METRICS_ROLLUP_SHARDS", "4"))
+
+COUNTERS_COLLECTION = "metrics_counters"
+ROLLUP_COLLECTIONS = {
+    "minute": "metrics_minute",
+    "hour": "metrics_hour",
+}
+_BUCKET_FORMATS = {
+    "minute": "%Y%m%d%H%M",
+    "hour": "%Y%m%d%H",
+}
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def bucket_start(at: datetime, granularity: str) -> datetime:
+    """
+    Начало бакета (минуты или часа) для момента времени в UTC.
+    """
+    at = at.astimezone(timezone.utc) if at.tzinfo else at.replace(tzinfo=timezone.utc)
+    if granularity == "minute":
+        return at.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return at.replace(minute=0, second=0, microsecond=0)
+    raise ValueError(f"unknown granularity: {granularity}")
+
+
+def bucket_key(at: datetime, granularity: str) -> str:
+    """
+    Строковый ключ бакета, сортируется лексикографически (202510191230 / 2025101912).
+    """
+    return bucket_start(at, granularity).strftime(_BUCKET_FORMATS[granularity])
+
+
+def _merge_counts(dst: Dict[str, Any], src: Dict[str, Any]) -> None:
+    """
+    Складывает вложенные карты счётчиков (сумма шардов одного бакета).
+    """
+    for key, value in (src or {}).items():
+        if isinstance(value, dict):
+            _merge_counts(dst.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)):
+            dst[key] = dst.get(key, 0) + value
+
+
+class MetricsRollup:
+    """
+    MetricsRollup — шардированные счётчики + поминутные/почасовые роллапы.
+    Пишется рядом с событиями и задачами, читается дашбордами и сводками.
+    """
+
+    def __init__(self,
+                 storage: "StorageBackend",
+                 num_shards: int = METRICS_SHARDS,
+                 rollup_shards: int = METRICS_ROLLUP_SHARDS):
+        self.storage = storage
+        self.num_shards = max(1, num_shards)
+        self.rollup_shards = max(1, rollup_shards)
+
+    # ---------------------------------------------------------------------------------
+    # ЗАПИСЬ
+    # ---------------------------------------------------------------------------------
+
+    def incr(self, metric: str, amount: int = 1, at: Optional[datetime] = None) -> None:
+        """
+        Инкремент одной метрики.
+        """
+        self.incr_many({metric: amount}, at=at)
+
+    def incr_many(self, deltas: Dict[str, int], at: Optional[datetime] = None) -> None:
+        """
+        Инкремент нескольких метрик одним батчем:
+        шард каждого счётчика + шард минутного и часового роллапа.
+        """
+        deltas = {k: v for k, v in deltas.items() if v}
+        if not deltas:
+            return
+
+        at = at or _utcnow()
+        ops = []
+
+        for metric, amount in deltas.items():
+            ops.append((
+                f"{COUNTERS_COLLECTION}/{metric}/shards",
+                str(random.randrange(self.num_shards)),
+                {"count": amount},
+                {},
+            ))
+
+        counts = {f"counts.{k}": v for k, v in deltas.items()}
+        rollup_shard = random.randrange(self.rollup_shards)
+        for granularity, collection in ROLLUP_COLLECTIONS.items():
+            key = bucket_key(at, granularity)
+            ops.append((collection, f"{key}_{rollup_shard}", counts, {
+                "bucket": key,
+                "bucket_start": bucket_start(at, granularity),
+                "shard": rollup_shard,
+                "updated_at": self.storage.server_timestamp(),
+            }))
+
+        self.storage.increment_docs(ops)
+
+    # ---------------------------------------------------------------------------------
+    # ЧТЕНИЕ
+    # ---------------------------------------------------------------------------------
+
+    def get_total(self, metric: str) -> int:
+        """
+        Итог по счётчику за всё время: сумма N шардов.
+        """
+        shards = self.storage.query_docs(f"{COUNTERS_COLLECTION}/{metric}/shards")
+        return sum(int(s.get("count", 0)) for s in shards)
+
+    def get_totals(self, metrics: Iterable[str]) -> Dict[str, int]:
+        return {m: self.get_total(m) for m in metrics}
+
+    def get_rollups(
+        self,
+        granularity: str,
+        start: datetime,
+        end: Optional[datetime] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Роллапы за диапазон [start, end] с уже сложенными шардами.
+        Одно range-условие по полю bucket — составной индекс не нужен.
+        """
+        end = end or _utcnow()
+        docs = self.storage.query_docs(
+            ROLLUP_COLLECTIONS[granularity],
+            where=[
+                ("bucket", ">=", bucket_key(start, granularity)),
+                ("bucket", "<=", bucket_key(end, granularity)),
+            ],
+        )
+
+        merged: Dict[str, Dict[str, Any]] = {}
+        for d in docs:
+            row = merged.setdefault(d.get("bucket", ""), {
+                "bucket": d.get("bucket", ""),
+                "bucket_start": d.get("bucket_start"),
+                "counts": {},
+            })
+            _merge_counts(row["counts"], d.get("counts", {}))
+
+        return [merged[k] for k in sorted(merged)]
+
+    def summarize(self, hours: int = 24) -> Dict[str, Any]:
+        """
+        Сводка за последние N часов: сумма по метрикам + почасовой ряд.
+        """
+        end = _utcnow()
+        start = end - timedelta(hours=max(1, hours) - 1)
+        series = self.get_rollups("hour", start, end)
+
+        totals: Dict[str, Any] = {}
+        for row in series:
+            _merge_counts(totals, row["counts"])
+
+        return {
+            "hours": hours,
+            "totals": totals,
+            "series": series,
+        }
+
+
+# Быстрый линейный тест (локально)
+if __name__ == "__main__":
+    from data_layer.storage import get_storage
+
+    metrics = get_storage().metrics
+    metrics.incr_many({"messages": 1, "jobs_completed.scene_generation": 1})
+    print("messages total:", metrics.get_total("messages"))
+    print("last 2h:", metrics.summarize(hours=2))
@@ -0,0 +1,253 @@
+# src/data_layer/sqlite_storage.py
+
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Sequence, Tuple
+import json
+import sqlite3
+import threading
+import uuid
+
+from data_layer.storage import (
+    StorageBackend,
+    DocumentNotFound,
+    IncrementOp,
+    Where,
+    matches,
+    merge_into,
+    update_into,
+    increment_into,
+    sort_docs,
+)
+
+
+# Важно:
+# - single-node хранилище: один файл SQLite в режиме WAL (читатели не блокируют писателя)
+# - документ хранится JSON-ом, а поля, по которым фабрика реально фильтрует
+#   (created_at, status, book_id, chat_id, type, bucket), вынесены в колонки с индексами
+# - условия по вынесенным полям уходят в SQL, остальные доигрываются в Python
+# - datetime в JSON: {"$dt": "<iso>"}; created_at в колонке — epoch секунды
+
+PROMOTED = ("created_at", "status", "book_id", "chat_id", "type", "bucket")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    collection TEXT NOT NULL,
+    doc_id     TEXT NOT NULL,
+    data       TEXT NOT NULL,
+    created_at REAL,
+    status,
+    book_id,
+    chat_id,
+    type,
+    bucket,
+    PRIMARY KEY (collection, doc_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_docs_created ON docs(collection, created_at);
+CREATE INDEX IF NOT EXISTS idx_docs_status  ON docs(collection, status, created_at);
+CREATE INDEX IF NOT EXISTS idx_docs_type    ON docs(collection, type, status, created_at);
+CREATE INDEX IF NOT EXISTS idx_docs_book    ON docs(collection, book_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_docs_chat    ON docs(collection, chat_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_docs_bucket  ON docs(collection, bucket);
+"""
+
+_SQL_OPS = {"==": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+
+
+def _encode_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return {"$dt": value.isoformat()}
+    raise TypeError(f"not JSON serializable: {type(value).__name__}")
+
+
+def _decode_hook(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1 and "$dt" in obj:
+        return datetime.fromisoformat(obj["$dt"])
+    return obj
+
+
+def _dumps(doc: Dict[str, Any]) -> str:
+    return json.dumps(doc, ensure_ascii=False, default=_encode_default, separators=(",", ":"))
+
+
+def _loads(raw: str) -> Dict[str, Any]:
+    return json.loads(raw, object_hook=_decode_hook)
+
+
+def _column_value(field: str, value: Any) -> Any:
+    """
+    Значение для вынесенной колонки; None — поле не индексируется для этого документа.
+    """
+    if field == "created_at":
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            return value.timestamp()
+        return None
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return None
+    return value
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    SQLiteStorage — документы в одной таблице SQLite/WAL с индексами под запросы фабрики.
+    """
+
+    def __init__(self, path: str = "booksoul.db", root_collection: str = "books"):
+        self.path = path
+        self.root_collection = root_collection
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # ---------------------------------------------------------------------------------
+    # ВНУТРЕННЕЕ
+    # ---------------------------------------------------------------------------------
+
+    def _read(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn.execute(
+            "SELECT data FROM docs WHERE collection = ? AND doc_id = ?", (collection, doc_id)
+        ).fetchone()
+        return _loads(row[0]) if row else None
+
+    def _write(self, collection: str, doc_id: str, doc: Dict[str, Any]) -> None:
+        columns = [_column_value(f, doc.get(f)) for f in PROMOTED]
+        self._conn.execute(
+            "INSERT OR REPLACE INTO docs (collection, doc_id, data, "
+            + ", ".join(PROMOTED) + ") VALUES (?, ?, ?, " + ", ".join("?" * len(PROMOTED)) + ")",
+            (collection, doc_id, _dumps(doc), *columns),
+        )
+
+    def _split_where(self, where: Sequence[Where]) -> Tuple[List[str], List[Any], List[Where]]:
+        """
+        Делим условия: что SQL умеет по индексу, а что проверим в Python.
+        """
+        sql, params, rest = [], [], []
+        for field, op, value in where:
+            col_value = _column_value(field, value) if field in PROMOTED else None
+            if col_value is not None and op in _SQL_OPS:
+                sql.append(f"{field} {_SQL_OPS[op]} ?")
+                params.append(col_value)
+            elif field in PROMOTED and op == "in" and value and all(_column_value(field, v) is not None for v in value):
+                sql.append(f"{field} IN ({', '.join('?' * len(value))})")
+                params.extend(_column_value(field, v) for v in value)
+            else:
+                rest.append((field, op, value))
+        return sql, params, rest
+
+    # ---------------------------------------------------------------------------------
+    # ПРИМИТИВЫ
+    # ---------------------------------------------------------------------------------
+
+    def get_doc(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._read(collection, doc_id)
+
+    def set_doc(self, collection: str, doc_id: str, data: Dict[str, Any], merge: bool = False) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                doc = self._read(collection, doc_id) if merge else None
+                if doc is None:
+                    doc = {}
+                merge_into(doc, data)
+                self._write(collection, doc_id, doc)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def update_doc(self, collection: str, doc_id: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                doc = self._read(collection, doc_id)
+                if doc is None:
+                    raise DocumentNotFound(f"{collection}/{doc_id}")
+                update_into(doc, fields)
+                self._write(collection, doc_id, doc)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def add_doc(self, collection: str, data: Dict[str, Any]) -> str:
+        doc_id = uuid.uuid4().hex[:20]
+        self.set_doc(collection, doc_id, data)
+        return doc_id
+
+    def create_doc_once(self, collection: str, doc_id: str, data: Dict[str, Any]) -> bool:
+        columns = [_column_value(f, data.get(f)) for f in PROMOTED]
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT OR IGNORE INTO docs (collection, doc_id, data, "
+                + ", ".join(PROMOTED) + ") VALUES (?, ?, ?, " + ", ".join("?" * len(PROMOTED)) + ")",
+                (collection, doc_id, _dumps(data), *columns),
+            )
+            return cur.rowcount == 1
+
+    def query_docs(
+        self,
+        collection: str,
+        where: Sequence[Where] = (),
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        sql_where, params, rest = self._split_where(where)
+        sql = "SELECT doc_id, data FROM docs WHERE collection = ?"
+        params = [collection] + params
+        if sql_where:
+            sql += " AND " + " AND ".join(sql_where)
+
+        sql_order = order_by in PROMOTED
+        if sql_order:
+            sql += f" AND {order_by} IS NOT NULL ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        # LIMIT в SQL только если всё остальное тоже посчитал SQL
+        if limit is not None and not rest and (sql_order or not order_by):
+            sql += f" LIMIT {int(limit)}"
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        docs = [dict(_loads(raw), id=doc_id) for doc_id, raw in rows]
+        if rest:
+            docs = [d for d in docs if matches(d, rest)]
+        if order_by and not sql_order:
+            docs = sort_docs(docs, order_by, descending)
+        if limit is not None:
+            docs = docs[:limit]
+        return docs
+
+    def delete_docs(self, collection: str, doc_ids: Sequence[str]) -> int:
+        if not doc_ids:
+            return 0
+        with self._lock:
+            cur = self._conn.executemany(
+                "DELETE FROM docs WHERE collection = ? AND doc_id = ?",
+                [(collection, doc_id) for doc_id in doc_ids],
+            )
+            return cur.rowcount
+
+    def increment_docs(self, ops: Sequence[IncrementOp]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for collection, doc_id, deltas, extra in ops:
+                    doc = self._read(collection, doc_id) or {}
+                    merge_into(doc, extra or {})
+                    increment_into(doc, deltas)
+                    self._write(collection, doc_id, doc)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
@@ -0,0 +1,589 @@
+# src/data_layer/storage.py
+
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Iterable, Sequence, Tuple
+import copy
+import os
+
+
+# Важно:
+# - StorageBackend — единый интерфейс хранилища фабрики: книги, сцены, задачи, фидбек,
+#   inbox/outbox, события, чаты
+# - реализации: FirestoreClient (прод), MemoryStorage (тесты / бенчмарки), SQLiteStorage (single-node)
+# - бэкенд реализует только примитивы над документами (get / set / update / query ...),
+#   вся доменная логика (какие поля, какие статусы, какие метрики) живёт здесь, один раз
+# - коллекция — это путь: "books", "books/BKS-.../scenes", "metrics_counters/messages/shards"
+# - выбор бэкенда: BOOKSOUL_STORAGE = firestore | memory | sqlite
+
+
+# (field, op, value); op: == != < <= > >= in
+Where = Tuple[str, str, Any]
+
+# (collection, doc_id, {"path.to.counter": delta}, {доп. поля документа})
+IncrementOp = Tuple[str, str, Dict[str, int], Dict[str, Any]]
+
+
+class DocumentNotFound(KeyError):
+    """update_doc по несуществующему документу (как NotFound у Firestore)."""
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# ---------------------------------------------------------------------------------
+# ОБЩИЕ ХЕЛПЕРЫ ДЛЯ ЛОКАЛЬНЫХ БЭКЕНДОВ (memory / sqlite)
+# ---------------------------------------------------------------------------------
+
+def nest_paths(flat: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    {"jobs_completed.cover": x} -> {"jobs_completed": {"cover": x}}
+    """
+    out: Dict[str, Any] = {}
+    for name, value in flat.items():
+        node = out
+        parts = name.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return out
+
+
+def get_path(doc: Dict[str, Any], path: str) -> Any:
+    node: Any = doc
+    for part in path.split("."):
+        if not isinstance(node, dict):
+            return None
+        node = node.get(part)
+    return node
+
+
+def merge_into(dst: Dict[str, Any], src: Dict[str, Any]) -> None:
+    """
+    set(..., merge=True): вложенные карты сливаются, остальное перезаписывается.
+    """
+    for key, value in src.items():
+        if isinstance(value, dict) and isinstance(dst.get(key), dict):
+            merge_into(dst[key], value)
+        else:
+            dst[key] = copy.deepcopy(value)
+
+
+def update_into(dst: Dict[str, Any], fields: Dict[str, Any]) -> None:
+    """
+    update(): точка в ключе — путь к вложенному полю (как у Firestore).
+    """
+    for path, value in fields.items():
+        node = dst
+        parts = path.split(".")
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        node[parts[-1]] = copy.deepcopy(value)
+
+
+def increment_into(dst: Dict[str, Any], deltas: Dict[str, int]) -> None:
+    for path, delta in deltas.items():
+        node = dst
+        parts = path.split(".")
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        current = node.get(parts[-1])
+        node[parts[-1]] = (current if isinstance(current, (int, float)) else 0) + delta
+
+
+_OPS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+}
+
+
+def matches(doc: Dict[str, Any], where: Iterable[Where]) -> bool:
+    return all(_OPS[op](get_path(doc, field), value) for field, op, value in where)
+
+
+def sort_docs(docs: List[Dict[str, Any]], order_by: Optional[str], descending: bool) -> List[Dict[str, Any]]:
+    if not order_by:
+        return docs
+    # документы без поля — в конец (Firestore такие вообще не возвращает при order_by)
+    present = [d for d in docs if get_path(d, order_by) is not None]
+    present.sort(key=lambda d: get_path(d, order_by), reverse=descending)
+    return present
+
+
+# ---------------------------------------------------------------------------------
+# ИНТЕРФЕЙС
+# ---------------------------------------------------------------------------------
+
+class StorageBackend(ABC):
+    """
+    StorageBackend — хранилище фабрики BookSoul.
+    Бэкенд реализует примитивы, доменные методы ниже общие для всех бэкендов.
+    """
+
+    root_collection: str = "books"
+
+    # ---------------------------------------------------------------------------------
+    # ПРИМИТИВЫ (реализует бэкенд)
+    # ---------------------------------------------------------------------------------
+
+    @abstractmethod
+    def get_doc(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        """Документ без поля id или None."""
+
+    @abstractmethod
+    def set_doc(self, collection: str, doc_id: str, data: Dict[str, Any], merge: bool = False) -> None:
+        """Запись документа; merge=True сливает вложенные карты."""
+
+    @abstractmethod
+    def update_doc(self, collection: str, doc_id: str, fields: Dict[str, Any]) -> None:
+        """Частичное обновление; точки в ключах — пути. Нет документа -> DocumentNotFound."""
+
+    @abstractmethod
+    def add_doc(self, collection: str, data: Dict[str, Any]) -> str:
+        """Новый документ с автоматическим ID, возвращает ID."""
+
+    @abstractmethod
+    def create_doc_once(self, collection: str, doc_id: str, data: Dict[str, Any]) -> bool:
+        """Создаёт документ, только если его ещё нет. True — создали мы."""
+
+    @abstractmethod
+    def query_docs(
+        self,
+        collection: str,
+        where: Sequence[Where] = (),
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Выборка документов коллекции; каждый с полем "id"."""
+
+    @abstractmethod
+    def delete_docs(self, collection: str, doc_ids: Sequence[str]) -> int:
+        """Пакетное удаление, возвращает число удалённых."""
+
+    @abstractmethod
+    def increment_docs(self, ops: Sequence[IncrementOp]) -> None:
+        """Атомарные инкременты счётчиков (по возможности одним батчем)."""
+
+    def server_timestamp(self) -> Any:
+        """Метка времени записи. Firestore подставляет SERVER_TIMESTAMP."""
+        return utcnow()
+
+    # ---------------------------------------------------------------------------------
+    # МЕТРИКИ
+    # ---------------------------------------------------------------------------------
+
+    @property
+    def metrics(self):
+        rollup = self.__dict__.get("_metrics")
+        if rollup is None:
+            from data_layer.metrics_rollup import MetricsRollup
+            rollup = self.__dict__["_metrics"] = MetricsRollup(self)
+        return rollup
+
+    def _track(self, deltas: Dict[str, int]) -> None:
+        """
+        Метрики пишутся рядом с основной записью, но никогда её не ломают.
+        """
+        try:
+            self.metrics.incr_many(deltas)
+        except Exception as e:
+            print(f"⚠ metrics error: {e!r}")
+
+    @staticmethod
+    def _job_deltas(job_type: str, status: str) -> Dict[str, int]:
+        """
+        Какие метрики трогает переход задачи в статус.
+        """
+        if status == "done":
+            return {f"jobs_completed.{job_type}": 1}
+        if status == "error":
+            return {"errors": 1, f"jobs_failed.{job_type}": 1}
+        return {}
+
+    # ---------------------------------------------------------------------------------
+    # КНИГА
+    # ---------------------------------------------------------------------------------
+
+    def create_book(
+        self,
+        book_id: str,
+        child_name: str,
+        theme: str,
+        language: str = "ru",
+        status: str = "draft",
+        title: Optional[str] = None,
+    ) -> None:
+        """
+        Создаёт запись о книге в коллекции books/{book_id}.
+        Используется сразу после того, как пользователь в Telegram дал тему сказки.
+        """
+        if title is None:
+            title = f"История для {child_name}"
+
+        self.set_doc(self.root_collection, book_id, {
+            "child_name": child_name,
+            "title": title,
+            "theme": theme,
+            "language": language,
+            "status": status,  # draft / writing / drawing / styling / cover / layout / approval / ready
+            "pdf_url": "",
+            "cover_url": "",
+            "created_at": self.server_timestamp(),
+            "updated_at": self.server_timestamp(),
+        }, merge=True)
+        self._track({"books_created": 1})
+
+    def update_book_status(self, book_id: str, status: str) -> None:
+        """
+        Меняет статус книги (например 'writing' -> 'drawing' -> 'styling' ...).
+        Вызывается Router-GPT после завершения этапа.
+        """
+        self.update_doc(self.root_collection, book_id, {
+            "status": status,
+            "updated_at": self.server_timestamp(),
+        })
+
+    def attach_cover_url(self, book_id: str, cover_url: str) -> None:
+        """
+        Сохраняет ссылку на финальную обложку.
+        """
+        self.update_doc(self.root_collection, book_id, {
+            "cover_url": cover_url,
+            "updated_at": self.server_timestamp(),
+        })
+
+    def attach_pdf_url(self, book_id: str, pdf_url: str) -> None:
+        """
+        Сохраняет ссылку на финальный PDF.
+        """
+        self.update_doc(self.root_collection, book_id, {
+            "pdf_url": pdf_url,
+            "updated_at": self.server_timestamp(),
+        })
+
+    def get_book(self, book_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Получает всю инфу по книге (для Telegram: показать статус, ссылки, прогресс).
+        """
+        data = self.get_doc(self.root_collection, book_id)
+        if data is None:
+            return None
+        data["id"] = book_id
+        return data
+
+    # ---------------------------------------------------------------------------------
+    # СЦЕНЫ
+    # ---------------------------------------------------------------------------------
+
+    def _scenes_collection(self, book_id: str) -> str:
+        return f"{self.root_collection}/{book_id}/scenes"
+
+    def add_scene(
+        self,
+        book_id: str,
+        scene_id: str,
+        page_number: int,
+        text: str,
+        prompt_main: str,
+        prompt_background: str,
+        status: str = "pending",
+        image_url: str = "",
+    ) -> None:
+        """
+        Добавляет сцену (страницу книги) в подколлекцию books/{book_id}/scenes/{scene_id}.
+        StoryWriter будет вызывать это для каждой сцены.
+        """
+        self.set_doc(self._scenes_collection(book_id), scene_id, {
+            "page": page_number,
+            "text": text,
+            "image_prompt_main": prompt_main,
+            "image_prompt_background": prompt_background,
+            "status": status,       # pending / drawn / approved / redo
+            "image_url": image_url, # GCS URL после генерации иллюстрации
+            "updated_at": self.server_timestamp(),
+        }, merge=True)
+
+    def update_scene_image_url(
+        self,
+        book_id: str,
+        scene_id: str,
+        image_url: str,
+        status: Optional[str] = None,
+        background_url: Optional[str] = None,
+    ) -> None:
+        """
+        Сохраняет ссылку на сгенерированную картинку для сцены.
+        Может также обновлять статус сцены и ссылку на фон (если фон рисовался отдельно).
+        """
+        payload = {
+            "image_url": image_url,
+            "updated_at": self.server_timestamp(),
+        }
+        if status:
+            payload["status"] = status
+        if background_url:
+            payload["background_url"] = background_url
+        self.update_doc(self._scenes_collection(book_id), scene_id, payload)
+
+    def update_scene(self, book_id: str, scene_id: str, **fields) -> None:
+        """
+        Частичное обновление сцены одной записью (картинка + статус + QA-поля художки).
+        """
+        fields["updated_at"] = self.server_timestamp()
+        self.update_doc(self._scenes_collection(book_id), scene_id, fields)
+
+    def list_scenes(self, book_id: str) -> List[Dict[str, Any]]:
+        """
+        Возвращает список сцен книги отсортированных по page.
+        Нужно Layout Engine для сборки PDF.
+        """
+        scenes = self.query_docs(self._scenes_collection(book_id))
+        scenes.sort(key=lambda x: x.get("page", 0))
+        return scenes
+
+    # ---------------------------------------------------------------------------------
+    # ОБРАТНАЯ СВЯЗЬ / КОММЕНТАРИИ
+    # ---------------------------------------------------------------------------------
+
+    def add_feedback(
+        self,
+        book_id: str,
+        comment_text: str,
+        source: str = "user",
+    ) -> str:
+        """
+        Сохраняет комментарий (правку) от тебя.
+        Это будет дублироваться и в Google Sheets.
+        """
+        return self.add_doc("feedback", {
+            "book_id": book_id,
+            "comment": comment_text,
+            "source": source,  # user / router / style_engine / layout_engine
+            "created_at": self.server_timestamp(),
+        })
+
+    def list_feedback(self, book_id: str) -> List[Dict[str, Any]]:
+        """
+        Все правки по книге, старые первыми.
+        """
+        items = self.query_docs("feedback", where=[("book_id", "==", book_id)])
+        items.sort(key=lambda x: str(x.get("created_at", "")))
+        return items
+
+    # ---------------------------------------------------------------------------------
+    # JOBS (таски фабрики)
+    # ---------------------------------------------------------------------------------
+
+    def create_job(
+        self,
+        book_id: str,
+        job_type: str,
+        status: str = "pending",
+        result_url: str = "",
+        scene_id: Optional[str] = None,
+    ) -> str:
+        """
+        Создаёт задачу для фабрики (например 'scene_generation', 'cover', 'layout').
+        scene_id — для задач по одной сцене (художка закрывает задачу своей сцены).
+        Возвращает ID задачи.
+        """
+        data = {
+            "book_id": book_id,
+            "type": job_type,        # scene_generation / style_pass / cover / layout
+            "status": status,        # pending / running / done / error
+            "result_url": result_url,
+            "created_at": self.server_timestamp(),
+            "updated_at": self.server_timestamp(),
+        }
+        if scene_id:
+            data["scene_id"] = scene_id
+        job_id = self.add_doc("jobs", data)
+        self._track(self._job_deltas(job_type, status))
+        return job_id
+
+    def update_job_status(
+        self,
+        job_id: str,
+        status: str,
+        result_url: Optional[str] = None,
+        job_type: Optional[str] = None,
+    ) -> None:
+        """
+        Обновляет статус задачи фабрики.
+        Например когда обложка готова или PDF собран.
+        job_type нужен для метрик; если не передан — дочитаем его из задачи.
+        """
+        payload = {
+            "status": status,
+            "updated_at": self.server_timestamp(),
+        }
+        if result_url is not None:
+            payload["result_url"] = result_url
+        self.update_doc("jobs", job_id, payload)
+
+        if status in ("done", "error"):
+            if job_type is None:
+                job_type = (self.get_doc("jobs", job_id) or {}).get("type", "unknown")
+            self._track(self._job_deltas(job_type, status))
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        data = self.get_doc("jobs", job_id)
+        if data is None:
+            return None
+        data["id"] = job_id
+        return data
+
+    def list_jobs(
+        self,
+        job_type: Optional[str] = None,
+        status: Optional[str] = None,
+        book_id: Optional[str] = None,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Очередь задач, старые первыми.
+        Firestore: нужен составной индекс jobs(type, status, created_at).
+        """
+        where: List[Where] = []
+        if job_type:
+            where.append(("type", "==", job_type))
+        if status:
+            where.append(("status", "==", status))
+        if book_id:
+            where.append(("book_id", "==", book_id))
+        return self.query_docs("jobs", where=where, order_by="created_at", limit=limit)
+
+    # ---------------------------------------------------------------------------------
+    # INBOX / OUTBOX (идемпотентность Telegram-апдейтов)
+    # ---------------------------------------------------------------------------------
+
+    def create_inbox_once(self, inbox_id: str, data: Dict[str, Any]) -> bool:
+        """
+        Входящий апдейт пишется ровно один раз. False — такой уже был (ретрай Telegram).
+        """
+        payload = dict(data)
+        payload.setdefault("created_at", self.server_timestamp())
+        return self.create_doc_once("inbox", inbox_id, payload)
+
+    def get_inbox(self, inbox_id: str) -> Optional[Dict[str, Any]]:
+        return self.get_doc("inbox", inbox_id)
+
+    def get_outbox(self, out_id: str) -> Optional[Dict[str, Any]]:
+        return self.get_doc("outbox", out_id)
+
+    def mark_outbox_sent(self, out_id: str, **fields) -> None:
+        now = self.server_timestamp()
+        self.set_doc("outbox", out_id, {"sent": True, "sent_at": now, "created_at": now, **fields}, merge=True)
+
+    # ---------------------------------------------------------------------------------
+    # СОБЫТИЯ
+    # ---------------------------------------------------------------------------------
+
+    def log_event(self, data: Dict[str, Any], event_id: Optional[str] = None) -> str:
+        """
+        Журнал событий. С event_id — идемпотентно (merge), без — новый документ.
+        """
+        payload = dict(data)
+        payload.setdefault("created_at", self.server_timestamp())
+        if event_id is None:
+            return self.add_doc("events", payload)
+        self.set_doc("events", event_id, payload, merge=True)
+        return event_id
+
+    def list_events(
+        self,
+        chat_id: Any,
+        limit: Optional[int] = None,
+        event_types: Optional[Sequence[str]] = None,
+        since: Optional[datetime] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        События чата, новые первыми. since — только created_at >= since.
+        Фильтр по типу уходит в запрос (type in ...), поэтому limit работает на стороне хранилища.
+        Firestore: нужны составные индексы events(chat_id, created_at desc)
+        и events(chat_id, type, created_at desc).
+        """
+        where: List[Where] = [("chat_id", "==", chat_id)]
+        if event_types:
+            where.append(("type", "in", list(event_types)))
+        if since is not None:
+            where.append(("created_at", ">=", since))
+        return self.query_docs(
+            "events",
+            where=where,
+            order_by="created_at",
+            descending=True,
+            limit=limit,
+        )
+
+    # ---------------------------------------------------------------------------------
+    # ЧАТЫ
+    # ---------------------------------------------------------------------------------
+
+    def get_chat(self, chat_id: Any) -> Optional[Dict[str, Any]]:
+        return self.get_doc("chats", str(chat_id))
+
+    def update_chat(self, chat_id: Any, **fields) -> None:
+        self.set_doc("chats", str(chat_id), fields, merge=True)
+
+    # ---------------------------------------------------------------------------------
+    # УТИЛИТНЫЕ ШТУКИ
+    # ---------------------------------------------------------------------------------
+
+    def make_trace_id(self) -> str:
+        """
+        Генератор ID книги формата BKS-YYYYMMDD-HHMMSS.
+        Вызывается при создании новой книги.
+        """
+        now = datetime.utcnow()
+        return "BKS-" + now.strftime("%Y%m%d-%H%M%S")
+
+
+# ---------------------------------------------------------------------------------
+# ФАБРИКА
+# ---------------------------------------------------------------------------------
+
+_instances: Dict[Tuple[str, str], StorageBackend] = {}
+
+
+def get_storage(kind: Optional[str] = None, project_id: Optional[str] = None) -> StorageBackend:
+    """
+    Хранилище процесса (одно на вид бэкенда и проект, чтобы webhook, Router и метрики видели
+    одни данные). kind: firestore | memory | sqlite; по умолчанию BOOKSOUL_STORAGE или firestore.
+    project_id — только для firestore: другой проект — другой экземпляр.
+    """
+    kind = (kind or os.getenv("BOOKSOUL_STORAGE", "firestore")).strip().lower()
+    if kind == "firestore":
+        project_id = project_id or os.getenv("GOOGLE_CLOUD_PROJECT") or os.getenv("GCP_PROJECT_ID") or None
+    key = (kind, project_id or "" if kind == "firestore" else "")
+    if key in _instances:
+        return _instances[key]
+
+    if kind == "memory":
+        from data_layer.memory_storage import MemoryStorage
+        backend: StorageBackend = MemoryStorage()
+    elif kind == "sqlite":
+        from data_layer.sqlite_storage import SQLiteStorage
+        backend = SQLiteStorage(os.getenv("BOOKSOUL_SQLITE_PATH", "booksoul.db"))
+    elif kind == "firestore":
+        from data_layer.firestore_client import FirestoreClient
+        backend = FirestoreClient(
+            project_id=project_id,
+            root_collection=os.getenv("FIRESTORE_COLLECTION", "books"),
+        )
+    else:
+        raise ValueError(f"unknown BOOKSOUL_STORAGE: {kind}")
+
+    _instances[key] = backend
+    return backend
@@ -0,0 +1,246 @@
+# src/data_layer/storage_conformance.py
+
+"""
+storage_conformance.py — общий набор проверок для всех реализаций StorageBackend.
+Один и тот же прогон для Firestore, memory и sqlite: если бэкенд его проходит,
+фабрика ведёт себя на нём одинаково.
+
+Запуск:
+    python src/data_layer/storage_conformance.py                 # memory + sqlite
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python src/data_layer/storage_conformance.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+from datetime import timedelta
+from typing import Callable, List, Tuple
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/data_layer
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend, DocumentNotFound, utcnow
+
+
+def _check(cond: bool, msg: str) -> None:
+    if not cond:
+        raise AssertionError(msg)
+
+
+# ---------------------------------------------------------------------------------
+# ПРОВЕРКИ
+# ---------------------------------------------------------------------------------
+# Каждая проверка получает бэкенд и уникальный префикс (чтобы не пересекаться
+# с данными реального Firestore / эмулятора).
+
+def check_books(s: StorageBackend, p: str) -> None:
+    book_id = f"{p}-book"
+    _check(s.get_book(book_id) is None, "несуществующая книга должна быть None")
+    s.create_book(book_id, child_name="Амина", theme="луна")
+    book = s.get_book(book_id)
+    _check(book is not None and book["id"] == book_id, "get_book вернул книгу с id")
+    _check(book["title"] == "История для Амина", "title по умолчанию")
+    _check(book["status"] == "draft" and book["pdf_url"] == "", "поля по умолчанию")
+
+    s.update_book_status(book_id, "writing")
+    s.attach_cover_url(book_id, "gs://b/cover.png")
+    s.attach_pdf_url(book_id, "gs://b/book.pdf")
+    book = s.get_book(book_id)
+    _check(book["status"] == "writing", "update_book_status")
+    _check(book["cover_url"] == "gs://b/cover.png" and book["pdf_url"] == "gs://b/book.pdf", "attach_*_url")
+    _check(book["child_name"] == "Амина", "update не трогает остальные поля")
+
+
+def check_update_missing(s: StorageBackend, p: str) -> None:
+    try:
+        s.update_book_status(f"{p}-nope", "writing")
+    except DocumentNotFound:
+        return
+    raise AssertionError("update несуществующего документа должен бросать DocumentNotFound")
+
+
+def check_scenes(s: StorageBackend, p: str) -> None:
+    book_id = f"{p}-scenes"
+    s.create_book(book_id, child_name="Лейла", theme="сад")
+    for page in (3, 1, 2):
+        s.add_scene(book_id, f"scene_{page:03d}", page, f"текст {page}", "main", "bg")
+    scenes = s.list_scenes(book_id)
+    _check([x["page"] for x in scenes] == [1, 2, 3], "list_scenes сортирует по page")
+    _check(scenes[0]["id"] == "scene_001", "сцена несёт id")
+
+    s.update_scene_image_url(book_id, "scene_002", "gs://b/2.png", status="approved")
+    scene = {x["id"]: x for x in s.list_scenes(book_id)}["scene_002"]
+    _check(scene["image_url"] == "gs://b/2.png" and scene["status"] == "approved", "update_scene_image_url")
+    _check(scene["text"] == "текст 2", "update сцены не трогает текст")
+
+
+def check_jobs(s: StorageBackend, p: str) -> None:
+    book_id = f"{p}-jobs"
+    first = s.create_job(book_id, "storywriter")
+    time.sleep(0.01)
+    second = s.create_job(book_id, "scene_generation")
+    time.sleep(0.01)
+    third = s.create_job(book_id, "scene_generation")
+
+    s.update_job_status(second, "done", result_url="gs://b/x.png")
+    job = s.get_job(second)
+    _check(job["status"] == "done" and job["result_url"] == "gs://b/x.png", "update_job_status")
+    _check(job["type"] == "scene_generation" and job["book_id"] == book_id, "поля задачи")
+
+    pending = s.list_jobs(job_type="scene_generation", status="pending", book_id=book_id)
+    _check([j["id"] for j in pending] == [third], "list_jobs фильтрует по type/status")
+    all_jobs = s.list_jobs(book_id=book_id)
+    _check([j["id"] for j in all_jobs] == [first, second, third], "list_jobs: старые первыми")
+    _check(len(s.list_jobs(book_id=book_id, limit=2)) == 2, "list_jobs limit")
+
+
+def check_feedback(s: StorageBackend, p: str) -> None:
+    book_id = f"{p}-fb"
+    s.add_feedback(book_id, "обложку светлее")
+    time.sleep(0.01)
+    s.add_feedback(book_id, "сцена 2: лицо", source="router")
+    items = s.list_feedback(book_id)
+    _check([x["comment"] for x in items] == ["обложку светлее", "сцена 2: лицо"], "list_feedback")
+    _check(items[1]["source"] == "router", "source")
+
+
+def check_inbox_outbox(s: StorageBackend, p: str) -> None:
+    inbox_id = f"{p}:1"
+    _check(s.create_inbox_once(inbox_id, {"chat_id": 1, "text": "привет"}) is True, "первое создание inbox")
+    _check(s.create_inbox_once(inbox_id, {"chat_id": 1, "text": "дубль"}) is False, "повтор inbox отклонён")
+    _check(s.get_inbox(inbox_id)["text"] == "привет", "inbox не перезаписан дублем")
+
+    out_id = f"{p}:1"
+    _check(s.get_outbox(out_id) is None, "outbox пуст")
+    s.mark_outbox_sent(out_id)
+    _check(s.get_outbox(out_id).get("sent") is True, "mark_outbox_sent")
+
+
+def check_events(s: StorageBackend, p: str) -> None:
+    chat_id = int(uuid.uuid4().int % 10**9)
+    s.log_event({"type": "incoming_message", "chat_id": chat_id, "text": "1"})
+    time.sleep(0.01)
+    s.log_event({"type": "router_sent", "chat_id": chat_id, "answer": "2"}, event_id=f"{p}:sent")
+    s.log_event({"type": "router_sent", "chat_id": chat_id, "stage": "router_sent"}, event_id=f"{p}:sent")
+    time.sleep(0.01)
+    s.log_event({"type": "incoming_message", "chat_id": chat_id, "text": "3"})
+
+    events = s.list_events(chat_id)
+    _check(len(events) == 3, "идемпотентный event_id не плодит документы")
+    _check(events[0].get("text") == "3", "list_events: новые первыми")
+    merged = [e for e in events if e["id"] == f"{p}:sent"][0]
+    _check(merged.get("answer") == "2" and merged.get("stage") == "router_sent", "log_event с id делает merge")
+    _check(len(s.list_events(chat_id, limit=1)) == 1, "list_events limit")
+    only_in = s.list_events(chat_id, event_types=["incoming_message"])
+    _check([e["text"] for e in only_in] == ["3", "1"], "list_events фильтр по типу")
+
+
+def check_chats(s: StorageBackend, p: str) -> None:
+    chat_id = f"{p}-chat"
+    _check(s.get_chat(chat_id) is None, "чата нет")
+    s.update_chat(chat_id, greeted=True)
+    s.update_chat(chat_id, last_message_at_iso="2025-01-01T00:00:00+00:00")
+    chat = s.get_chat(chat_id)
+    _check(chat["greeted"] is True and chat["last_message_at_iso"].startswith("2025"), "update_chat делает merge")
+
+
+def check_primitives(s: StorageBackend, p: str) -> None:
+    col = f"conformance_{p}"
+    s.set_doc(col, "a", {"n": 1, "m": {"x": 1, "y": 1}})
+    s.set_doc(col, "a", {"m": {"y": 2}}, merge=True)
+    _check(s.get_doc(col, "a") == {"n": 1, "m": {"x": 1, "y": 2}}, "set merge сливает вложенные карты")
+    s.update_doc(col, "a", {"m.x": 5})
+    _check(s.get_doc(col, "a")["m"] == {"x": 5, "y": 2}, "update по пути с точкой")
+    s.set_doc(col, "a", {"only": True})
+    _check(s.get_doc(col, "a") == {"only": True}, "set без merge перезаписывает")
+
+    new_id = s.add_doc(col, {"n": 2})
+    _check(bool(new_id) and s.get_doc(col, new_id) == {"n": 2}, "add_doc")
+
+    s.increment_docs([
+        (col, "cnt", {"count": 2, "nested.a": 1}, {"label": "x"}),
+        (col, "cnt", {"count": 3}, {}),
+    ])
+    cnt = s.get_doc(col, "cnt")
+    _check(cnt["count"] == 5 and cnt["nested"]["a"] == 1 and cnt["label"] == "x", "increment_docs")
+
+    now = utcnow()
+    s.set_doc(col, "old", {"created_at": now - timedelta(days=10), "status": "x"})
+    s.set_doc(col, "new", {"created_at": now, "status": "x"})
+    older = s.query_docs(col, where=[("created_at", "<", now - timedelta(days=1))])
+    _check([d["id"] for d in older] == ["old"], "query по datetime-диапазону")
+    ordered = s.query_docs(col, where=[("status", "==", "x")], order_by="created_at", descending=True)
+    _check([d["id"] for d in ordered] == ["new", "old"], "order_by desc")
+
+    _check(s.delete_docs(col, ["old", "new"]) == 2, "delete_docs")
+    _check(s.get_doc(col, "old") is None, "документ удалён")
+    s.delete_docs(col, ["a", new_id, "cnt"])
+
+
+def check_metrics(s: StorageBackend, p: str) -> None:
+    metric = f"conformance_{p}"
+    s.metrics.incr_many({metric: 2})
+    s.metrics.incr(metric)
+    _check(s.metrics.get_total(metric) == 3, "шардированный счётчик суммируется")
+    hourly = s.metrics.summarize(hours=1)["totals"]
+    _check(hourly.get(metric) == 3, "почасовой роллап")
+
+
+CHECKS: List[Callable[[StorageBackend, str], None]] = [
+    check_books,
+    check_update_missing,
+    check_scenes,
+    check_jobs,
+    check_feedback,
+    check_inbox_outbox,
+    check_events,
+    check_chats,
+    check_primitives,
+    check_metrics,
+]
+
+
+def run_conformance(storage: StorageBackend) -> List[Tuple[str, str]]:
+    """
+    Прогоняет все проверки, возвращает список провалов [(имя, причина)].
+    """
+    prefix = f"cf{uuid.uuid4().hex[:8]}"
+    failures = []
+    for check in CHECKS:
+        try:
+            check(storage, prefix)
+        except Exception as e:
+            failures.append((check.__name__, f"{e!r}\n{traceback.format_exc(limit=3)}"))
+    return failures
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ ПРОГОН
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    from data_layer.memory_storage import MemoryStorage
+    from data_layer.sqlite_storage import SQLiteStorage
+
+    backends = [("memory", MemoryStorage)]
+    tmp_dir = tempfile.mkdtemp(prefix="booksoul-conformance-")
+    backends.append(("sqlite", lambda: SQLiteStorage(os.path.join(tmp_dir, "conformance.db"))))
+    if os.getenv("FIRESTORE_EMULATOR_HOST"):
+        from data_layer.firestore_client import FirestoreClient
+        backends.append(("firestore", lambda: FirestoreClient(project_id="booksoul-local")))
+
+    failed = False
+    for name, factory in backends:
+        failures = run_conformance(factory())
+        print(f"{name:>10}: {len(CHECKS) - len(failures)}/{len(CHECKS)} ok")
+        for check_name, reason in failures:
+            failed = True
+            print(f"   ✗ {check_name}: {reason}")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,808 @@
+# src/layout_engine/pdf_maker.py
+
+"""
+pdf_maker.py — Layout Engine: печатный PDF книги (A5, 300 DPI) потоком, с ограниченной памятью.
+
+Почему не "один canvas на книгу": ReportLab держит все картинки документа в памяти до save(),
+а save() собирает весь PDF одним bytes — пик памяти растёт с числом страниц (на Cloud Run —
+гигабайты на книгу). Здесь:
+
+1. страница = отдельный одностраничный PDF ReportLab (фрагмент): картинка сцены скачивается,
+   приводится к точному размеру поля в 300 DPI (JPEG), рисуется — и отпускается до следующей;
+2. PdfStreamWriter дописывает объекты фрагмента в итоговый файл с перенумерацией ссылок и
+   забывает их; в памяти — только смещения для xref. Каталог, дерево страниц и xref —
+   в конце файла;
+3. файл — SpooledTemporaryFile (до PDF_SPOOL_MB в памяти, дальше на диске), загрузка —
+   put_file (в GCS — resumable, кусками RESUMABLE_CHUNK_SIZE).
+
+Пик памяти = одна страница (картинка + фрагмент), от числа страниц не зависит.
+
+Параллельно (PDF_WORKERS > 1): фрагменты независимы, поэтому диапазоны по PDF_PAGES_PER_TASK
+страниц рисуются в пуле процессов (spawn), каждый — в свой многостраничный фрагмент.
+Родитель качает картинки (I/O, пока воркеры заняты), отдаёт в задачу байты JPEG (~1-2 МБ,
+не кадр — shared memory тут не нужна) и склеивает готовые фрагменты строго по порядку. В работе
+не больше 2 * PDF_WORKERS диапазонов — память по-прежнему не зависит от числа страниц.
+Готовый URL — pdf_url книги; задача layout заводится "running" до сборки и закрывается done / error.
+
+Повторная сборка (правка одной сцены): фрагмент каждой страницы кэшируется по page_key —
+sha256 от текста, хэша картинки, шрифта и параметров вёрстки. Ключ и ссылка на фрагмент —
+в сцене (layout_page), сам фрагмент — books/<id>/layout/<scene_id>.pdf и LRU процесса
+(LAYOUT_CACHE_MB). Рисуются только страницы с новым ключом, остальные фрагменты склеиваются
+как есть. Хэш картинки: styled_hash сцены (style_corrector, точный), иначе сохранённый при
+прошлой сборке — если та же ссылка и тот же phash (как в palette.py), иначе sha256 байт.
+
+Картинки: styled_url сцены (style_corrector, JPEG) — иначе image_url. JPEG ровно размера поля
+идёт в PDF как есть (DCTDecode, без перекодирования); остальное — кадрирование под поле и
+JPEG q92 без субдискретизации. ASCII85-обёртка ReportLab для картинок выключена: +25% к
+размеру печатного файла ни к чему.
+
+Шрифт — REPORTLAB_FONT: путь к TTF (встраивается подмножеством — то, что нужно типографии)
+или имя CID-шрифта ReportLab (HeiseiMin-W3 по умолчанию: в нём есть кириллица JIS, но он
+не встраивается). Кегль текста — utils.text_fit (общий с обложкой): наибольший из
+text_min_pt..text_max_pt, при котором текст влезает в полосу под картинкой. Не влезает и при
+text_min_pt — полоса растёт за счёт картинки до text_band_max, дальше страница — ошибка сборки:
+текст не рисуется поверх арта и за обрезом.
+
+Бенчмарк (пик RSS против наивной сборки, 8 / 24 / 48 страниц; 1..N воркеров и пересборка
+после правки одной сцены на 24 страницах):
+    python src/layout_engine/pdf_maker.py
+"""
+
+from typing import Optional, Dict, Any, List, Tuple, IO
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import gc
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from PIL import Image, ImageOps
+except Exception:
+    Image = ImageOps = None
+
+try:
+    from reportlab import rl_config
+    from reportlab.lib.units import mm
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+    # JPEG в PDF — бинарным потоком, без ASCII85 (+25% к размеру)
+    rl_config.useA85 = 0
+except Exception:
+    canvas = None
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/layout_engine
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from utils.metrics import REGISTRY
+from utils.text_fit import default_font, get_metrics, register_font
+
+PDF_SPOOL_MB = int(os.getenv("PDF_SPOOL_MB", "8"))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "0")) or (os.cpu_count() or 1)
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "2"))
+LAYOUT_CACHE_MB = int(os.getenv("LAYOUT_CACHE_MB", "128"))
+
+PAGE_DPI = 300
+TRIM_MM = (148, 210)
+BLEED_MM = 3
+
+# вёрстка страницы: картинка сверху в вылет, текст — в белой полосе снизу (не на арте)
+LAYOUT: Dict[str, Any] = {
+    "text_band": 0.27,      # доля высоты обреза под текст
+    "text_band_max": 0.45,  # длинный текст: полоса растёт за счёт арта до этой доли
+    "text_band_step": 0.03,
+    "margin_mm": 12,
+    "text_max_pt": 20,
+    "text_min_pt": 11,
+    "text_step_pt": 0.5,
+    "leading": 1.3,
+    "jpeg_quality": 92,
+}
+
+JOB_TYPE = "layout"
+
+# меняется вместе с тем, как рисуется страница: старые фрагменты перестают совпадать по ключу
+LAYOUT_CACHE_VERSION = 3
+
+PDF_SECONDS = REGISTRY.histogram("booksoul_pdf_seconds", "Book PDF assembly time")
+PDF_PAGES = REGISTRY.counter("booksoul_pdf_pages_total", "Book PDF pages by source (rendered / cached)")
+
+
+# ---------------------------------------------------------------------------------
+# ГЕОМЕТРИЯ И ШРИФТ
+# ---------------------------------------------------------------------------------
+
+def page_size_pt() -> Tuple[float, float]:
+    return ((TRIM_MM[0] + 2 * BLEED_MM) * mm, (TRIM_MM[1] + 2 * BLEED_MM) * mm)
+
+
+def image_box(layout: Dict[str, Any] = LAYOUT) -> Tuple[float, float, float, float]:
+    """(x, y, w, h) в пунктах: от верхнего вылета до полосы текста, по ширине — в вылет."""
+    w, h = page_size_pt()
+    band_top = BLEED_MM * mm + TRIM_MM[1] * mm * layout["text_band"]
+    return (0.0, band_top, w, h - band_top)
+
+
+def text_box(layout: Dict[str, Any] = LAYOUT) -> Tuple[float, float, float, float]:
+    """(x, y, w, h) в пунктах: полоса под картинкой внутри обреза, с полями."""
+    margin = layout["margin_mm"] * mm
+    x = BLEED_MM * mm + margin
+    y = BLEED_MM * mm + margin * 0.75
+    w = TRIM_MM[0] * mm - 2 * margin
+    h = TRIM_MM[1] * mm * layout["text_band"] - margin * 1.25
+    return (x, y, w, h)
+
+
+def pt_to_px(pt: float) -> int:
+    return int(round(pt / 72 * PAGE_DPI))
+
+
+# ---------------------------------------------------------------------------------
+# СТРАНИЦА
+# ---------------------------------------------------------------------------------
+
+def prepare_image(data: bytes, box_px: Tuple[int, int], quality: int = LAYOUT["jpeg_quality"]) -> bytes:
+    """
+    Байты картинки -> JPEG ровно box_px. JPEG нужного размера — как есть.
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.format == "JPEG" and img.size == box_px and img.mode == "RGB":
+        return data
+    img.draft("RGB", box_px)
+    img = ImageOps.fit(img.convert("RGB"), box_px, Image.BICUBIC)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=quality, subsampling=0, dpi=(PAGE_DPI, PAGE_DPI))
+    return buf.getvalue()
+
+
+def fit_text(text: str, font: str, box: Tuple[float, float, float, float],
+             layout: Dict[str, Any] = LAYOUT) -> Tuple[float, List[str], bool]:
+    """
+    Наибольший кегль text_min_pt..text_max_pt, при котором текст влезает в полосу без арта
+    (utils.text_fit: двоичный поиск, ширины и переносы из кэша шрифта).
+    Третье значение — влез ли текст (False: строки при text_min_pt выходят за полосу).
+    """
+    res = get_metrics(font).fit(text, [box], layout["text_max_pt"], layout["text_min_pt"],
+                                layout["leading"], layout["text_step_pt"])
+    return res.size, res.lines, res.fits
+
+
+def text_layout(text: str, font: str, layout: Dict[str, Any] = LAYOUT) -> Tuple[Dict[str, Any], float, List[str]]:
+    """
+    Вёрстка страницы под текст -> (layout страницы, кегль, строки). Не влез при text_min_pt —
+    полоса текста растёт шагами text_band_step за счёт арта до text_band_max; не влез и так —
+    ValueError: поверх арта и за обрезом текст не рисуется.
+    """
+    band = layout["text_band"]
+    while True:
+        page_layout = layout if band == layout["text_band"] else dict(layout, text_band=band)
+        size, lines, fits = fit_text(text, font, text_box(page_layout), page_layout)
+        if fits:
+            return page_layout, size, lines
+        if band >= layout["text_band_max"]:
+            raise ValueError(f"текст не влезает в полосу {layout['text_band_max']:.0%} высоты "
+                             f"при {layout['text_min_pt']} pt ({len(text)} символов)")
+        band = min(layout["text_band_max"], round(band + layout["text_band_step"], 4))
+
+
+def draw_page(c, page: Dict[str, Any], image: Optional[bytes], font: str,
+              layout: Dict[str, Any] = LAYOUT) -> None:
+    """
+    Одна страница книги на canvas: картинка в вылет сверху, текст в полосе снизу.
+    Длинный текст забирает у картинки высоту (text_layout); не влезает и так — ValueError.
+    """
+    text = (page.get("text") or "").strip()
+    if text:
+        try:
+            layout, size, lines = text_layout(text, font, layout)
+        except ValueError as e:
+            raise ValueError(f"[PdfMaker] страница {page.get('page')}: {e}") from e
+
+    if image is not None:
+        x, y, iw, ih = image_box(layout)
+        jpeg = prepare_image(image, (pt_to_px(iw), pt_to_px(ih)), layout["jpeg_quality"])
+        c.drawImage(ImageReader(io.BytesIO(jpeg)), x, y, iw, ih)
+        del jpeg
+
+    if text:
+        box = text_box(layout)
+        lead = size * layout["leading"]
+        bx, by, bw, bh = box
+        top = by + bh - (bh - len(lines) * lead) / 2 - size
+        c.setFont(font, size)
+        c.setFillColorRGB(0.15, 0.15, 0.2)
+        for i, line in enumerate(lines):
+            c.drawCentredString(bx + bw / 2, top - i * lead, line)
+
+
+def render_pages(items: List[Tuple[Dict[str, Any], Optional[bytes]]], font: str,
+                 layout: Dict[str, Any] = LAYOUT) -> bytes:
+    """
+    Страницы книги -> один PDF-фрагмент (страницы в том же порядке).
+    items: [(page, image)] — page: {"text", "page"}; image — байты картинки сцены или None.
+    """
+    out = io.BytesIO()
+    w, h = page_size_pt()
+    c = canvas.Canvas(out, pagesize=(w, h), pageCompression=1)
+    for page, image in items:
+        c.setTrimBox((BLEED_MM * mm, BLEED_MM * mm, w - BLEED_MM * mm, h - BLEED_MM * mm))
+        c.setBleedBox((0, 0, w, h))
+        draw_page(c, page, image, font, layout)
+        c.showPage()
+    c.save()
+    data = out.getvalue()
+    # canvas и документ ReportLab связаны циклическими ссылками: без явной сборки страницы
+    # с картинками копятся до редкого прохода gen2 — и пик памяти снова растёт со страницами
+    del c, out, items
+    gc.collect()
+    return data
+
+
+def _render_task(items: List[Tuple[Dict[str, Any], Optional[bytes]]], font: str,
+                 layout: Dict[str, Any]) -> List[bytes]:
+    """
+    Задача пула: диапазон страниц -> фрагмент на каждую (кэшируются по одной).
+    font — как в REPORTLAB_FONT (путь к TTF регистрируется в воркере).
+    """
+    name = register_font(font)
+    return [render_pages([item], name, layout) for item in items]
+
+
+def page_key(text: str, image_hash: str, font: str, layout: Dict[str, Any]) -> str:
+    """Ключ фрагмента: всё, от чего зависит нарисованная страница."""
+    payload = json.dumps({"v": LAYOUT_CACHE_VERSION, "text": (text or "").strip(), "image": image_hash,
+                          "font": font, "layout": layout, "trim": TRIM_MM, "bleed": BLEED_MM, "dpi": PAGE_DPI},
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _FragmentCache:
+    """LRU фрагментов страниц по байтам (ключ — page_key)."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            frag = self._data.get(key)
+            if frag is not None:
+                self._data.move_to_end(key)
+            return frag
+
+    def put(self, key: str, frag: bytes) -> None:
+        with self._lock:
+            if key in self._data or len(frag) > self.max_bytes:
+                return
+            self._data[key] = frag
+            self.bytes += len(frag)
+            while self.bytes > self.max_bytes:
+                _, old = self._data.popitem(last=False)
+                self.bytes -= len(old)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+
+_fragments = _FragmentCache(LAYOUT_CACHE_MB * 1024 * 1024)
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_pool(workers: int = PDF_WORKERS) -> Optional[ProcessPoolExecutor]:
+    """
+    Пул процессов вёрстки на весь процесс сервиса (spawn). workers <= 1 — без пула, в потоке.
+    """
+    global _pool
+    if workers <= 1:
+        return None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+# ---------------------------------------------------------------------------------
+# ПОТОКОВАЯ СКЛЕЙКА ФРАГМЕНТОВ
+# ---------------------------------------------------------------------------------
+
+_XREF_RE = re.compile(rb"startxref\s+(\d+)\s+%%EOF\s*$")
+_REF_RE = re.compile(rb"(\d+) 0 R\b")
+_KIDS_RE = re.compile(rb"/Kids\s*\[([^\]]*)\]")
+_ROOT_RE = re.compile(rb"/Root\s+(\d+) 0 R")
+_PAGES_RE = re.compile(rb"/Pages\s+(\d+) 0 R")
+_STREAM_RE = re.compile(rb">>\s*stream\r?\n")
+_PARENT_RE = re.compile(rb"/Parent\s+\d+ 0 R")
+
+
+def _objects(frag: bytes) -> Dict[int, bytes]:
+    """
+    Фрагмент ReportLab -> {номер: тело объекта между "N 0 obj" и "endobj"}.
+    Границы — по классической таблице xref (ReportLab пишет её без потоков объектов).
+    """
+    m = _XREF_RE.search(frag[-64:])
+    if not m:
+        raise ValueError("pdf fragment: startxref not found")
+    pos = int(m.group(1))
+    lines = frag[pos:].split(b"\n", 2)
+    first, count = map(int, lines[1].split())
+    entries = lines[2]
+    offsets = {}
+    for i in range(count):
+        entry = entries[i * 20:(i + 1) * 20]
+        if entry[17:18] == b"n":
+            offsets[first + i] = int(entry[:10])
+    ordered = sorted(offsets.items(), key=lambda kv: kv[1])
+    bounds = [off for _, off in ordered[1:]] + [pos]
+    out = {}
+    for (num, off), end in zip(ordered, bounds):
+        body = frag[off:end]
+        start = body.index(b"obj") + 3
+        stop = body.rindex(b"endobj")
+        out[num] = body[start:stop].strip(b"\r\n ")
+    return out
+
+
+def _split_stream(body: bytes) -> Tuple[bytes, bytes]:
+    """Тело объекта -> (словарь, поток) — ссылки переписываются только в словаре."""
+    m = _STREAM_RE.search(body)
+    if not m:
+        return body, b""
+    return body[:m.start() + 2], body[m.start() + 2:]
+
+
+class PdfStreamWriter:
+    """
+    PdfStreamWriter — итоговый PDF, который пишется по одной странице-фрагменту.
+    Объекты фрагмента уходят в файл сразу; в памяти — смещения и номера страниц.
+    Номер 1 — каталог, 2 — дерево страниц: пишутся последними, ссылки на них известны заранее.
+    """
+
+    CATALOG, PAGES = 1, 2
+
+    def __init__(self, fileobj: IO[bytes]):
+        self.f = fileobj
+        self.offsets: Dict[int, int] = {}
+        self.page_ids: List[int] = []
+        self.next_id = 3
+        self.pos = 0
+        self._digest = hashlib.md5()
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data: bytes) -> None:
+        self.f.write(data)
+        self.pos += len(data)
+
+    def _obj(self, num: int, body: bytes) -> None:
+        self.offsets[num] = self.pos
+        self._write(b"%d 0 obj\n" % num + body + b"\nendobj\n")
+
+    def add_fragment(self, frag: bytes) -> int:
+        """Страницы фрагмента -> в конец документа. Возвращает число добавленных страниц."""
+        objs = _objects(frag)
+        root = int(_ROOT_RE.search(frag[frag.rindex(b"trailer"):]).group(1))
+        pages = int(_PAGES_RE.search(objs[root]).group(1))
+        kids = [int(n) for n in _REF_RE.findall(_KIDS_RE.search(objs[pages]).group(1))]
+
+        # всё, до чего можно дойти от страниц (кроме /Parent): ресурсы, шрифты, картинки, контент
+        keep, stack = set(), list(kids)
+        while stack:
+            num = stack.pop()
+            if num in keep or num not in objs:
+                continue
+            keep.add(num)
+            head, _ = _split_stream(objs[num])
+            stack.extend(int(n) for n in _REF_RE.findall(_PARENT_RE.sub(b"", head)))
+
+        remap = {}
+        for num in sorted(keep):
+            remap[num] = self.next_id
+            self.next_id += 1
+        fix = lambda m: b"%d 0 R" % remap[int(m.group(1))]
+        parent = b"/Parent %d 0 R" % self.PAGES
+        for num in sorted(keep):
+            head, stream = _split_stream(objs[num])
+            if num in kids:
+                # /Parent фрагмента не в keep — остаётся как есть и заменяется на общее дерево
+                head = _REF_RE.sub(lambda m: fix(m) if int(m.group(1)) in remap else m.group(0), head)
+                head = _PARENT_RE.sub(parent, head)
+            else:
+                head = _REF_RE.sub(fix, head)
+            self._obj(remap[num], head + stream)
+        self.page_ids.extend(remap[k] for k in kids)
+        self._digest.update(frag[:64])
+        return len(kids)
+
+    def close(self, info: Optional[Dict[str, str]] = None) -> int:
+        """Дерево страниц, каталог, Info, xref, trailer. Возвращает размер файла."""
+        kids = b" ".join(b"%d 0 R" % n for n in self.page_ids)
+        self._obj(self.PAGES, b"<< /Type /Pages /Count %d /Kids [ %s ] >>" % (len(self.page_ids), kids))
+        self._obj(self.CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES)
+        info_id = self.next_id
+        fields = {"Producer": "BookSoul Layout Engine (ReportLab)", **(info or {})}
+        body = b" ".join(b"/%s %s" % (k.encode(), _pdf_string(v)) for k, v in fields.items())
+        self._obj(info_id, b"<< " + body + b" >>")
+        size = info_id + 1
+
+        xref = self.pos
+        rows = [b"0000000000 65535 f \n"]
+        for num in range(1, size):
+            rows.append(b"%010d 00000 n \n" % self.offsets[num] if num in self.offsets else b"0000000000 65535 f \n")
+        doc_id = self._digest.hexdigest().encode()
+        self._write(b"xref\n0 %d\n" % size + b"".join(rows))
+        self._write(b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R /ID [<%s><%s>] >>\nstartxref\n%d\n%%%%EOF\n"
+                    % (size, self.CATALOG, info_id, doc_id, doc_id, xref))
+        return self.pos
+
+
+def _pdf_string(value: str) -> bytes:
+    """Строка Info: UTF-16BE с BOM (кириллица в заголовке книги)."""
+    return b"<" + ("﻿" + value).encode("utf-16-be").hex().encode() + b">"
+
+
+# ---------------------------------------------------------------------------------
+# КНИГА
+# ---------------------------------------------------------------------------------
+
+class PdfMaker:
+    """
+    PdfMaker — печатный PDF книги: фрагмент за фрагментом, в спул-файл, загрузка resumable.
+    pool — ProcessPoolExecutor (get_pool()): диапазоны страниц рисуются параллельно; None — в потоке.
+    """
+
+    def __init__(self, storage, blobs, font: Optional[str] = None, layout: Optional[Dict[str, Any]] = None,
+                 pool: Optional[ProcessPoolExecutor] = None, pages_per_task: int = PDF_PAGES_PER_TASK):
+        self.fs = storage
+        self.blobs = blobs
+        self.font_spec = font or default_font()
+        self.font = register_font(self.font_spec)
+        self.layout = dict(LAYOUT, **(layout or {}))
+        self.pool = pool
+        self.pages_per_task = max(1, pages_per_task)
+
+    def pages(self, book_id: str) -> List[Dict[str, Any]]:
+        """
+        Сцены книги -> страницы: текст и картинка (styled_url, иначе image_url),
+        плюс то, что нужно для ключа кэша: styled_hash / phash и прошлая сборка (layout_page).
+        """
+        return [{
+            "scene_id": s["id"],
+            "page": s.get("page", i + 1),
+            "text": s.get("text", ""),
+            "image_url": s.get("styled_url") or s.get("image_url") or "",
+            "styled": bool(s.get("styled_url")),
+            "styled_hash": s.get("styled_hash", "") if s.get("styled_url") else "",
+            "phash": s.get("phash", ""),
+            "cached": s.get("layout_page") or {},
+        } for i, s in enumerate(self.fs.list_scenes(book_id))]
+
+    # --- кэш фрагментов ---
+
+    def _image_hash(self, page: Dict[str, Any]) -> Tuple[str, str]:
+        """Хэш картинки страницы и его источник: styled / doc / computed (скачали и посчитали)."""
+        if not page["image_url"]:
+            return "", "none"
+        if page["styled_hash"]:
+            return page["styled_hash"], "styled"
+        prev = page["cached"]
+        # styled-файл перезаписывается по той же ссылке при том же phash исходника — только точный хэш
+        if not page["styled"] and page["phash"] and prev.get("image_hash") \
+                and prev.get("image_url") == page["image_url"] and prev.get("phash") == page["phash"]:
+            return prev["image_hash"], "doc"
+        data = self.blobs.get_bytes(self._path(page["image_url"]))
+        return hashlib.sha256(data).hexdigest(), "computed"
+
+    def plan(self, pages: List[Dict[str, Any]]) -> Dict[str, int]:
+        """
+        Ключ каждой страницы (page["key"]) и отметка, есть ли её готовый фрагмент (page["hit"]).
+        Возвращает счётчики источников хэшей картинок.
+        """
+        sources: Dict[str, int] = {}
+        for page in pages:
+            image_hash, source = self._image_hash(page)
+            sources[source] = sources.get(source, 0) + 1
+            page["image_hash"] = image_hash
+            page["key"] = page_key(page["text"], image_hash, self.font_spec, self.layout)
+            page["hit"] = page["cached"].get("key") == page["key"] and bool(page["cached"].get("url"))
+        return sources
+
+    def _load(self, page: Dict[str, Any]) -> Optional[bytes]:
+        """Готовый фрагмент: LRU процесса, иначе хранилище файлов. None — пропал, рисовать заново."""
+        frag = _fragments.get(page["key"])
+        if frag is None:
+            try:
+                frag = self.blobs.get_bytes(self._path(page["cached"]["url"]))
+            except Exception as e:
+                print(f"[PdfMaker] fragment of {page['scene_id']} unavailable, re-rendering: {e!r}")
+                return None
+            _fragments.put(page["key"], frag)
+        return frag
+
+    def _save(self, book_id: str, page: Dict[str, Any], frag: bytes) -> None:
+        _fragments.put(page["key"], frag)
+        url = self.blobs.put_bytes(f"books/{book_id}/layout/{page['scene_id']}.pdf", frag, "application/pdf")
+        self.fs.update_scene(book_id, page["scene_id"], layout_page={
+            "key": page["key"], "url": url, "image_url": page["image_url"],
+            "phash": page["phash"], "image_hash": page.get("image_hash", ""),
+        })
+
+    def _items(self, pages: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], Optional[bytes]]]:
+        """Страницы диапазона + байты их картинок."""
+        return [(page, self.blobs.get_bytes(self._path(page["image_url"])) if page.get("image_url") else None)
+                for page in pages]
+
+    def render(self, page: Dict[str, Any]) -> bytes:
+        """Страница -> фрагмент; картинка живёт только внутри вызова."""
+        return render_pages(self._items([page]), self.font, self.layout)
+
+    def _submit(self, chunk: List[Dict[str, Any]]):
+        """Диапазон страниц на отрисовку: Future в пуле или сразу список фрагментов (без пула)."""
+        items = self._items(chunk)
+        if self.pool is None:
+            return _render_task(items, self.font_spec, self.layout)
+        return self.pool.submit(_render_task, items, self.font_spec, self.layout)
+
+    def fragments(self, pages: List[Dict[str, Any]], book_id: Optional[str] = None,
+                  stats: Optional[Dict[str, int]] = None):
+        """
+        Фрагменты страниц строго по порядку. С book_id (после plan) — готовые берутся из кэша,
+        новые сохраняются; без — рисуется всё. Подряд идущие новые страницы — диапазонами по
+        pages_per_task; в работе не больше 2 * воркеров диапазонов.
+        """
+        stats = stats if stats is not None else {}
+        window = 2 * max(1, getattr(self.pool, "_max_workers", 1)) if self.pool is not None else 0
+        queue: deque = deque()
+        batch: List[Dict[str, Any]] = []
+
+        def flush() -> None:
+            if batch:
+                queue.append((list(batch), self._submit(batch)))
+                batch.clear()
+
+        def take():
+            chunk, value = queue.popleft()
+            if value is None:                             # готовый фрагмент
+                frag = self._load(chunk[0])
+                if frag is not None:
+                    stats["cached"] = stats.get("cached", 0) + 1
+                    yield frag
+                    return
+                value = self._submit(chunk)
+            frags = value.result() if hasattr(value, "result") else value
+            for page, frag in zip(chunk, frags):
+                if book_id is not None:
+                    self._save(book_id, page, frag)
+                stats["rendered"] = stats.get("rendered", 0) + 1
+                yield frag
+
+        for page in pages:
+            if book_id is not None and page.get("hit"):
+                flush()
+                queue.append(([page], None))
+            else:
+                batch.append(page)
+                if len(batch) >= self.pages_per_task:
+                    flush()
+            while len(queue) > window:
+                yield from take()
+        flush()
+        while queue:
+            yield from take()
+
+    def write_pdf(self, pages: List[Dict[str, Any]], fileobj: IO[bytes], title: str = "",
+                  book_id: Optional[str] = None, stats: Optional[Dict[str, int]] = None) -> int:
+        writer = PdfStreamWriter(fileobj)
+        for frag in self.fragments(pages, book_id, stats):
+            writer.add_fragment(frag)
+        return writer.close({"Title": title} if title else None)
+
+    def build(self, book_id: str) -> Dict[str, Any]:
+        """
+        Книга -> books/<id>/book.pdf -> pdf_url книги. Задача layout: running -> done / error.
+        Рисуются только страницы, чей ключ изменился с прошлой сборки.
+        """
+        t0 = time.perf_counter()
+        book = self.fs.get_book(book_id) or {}
+        pages = self.pages(book_id)
+        if not pages:
+            return {"book_id": book_id, "ok": False, "error": "no scenes"}
+        stats: Dict[str, int] = {"rendered": 0, "cached": 0}
+        job_id = self.fs.create_job(book_id, JOB_TYPE, status="running")
+        try:
+            sources = self.plan(pages)
+            with tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MB * 1024 * 1024) as spool:
+                size = self.write_pdf(pages, spool, title=book.get("title", ""), book_id=book_id, stats=stats)
+                url = self.blobs.put_file(f"books/{book_id}/book.pdf", spool, "application/pdf")
+            self.fs.attach_pdf_url(book_id, url)
+        except Exception:
+            self.fs.update_job_status(job_id, "error", job_type=JOB_TYPE)
+            raise
+        self.fs.update_job_status(job_id, "done", result_url=url, job_type=JOB_TYPE)
+        seconds = time.perf_counter() - t0
+        PDF_SECONDS.observe(seconds)
+        for source, count in stats.items():
+            PDF_PAGES.inc(count, source=source)
+        return {"book_id": book_id, "ok": True, "pdf_url": url, "pages": len(pages), **stats,
+                "image_hash": sources, "bytes": size, "seconds": round(seconds, 3)}
+
+    def _path(self, url: str) -> str:
+        """URL из сцены -> путь в хранилище файлов."""
+        if url.startswith("gs://"):
+            return url.split("/", 3)[3]
+        if url.startswith("file://"):
+            return os.path.relpath(url[len("file://"):], self.blobs.root_dir).replace(os.sep, "/")
+        return url
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+BENCH_TEXT = ("Лейла открыла старую дверь в саду, и золотой кот тихо мяукнул: «Идём, я покажу тебе "
+              "место, где живут звёзды». Они шли по тропинке из светлячков, и каждый шаг звенел, как колокольчик.")
+
+
+def _bench_book(root: str, pages: int) -> Tuple[Any, Any, str]:
+    from data_layer.memory_storage import MemoryStorage
+    from data_layer.gcs_client import LocalBlobStore
+    fs = MemoryStorage()
+    blobs = LocalBlobStore(root)
+    book_id = f"BKS-20251201-{pages:06d}"
+    fs.create_book(book_id, child_name="Лейла", theme="сад", status="layout", title="Лейла и золотой кот")
+    for i in range(pages):
+        sid = f"s{i:03d}"
+        fs.add_scene(book_id, sid, page_number=i + 1, text=BENCH_TEXT, prompt_main="", prompt_background="")
+        fs.update_scene(book_id, sid, styled_url=blobs.url(f"src/p{i % 6}.jpg"), status="drawn")
+    return fs, blobs, book_id
+
+
+def _naive_build(fs, blobs, book_id: str, out_path: str, font: str) -> None:
+    """Как в лоб: все картинки книги в памяти, один canvas, save() целиком."""
+    maker = PdfMaker(fs, blobs, font=font)
+    pages = maker.pages(book_id)
+    images = [Image.open(io.BytesIO(blobs.get_bytes(maker._path(p["image_url"])))).convert("RGB") for p in pages]
+    w, h = page_size_pt()
+    c = canvas.Canvas(out_path, pagesize=(w, h), pageCompression=1)
+    x, y, iw, ih = image_box()
+    for page, img in zip(pages, images):
+        c.drawImage(ImageReader(img), x, y, iw, ih)
+        size, lines, _ = fit_text(page["text"], maker.font, text_box())
+        c.setFont(maker.font, size)
+        for i, line in enumerate(lines):
+            c.drawCentredString(w / 2, text_box()[1] + text_box()[3] - size - i * size * LAYOUT["leading"], line)
+        c.showPage()
+    c.save()
+
+
+def _vm(field: str) -> float:
+    """МБ из /proc/self/status (VmRSS — сейчас, VmHWM — пик процесса; ru_maxrss тянет пик родителя)."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _bench_child(mode: str, root: str, pages: int, font: str, queue) -> None:
+    fs, blobs, book_id = _bench_book(root, pages)
+    register_font(font)
+    base = _vm("VmRSS")
+    t0 = time.perf_counter()
+    if mode == "stream":
+        res = PdfMaker(fs, blobs, font=font).build(book_id)
+        size = res["bytes"]
+    else:
+        path = os.path.join(root, f"naive_{pages}.pdf")
+        _naive_build(fs, blobs, book_id, path, font)
+        size = os.path.getsize(path)
+    queue.put({"mode": mode, "pages": pages, "base_mb": base, "peak_mb": _vm("VmHWM"),
+               "seconds": time.perf_counter() - t0, "mb": size / 1e6})
+
+
+def _bench_scale(root: str, pages: int, workers_list: List[int]) -> None:
+    """1..N воркеров на одной книге + доля склейки в родителе (то, что не параллелится)."""
+    fs, blobs, book_id = _bench_book(root, pages)
+    maker = PdfMaker(fs, blobs)
+    book_pages = maker.pages(book_id)
+    frags = [maker.render(p) for p in book_pages[:2]]                      # прогрев шрифта
+    t0 = time.perf_counter()
+    frags = [maker.render(p) for p in book_pages]
+    t_serial = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    writer = PdfStreamWriter(io.BytesIO())
+    for frag in frags:
+        writer.add_fragment(frag)
+    writer.close()
+    t_merge = time.perf_counter() - t0
+    del frags
+    print(f"{pages} стр. в потоке: {t_serial:.2f} с, из них склейка {t_merge:.2f} с "
+          f"(потолок ускорения по Амдалу ~x{t_serial / max(t_merge, 1e-6):.0f}); ядер: {os.cpu_count()}")
+    for workers in workers_list:
+        fs, blobs, book_id = _bench_book(root, pages)                      # без кэша фрагментов
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            maker = PdfMaker(fs, blobs, pool=pool)
+            list(pool.map(_render_task, [[(book_pages[0], None)]] * workers,
+                          [maker.font_spec] * workers, [LAYOUT] * workers))         # прогрев
+            t0 = time.perf_counter()
+            res = maker.build(book_id)
+            seconds = time.perf_counter() - t0
+        print(f"  воркеров {workers}: {seconds:5.2f} с (x{t_serial / seconds:.2f} к потоку), "
+              f"PDF {res['bytes'] / 1e6:.1f} МБ, {res['pages']} стр.")
+
+
+def _bench_incremental(root: str, pages: int) -> None:
+    """Полная сборка, затем пересборки после правки одной сцены (текст / картинка)."""
+    fs, blobs, book_id = _bench_book(root, pages)
+    for scene in fs.list_scenes(book_id):
+        # как после style_corrector: точный хэш styled-картинки в сцене
+        data = blobs.get_bytes(f"src/p{int(scene['id'][1:]) % 6}.jpg")
+        fs.update_scene(book_id, scene["id"], styled_hash=hashlib.sha256(data).hexdigest())
+    maker = PdfMaker(fs, blobs)
+
+    def run(label: str) -> None:
+        res = maker.build(book_id)
+        print(f"  {label:34s} {res['seconds']:5.2f} с: нарисовано {res['rendered']:2d}, из кэша {res['cached']:2d}, "
+              f"хэши картинок {res['image_hash']}")
+
+    print(f"пересборка книги {pages} стр. (в потоке):")
+    run("полная сборка")
+    run("без изменений")
+    fs.update_scene(book_id, "s005", text=BENCH_TEXT.replace("Лейла", "Айша"))
+    run("правка текста одной сцены")
+    url = blobs.put_bytes(f"books/{book_id}/styled/s010.jpg", blobs.get_bytes("src/p3.jpg"), "image/jpeg")
+    fs.update_scene(book_id, "s010", styled_url=url,
+                    styled_hash=hashlib.sha256(blobs.get_bytes("src/p3.jpg")).hexdigest())
+    run("новая картинка одной сцены")
+    _fragments.clear()
+    fs.update_scene(book_id, "s007", text=BENCH_TEXT[:80])
+    run("правка текста, холодный процесс")
+
+
+if __name__ == "__main__":
+    from style_engine.style_corrector import A5_300DPI, _synthetic_page
+
+    parser = argparse.ArgumentParser(description="BookSoul streaming PDF benchmark")
+    parser.add_argument("--pages", type=int, nargs="+", default=[8, 24, 48])
+    parser.add_argument("--edit-pages", type=int, default=24)
+    parser.add_argument("--scale-pages", type=int, default=24)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=sorted({1, 2, 4, max(PDF_WORKERS, 1)}))
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="booksoul_pdf_")
+    for i in range(6):
+        img = Image.open(io.BytesIO(_synthetic_page(i, size=A5_300DPI)))
+        os.makedirs(os.path.join(root, "src"), exist_ok=True)
+        img.save(os.path.join(root, "src", f"p{i}.jpg"), format="JPEG", quality=95, subsampling=0)
+
+    ctx = multiprocessing.get_context("spawn")
+    font = default_font()
+    print(f"страница {page_size_pt()[0] / mm:.0f}x{page_size_pt()[1] / mm:.0f} мм, поле картинки "
+          f"{pt_to_px(image_box()[2])}x{pt_to_px(image_box()[3])} px, шрифт {font}")
+    for pages in args.pages:
+        for mode in ("naive", "stream"):
+            q = ctx.Queue()
+            p = ctx.Process(target=_bench_child, args=(mode, root, pages, font, q))
+            p.start()
+            r = q.get()
+            p.join()
+            print(f"{mode:6s} {pages:3d} стр.: пик RSS {r['peak_mb']:6.0f} МБ (+{r['peak_mb'] - r['base_mb']:4.0f} МБ "
+                  f"на сборку), {r['seconds']:5.1f} с, PDF {r['mb']:5.1f} МБ")
+
+    _bench_scale(root, args.scale_pages, args.workers)
+    _bench_incremental(root, args.edit_pages)
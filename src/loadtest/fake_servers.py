@@ -0,0 +1,251 @@
+# src/loadtest/fake_servers.py
+
+"""
+fake_servers.py — локальные заглушки внешних API для нагрузочного стенда:
+- Fake Telegram Bot API: принимает sendMessage / sendPhoto, записывает время получения.
+- Fake OpenAI: /v1/responses и /v1/chat/completions с настраиваемой задержкой и ошибками.
+Оба — обычные FastAPI-приложения, поднимаются uvicorn-ом в фоновом потоке.
+"""
+
+import asyncio
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from starlette.requests import ClientDisconnect
+
+
+# маркер апдейта в тексте: по нему сводим ответ бота с исходным апдейтом
+MARKER_RE = re.compile(r"lt-(\d+)")
+
+
+# ---------------------------------------------------------------------------------
+# TELEGRAM
+# ---------------------------------------------------------------------------------
+
+class TelegramRecorder:
+    """
+    Журнал всего, что "отправил" бот. Потокобезопасный.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls: List[Dict[str, Any]] = []
+        self.reply_at: Dict[int, float] = {}
+
+    def record(self, method: str, params: Dict[str, Any]) -> None:
+        now = time.perf_counter()
+        with self._lock:
+            self.calls.append({"method": method, "params": params, "t": now})
+            if method == "sendMessage":
+                m = MARKER_RE.search(str(params.get("text", "")))
+                if m:
+                    self.reply_at.setdefault(int(m.group(1)), now)
+
+    def count(self, method: Optional[str] = None) -> int:
+        with self._lock:
+            return sum(1 for c in self.calls if method is None or c["method"] == method)
+
+
+def make_fake_telegram_app(recorder: TelegramRecorder) -> FastAPI:
+    app = FastAPI(title="Fake Telegram Bot API")
+
+    @app.post("/{bot_token}/{method}")
+    async def bot_method(bot_token: str, method: str, request: Request):
+        ctype = request.headers.get("content-type", "")
+        if "json" in ctype:
+            params = await request.json()
+        elif "urlencoded" in ctype:
+            # без python-multipart: разбираем x-www-form-urlencoded сами
+            body = (await request.body()).decode("utf-8", "replace")
+            params = {k: v[-1] for k, v in parse_qs(body).items()}
+        else:
+            # multipart (sendPhoto с файлом) — содержимое стенду не нужно
+            params = dict(request.query_params)
+        recorder.record(method, params)
+        return {"ok": True, "result": {"message_id": len(recorder.calls), "chat": {"id": params.get("chat_id")}}}
+
+    @app.get("/{bot_token}/getMe")
+    async def get_me(bot_token: str):
+        return {"ok": True, "result": {"id": 1, "is_bot": True, "username": "booksoul_loadtest_bot"}}
+
+    return app
+
+
+# ---------------------------------------------------------------------------------
+# OPENAI
+# ---------------------------------------------------------------------------------
+
+class OpenAIBehaviour:
+    """
+    Профиль поведения фейкового OpenAI: задержка (мс), разброс, доля ошибок,
+    хвост (доля запросов tail_rate, которые ждут tail_ms — медленные реплики провайдера).
+    """
+
+    def __init__(self, latency_ms: float = 300.0, jitter_ms: float = 100.0,
+                 error_rate: float = 0.0, error_status: int = 500,
+                 tail_rate: float = 0.0, tail_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+        self.calls = 0
+        self.errors = 0
+        self.tails = 0
+
+    async def delay(self) -> None:
+        ms = max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) if self.jitter_ms else self.latency_ms
+        if self.tail_rate and random.random() < self.tail_rate:
+            self.tails += 1
+            ms += self.tail_ms
+        await asyncio.sleep(ms / 1000.0)
+
+    def should_fail(self) -> bool:
+        self.calls += 1
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+
+def _last_user_text(items: Any) -> str:
+    if isinstance(items, str):
+        return items
+    for item in reversed(items or []):
+        if item.get("role") == "user":
+            content = item.get("content")
+            return content if isinstance(content, str) else str(content)
+    return ""
+
+
+def _usage(prompt: str, answer: str) -> Dict[str, int]:
+    # грубо: ~4 символа на токен, этого достаточно для отчёта о стоимости
+    return {"prompt": max(1, len(prompt) // 4), "completion": max(1, len(answer) // 4)}
+
+
+def make_fake_openai_app(behaviour: OpenAIBehaviour) -> FastAPI:
+    app = FastAPI(title="Fake OpenAI")
+
+    def _error() -> JSONResponse:
+        return JSONResponse(
+            {"error": {"message": "injected failure", "type": "server_error", "code": None}},
+            status_code=behaviour.error_status,
+        )
+
+    async def _body(request: Request) -> Optional[Dict[str, Any]]:
+        # хедж-запросы отменяются клиентом на лету — это норма, а не ошибка заглушки
+        try:
+            return await request.json()
+        except ClientDisconnect:
+            return None
+
+    @app.post("/v1/responses")
+    async def responses(request: Request):
+        body = await _body(request)
+        if body is None:
+            return JSONResponse({}, status_code=499)
+        await behaviour.delay()
+        if behaviour.should_fail():
+            return _error()
+        user_text = _last_user_text(body.get("input"))
+        answer = f"Принято: {user_text}"
+        u = _usage(str(body.get("input")), answer)
+        return {
+            "id": f"resp_{behaviour.calls}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model", "fake"),
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": f"msg_{behaviour.calls}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": answer, "annotations": []}],
+            }],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": u["prompt"],
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": u["completion"],
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": u["prompt"] + u["completion"],
+            },
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await _body(request)
+        if body is None:
+            return JSONResponse({}, status_code=499)
+        await behaviour.delay()
+        if behaviour.should_fail():
+            return _error()
+        user_text = _last_user_text(body.get("messages"))
+        answer = f"Принято: {user_text}"
+        u = _usage(str(body.get("messages")), answer)
+        return {
+            "id": f"chatcmpl_{behaviour.calls}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": answer},
+            }],
+            "usage": {
+                "prompt_tokens": u["prompt"],
+                "completion_tokens": u["completion"],
+                "total_tokens": u["prompt"] + u["completion"],
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        }
+
+    return app
+
+
+# ---------------------------------------------------------------------------------
+# ЗАПУСК В ФОНОВОМ ПОТОКЕ
+# ---------------------------------------------------------------------------------
+
+class BackgroundServer:
+    """
+    uvicorn в отдельном потоке со своим event loop-ом.
+    Отдельный loop важен: стенд меряет блокировки event loop-а самого приложения,
+    заглушки не должны в них участвовать.
+    """
+
+    def __init__(self, app: FastAPI, host: str = "127.0.0.1", port: int = 0):
+        self.config = uvicorn.Config(app, host=host, port=port, log_level="warning", access_log=False)
+        self.server = uvicorn.Server(self.config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout: float = 10.0) -> "BackgroundServer":
+        self.thread.start()
+        deadline = time.time() + timeout
+        while not self.server.started:
+            if time.time() > deadline:
+                raise RuntimeError("fake server did not start")
+            time.sleep(0.01)
+        return self
+
+    @property
+    def url(self) -> str:
+        sock = self.server.servers[0].sockets[0]
+        host, port = sock.getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
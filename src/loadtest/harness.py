@@ -0,0 +1,335 @@
+# src/loadtest/harness.py
+
+"""
+harness.py — нагрузочный стенд BookSoul без продакшена.
+
+Гоняет FastAPI-приложения src/webhook/main.py и src/worker/main.py синтетическими
+Telegram-апдейтами с заданным RPS и числом чатов. Вокруг — локальные заглушки:
+Fake Telegram Bot API, Fake OpenAI (задержка + инъекция ошибок) и хранилище
+MemoryStorage / SQLiteStorage (или Firestore emulator, если выставлен FIRESTORE_EMULATOR_HOST).
+
+Отчёт: p50/p95/p99 ACK-латентности /telegram_webhook, end-to-end латентность ответа
+(от POST апдейта до sendMessage в Telegram), операций Firestore на апдейт, пропускная способность.
+
+Запуск:
+    python src/loadtest/harness.py --rps 20 --duration 10 --chats 50
+    python src/loadtest/harness.py --target worker --jobs 200
+    python src/loadtest/harness.py --store sqlite
+    python src/loadtest/harness.py --store emulator      # нужен FIRESTORE_EMULATOR_HOST
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+# --- путь к проекту, чтобы работали импорты ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/loadtest
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+PROJECT_ROOT = os.path.dirname(SRC_DIR)                        # .../
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import httpx
+
+from data_layer.storage import StorageBackend, get_storage
+from loadtest.fake_servers import (
+    BackgroundServer,
+    OpenAIBehaviour,
+    TelegramRecorder,
+    make_fake_openai_app,
+    make_fake_telegram_app,
+)
+
+
+LOADTEST_TOKEN = "000000:LOADTEST"
+
+
+# ---------------------------------------------------------------------------------
+# СТАТИСТИКА
+# ---------------------------------------------------------------------------------
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """
+    Перцентиль по nearest-rank. Пустой список -> None.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def latency_summary(values_s: List[float]) -> Dict[str, Any]:
+    ms = [v * 1000.0 for v in values_s]
+    return {
+        "count": len(ms),
+        "p50_ms": _round(percentile(ms, 50)),
+        "p95_ms": _round(percentile(ms, 95)),
+        "p99_ms": _round(percentile(ms, 99)),
+        "max_ms": _round(max(ms) if ms else None),
+    }
+
+
+def _round(v: Optional[float]) -> Optional[float]:
+    return round(v, 2) if v is not None else None
+
+
+# ---------------------------------------------------------------------------------
+# ОКРУЖЕНИЕ
+# ---------------------------------------------------------------------------------
+
+class Stand:
+    """
+    Поднимает заглушки и импортирует приложения уже "внутри" стенда.
+    Переменные окружения выставляются ДО импорта: webhook читает их на уровне модуля.
+    """
+
+    def __init__(self, store: str, openai: OpenAIBehaviour, send_banners: bool):
+        self.store = store
+        self.openai_behaviour = openai
+        self.send_banners = send_banners
+        self.recorder = TelegramRecorder()
+        self.storage: Optional[StorageBackend] = None
+        self.servers: List[BackgroundServer] = []
+
+    def start(self) -> "Stand":
+        tg = BackgroundServer(make_fake_telegram_app(self.recorder)).start()
+        oa = BackgroundServer(make_fake_openai_app(self.openai_behaviour)).start()
+        self.servers = [tg, oa]
+
+        os.environ.update({
+            "TELEGRAM_BOT_TOKEN": LOADTEST_TOKEN,
+            "TELEGRAM_API_BASE": tg.url,
+            "OPENAI_API_KEY": "sk-loadtest",
+            "OPENAI_BASE_URL": f"{oa.url}/v1",
+            "SEND_ACK_BANNER": "true" if self.send_banners else "false",
+        })
+
+        if self.store == "memory":
+            os.environ["BOOKSOUL_STORAGE"] = "memory"
+        elif self.store == "sqlite":
+            os.environ["BOOKSOUL_STORAGE"] = "sqlite"
+            os.environ["BOOKSOUL_SQLITE_PATH"] = os.path.join(
+                tempfile.mkdtemp(prefix="booksoul-loadtest-"), "loadtest.db")
+        elif not os.getenv("FIRESTORE_EMULATOR_HOST"):
+            raise SystemExit("--store emulator: выстави FIRESTORE_EMULATOR_HOST (gcloud emulators firestore start)")
+        else:
+            os.environ["BOOKSOUL_STORAGE"] = "firestore"
+            os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "booksoul-loadtest")
+
+        # тот же экземпляр, что получат приложения через get_storage()
+        self.storage = get_storage()
+        return self
+
+    def webhook_app(self):
+        return importlib.import_module("webhook.main").app
+
+    def worker_app(self):
+        return importlib.import_module("worker.main").app
+
+    def firestore_ops(self) -> Optional[Dict[str, int]]:
+        # операции считает только MemoryStorage (1:1 с тем, что стоило бы в Firestore)
+        ops = getattr(self.storage, "ops", None)
+        return dict(ops) if ops is not None else None
+
+    def stop(self) -> None:
+        for s in self.servers:
+            s.stop()
+
+
+# ---------------------------------------------------------------------------------
+# WEBHOOK: ACK + END-TO-END
+# ---------------------------------------------------------------------------------
+
+def make_update(update_id: int, chat_id: int) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load", "language_code": "ru"},
+            "text": f"сделай книгу для Арсен тема космос lt-{update_id}",
+        },
+    }
+
+
+async def run_webhook(stand: Stand, rps: float, duration: float, chats: int, drain_timeout: float) -> Dict[str, Any]:
+    app = stand.webhook_app()
+    total = max(1, int(rps * duration))
+    sent_at: Dict[int, float] = {}
+    ack_latency: List[float] = []
+    ack_errors = 0
+    ops_before = stand.firestore_ops()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://webhook") as client:
+
+        async def fire(update_id: int, chat_id: int):
+            nonlocal ack_errors
+            t0 = time.perf_counter()
+            sent_at[update_id] = t0
+            try:
+                r = await client.post("/telegram_webhook", json=make_update(update_id, chat_id))
+                if r.status_code != 200:
+                    ack_errors += 1
+            except Exception:
+                ack_errors += 1
+            ack_latency.append(time.perf_counter() - t0)
+
+        # open-loop: апдейты идут по расписанию, не дожидаясь ответов
+        t_start = time.perf_counter()
+        tasks = []
+        for i in range(total):
+            due = t_start + i / rps
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            update_id = 1_000_000 + i
+            tasks.append(asyncio.create_task(fire(update_id, 100_000 + i % chats)))
+        await asyncio.gather(*tasks)
+        t_acked = time.perf_counter()
+
+        # ждём, пока фоновые _process_update разошлют ответы
+        deadline = time.perf_counter() + drain_timeout
+        while len(stand.recorder.reply_at) < total and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        t_done = time.perf_counter()
+
+    e2e = [stand.recorder.reply_at[u] - t for u, t in sent_at.items() if u in stand.recorder.reply_at]
+    replies = len(e2e)
+    ops_after = stand.firestore_ops()
+
+    report: Dict[str, Any] = {
+        "target": "webhook",
+        "updates": total,
+        "rps_target": rps,
+        "chats": chats,
+        "ack": latency_summary(ack_latency),
+        "ack_errors": ack_errors,
+        "ack_throughput_rps": round(total / max(1e-9, t_acked - t_start), 2),
+        "e2e_reply": latency_summary(e2e),
+        "replies": replies,
+        "replies_missing": total - replies,
+        "reply_throughput_rps": round(replies / max(1e-9, t_done - t_start), 2),
+        "openai_calls": stand.openai_behaviour.calls,
+        "openai_injected_errors": stand.openai_behaviour.errors,
+        "openai_slow_tails": stand.openai_behaviour.tails,
+        "telegram_calls": stand.recorder.count(),
+    }
+    if ops_before is not None and ops_after is not None:
+        report["firestore_ops_per_update"] = {
+            k: round((ops_after[k] - ops_before[k]) / total, 2) for k in ops_after
+        }
+    return report
+
+
+# ---------------------------------------------------------------------------------
+# WORKER: /tick
+# ---------------------------------------------------------------------------------
+
+async def run_worker(stand: Stand, jobs: int, chats: int, max_ticks: int) -> Dict[str, Any]:
+    app = stand.worker_app()
+
+    for i in range(jobs):
+        stand.storage.set_doc("jobs_inbox", f"lt-{i}", {
+            "status": "pending",
+            "chat_id": 100_000 + i % chats,
+            "user_text": f"job lt-{i}",
+        })
+
+    ops_before = stand.firestore_ops()
+    tick_latency: List[float] = []
+    processed = 0
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://worker") as client:
+        t_start = time.perf_counter()
+        for _ in range(max_ticks):
+            t0 = time.perf_counter()
+            r = await client.get("/tick")
+            tick_latency.append(time.perf_counter() - t0)
+            done = (r.json() or {}).get("processed_jobs", 0)
+            processed += done
+            if not done:
+                break
+        elapsed = time.perf_counter() - t_start
+
+    ops_after = stand.firestore_ops()
+    report: Dict[str, Any] = {
+        "target": "worker",
+        "jobs": jobs,
+        "processed": processed,
+        "ticks": len(tick_latency),
+        "tick": latency_summary(tick_latency),
+        "jobs_per_sec": round(processed / max(1e-9, elapsed), 2),
+        "telegram_calls": stand.recorder.count(),
+    }
+    if ops_before is not None and ops_after is not None:
+        report["firestore_ops_per_job"] = {
+            k: round((ops_after[k] - ops_before[k]) / max(1, processed), 2) for k in ops_after
+        }
+    return report
+
+
+# ---------------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------------
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="BookSoul local load-test harness")
+    p.add_argument("--target", choices=["webhook", "worker"], default="webhook")
+    p.add_argument("--store", choices=["memory", "sqlite", "emulator"], default="memory")
+    p.add_argument("--rps", type=float, default=10.0)
+    p.add_argument("--duration", type=float, default=5.0, help="секунд генерации апдейтов")
+    p.add_argument("--chats", type=int, default=20, help="кардинальность chat_id")
+    p.add_argument("--jobs", type=int, default=100, help="заявок jobs_inbox для --target worker")
+    p.add_argument("--max-ticks", type=int, default=1000)
+    p.add_argument("--drain-timeout", type=float, default=30.0)
+    p.add_argument("--openai-latency-ms", type=float, default=300.0)
+    p.add_argument("--openai-jitter-ms", type=float, default=100.0)
+    p.add_argument("--openai-error-rate", type=float, default=0.0)
+    p.add_argument("--openai-tail-rate", type=float, default=0.0, help="доля медленных ответов")
+    p.add_argument("--openai-tail-ms", type=float, default=3000.0, help="добавка к задержке медленного ответа")
+    p.add_argument("--banners", action="store_true", help="включить приветственные баннеры")
+    p.add_argument("--json", action="store_true", help="вывести отчёт JSON-ом")
+    return p.parse_args(argv)
+
+
+def main(argv=None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    behaviour = OpenAIBehaviour(
+        latency_ms=args.openai_latency_ms,
+        jitter_ms=args.openai_jitter_ms,
+        error_rate=args.openai_error_rate,
+        tail_rate=args.openai_tail_rate,
+        tail_ms=args.openai_tail_ms,
+    )
+    stand = Stand(args.store, behaviour, send_banners=args.banners).start()
+    try:
+        if args.target == "webhook":
+            report = asyncio.run(run_webhook(stand, args.rps, args.duration, args.chats, args.drain_timeout))
+        else:
+            report = asyncio.run(run_worker(stand, args.jobs, args.chats, args.max_ticks))
+    finally:
+        stand.stop()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print("=== BookSoul load test ===")
+        for key, value in report.items():
+            print(f"{key:>26}: {value}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -12,60 +12,20 @@ if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
 from config import settings
-from openai import OpenAI
+from openai import OpenAI, BadRequestError, UnprocessableEntityError
 from router.tools_router import ToolRouter
-
-
-ROUTER_SYSTEM_PROMPT = """
-Ты — BookSoul Router, директор и художественный редактор фабрики персональных детских книг BookSoul.
-
-Твоя миссия:
-1. Понимать просьбу автора (Фудо) и переводить её в понятные, вменяемые задачи для цехов.
-2. Контролировать качество на каждом этапе: текст → иллюстрация → стиль → обложка → вёрстка → PDF.
-3. Никогда не гнать брак вперёд без утверждения.
-
-Цеха:
-- StoryWriter: пишет историю ребёнка и разбивает на сцены (каждая сцена — завершённый момент с эмоцией).
-- SceneBuilder: делает визуал по сценам через Nano Banana (Gemini). Отдельно герой (ребёнок), отдельно фон.
-- Style Engine: следит за единым стилем (цвета, освещение, возраст героя, настроение).
-- Cover Builder: делает обложку (титульную страницу). Лицо ребёнка должно быть тем же самым лицом.
-- Layout Engine: вёрстка финальной книги в PDF (A5, 300 DPI). Крупный дружелюбный шрифт, текст не налезает на арт.
-
-Правила Nano Banana (важно):
-- В начале и в конце промта для генерации героя обязательно фраза:
-  "Keep the same face as in the uploaded photo. Do not distort or change the face."
-- Затем блок Face description: сухое визуальное описание лица (форма лица, кожа, волосы, глаза/нос/губы, выражение).
-  Без эмо-поэзии, строго визуально.
-- Потом блок Scene: кто он, где он, какой свет, какая атмосфера, какая одежда, что он делает.
-- В конце снова фраза про сохранение лица.
-- Температура генерации 0.1–0.2, чтобы избежать искажений.
-- Если герой должен выглядеть как игрушка/фигурка, добавляй:
-  "clearly toy-like, made of painted resin or plastic, not alive."
-
-Правила текста:
-- Текст должен звучать человечно и тепло, как родитель рассказывает ребёнку, а не как сухой ИИ.
-- Каждая сцена читабельна вслух.
-- После напряжения всегда даём мягкость и безопасность.
-- Финал истории оставляет ощущение уюта и надежды, а не просто "конец."
-
-Правила дизайна:
-- На обложке герой смотрит "вперёд", свет тёплый, чувство мечты и надежды.
-- Цветовая психология: тёплые тона = безопасность, закат = мечта.
-- Вёрстка: поля не слишком узкие, текст не прилипает к краю, не закрывает лицо героя.
-- Шрифт крупный, дружелюбный (например Nunito / Comic Neue / шрифт без острых углов).
-- Белое пространство — не ошибка, а дыхание страницы.
-
-Процесс управления:
-- Если Фудо даёт правку ("сделай фон светлее", "ребёнок должен быть по центру", "обложка темновата"),
-  ты фиксируешь это как задачу, и книга не двигается дальше, пока он не скажет "утверждаю".
-- Твоя задача — понимать неформальные правки и переводить их в чёткие технические инструкции для соответствующего цеха.
-- Перед тем как отправить дальше, ты всегда уточняешь у Фудо, всё ли ок.
-
-Как говорить:
-- Коротко, по делу, но по-человечески.
-- Ты не извиняешься лишний раз. Ты производственный директор, у тебя спокойствие и уверенность.
-- Ты объясняешь, что ты делаешь, так, чтобы Фудо чувствовал контроль.
-"""
+from router.tool_schemas import openai_tools, check_tool_call, ToolArgumentsError
+from router.intent_fastpath import FastIntentRouter, FAST_INTENTS
+from router.prompts import (
+    PLANNER_SYSTEM_PROMPT,
+    PLANNER_JSON_PROMPT,
+    PLANNER_JSON_USER_TEMPLATE,
+    build_messages,
+    prompt_cache_key,
+)
+from router.token_accounting import TokenLedger, usage_from_response
+from router.conversation_memory import ConversationMemory, make_summarizer
+from utils.metrics import llm_call, record_fallback, record_json_failure
 
 
 class OpenAIRouterAgent:
@@ -75,60 +35,88 @@ class OpenAIRouterAgent:
     и, через вспомогательные методы, может отдавать короткие формальные инструкции.
     """
 
-    def __init__(self):
+    def __init__(self, ledger: TokenLedger = None, memory: ConversationMemory = None):
         self.client = OpenAI(api_key=settings.openai_api_key)
         self.model_name = settings.openai_model_name  # например "gpt-5" или "gpt-5-pro"
-
-    def _call_responses_api(self, messages, temperature: float = 0.3) -> str:
+        # usage последнего вызова: prompt / cached / completion токены
+        self.last_usage = {}
+        # куда писать usage (Orchestrator подставляет свой, если не задан)
+        self.ledger = ledger
+        # память диалога по chat_id (без неё ask_router отвечает на одно сообщение)
+        self.memory = memory
+
+    def _call_responses_api(self, messages, temperature: float = 0.3, cache_key: str = None,
+                            kind: str = "router") -> str:
         """
         Внутренний низкоуровневый вызов Responses API.
         messages — это список {role, content}.
         Возвращает слитый текст.
         Поддерживает и новые SDK (inference_config), и старые.
+        cache_key уходит как prompt_cache_key через extra_body (работает и на старых SDK).
+        kind — метка вызова в /metrics (router / plan_json / ...).
         """
-        try:
-            response = self.client.responses.create(
-                model=self.model_name,
-                input=messages,
-                inference_config={
-                    "temperature": temperature
-                }
-            )
-        except TypeError:
-            # версия SDK без inference_config
-            response = self.client.responses.create(
-                model=self.model_name,
-                input=messages
-            )
-
-        # собираем текст
-        chunks = []
-        if hasattr(response, "output"):
-            for item in response.output:
-                if getattr(item, "type", None) == "message":
-                    for c in getattr(item, "content", []):
-                        txt = getattr(c, "text", None)
-                        if txt:
-                            chunks.append(txt)
-
-        if not chunks and hasattr(response, "output_text"):
-            chunks.append(response.output_text)
-
-        return "\n".join(chunks).strip()
+        extra = {"extra_body": {"prompt_cache_key": cache_key}} if cache_key else {}
+        with llm_call(kind, self.model_name, "responses") as call:
+            try:
+                response = self.client.responses.create(
+                    model=self.model_name,
+                    input=messages,
+                    inference_config={
+                        "temperature": temperature
+                    },
+                    **extra
+                )
+            except TypeError:
+                # версия SDK без inference_config
+                record_fallback(kind, "sdk_without_inference_config")
+                response = self.client.responses.create(
+                    model=self.model_name,
+                    input=messages,
+                    **extra
+                )
 
-    def ask_router(self, user_text: str) -> str:
+            # собираем текст
+            chunks = []
+            if hasattr(response, "output"):
+                for item in response.output:
+                    if getattr(item, "type", None) == "message":
+                        for c in getattr(item, "content", []):
+                            txt = getattr(c, "text", None)
+                            if txt:
+                                chunks.append(txt)
+
+            if not chunks and hasattr(response, "output_text"):
+                chunks.append(response.output_text)
+
+            text = "\n".join(chunks).strip()
+            self.last_usage = call.usage = usage_from_response(response, messages, completion_text=text)
+        return text
+
+    def _record(self, kind: str, chat_id=None, book_id: str = None) -> None:
+        """usage последнего вызова -> TokenLedger (если подключён)."""
+        if self.ledger is not None:
+            self.ledger.record(self.model_name, self.last_usage, kind=kind, chat_id=chat_id, book_id=book_id)
+
+    def ask_router(self, user_text: str, chat_id=None, book_id: str = None) -> str:
         """
         Свободный режим. Ты спрашиваешь как человек,
         он отвечает как директор фабрики (редактор).
         Это хорошо для обсуждения стиля, качества, правок.
+        Статический ROUTER_SYSTEM_PROMPT идёт первым — префикс кэшируется провайдером.
+        С chat_id и памятью: сводка старых реплик + окно последних под бюджет токенов.
         """
-        messages = [
-            {"role": "system", "content": ROUTER_SYSTEM_PROMPT},
-            {"role": "user", "content": user_text},
-        ]
-        return self._call_responses_api(messages, temperature=0.3)
+        context, history = None, None
+        if chat_id is not None and self.memory is not None:
+            ctx = self.memory.build(chat_id, summarizer=make_summarizer(self.client, self.ledger))
+            context, history = self.memory.summary_text(ctx), ctx["history"]
+        messages = build_messages("router", user_text, context=context, history=history)
+        answer = self._call_responses_api(messages, temperature=0.3, cache_key=prompt_cache_key("router"),
+                                          kind="ask_router")
+        self._record("ask_router", chat_id, book_id)
+        return answer
 
-    def _raw_responses_call(self, system_prompt: str, user_text: str) -> str:
+    def _raw_responses_call(self, system_prompt: str, user_text: str, cache_key: str = None,
+                            kind: str = "raw") -> str:
         """
         Специальный режим: просим GPT-5 выдать СТРОГО СТРУКТУРИРОВАННЫЙ ответ,
         например JSON команды для фабрики.
@@ -139,7 +127,38 @@ class OpenAIRouterAgent:
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_text},
         ]
-        return self._call_responses_api(messages, temperature=0.2)
+        return self._call_responses_api(messages, temperature=0.2, cache_key=cache_key, kind=kind)
+
+    def _tool_call(self, system_prompt: str, user_text: str, tools: list, cache_key: str = None) -> tuple:
+        """
+        Function calling через Responses API: модель обязана вызвать один инструмент,
+        аргументы (strict) гарантированно соответствуют JSON-схеме.
+        Возвращает (имя инструмента, строка аргументов) или (None, текст), если вызова нет.
+        """
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_text},
+        ]
+        extra = {"extra_body": {"prompt_cache_key": cache_key}} if cache_key else {}
+        with llm_call("plan", self.model_name, "responses") as call:
+            response = self.client.responses.create(
+                model=self.model_name,
+                input=messages,
+                tools=tools,
+                tool_choice="required",
+                parallel_tool_calls=False,
+                **extra
+            )
+
+            for item in getattr(response, "output", []) or []:
+                if getattr(item, "type", None) == "function_call":
+                    self.last_usage = call.usage = usage_from_response(response, messages, tools, item.arguments)
+                    call.extra = {"tool": item.name}
+                    return item.name, item.arguments
+            text = getattr(response, "output_text", "") or ""
+            self.last_usage = call.usage = usage_from_response(response, messages, tools, text)
+            call.extra = {"tool": None}
+        return None, text
 
 
 class Orchestrator:
@@ -147,18 +166,61 @@ class Orchestrator:
     Orchestrator = мост между человеком (тобой), GPT-5 и фабрикой BookSoul.
     Логика:
     1. Ты говоришь обычной человеческой фразой.
-    2. GPT-5 превращает это в JSON-команду для завода.
+    2. Однозначные команды разбирает локальный быстрый путь (FastIntentRouter),
+       остальное GPT-5 превращает в JSON-команду для завода.
     3. Мы исполняем эту команду через ToolRouter (он дёргает BookSoulRouter и Firestore).
     4. Мы формируем понятный ответ для тебя.
     """
 
-    def __init__(self, agent: OpenAIRouterAgent):
+    def __init__(self, agent: OpenAIRouterAgent, fastpath: FastIntentRouter = None):
         self.agent = agent
         self.tools = ToolRouter()
+        self.fastpath = fastpath or FAST_INTENTS
+        self.ledger = TokenLedger(self.tools.router.fs)
+        if self.agent.ledger is None:
+            self.agent.ledger = self.ledger
+        if self.agent.memory is None:
+            self.agent.memory = ConversationMemory(self.tools.router.fs)
 
     def plan_action(self, user_text: str) -> dict:
         """
-        Просим GPT-5 сделать план в виде JSON.
+        Просим GPT-5 выбрать инструмент (function calling со строгими схемами из tool_schemas).
+        Один вызов модели на действие, без разбора свободного текста.
+        Возвращает план того же формата, что и plan_action_json.
+        """
+        tools = openai_tools()
+        try:
+            tool, raw_args = self.agent._tool_call(
+                PLANNER_SYSTEM_PROMPT, user_text, tools, cache_key=prompt_cache_key("planner", tools)
+            )
+        except (BadRequestError, UnprocessableEntityError) as e:
+            # модель без function calling или отказ в схеме — старый JSON-планировщик.
+            # Сеть, таймауты и квоты не ловим: повторный вызов их не вылечит, а счёт удвоит.
+            print(f"[Orchestrator] tool calling недоступен ({e!r}), fallback на JSON-план")
+            record_fallback("plan", "json_planner")
+            return self.plan_action_json(user_text)
+
+        usage = dict(self.agent.last_usage)
+        if tool is None:
+            return {"action": "unknown", "question": raw_args, "_usage": usage}
+
+        try:
+            args = check_tool_call(tool, json.loads(raw_args or "{}"))
+        except (json.JSONDecodeError, ToolArgumentsError) as e:
+            if isinstance(e, json.JSONDecodeError):
+                record_json_failure("plan")
+            return {"action": "unknown", "question": "", "raw": raw_args, "error": str(e), "_usage": usage}
+
+        if tool == "ask_clarification":
+            return {"action": "unknown", "question": args["question"], "_usage": usage}
+
+        plan = {"action": tool, **args}
+        plan["_usage"] = usage
+        return plan
+
+    def plan_action_json(self, user_text: str) -> dict:
+        """
+        Старый планировщик: просим GPT-5 сделать план в виде JSON текстом.
         Форматы команд:
         - {"action": "create_book", "author": "Арсен", "theme": "маленький пилот и волшебный самолёт"}
         - {"action": "add_feedback", "book_id": "BKS-2025...", "note": "обложку сделать светлее"}
@@ -166,56 +228,25 @@ class Orchestrator:
         Если он не уверен: {"action": "unknown", "question": "..."}
         """
 
-        system_msg = (
-            "Ты — планировщик действий для производственной линии BookSoul.\n"
-            "Твоя задача — понять запрос человека и вернуть ТОЛЬКО JSON-команду для выполнения.\n"
-            "НЕ давать пояснений, НЕ болтать, НЕТ текста вне JSON.\n"
-            "\n"
-            "Типы команд:\n"
-            "1) create_book:\n"
-            "   - Создать новую детскую книгу.\n"
-            "   - Поля в ответе:\n"
-            "     {\n"
-            "       \"action\": \"create_book\",\n"
-            "       \"author\": \"имя ребёнка\",\n"
-            "       \"theme\": \"тема сказки\"\n"
-            "     }\n"
-            "   - Правило интерпретации: если пользователь говорит 'создай книгу для Арсена',\n"
-            "     считай, что author = 'Арсен' (это имя ребёнка / главный герой).\n"
-            "   - НЕ задавай уточняющих вопросов, просто поставь это имя как author.\n"
-            "\n"
-            "2) add_feedback:\n"
-            "   {\n"
-            "     \"action\": \"add_feedback\",\n"
-            "     \"book_id\": \"...\",\n"
-            "     \"note\": \"текст правки\"\n"
-            "   }\n"
-            "\n"
-            "3) get_status:\n"
-            "   {\n"
-            "     \"action\": \"get_status\",\n"
-            "     \"book_id\": \"...\"\n"
-            "   }\n"
-            "\n"
-            "Если невозможно определить намерение, верни:\n"
-            "{ \"action\": \"unknown\", \"question\": \"что уточнить\" }\n"
-        )
+        planning_prompt = PLANNER_JSON_USER_TEMPLATE.format(user_text=user_text)
 
-        planning_prompt = (
-            f"Запрос пользователя:\n'''{user_text}'''\n\n"
-            "Верни только один JSON-объект с полями команды, без пояснений."
+        raw_plan = self.agent._raw_responses_call(
+            PLANNER_JSON_PROMPT, planning_prompt, cache_key=prompt_cache_key("planner_json"), kind="plan_json"
         )
 
-        raw_plan = self.agent._raw_responses_call(system_msg, planning_prompt)
-
         try:
             plan = json.loads(raw_plan)
         except json.JSONDecodeError:
+            plan = None
+        if not isinstance(plan, dict):
+            # не JSON или JSON, но не объект (список, строка, число) — плана нет
+            record_json_failure("plan_json")
             plan = {
                 "action": "unknown",
                 "raw": raw_plan,
             }
 
+        plan["_usage"] = dict(self.agent.last_usage)
         return plan
 
     def execute_plan(self, plan: dict) -> dict:
@@ -276,27 +307,42 @@ class Orchestrator:
             "или книга не найдена."
         )
 
-    def run(self, user_text: str) -> str:
+    def run(self, user_text: str, chat_id=None) -> str:
         """
         Полный цикл:
-        1. GPT-5 планирует действие (возвратит JSON команды).
+        1. Быстрый путь или GPT-5 планирует действие (возвратит JSON команды).
         2. Мы исполняем его через фабрику.
         3. Я возвращаю тебе нормальный человеческий ответ.
+        Токены планирования пишутся на чат и на книгу (для create_book — на новую).
         """
-        plan = self.plan_action(user_text)
+        plan = self.fastpath.match(user_text)
+        self._track_intent("fastpath" if plan is not None else "llm")
+        if plan is None:
+            plan = self.plan_action(user_text)
         result = self.execute_plan(plan)
+        if plan.get("_usage"):
+            book_id = plan.get("book_id") or (result.get("result") or {}).get("book_id")
+            self.ledger.record(self.agent.model_name, plan["_usage"], kind="plan", chat_id=chat_id, book_id=book_id)
         answer = self.pretty_answer_for_user(plan, result)
         return answer
 
+    def _track_intent(self, source: str) -> None:
+        """Доля команд без GPT в роллапах фабрики; ошибки метрик не ломают ответ."""
+        try:
+            self.tools.router.fs.metrics.incr_many({f"intents.{source}": 1})
+        except Exception as e:
+            print(f"[Orchestrator] metrics error: {e!r}")
+
 
-def handle_user_message(user_text: str) -> str:
+def handle_user_message(user_text: str, chat_id=None) -> str:
     """
     Публичная обёртка для внешних интерфейсов (Telegram webhook и т.д.).
     Принимает текст пользователя и возвращает готовый человеческий ответ.
+    chat_id — для учёта токенов по чату.
     """
     agent = OpenAIRouterAgent()
     orch = Orchestrator(agent)
-    return orch.run(user_text)
+    return orch.run(user_text, chat_id=chat_id)
 
 
 if __name__ == "__main__":
@@ -320,4 +366,31 @@ if __name__ == "__main__":
 
     print("=== Режим Б / производство ===")
     print(result_for_user)
-    print("=== /конец Б ===")
+    print("=== /конец Б ===\n")
+
+    # режим В: токены планирования — JSON-промт против function calling
+    bench_cmds = [
+        "сделай книгу для Алисы, тема: космос и добрый робот",
+        "что там с BKS-20251028-111405?",
+        "к BKS-20251028-111405: лицо на обложке светлее, фон теплее",
+        "хочу книжку, но пока не знаю про что",
+    ]
+    totals = {"json": {"prompt_tokens": 0, "completion_tokens": 0, "unknown": 0},
+              "tools": {"prompt_tokens": 0, "completion_tokens": 0, "unknown": 0}}
+    for cmd in bench_cmds:
+        for mode, planner in (("json", orch.plan_action_json), ("tools", orch.plan_action)):
+            plan = planner(cmd)
+            usage = plan.get("_usage", {})
+            totals[mode]["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            totals[mode]["completion_tokens"] += usage.get("completion_tokens", 0)
+            totals[mode]["unknown"] += plan.get("action") == "unknown"
+            print(f"[{mode:>5}] {cmd} -> {plan.get('action')} {usage}")
+
+    print("=== Режим В / токены планирования ===")
+    for mode, t in totals.items():
+        print(f"{mode:>5}: prompt={t['prompt_tokens']} completion={t['completion_tokens']} unknown={t['unknown']}/{len(bench_cmds)}")
+    print("=== /конец В ===")
+
+    # режим Г: доля кэша и стоимость по итогам прогона
+    print("\n=== Режим Г / токены и кэш за час ===")
+    print(json.dumps(orch.ledger.report(hours=1), ensure_ascii=False, indent=2))
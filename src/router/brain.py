@@ -21,6 +21,24 @@ if PROJECT_ROOT not in sys.path:
 from router.main_router import BookSoulRouter
 
 
+# -------------------------------------------------
+# ШАБЛОНЫ КОМАНД
+# Компилируются один раз при импорте. Группы именованные и уникальные между шаблонами,
+# чтобы intent_fastpath мог склеить их в одно регулярное выражение.
+# -------------------------------------------------
+
+# 'сделай книгу для Алисы тема космос'
+CREATE_PATTERN = r"(?:сделай|созда(?:й|ть))\s+книгу\s+для\s+(?P<child_name>[А-Яа-яA-Za-z0-9_\-]+)\s+тема\s+(?P<theme>.+)"
+# 'статус книги BKS-20251028-123045'
+STATUS_PATTERN = r"(?:статус|status).*(?P<status_book_id>BKS-[0-9\-]+)"
+# 'заметка к книге BKS-... сделай обложку ярче'
+FEEDBACK_PATTERN = r"(?:заметка|правка).*(?P<feedback_book_id>BKS-[0-9\-]+)\s+(?P<comment_text>.+)"
+
+CREATE_RE = re.compile(CREATE_PATTERN, re.IGNORECASE)
+STATUS_RE = re.compile(STATUS_PATTERN, re.IGNORECASE)
+FEEDBACK_RE = re.compile(FEEDBACK_PATTERN, re.IGNORECASE)
+
+
 class RouterBrain:
     """
     RouterBrain — это слой "понимания намерений".
@@ -81,16 +99,12 @@ class RouterBrain:
         'сделай книгу для Алисы тема космос'
         'создай книгу для Арсен тема динозавры'
         """
-        m = re.search(
-            r"(сделай|созда(й|ть))\s+книгу\s+для\s+([А-Яа-яA-Za-z0-9_\-]+)\s+тема\s+(.+)",
-            text.strip(),
-            re.IGNORECASE
-        )
+        m = CREATE_RE.search(text.strip())
         if not m:
             return None
 
-        child_name = m.group(3).strip()
-        theme = m.group(4).strip()
+        child_name = m.group("child_name").strip()
+        theme = m.group("theme").strip()
 
         return {
             "child_name": child_name,
@@ -104,15 +118,11 @@ class RouterBrain:
         'статус книги BKS-20251028-123045'
         'какой статус у BKS-20251028-123045'
         """
-        m = re.search(
-            r"(статус|status).*(BKS-[0-9\-]+)",
-            text.strip(),
-            re.IGNORECASE
-        )
+        m = STATUS_RE.search(text.strip())
         if not m:
             return None
 
-        book_id = m.group(2).strip()
+        book_id = m.group("status_book_id").strip()
         return {"book_id": book_id}
 
     def _try_parse_feedback_request(self, text: str) -> Optional[Dict[str, str]]:
@@ -121,16 +131,12 @@ class RouterBrain:
         'заметка к книге BKS-... сделай обложку ярче'
         'правка к книге BKS-... сцена 2 не нравится лицо'
         """
-        m = re.search(
-            r"(заметка|правка).*(BKS-[0-9\-]+)\s+(.+)",
-            text.strip(),
-            re.IGNORECASE
-        )
+        m = FEEDBACK_RE.search(text.strip())
         if not m:
             return None
 
-        book_id = m.group(2).strip()
-        comment_text = m.group(3).strip()
+        book_id = m.group("feedback_book_id").strip()
+        comment_text = m.group("comment_text").strip()
 
         return {
             "book_id": book_id,
@@ -0,0 +1,310 @@
+# src/router/conversation_memory.py
+
+"""
+conversation_memory.py — память диалога чата под фиксированный бюджет токенов.
+
+Источник — журнал events (incoming_message = реплика пользователя, router_sent = ответ).
+В запрос к модели уходит:
+    [статический system] + [сводка старых реплик] + [последние реплики окном] + [новое сообщение]
+
+- окно набирается с конца, пока влезает в бюджет (MEMORY_BUDGET_TOKENS минус потолок сводки);
+- при переполнении окно ужимается до MEMORY_LOW_WATER, выпавшие реплики один раз
+  сворачиваются в сводку (инкрементально, пачкой) —
+  сводка и водяной знак лежат в chats/{chat_id}, повторно ничего не пересказывается;
+- читается не больше MEMORY_FETCH_EVENTS событий новее водяного знака,
+  поэтому цена сборки не растёт с длиной переписки.
+
+Сводка по умолчанию локальная (выжимка без LLM). MEMORY_SUMMARIZER=llm — дешёвая модель
+(MEMORY_SUMMARY_MODEL), при ошибке — снова локальная выжимка.
+
+Бенчмарк (размер промта при росте диалога до сотен реплик):
+    python src/router/conversation_memory.py --turns 500
+"""
+
+from typing import Optional, Dict, Any, List, Callable
+import argparse
+import os
+import sys
+import time
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/router
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend
+from router.token_accounting import count_tokens, count_messages, usage_from_response, MESSAGE_OVERHEAD
+from utils.metrics import llm_call, record_fallback
+
+
+MEMORY_BUDGET_TOKENS = int(os.getenv("MEMORY_BUDGET_TOKENS", "1500"))   # сводка + окно
+SUMMARY_BUDGET_TOKENS = int(os.getenv("SUMMARY_BUDGET_TOKENS", "400"))  # потолок сводки
+MEMORY_FETCH_EVENTS = int(os.getenv("MEMORY_FETCH_EVENTS", "80"))
+# переполнение окна сворачивается пачкой до этой доли окна: сводка пишется раз в несколько сообщений
+MEMORY_LOW_WATER = float(os.getenv("MEMORY_LOW_WATER", "0.7"))
+MEMORY_SUMMARIZER = os.getenv("MEMORY_SUMMARIZER", "local").lower()     # local | llm
+MEMORY_SUMMARY_MODEL = os.getenv("MEMORY_SUMMARY_MODEL", "gpt-4o-mini")
+
+# тип события -> (роль в запросе, поле с текстом)
+TURN_EVENTS = {
+    "incoming_message": ("user", "text"),
+    "router_sent": ("assistant", "answer"),
+}
+
+ROLE_LABELS = {"user": "Пользователь", "assistant": "Технолог"}
+
+SUMMARY_HEADER = "Краткая память предыдущего разговора (старые реплики, сжато):"
+
+# статический промт суммаризатора — константа, чтобы префикс кэшировался
+SUMMARIZER_PROMPT = (
+    "Ты ведёшь краткую память диалога фабрики детских книг BookSoul.\n"
+    "Дано: прежняя сводка и новые реплики. Верни обновлённую сводку на русском,\n"
+    "до 8 коротких пунктов: имена детей, темы, ID книг (BKS-...), принятые решения, открытые вопросы.\n"
+    "Без вступлений, без повторов, только факты."
+)
+
+# сколько символов реплики попадает в локальную выжимку
+_EXTRACT_CHARS = {"user": 200, "assistant": 140}
+
+
+# ---------------------------------------------------------------------------------
+# СУММАРИЗАТОРЫ
+# ---------------------------------------------------------------------------------
+
+def _fit_lines(lines: List[str], budget: int) -> str:
+    """Старые строки выпадают первыми, пока текст не влезет в бюджет."""
+    while lines and count_tokens("\n".join(lines)) > budget:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def extractive_summarizer(previous: str, turns: List[Dict[str, Any]], chat_id: Any = None) -> str:
+    """
+    Локальная выжимка без LLM: по строке на реплику, обрезка длинных, старое вытесняется.
+    """
+    lines = [l for l in (previous or "").split("\n") if l.strip()]
+    for t in turns:
+        text = " ".join(t["content"].split())
+        limit = _EXTRACT_CHARS.get(t["role"], 140)
+        if len(text) > limit:
+            text = text[:limit].rstrip() + "…"
+        lines.append(f"— {ROLE_LABELS.get(t['role'], t['role'])}: {text}")
+    return _fit_lines(lines, SUMMARY_BUDGET_TOKENS)
+
+
+class LLMSummarizer:
+    """
+    Сводка дешёвой моделью. Вызывается только когда реплики выпадают из окна
+    (раз в несколько сообщений), а не на каждый ответ.
+    """
+
+    def __init__(self, client, model: str = MEMORY_SUMMARY_MODEL, ledger=None):
+        self.client = client
+        self.model = model
+        self.ledger = ledger
+
+    def __call__(self, previous: str, turns: List[Dict[str, Any]], chat_id: Any = None) -> str:
+        body = "Прежняя сводка:\n" + (previous or "—") + "\n\nНовые реплики:\n" + "\n".join(
+            f"{ROLE_LABELS.get(t['role'], t['role'])}: {t['content']}" for t in turns
+        )
+        messages = [
+            {"role": "system", "content": SUMMARIZER_PROMPT},
+            {"role": "user", "content": body},
+        ]
+        try:
+            with llm_call("memory_summary", self.model, "responses") as call:
+                resp = self.client.responses.create(
+                    model=self.model,
+                    input=messages,
+                    max_output_tokens=SUMMARY_BUDGET_TOKENS,
+                )
+                text = (getattr(resp, "output_text", "") or "").strip()
+                call.usage = usage_from_response(resp, messages, completion_text=text)
+            if self.ledger is not None:
+                self.ledger.record(self.model, call.usage, kind="memory_summary", chat_id=chat_id)
+            if text:
+                return _fit_lines(text.split("\n"), SUMMARY_BUDGET_TOKENS)
+        except Exception as e:
+            print(f"[ConversationMemory] LLM summary error: {e!r}")
+        record_fallback("memory_summary", "extractive")
+        return extractive_summarizer(previous, turns)
+
+
+def make_summarizer(client=None, ledger=None) -> Callable[..., str]:
+    if MEMORY_SUMMARIZER == "llm" and client is not None:
+        return LLMSummarizer(client, ledger=ledger)
+    return extractive_summarizer
+
+
+# ---------------------------------------------------------------------------------
+# ПАМЯТЬ
+# ---------------------------------------------------------------------------------
+
+class ConversationMemory:
+    """
+    ConversationMemory — собирает контекст чата под бюджет и двигает сводку.
+    """
+
+    def __init__(self,
+                 storage: StorageBackend,
+                 budget_tokens: int = MEMORY_BUDGET_TOKENS,
+                 fetch_events: int = MEMORY_FETCH_EVENTS,
+                 summarizer: Optional[Callable[..., str]] = None):
+        self.storage = storage
+        self.budget_tokens = budget_tokens
+        self.fetch_events = fetch_events
+        self.summarizer = summarizer or extractive_summarizer
+
+    def _turns_after_mark(self, chat_id: Any, chat: Dict[str, Any], exclude_update_id: Any) -> List[Dict[str, Any]]:
+        """
+        Реплики новее водяного знака, от старых к новым.
+        """
+        mark = chat.get("memory_mark_at")
+        mark_ids = set(chat.get("memory_mark_ids") or [])
+        events = self.storage.list_events(
+            chat_id,
+            limit=self.fetch_events,
+            event_types=list(TURN_EVENTS),
+            since=mark,
+        )
+
+        turns = []
+        for e in reversed(events):
+            if mark is not None and e.get("created_at") == mark and e["id"] in mark_ids:
+                continue
+            if exclude_update_id is not None and e.get("update_id") == exclude_update_id:
+                continue
+            role, field = TURN_EVENTS[e["type"]]
+            text = (e.get(field) or "").strip()
+            if not text:
+                continue
+            turns.append({
+                "id": e["id"],
+                "role": role,
+                "content": text,
+                "created_at": e.get("created_at"),
+                "tokens": count_tokens(text) + MESSAGE_OVERHEAD,
+            })
+        return turns
+
+    def build(
+        self,
+        chat_id: Any,
+        exclude_update_id: Any = None,
+        summarizer: Optional[Callable[..., str]] = None,
+    ) -> Dict[str, Any]:
+        """
+        {"summary": str, "history": [{"role", "content"}], "stats": {...}}
+        exclude_update_id — текущее сообщение (оно уже в events, но придёт отдельным user-сообщением).
+        summarizer — на один вызов (например, LLMSummarizer с клиентом запроса).
+        """
+        t0 = time.perf_counter()
+        chat = self.storage.get_chat(chat_id) or {}
+        summary = chat.get("memory_summary", "")
+        turns = self._turns_after_mark(chat_id, chat, exclude_update_id)
+
+        # окно: с конца, пока влезает; место под сводку зарезервировано по её потолку
+        window_budget = self.budget_tokens - SUMMARY_BUDGET_TOKENS
+        used = 0
+        start = len(turns)
+        while start > 0 and used + turns[start - 1]["tokens"] <= window_budget:
+            start -= 1
+            used += turns[start]["tokens"]
+        if start > 0:
+            # не влезло — ужимаемся до нижней отметки, чтобы не сворачивать на каждом сообщении
+            low = int(window_budget * MEMORY_LOW_WATER)
+            while start < len(turns) - 1 and used > low:
+                used -= turns[start]["tokens"]
+                start += 1
+        overflow, window = turns[:start], turns[start:]
+
+        summarized_now = 0
+        if overflow:
+            summary = (summarizer or self.summarizer)(summary, overflow, chat_id=chat_id)
+            summarized_now = len(overflow)
+            mark = overflow[-1]["created_at"]
+            mark_ids = [t["id"] for t in overflow if t["created_at"] == mark]
+            self.storage.update_chat(
+                chat_id,
+                memory_summary=summary,
+                memory_mark_at=mark,
+                memory_mark_ids=mark_ids,
+                memory_summarized_turns=(chat.get("memory_summarized_turns") or 0) + summarized_now,
+            )
+
+        return {
+            "summary": summary,
+            "history": [{"role": t["role"], "content": t["content"]} for t in window],
+            "stats": {
+                "window_turns": len(window),
+                "window_tokens": used,
+                "summary_tokens": count_tokens(summary),
+                "summarized_now": summarized_now,
+                "summarized_total": (chat.get("memory_summarized_turns") or 0) + summarized_now,
+                "build_ms": round((time.perf_counter() - t0) * 1000, 2),
+            },
+        }
+
+    @staticmethod
+    def summary_text(ctx: Dict[str, Any]) -> Optional[str]:
+        return f"{SUMMARY_HEADER}\n{ctx['summary']}" if ctx.get("summary") else None
+
+    def as_messages(self, ctx: Dict[str, Any]) -> List[Dict[str, str]]:
+        """
+        Сообщения памяти, которые ставятся между статическим префиксом и новым сообщением.
+        """
+        out = []
+        text = self.summary_text(ctx)
+        if text:
+            out.append({"role": "system", "content": text})
+        out.extend(ctx["history"])
+        return out
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    from data_layer.memory_storage import MemoryStorage
+
+    parser = argparse.ArgumentParser(description="BookSoul conversation memory benchmark")
+    parser.add_argument("--turns", type=int, default=500, help="сколько пар вопрос/ответ")
+    parser.add_argument("--every", type=int, default=50, help="печатать строку каждые N пар")
+    args = parser.parse_args()
+
+    store = MemoryStorage()
+    memory = ConversationMemory(store)
+    chat_id = 4242
+    system = [{"role": "system", "content": "static prefix"}]
+
+    user_lines = [
+        "Сделай книгу для Алисы, тема — космос и добрый робот, ей 5 лет.",
+        "Обложку хочу теплее, и чтобы робот держал её за руку.",
+        "Какой статус у BKS-20251028-111405? Уже есть сцены?",
+        "Давай в третьей сцене добавим кота, он рыжий и пушистый.",
+        "Шрифт покрупнее, пожалуйста, она только учится читать.",
+    ]
+    answer = ("Принял. Фиксирую правку для цеха и держу книгу на паузе до твоего 'утверждаю'. "
+              "Следующий шаг — обновлённый эскиз сцены, пришлю превью.")
+
+    print(f"{'пар':>5} {'полная история':>15} {'с памятью':>10} {'окно':>5} {'сводка':>7} {'сжато':>6} {'build_ms':>9}")
+    for i in range(1, args.turns + 1):
+        text = user_lines[i % len(user_lines)] + f" (#{i})"
+        store.log_event({"type": "incoming_message", "chat_id": chat_id, "update_id": i, "text": text})
+        ctx = memory.build(chat_id, exclude_update_id=i)
+        store.log_event({"type": "router_sent", "chat_id": chat_id, "update_id": i, "answer": answer})
+
+        if i == 1 or i % args.every == 0:
+            events = store.list_events(chat_id, event_types=list(TURN_EVENTS))
+            full = system + [
+                {"role": TURN_EVENTS[e["type"]][0], "content": e.get(TURN_EVENTS[e["type"]][1], "")}
+                for e in reversed(events)
+            ]
+            bounded = system + memory.as_messages(ctx) + [{"role": "user", "content": text}]
+            s = ctx["stats"]
+            print(f"{i:>5} {count_messages(full):>15} {count_messages(bounded):>10} {s['window_turns']:>5} "
+                  f"{s['summary_tokens']:>7} {s['summarized_total']:>6} {s['build_ms']:>9}")
+
+    print(f"\nбюджет памяти: {MEMORY_BUDGET_TOKENS} токенов (сводка ≤ {SUMMARY_BUDGET_TOKENS})")
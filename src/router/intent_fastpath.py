@@ -0,0 +1,469 @@
+# src/router/intent_fastpath.py
+
+"""
+intent_fastpath.py — локальный быстрый путь распознавания команд до вызова GPT.
+
+Orchestrator.run раньше всегда платил полный раунд-трип к LLM в plan_action,
+даже за "статус книги BKS-...", который RouterBrain разбирает регуляркой.
+Теперь порядок такой:
+    1. одно склеенное регулярное выражение из шаблонов RouterBrain (приоритет как в handle_text_command);
+    2. крошечный наивный байесовский классификатор по словам + извлечение полей;
+    3. всё, что не однозначно, — в plan_action (GPT): отрицание в самой команде ("не делай
+       книгу ..."), признаки двух намерений сразу (статус + правка), лишние слова вне команды
+       и её полей (имя, тема, book_id, текст правки).
+
+Результат — план в том же формате, что возвращает plan_action:
+    {"action": "create_book", "author": "...", "theme": "..."}
+    {"action": "add_feedback", "book_id": "...", "note": "..."}
+    {"action": "get_status", "book_id": "..."}
+
+Бенчмарк (доля попаданий и задержка против GPT-планировщика):
+    python src/router/intent_fastpath.py
+    python src/router/intent_fastpath.py --llm      # реальные вызовы plan_action (нужен OPENAI_API_KEY)
+"""
+
+from typing import Optional, Dict, Any, List, Tuple
+import argparse
+import math
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/router
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from router.brain import CREATE_PATTERN, STATUS_PATTERN, FEEDBACK_PATTERN
+from router.tool_schemas import check_tool_call, ToolArgumentsError
+
+
+# ---------------------------------------------------------------------------------
+# СКЛЕЕННЫЙ ШАБЛОН
+# ---------------------------------------------------------------------------------
+# Каждая ветка — lookahead от начала строки, поэтому выигрывает первая подходящая ветка
+# (статус -> создание -> правка, как в RouterBrain.handle_text_command),
+# а не та, что совпала левее в тексте.
+
+COMBINED_RE = re.compile(
+    r"^(?:"
+    rf"(?=(?s:.*?)(?:{STATUS_PATTERN}))"
+    rf"|(?=(?s:.*?)(?:{CREATE_PATTERN}))"
+    rf"|(?=(?s:.*?)(?:{FEEDBACK_PATTERN}))"
+    r")",
+    re.IGNORECASE,
+)
+
+BOOK_ID_RE = re.compile(r"BKS-[0-9][0-9\-]*[0-9]", re.IGNORECASE)
+WORD_RE = re.compile(r"[а-яёa-z]+", re.IGNORECASE)
+
+# имя ребёнка: "для Арсена", "ребёнка зовут Арсен"
+CHILD_NAME_RE = re.compile(
+    r"(?:\bдля|зовут)\s+(?P<name>[А-ЯЁA-Z][А-Яа-яЁёA-Za-z\-]+)"
+)
+# тема: "тема: космос", "про динозавров", "о том, как ..." — до конца фразы или до "для ИМЯ"
+THEME_RE = re.compile(
+    r"(?:\bтема\b\s*[:\-—]?|\bпро\b|\bо том,?\s+как\b)\s*"
+    r"(?P<theme>[^.!?\n]+?)(?=\s+(?:для|зовут)\s|[.!?\n]|$)",
+    re.IGNORECASE,
+)
+# после book_id в правке: "BKS-... : обложку светлее"
+NOTE_LEAD_RE = re.compile(r"^[\s:,\-—–]+")
+
+# отрицание в словах команды (не в теме и не в тексте правки: "лицо не похоже" — это правка)
+NEGATION_RE = re.compile(
+    r"(?<![а-яё])(?:не|нет|ни|отмени\w*|отмена|стоп|хватит)(?![а-яё])|\b(?:don'?t|do not|not|cancel|stop)\b",
+    re.IGNORECASE,
+)
+# признаки намерений — по всему тексту: два разных сразу — смешанная просьба, решает GPT
+INTENT_MARKERS = {
+    "get_status": re.compile(r"статус|status|на каком этапе|как продвигается|готова ли", re.IGNORECASE),
+    "create_book": re.compile(
+        r"(?:сделай|создай|создать|напиши|запусти|хочу)\s+(?:\w+\s+)?(?:книгу|сказку|историю)"
+        r"|\bnew (?:book|story)\b|\bcreate a book\b",
+        re.IGNORECASE,
+    ),
+    "add_feedback": re.compile(r"заметк|правк|комментари|замечани|исправ|поправ|переделай|feedback",
+                               re.IGNORECASE),
+}
+# слова, которые можно добавить к любой команде
+FILLER_WORDS = {
+    "а", "и", "ну", "пожалуйста", "плиз", "привет", "слушай", "подскажи", "скажи", "давай",
+    "мне", "моей", "моя", "мою", "эту", "этой", "please", "hi", "the", "a", "my",
+}
+
+
+def _plan_from_match(m: "re.Match") -> Tuple[Dict[str, Any], List[Tuple[int, int]]]:
+    """План из склеенного шаблона + участки полей (они не считаются словами команды)."""
+    if m.group("status_book_id"):
+        return ({"action": "get_status", "book_id": m.group("status_book_id").strip().upper()},
+                [m.span("status_book_id")])
+    if m.group("child_name"):
+        return ({
+            "action": "create_book",
+            "author": m.group("child_name").strip(),
+            "theme": m.group("theme").strip(),
+        }, [m.span("child_name"), m.span("theme")])
+    return ({
+        "action": "add_feedback",
+        "book_id": m.group("feedback_book_id").strip().upper(),
+        "note": m.group("comment_text").strip(),
+    }, [(m.start("feedback_book_id"), m.end("comment_text"))])
+
+
+# ---------------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ КЛАССИФИКАТОР
+# ---------------------------------------------------------------------------------
+
+# Обучающие фразы. Метка "other" — всё, что надо отдать GPT (обсуждение, вопросы, смешанные просьбы).
+SEED_PHRASES: Dict[str, List[str]] = {
+    "get_status": [
+        "статус книги",
+        "какой статус у книги",
+        "что с книгой",
+        "как там книга",
+        "на каком этапе книга",
+        "где сейчас книга",
+        "готова ли книга",
+        "покажи состояние книги",
+        "что по книге",
+        "что с",
+        "что там с",
+        "как продвигается книга",
+        "status of book",
+        "how is book going",
+    ],
+    "create_book": [
+        "сделай книгу для",
+        "создай книгу для тема",
+        "создай сказку про для",
+        "новая книга для тема",
+        "напиши историю для про",
+        "запусти книгу для ребёнка тема",
+        "хочу книгу для про",
+        "ребёнка зовут тема",
+        "сделай сказку для про",
+        "create a book for about",
+        "new story for about",
+    ],
+    "add_feedback": [
+        "заметка к книге",
+        "правка к книге",
+        "добавь комментарий к книге",
+        "в книге обложку сделай светлее",
+        "поправь в книге фон",
+        "у книги лицо не похоже переделай",
+        "к книге замечание текст слишком длинный",
+        "исправь в книге сцену",
+        "комментарий к книге сделай ярче",
+        "в книге поменяй цвет",
+        "feedback for book make it brighter",
+    ],
+    "other": [
+        "привет",
+        "что ты умеешь",
+        "расскажи про правила обложки",
+        "как сделать фон теплее вообще",
+        "какие цеха есть на фабрике",
+        "объясни процесс",
+        "спасибо",
+        "опиши финальную обложку",
+        "почему так долго",
+        "какой шрифт лучше для детей",
+        "давай обсудим стиль",
+        "что думаешь про тёплые тона",
+        "сравни две книги и скажи какая лучше",
+    ],
+}
+
+
+def _features(text: str) -> List[str]:
+    """
+    Слова + их 5-буквенные основы: грубый стемминг, чтобы "книгу/книги/книга" совпадали.
+    """
+    out = []
+    for w in WORD_RE.findall(text.lower()):
+        out.append(w)
+        if len(w) > 5:
+            out.append(w[:5] + "~")
+    return out
+
+
+class NaiveBayesIntent:
+    """
+    Мультиномиальный наивный Байес по словам. Обучается на SEED_PHRASES при импорте
+    (доли миллисекунды), предсказание — словарный lookup на каждый признак.
+    """
+
+    def __init__(self, phrases: Dict[str, List[str]], alpha: float = 0.5):
+        self.alpha = alpha
+        self.labels = list(phrases)
+        self.vocab = set()
+        counts: Dict[str, Dict[str, int]] = {}
+        totals: Dict[str, int] = {}
+        n_docs = sum(len(v) for v in phrases.values())
+
+        for label, samples in phrases.items():
+            c: Dict[str, int] = {}
+            for s in samples:
+                for f in _features(s):
+                    c[f] = c.get(f, 0) + 1
+                    self.vocab.add(f)
+            counts[label] = c
+            totals[label] = sum(c.values())
+
+        v = len(self.vocab)
+        self.log_prior = {l: math.log(len(phrases[l]) / n_docs) for l in self.labels}
+        self.log_unknown = {l: math.log(alpha / (totals[l] + alpha * v)) for l in self.labels}
+        self.log_prob = {
+            l: {f: math.log((n + alpha) / (totals[l] + alpha * v)) for f, n in counts[l].items()}
+            for l in self.labels
+        }
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """
+        (метка, вероятность). Признаки вне словаря игнорируются:
+        имена и темы не должны сдвигать решение.
+        """
+        feats = [f for f in _features(text) if f in self.vocab]
+        if not feats:
+            return "other", 1.0
+
+        scores = {}
+        for l in self.labels:
+            lp = self.log_prob[l]
+            unk = self.log_unknown[l]
+            scores[l] = self.log_prior[l] + sum(lp.get(f, unk) for f in feats)
+
+        best = max(scores, key=scores.get)
+        top = scores[best]
+        norm = sum(math.exp(s - top) for s in scores.values())
+        return best, 1.0 / norm
+
+
+# ---------------------------------------------------------------------------------
+# БЫСТРЫЙ РОУТЕР
+# ---------------------------------------------------------------------------------
+
+class FastIntentRouter:
+    """
+    FastIntentRouter — отвечает планом, если команда однозначна, иначе None
+    (тогда Orchestrator идёт в plan_action).
+    """
+
+    def __init__(self, min_confidence: float = 0.8, classifier: Optional[NaiveBayesIntent] = None):
+        self.min_confidence = min_confidence
+        self.classifier = classifier or NaiveBayesIntent(SEED_PHRASES)
+        # слова команды каждого намерения: из обучающих фраз + общие вставки
+        self.command_words = {
+            label: {f for p in phrases for f in _features(p)} | FILLER_WORDS
+            for label, phrases in SEED_PHRASES.items() if label != "other"
+        }
+        self._lock = threading.Lock()
+        self._stats = {"total": 0, "regex": 0, "classifier": 0, "llm": 0, "ns": 0}
+        self._by_action: Dict[str, int] = {}
+
+    def match(self, text: str) -> Optional[Dict[str, Any]]:
+        t0 = time.perf_counter_ns()
+        text = (text or "").strip()
+
+        source = "llm"
+        plan = None
+        if sum(1 for r in INTENT_MARKERS.values() if r.search(text)) <= 1:
+            m = COMBINED_RE.match(text)
+            if m:
+                plan, spans = _plan_from_match(m)
+                source = "regex"
+            else:
+                plan, spans = self._classify(text)
+                source = "classifier"
+            if plan is None or not self._unambiguous(text, plan["action"], spans) or not self._valid(plan):
+                plan, source = None, "llm"
+
+        self._record(source, plan, time.perf_counter_ns() - t0)
+        if plan is not None:
+            plan["_source"] = f"fastpath:{source}"
+        return plan
+
+    @staticmethod
+    def _valid(plan: Dict[str, Any]) -> bool:
+        """
+        Те же схемы, что у function calling (tool_schemas): "bks-12" в план не уходит —
+        GPT переспросит, а не ToolRouter ответит "Некорректные аргументы".
+        """
+        args = {k: v for k, v in plan.items() if k != "action"}
+        try:
+            check_tool_call(plan["action"], args)
+        except ToolArgumentsError:
+            return False
+        return True
+
+    def _unambiguous(self, text: str, action: str, spans: List[Tuple[int, int]]) -> bool:
+        """
+        Слова вне полей плана — только слова команды этого намерения, без отрицания.
+        """
+        head, pos = [], 0
+        for start, end in sorted(spans):
+            head.append(text[pos:start])
+            pos = max(pos, end)
+        head.append(text[pos:])
+        head = " ".join(head)
+        if NEGATION_RE.search(head):
+            return False
+        allowed = self.command_words[action]
+        return all(w in allowed or (len(w) > 5 and w[:5] + "~" in allowed)
+                   for w in WORD_RE.findall(head.lower()))
+
+    def _classify(self, text: str) -> Tuple[Optional[Dict[str, Any]], List[Tuple[int, int]]]:
+        label, prob = self.classifier.predict(text)
+        if label == "other" or prob < self.min_confidence:
+            return None, []
+
+        book_ids = list(BOOK_ID_RE.finditer(text))
+
+        if label == "get_status":
+            # несколько ID — пусть решает GPT
+            if len(book_ids) != 1:
+                return None, []
+            return {"action": "get_status", "book_id": book_ids[0].group().upper()}, [book_ids[0].span()]
+
+        if label == "add_feedback":
+            if len(book_ids) != 1:
+                return None, []
+            note = NOTE_LEAD_RE.sub("", text[book_ids[0].end():]).strip()
+            if not note:
+                return None, []
+            return ({"action": "add_feedback", "book_id": book_ids[0].group().upper(), "note": note},
+                    [(book_ids[0].start(), len(text))])
+
+        if label == "create_book":
+            if book_ids:
+                return None, []
+            name = CHILD_NAME_RE.search(text)
+            theme = THEME_RE.search(text)
+            if not name or not theme:
+                return None, []
+            return ({
+                "action": "create_book",
+                "author": name.group("name").strip(),
+                "theme": theme.group("theme").strip(" ,.;"),
+            }, [name.span("name"), theme.span("theme")])
+
+        return None, []
+
+    def _record(self, source: str, plan: Optional[Dict[str, Any]], ns: int) -> None:
+        with self._lock:
+            self._stats["total"] += 1
+            self._stats[source] += 1
+            self._stats["ns"] += ns
+            if plan is not None:
+                action = plan["action"]
+                self._by_action[action] = self._by_action.get(action, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Доля сообщений, обслуженных без GPT, и средняя цена быстрого пути.
+        """
+        with self._lock:
+            s = dict(self._stats)
+            by_action = dict(self._by_action)
+        total = s["total"] or 1
+        return {
+            "total": s["total"],
+            "hits_regex": s["regex"],
+            "hits_classifier": s["classifier"],
+            "misses": s["llm"],
+            "hit_rate": round((s["regex"] + s["classifier"]) / total, 4),
+            "avg_us": round(s["ns"] / total / 1000, 2),
+            "by_action": by_action,
+        }
+
+
+# общий экземпляр процесса: Orchestrator создаётся на каждое сообщение, статистика должна копиться
+FAST_INTENTS = FastIntentRouter()
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ ТЕСТ / БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+BENCH_CORPUS: List[Tuple[str, Optional[str]]] = [
+    ("статус книги BKS-20251028-123045", "get_status"),
+    ("какой статус у BKS-20251028-123045", "get_status"),
+    ("как там книга BKS-20251028-123045?", "get_status"),
+    ("что с BKS-20251101-090000", "get_status"),
+    ("сделай книгу для Алисы тема космос", "create_book"),
+    ("создай книгу для Арсен тема динозавры", "create_book"),
+    ("создай сказку про маленького пилота для Арсена", "create_book"),
+    ("заметка к книге BKS-20251028-123045 сделай обложку ярче", "add_feedback"),
+    ("правка к книге BKS-20251028-123045 сцена 2 не нравится лицо", "add_feedback"),
+    ("добавь комментарий к книге BKS-20251028-123045: фон теплее", "add_feedback"),
+    ("привет! что ты умеешь?", None),
+    ("опиши финальную обложку для книги про пилота", None),
+    ("сравни BKS-20251028-123045 и BKS-20251029-000001, какая лучше", None),
+    ("создай книгу. ребёнка зовут Арсен, ему 6 лет", None),
+    ("почему книга так долго делается", None),
+    ("не делай книгу для Алисы про космос", None),
+    ("статус книги bks-12", None),
+    ("статус книги bks-20251028-123045", "get_status"),
+    ("не надо: сделай книгу для Алисы тема космос", None),
+    ("заметка к книге BKS-20251028-123045 обложку светлее, и какой у неё статус?", None),
+    ("статус книги BKS-20251028-123045, и заодно поправь обложку", None),
+    ("какой статус у BKS-20251028-123045 и почему так долго", None),
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BookSoul fast-path intent benchmark")
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--llm", action="store_true", help="замерить реальный plan_action на том же корпусе")
+    args = parser.parse_args()
+
+    fast = FastIntentRouter()
+
+    print("=== Разбор корпуса ===")
+    wrong = 0
+    for text, expected in BENCH_CORPUS:
+        plan = fast.match(text)
+        got = plan["action"] if plan else None
+        mark = "ok" if got == expected else "✗"
+        wrong += got != expected
+        print(f"{mark:>2} {str(got):<13} <- {text}")
+        if plan:
+            print(f"   {plan}")
+
+    # замер чистой задержки быстрого пути
+    samples = []
+    for _ in range(args.rounds):
+        for text, _ in BENCH_CORPUS:
+            t0 = time.perf_counter_ns()
+            fast.match(text)
+            samples.append((time.perf_counter_ns() - t0) / 1000)
+    samples.sort()
+
+    print("\n=== Быстрый путь ===")
+    print(f"вызовов: {len(samples)}, p50={samples[len(samples) // 2]:.1f}µs, "
+          f"p95={samples[int(len(samples) * 0.95)]:.1f}µs, max={samples[-1]:.1f}µs")
+    print("статистика:", fast.stats())
+
+    if args.llm:
+        from router.assistant_openai import OpenAIRouterAgent, Orchestrator
+        orch = Orchestrator(OpenAIRouterAgent())
+        llm_ms = []
+        for text, _ in BENCH_CORPUS:
+            t0 = time.perf_counter()
+            orch.plan_action(text)
+            llm_ms.append((time.perf_counter() - t0) * 1000)
+        hit_share = sum(1 for t, e in BENCH_CORPUS if e) / len(BENCH_CORPUS)
+        llm_avg = statistics.mean(llm_ms)
+        fast_avg_ms = statistics.mean(samples) / 1000
+        mixed = hit_share * fast_avg_ms + (1 - hit_share) * (fast_avg_ms + llm_avg)
+        print("\n=== GPT plan_action ===")
+        print(f"avg={llm_avg:.0f}ms, p50={statistics.median(llm_ms):.0f}ms, max={max(llm_ms):.0f}ms")
+        print(f"средняя цена планирования: было {llm_avg:.0f}ms, с быстрым путём ~{mixed:.0f}ms")
+
+    sys.exit(1 if wrong else 0)
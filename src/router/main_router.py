@@ -4,7 +4,7 @@ import os
 from datetime import datetime
 from typing import Optional, Dict, Any, List
 
-from data_layer.firestore_client import FirestoreClient
+from data_layer.storage import StorageBackend, get_storage
 
 
 class BookSoulRouter:
@@ -15,18 +15,17 @@ class BookSoulRouter:
     - обновляет статус этапа
     - регистрирует сцены
     - возвращает сводку прогресса
-    - пишет служебные записи в Firestore (через FirestoreClient)
+    - пишет служебные записи в хранилище (через StorageBackend: Firestore / memory / sqlite)
 
     Важно: это бизнес-логика. Никаких Telegram, никакого FastAPI здесь.
     Потом мы будем вызывать эти методы из бота и из HTTP.
     """
 
     def __init__(self,
-                 project_id: str = "booksoulv2"):
-        self.fs = FirestoreClient(
-            project_id=project_id,
-            root_collection="books"
-        )
+                 project_id: str = "booksoulv2",
+                 storage: Optional[StorageBackend] = None):
+        # по умолчанию — бэкенд из BOOKSOUL_STORAGE (в проде Firestore)
+        self.fs = storage or get_storage(project_id=project_id)
 
     # -------------------------------------------------------------------------
     # ВСПОМОГАТЕЛЬНОЕ
@@ -119,7 +118,8 @@ class BookSoulRouter:
             book_id=book_id,
             job_type="scene_generation",
             status="pending",
-            result_url=""
+            result_url="",
+            scene_id=scene_id
         )
 
         return {
@@ -264,6 +264,30 @@ class BookSoulRouter:
             "info": info
         }
 
+    # -------------------------------------------------------------------------
+    # СВОДКА ФАБРИКИ (ДАШБОРД)
+    # -------------------------------------------------------------------------
+
+    def get_factory_stats(self, hours: int = 24) -> Dict[str, Any]:
+        """
+        Сколько сообщений / книг / готовых задач за последние N часов.
+        Читает почасовые роллапы (пара десятков документов), а не сырые events/jobs/books.
+        """
+        summary = self.fs.metrics.summarize(hours=hours)
+        totals = summary["totals"]
+
+        return {
+            "ok": True,
+            "hours": hours,
+            "messages": totals.get("messages", 0),
+            "books_created": totals.get("books_created", 0),
+            "jobs_completed": totals.get("jobs_completed", {}),
+            "errors": totals.get("errors", 0),
+            "intents": totals.get("intents", {}),
+            "llm": totals.get("llm", {}),
+            "series": summary["series"],
+        }
+
 
 # -----------------------------------------------------------------------------
 # ЛОКАЛЬНЫЙ ТЕСТ (чтобы проверить, что Router реально живой)
@@ -0,0 +1,374 @@
+# src/router/model_router.py
+
+"""
+model_router.py — выбор модели по сложности сообщения и хеджирование медленных запросов.
+
+1. Ярусы (tiers):
+   fast — короткие и простые сообщения (привет, "ок", короткий вопрос) -> OPENAI_MODEL_FAST;
+   main — творческая и редакторская работа (сюжет, сцены, обложка, правки, длинные тексты) -> OPENAI_MODEL.
+2. Хеджирование: основной запрос идёт в Responses API; если он не ответил за порог
+   (p95 последних ответов этого яруса), параллельно стартует запасной запрос в Chat Completions.
+   Берётся первый успешный ответ, проигравший отменяется. Ошибка основного — запасной сразу,
+   без ожидания (раньше это был строго последовательный fallback).
+   Доля хеджей ограничена HEDGE_MAX_RATIO, чтобы медленный провайдер не получил двойную нагрузку.
+3. Отчёт: p50/p95/p99, хеджи, победы хеджа, стоимость по ярусам.
+
+Бенчмарк на фейковом OpenAI с медленным хвостом:
+    python src/router/model_router.py --requests 400 --tail-rate 0.03
+"""
+
+from typing import Optional, Dict, Any, List, Tuple
+from collections import deque
+import argparse
+import asyncio
+import os
+import re
+import sys
+import threading
+import time
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/router
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from router.token_accounting import usage_from_response, cost_micro_usd
+from utils.metrics import llm_call, record_fallback
+
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+OPENAI_MODEL_FAST = os.getenv("OPENAI_MODEL_FAST", "gpt-4o-mini")
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "true").lower() == "true"   # false — всё в main
+
+# хеджирование
+HEDGING = os.getenv("HEDGING", "true").lower() == "true"
+HEDGE_DEFAULT_MS = float(os.getenv("HEDGE_DEFAULT_MS", "3000"))  # порог, пока мало замеров
+HEDGE_MIN_MS = float(os.getenv("HEDGE_MIN_MS", "400"))
+HEDGE_MAX_MS = float(os.getenv("HEDGE_MAX_MS", "8000"))
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))    # не больше 10% запросов с хеджем
+
+# короткое сообщение без творческих слов -> fast
+FAST_MAX_CHARS = int(os.getenv("FAST_MAX_CHARS", "160"))
+CREATIVE_RE = re.compile(
+    r"сюжет|истори|сказк|сцен|обложк|иллюстр|стил|шрифт|вёрстк|верстк|текст|перепиш|придума|опиши|"
+    r"сочини|правк|поправ|исправ|переделай|глав|персонаж|герой|диалог|рифм|story|scene|cover|rewrite",
+    re.IGNORECASE,
+)
+
+LATENCY_WINDOW = 500
+
+
+class ModelTier:
+    """Ярус: модель + лимиты ответа."""
+
+    def __init__(self, name: str, model: str, max_output_tokens: int, temperature: float = 0.2):
+        self.name = name
+        self.model = model
+        self.max_output_tokens = max_output_tokens
+        self.temperature = temperature
+
+
+TIERS: Dict[str, ModelTier] = {
+    "fast": ModelTier("fast", OPENAI_MODEL_FAST, max_output_tokens=350),
+    "main": ModelTier("main", OPENAI_MODEL, max_output_tokens=700),
+}
+
+
+def choose_tier(user_text: str) -> Tuple[str, str]:
+    """
+    (ярус, причина). Дёшево: длина + одно регулярное выражение.
+    """
+    if not MODEL_ROUTING:
+        return "main", "routing_off"
+    text = (user_text or "").strip()
+    if CREATIVE_RE.search(text):
+        return "main", "creative"
+    if len(text) > FAST_MAX_CHARS:
+        return "main", "long"
+    return "fast", "short"
+
+
+def _percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+class EmptyAnswer(RuntimeError):
+    """Модель вернула пустой текст — считаем неудачей эндпоинта."""
+
+
+# ---------------------------------------------------------------------------------
+# СТАТИСТИКА
+# ---------------------------------------------------------------------------------
+
+class TierStats:
+    def __init__(self):
+        self.primary_ms = deque(maxlen=LATENCY_WINDOW)  # задержки основного эндпоинта (для порога)
+        self.total_ms = deque(maxlen=LATENCY_WINDOW * 4)  # что увидел пользователь
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+        self.errors = 0
+        self.cost_micro_usd = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+
+class ModelRouter:
+    """
+    ModelRouter — асинхронный вызов LLM с ярусами и хеджированием.
+    client — openai.AsyncOpenAI (или совместимый объект с .responses / .chat.completions).
+    """
+
+    def __init__(self, client, tiers: Optional[Dict[str, ModelTier]] = None, hedging: bool = HEDGING):
+        self.client = client
+        self.tiers = tiers or TIERS
+        self.hedging = hedging
+        self._lock = threading.Lock()
+        self._stats: Dict[str, TierStats] = {name: TierStats() for name in self.tiers}
+
+    # ---------------------------------------------------------------------------------
+    # ПОРОГ ХЕДЖА
+    # ---------------------------------------------------------------------------------
+
+    def hedge_threshold_ms(self, tier: str) -> float:
+        samples = list(self._stats[tier].primary_ms)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_MS
+        return min(HEDGE_MAX_MS, max(HEDGE_MIN_MS, _percentile(samples, HEDGE_PERCENTILE)))
+
+    def _hedge_allowed(self, tier: str) -> bool:
+        st = self._stats[tier]
+        return self.hedging and st.hedged < max(1.0, HEDGE_MAX_RATIO * st.calls)
+
+    # ---------------------------------------------------------------------------------
+    # ВЫЗОВЫ
+    # ---------------------------------------------------------------------------------
+
+    async def _call(self, endpoint: str, tier: ModelTier, messages: List[Dict[str, Any]],
+                    cache_key: Optional[str], kind: str) -> Tuple[str, Dict[str, Any]]:
+        extra = {"extra_body": {"prompt_cache_key": cache_key}} if cache_key else {}
+        with llm_call(kind, tier.model, endpoint) as call:
+            if endpoint == "responses":
+                resp = await self.client.responses.create(
+                    model=tier.model,
+                    input=messages,
+                    temperature=tier.temperature,
+                    max_output_tokens=tier.max_output_tokens,
+                    **extra,
+                )
+                text = (getattr(resp, "output_text", "") or "").strip()
+            else:
+                resp = await self.client.chat.completions.create(
+                    model=tier.model,
+                    messages=messages,
+                    temperature=tier.temperature,
+                    max_tokens=tier.max_output_tokens,
+                    **extra,
+                )
+                text = ((resp.choices[0].message.content if resp and resp.choices else "") or "").strip()
+            call.usage = usage_from_response(resp, messages, completion_text=text)
+            if not text:
+                raise EmptyAnswer(endpoint)
+        return text, call.usage
+
+    async def answer(self, messages: List[Dict[str, Any]], tier: str = "main",
+                     cache_key: Optional[str] = None, kind: str = "director") -> Dict[str, Any]:
+        """
+        {"text", "tier", "model", "endpoint", "latency_ms", "hedged", "fallback", "usage", "cost_micro_usd"}
+        Бросает последнюю ошибку, если не ответил ни один эндпоинт.
+        """
+        spec = self.tiers[tier]
+        st = self._stats[tier]
+        t0 = time.perf_counter()
+        with self._lock:
+            st.calls += 1
+
+        primary = asyncio.create_task(self._call("responses", spec, messages, cache_key, kind))
+        tasks = {primary: "responses"}
+        hedged = fallback = False
+
+        threshold = self.hedge_threshold_ms(tier) if self._hedge_allowed(tier) else None
+        done, _ = await asyncio.wait({primary}, timeout=threshold / 1000.0 if threshold else None)
+
+        if primary in done and primary.exception() is None:
+            winner = primary
+        else:
+            if primary in done:
+                fallback = True       # основной упал — запасной сразу
+                record_fallback(kind, "endpoint_error")
+            else:
+                hedged = True         # основной медленный — запасной параллельно
+                record_fallback(kind, "hedge")
+            backup = asyncio.create_task(self._call("chat", spec, messages, cache_key, kind))
+            tasks[backup] = "chat"
+            winner = await self._first_success(tasks)
+
+        elapsed_ms = (time.perf_counter() - t0) * 1000.0
+        self._account(st, primary, winner, hedged, fallback, elapsed_ms)
+
+        if winner is None:
+            raise next((t.exception() for t in tasks if t.done() and not t.cancelled() and t.exception()),
+                       RuntimeError("no answer"))
+
+        text, usage = winner.result()
+        cost = cost_micro_usd(spec.model, usage)
+        with self._lock:
+            st.cost_micro_usd += cost
+            st.prompt_tokens += usage.get("prompt_tokens", 0)
+            st.completion_tokens += usage.get("completion_tokens", 0)
+
+        return {
+            "text": text,
+            "tier": tier,
+            "model": spec.model,
+            "endpoint": tasks[winner],
+            "latency_ms": round(elapsed_ms, 2),
+            "hedged": hedged,
+            "fallback": fallback,
+            "usage": usage,
+            "cost_micro_usd": cost,
+        }
+
+    @staticmethod
+    async def _first_success(tasks: Dict[asyncio.Task, str]) -> Optional[asyncio.Task]:
+        """Первый успешный; остальные отменяются."""
+        pending = {t for t in tasks if not t.done()}
+        winner = next((t for t in tasks if t.done() and t.exception() is None), None)
+        while winner is None and pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((t for t in done if t.exception() is None), None)
+        for t in pending:
+            t.cancel()
+        return winner
+
+    def _account(self, st: TierStats, primary, winner, hedged, fallback, elapsed_ms) -> None:
+        with self._lock:
+            st.total_ms.append(elapsed_ms)
+            if hedged:
+                st.hedged += 1
+                if winner is not None and winner is not primary:
+                    st.hedge_wins += 1
+            if fallback:
+                st.fallbacks += 1
+            if winner is None:
+                st.errors += 1
+            # порог считается по основному эндпоинту; отменённый медленный основной — замер снизу
+            if winner is primary or not primary.done() or primary.cancelled():
+                st.primary_ms.append(elapsed_ms)
+
+    # ---------------------------------------------------------------------------------
+    # ОТЧЁТ
+    # ---------------------------------------------------------------------------------
+
+    def reset_stats(self) -> None:
+        """Обнуляет отчёт, но сохраняет замеры основного эндпоинта (пороги хеджа остаются прогретыми)."""
+        with self._lock:
+            for name, st in self._stats.items():
+                fresh = TierStats()
+                fresh.primary_ms = st.primary_ms
+                self._stats[name] = fresh
+
+    def report(self) -> Dict[str, Any]:
+        out = {}
+        with self._lock:
+            for name, st in self._stats.items():
+                total = list(st.total_ms)
+                out[name] = {
+                    "model": self.tiers[name].model,
+                    "calls": st.calls,
+                    "p50_ms": _round(_percentile(total, 50)),
+                    "p95_ms": _round(_percentile(total, 95)),
+                    "p99_ms": _round(_percentile(total, 99)),
+                    "hedge_threshold_ms": None,
+                    "hedged": st.hedged,
+                    "hedge_wins": st.hedge_wins,
+                    "fallbacks": st.fallbacks,
+                    "errors": st.errors,
+                    "prompt_tokens": st.prompt_tokens,
+                    "completion_tokens": st.completion_tokens,
+                    "cost_usd": round(st.cost_micro_usd / 1e6, 6),
+                    "cost_per_call_usd": round(st.cost_micro_usd / 1e6 / st.calls, 6) if st.calls else None,
+                }
+        for name in out:
+            out[name]["hedge_threshold_ms"] = _round(self.hedge_threshold_ms(name))
+        return out
+
+
+def _round(v: Optional[float]) -> Optional[float]:
+    return round(v, 2) if v is not None else None
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+BENCH_MESSAGES = [
+    "привет",
+    "ок, спасибо",
+    "когда будет готово?",
+    "придумай сюжет про девочку и дракона, который боится темноты",
+    "перепиши третью сцену мягче, без слова 'страшно'",
+    "обложка темновата, сделай свет теплее и героя по центру",
+    "да",
+    "какой статус?",
+]
+
+
+async def _bench(client, requests: int, concurrency: int, hedging: bool, warmup: int) -> Dict[str, Any]:
+    router = ModelRouter(client, hedging=hedging)
+    sem = asyncio.Semaphore(concurrency)
+    tiers_seen: Dict[str, int] = {}
+
+    async def one(i: int) -> None:
+        text = BENCH_MESSAGES[i % len(BENCH_MESSAGES)]
+        tier, _ = choose_tier(text)
+        tiers_seen[tier] = tiers_seen.get(tier, 0) + 1
+        async with sem:
+            await router.answer([{"role": "system", "content": "bench"}, {"role": "user", "content": text}], tier)
+
+    # прогрев: порог хеджа считается по p95, пока замеров мало — стоит HEDGE_DEFAULT_MS
+    await asyncio.gather(*(one(i) for i in range(warmup)))
+    router.reset_stats()
+    tiers_seen.clear()
+
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return {"tiers": tiers_seen, "report": router.report()}
+
+
+if __name__ == "__main__":
+    import json
+    from openai import AsyncOpenAI
+    from loadtest.fake_servers import OpenAIBehaviour, make_fake_openai_app, BackgroundServer
+
+    parser = argparse.ArgumentParser(description="BookSoul tiered routing + hedging benchmark")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--jitter-ms", type=float, default=80.0)
+    parser.add_argument("--tail-rate", type=float, default=0.03)
+    parser.add_argument("--tail-ms", type=float, default=3000.0)
+    parser.add_argument("--warmup", type=int, default=80)
+    args = parser.parse_args()
+
+    for text in BENCH_MESSAGES:
+        print(f"{choose_tier(text)[0]:>5} <- {text}")
+
+    behaviour = OpenAIBehaviour(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                tail_rate=args.tail_rate, tail_ms=args.tail_ms)
+    server = BackgroundServer(make_fake_openai_app(behaviour)).start()
+    client = AsyncOpenAI(api_key="sk-bench", base_url=f"{server.url}/v1", max_retries=0)
+    try:
+        for hedging in (False, True):
+            result = asyncio.run(_bench(client, args.requests, args.concurrency, hedging, args.warmup))
+            print(f"\n=== hedging={'on' if hedging else 'off'} (tiers: {result['tiers']}) ===")
+            print(json.dumps(result["report"], ensure_ascii=False, indent=2))
+    finally:
+        server.stop()
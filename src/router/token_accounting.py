@@ -0,0 +1,310 @@
+# src/router/token_accounting.py
+
+"""
+token_accounting.py — учёт токенов и стоимости LLM-вызовов.
+
+На каждый вызов пишем prompt / cached-prompt / completion токены и стоимость:
+- в шардированные счётчики и роллапы (storage.metrics) — для окон "за N часов";
+- в token_usage/chat_{chat_id} и token_usage/book_{book_id} — накопительно по чату и книге.
+
+Если провайдер не вернул usage (старый SDK, fallback-путь), токены считаются локально:
+tiktoken, если установлен, иначе грубая оценка по символам.
+
+Отчёт (доля кэша, стоимость на сообщение, топ чатов/книг):
+    python src/router/token_accounting.py --hours 24
+    BOOKSOUL_STORAGE=memory python src/router/token_accounting.py --demo
+"""
+
+from typing import Optional, Dict, Any, List
+import argparse
+import json
+import math
+import os
+import re
+import sys
+
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/router
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend, utcnow
+
+
+USAGE_COLLECTION = "token_usage"
+
+# USD за 1M токенов: (input, cached input, output). Ищется по самому длинному префиксу имени модели.
+# LLM_PRICES_JSON='{"gpt-4o": [2.5, 1.25, 10]}' переопределяет/дополняет таблицу.
+PRICES: Dict[str, tuple] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-5-pro": (15.00, 15.00, 120.00),
+    "gpt-5": (1.25, 0.125, 10.00),
+}
+try:
+    PRICES.update({k: tuple(v) for k, v in json.loads(os.getenv("LLM_PRICES_JSON", "") or "{}").items()})
+except Exception as e:
+    print(f"[token_accounting] LLM_PRICES_JSON не разобран: {e!r}")
+
+# Batch API тарифицируется вдвое дешевле интерактивных вызовов
+BATCH_PRICE_FACTOR = float(os.getenv("BATCH_PRICE_FACTOR", "0.5"))
+
+# накладные токены на сообщение в chat-формате (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+_TOKEN_PIECE_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_encoder = None
+
+
+# ---------------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ ПОДСЧЁТ
+# ---------------------------------------------------------------------------------
+
+def count_tokens(text: str) -> int:
+    """
+    Число токенов текста. С tiktoken — точно (o200k_base, семейство gpt-4o/gpt-5),
+    без него — оценка: латиница ~4 символа на токен, кириллица ~3, знак препинания = токен.
+    """
+    global _encoder
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if _encoder is None:
+            _encoder = tiktoken.get_encoding("o200k_base")
+        return len(_encoder.encode(text))
+
+    total = 0
+    for piece in _TOKEN_PIECE_RE.findall(text):
+        if piece.isascii():
+            total += math.ceil(len(piece) / 4)
+        else:
+            total += math.ceil(len(piece) / 3)
+    return total
+
+
+def count_messages(messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]] = None) -> int:
+    total = sum(count_tokens(str(m.get("content", ""))) + MESSAGE_OVERHEAD for m in messages)
+    if tools:
+        total += count_tokens(json.dumps(tools, ensure_ascii=False, separators=(",", ":")))
+    return total
+
+
+def _field(obj: Any, name: str) -> Any:
+    # SDK-объект или сырой JSON (тело ответа из Batch API)
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def usage_from_response(
+    response: Any,
+    messages: Optional[List[Dict[str, Any]]] = None,
+    tools: Optional[List[Dict[str, Any]]] = None,
+    completion_text: str = "",
+) -> Dict[str, Any]:
+    """
+    Единый вид usage для Responses API и Chat Completions:
+    {"prompt_tokens", "cached_tokens", "completion_tokens", "estimated"}.
+    response — объект SDK или dict с телом ответа (результаты Batch API).
+    Нет usage в ответе — локальная оценка по messages/tools/completion_text.
+    """
+    usage = _field(response, "usage") if response is not None else None
+    if usage is not None:
+        # Responses API: input_tokens / output_tokens / input_tokens_details.cached_tokens
+        prompt = _field(usage, "input_tokens")
+        completion = _field(usage, "output_tokens")
+        details = _field(usage, "input_tokens_details")
+        if prompt is None:
+            # Chat Completions: prompt_tokens / completion_tokens / prompt_tokens_details.cached_tokens
+            prompt = _field(usage, "prompt_tokens")
+            completion = _field(usage, "completion_tokens")
+            details = _field(usage, "prompt_tokens_details")
+        if prompt is not None:
+            return {
+                "prompt_tokens": int(prompt or 0),
+                "cached_tokens": int((_field(details, "cached_tokens") if details is not None else 0) or 0),
+                "completion_tokens": int(completion or 0),
+                "estimated": False,
+            }
+
+    return {
+        "prompt_tokens": count_messages(messages or [], tools),
+        "cached_tokens": 0,
+        "completion_tokens": count_tokens(completion_text),
+        "estimated": True,
+    }
+
+
+def price_for(model: str) -> tuple:
+    best = ""
+    for name in PRICES:
+        if (model or "").startswith(name) and len(name) > len(best):
+            best = name
+    return PRICES.get(best, PRICES["gpt-4o"])
+
+
+def cost_micro_usd(model: str, usage: Dict[str, Any]) -> int:
+    """
+    Стоимость в микродолларах (целое — чтобы складывать атомарными инкрементами).
+    Цена за 1M токенов в USD * токены = микродоллары.
+    """
+    p_in, p_cached, p_out = price_for(model)
+    prompt = usage.get("prompt_tokens", 0)
+    cached = min(usage.get("cached_tokens", 0), prompt)
+    completion = usage.get("completion_tokens", 0)
+    return int(round((prompt - cached) * p_in + cached * p_cached + completion * p_out))
+
+
+# ---------------------------------------------------------------------------------
+# ЖУРНАЛ
+# ---------------------------------------------------------------------------------
+
+class TokenLedger:
+    """
+    TokenLedger — пишет usage каждого LLM-вызова в метрики и накопители по чату/книге.
+    Ошибки записи не ломают ответ пользователю.
+    """
+
+    def __init__(self, storage: StorageBackend):
+        self.storage = storage
+
+    def record(
+        self,
+        model: str,
+        usage: Dict[str, Any],
+        kind: str = "router",
+        chat_id: Any = None,
+        book_id: Optional[str] = None,
+        price_factor: float = 1.0,
+    ) -> Dict[str, Any]:
+        """
+        price_factor — множитель к прайсу (Batch API: BATCH_PRICE_FACTOR = 0.5).
+        """
+        if not usage:
+            return {}
+        cost = int(round(cost_micro_usd(model, usage) * price_factor))
+        deltas = {
+            "calls": 1,
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "cached_tokens": usage.get("cached_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "cost_micro_usd": cost,
+        }
+
+        metrics = {f"llm.{k}": v for k, v in deltas.items()}
+        metrics[f"llm.by_kind.{kind}"] = 1
+        metrics[f"llm.cost_by_kind.{kind}"] = cost
+        if usage.get("estimated"):
+            metrics["llm.estimated_calls"] = 1
+        try:
+            self.storage.metrics.incr_many(metrics)
+        except Exception as e:
+            print(f"[TokenLedger] metrics error: {e!r}")
+
+        ops = []
+        now = utcnow()
+        if chat_id is not None:
+            ops.append((USAGE_COLLECTION, f"chat_{chat_id}", deltas,
+                        {"type": "chat", "chat_id": chat_id, "updated_at": now}))
+        if book_id:
+            ops.append((USAGE_COLLECTION, f"book_{book_id}", deltas,
+                        {"type": "book", "book_id": book_id, "updated_at": now}))
+        if ops:
+            try:
+                self.storage.increment_docs(ops)
+            except Exception as e:
+                print(f"[TokenLedger] usage write error: {e!r}")
+
+        return {**deltas, "model": model, "kind": kind}
+
+    def get_usage(self, chat_id: Any = None, book_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        doc_id = f"chat_{chat_id}" if chat_id is not None else f"book_{book_id}"
+        return self.storage.get_doc(USAGE_COLLECTION, doc_id)
+
+    def report(self, hours: int = 24, top: int = 5) -> Dict[str, Any]:
+        """
+        Доля кэшированных prompt-токенов и стоимость на сообщение за окно + топ чатов/книг
+        по накопленной стоимости.
+        """
+        totals = self.storage.metrics.summarize(hours=hours)["totals"]
+        llm = totals.get("llm", {})
+        prompt = llm.get("prompt_tokens", 0)
+        cached = llm.get("cached_tokens", 0)
+        cost = llm.get("cost_micro_usd", 0)
+        messages = totals.get("messages", 0)
+
+        def _top(kind: str) -> List[Dict[str, Any]]:
+            docs = self.storage.query_docs(
+                USAGE_COLLECTION,
+                where=[("type", "==", kind)],
+                order_by="cost_micro_usd",
+                descending=True,
+                limit=top,
+            )
+            return [{
+                "id": d.get(f"{kind}_id"),
+                "calls": d.get("calls", 0),
+                "prompt_tokens": d.get("prompt_tokens", 0),
+                "cached_tokens": d.get("cached_tokens", 0),
+                "completion_tokens": d.get("completion_tokens", 0),
+                "cost_usd": round(d.get("cost_micro_usd", 0) / 1e6, 6),
+            } for d in docs]
+
+        return {
+            "hours": hours,
+            "calls": llm.get("calls", 0),
+            "messages": messages,
+            "prompt_tokens": prompt,
+            "cached_tokens": cached,
+            "completion_tokens": llm.get("completion_tokens", 0),
+            "cache_hit_rate": round(cached / prompt, 4) if prompt else 0.0,
+            "cost_usd": round(cost / 1e6, 6),
+            "cost_per_message_usd": round(cost / 1e6 / messages, 6) if messages else None,
+            "estimated_calls": llm.get("estimated_calls", 0),
+            "by_kind": llm.get("by_kind", {}),
+            "cost_by_kind_usd": {k: round(v / 1e6, 6) for k, v in llm.get("cost_by_kind", {}).items()},
+            "top_chats": _top("chat"),
+            "top_books": _top("book"),
+        }
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ ЗАПУСК
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    from data_layer.storage import get_storage
+
+    parser = argparse.ArgumentParser(description="BookSoul LLM token / cost report")
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--demo", action="store_true", help="засеять хранилище синтетическими вызовами")
+    args = parser.parse_args()
+
+    store = get_storage()
+    ledger = TokenLedger(store)
+
+    if args.demo:
+        from router.prompts import ROUTER_SYSTEM_PROMPT
+        prefix = count_tokens(ROUTER_SYSTEM_PROMPT)
+        for i in range(40):
+            chat_id = 1000 + i % 4
+            # первый вызов каждого чата — холодный кэш, дальше префикс кэширован
+            cached = 0 if i < 4 else prefix // 128 * 128
+            ledger.record("gpt-4o", {"prompt_tokens": prefix + 30, "cached_tokens": cached,
+                                     "completion_tokens": 120}, kind="ask_router", chat_id=chat_id,
+                          book_id="BKS-20251028-111405" if i % 4 == 0 else None)
+            store.metrics.incr("messages")
+        print(f"локальный подсчёт ROUTER_SYSTEM_PROMPT: {prefix} токенов "
+              f"({'tiktoken' if tiktoken is not None else 'оценка'})")
+
+    print(json.dumps(ledger.report(hours=args.hours, top=args.top), ensure_ascii=False, indent=2))
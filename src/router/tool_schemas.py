@@ -0,0 +1,200 @@
+# src/router/tool_schemas.py
+
+"""
+tool_schemas.py — JSON-схемы инструментов фабрики для function calling.
+
+Одни и те же схемы:
+- уходят в модель (tools=..., strict) — модель физически не может вернуть кривые аргументы;
+- проверяют аргументы локально в ToolRouter перед вызовом BookSoulRouter
+  (быстрый путь и старые JSON-планы тоже идут через эту проверку).
+
+Валидатор покрывает только то подмножество JSON Schema, которое здесь используется:
+type object/string, required, additionalProperties, minLength, maxLength, pattern.
+"""
+
+from typing import Dict, Any, List
+import re
+
+
+BOOK_ID_PATTERN = r"^BKS-[0-9]{8}-[0-9]{6}$"
+
+TOOL_SCHEMAS: Dict[str, Dict[str, Any]] = {
+    "create_book": {
+        "description": "Создать новую детскую книгу и поставить сценарий в очередь StoryWriter.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "author": {"type": "string", "minLength": 1, "maxLength": 80,
+                           "description": "Имя ребёнка (главный герой)."},
+                "theme": {"type": "string", "minLength": 1, "maxLength": 300,
+                          "description": "Тема сказки."},
+            },
+            "required": ["author", "theme"],
+            "additionalProperties": False,
+        },
+    },
+    "add_feedback": {
+        "description": "Записать правку к существующей книге.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "book_id": {"type": "string", "pattern": BOOK_ID_PATTERN},
+                "note": {"type": "string", "minLength": 1, "maxLength": 2000,
+                         "description": "Текст правки как есть."},
+            },
+            "required": ["book_id", "note"],
+            "additionalProperties": False,
+        },
+    },
+    "get_status": {
+        "description": "Показать текущий этап книги.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "book_id": {"type": "string", "pattern": BOOK_ID_PATTERN},
+            },
+            "required": ["book_id"],
+            "additionalProperties": False,
+        },
+    },
+    "ask_clarification": {
+        "description": "Запрос неоднозначен или не хватает данных: задать один уточняющий вопрос.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "question": {"type": "string", "minLength": 1, "maxLength": 300},
+            },
+            "required": ["question"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# инструменты, которые реально что-то делают на фабрике (ask_clarification — нет)
+FACTORY_TOOLS = ("create_book", "add_feedback", "get_status")
+
+# ключи JSON Schema, которые strict-режим OpenAI не принимает — только для локальной проверки
+_LOCAL_ONLY_KEYS = ("minLength", "maxLength")
+
+
+class ToolArgumentsError(ValueError):
+    """Аргументы инструмента не прошли схему."""
+
+    def __init__(self, tool: str, errors: List[str]):
+        super().__init__(f"{tool}: " + "; ".join(errors))
+        self.tool = tool
+        self.errors = errors
+
+
+def _strip_local_keys(schema: Dict[str, Any]) -> Dict[str, Any]:
+    out = {}
+    for k, v in schema.items():
+        if k in _LOCAL_ONLY_KEYS:
+            continue
+        if isinstance(v, dict):
+            v = _strip_local_keys(v)
+        out[k] = v
+    return out
+
+
+def openai_tools() -> List[Dict[str, Any]]:
+    """
+    Описание инструментов в формате Responses API (плоский function tool, strict).
+    Собирается из TOOL_SCHEMAS в фиксированном порядке — байт-в-байт одинаково на каждом вызове.
+    """
+    return [
+        {
+            "type": "function",
+            "name": name,
+            "description": spec["description"],
+            "parameters": _strip_local_keys(spec["parameters"]),
+            "strict": True,
+        }
+        for name, spec in TOOL_SCHEMAS.items()
+    ]
+
+
+def validate_args(schema: Dict[str, Any], value: Any, path: str = "") -> List[str]:
+    """
+    Возвращает список ошибок (пустой — всё ок).
+    """
+    errors = []
+    where = path or "arguments"
+    expected = schema.get("type")
+
+    if expected == "object":
+        if not isinstance(value, dict):
+            return [f"{where}: ожидался объект"]
+        props = schema.get("properties", {})
+        for key in schema.get("required", []):
+            if key not in value:
+                errors.append(f"{where}.{key}: обязательное поле")
+        if schema.get("additionalProperties") is False:
+            for key in value:
+                if key not in props:
+                    errors.append(f"{where}.{key}: лишнее поле")
+        for key, sub in props.items():
+            if key in value:
+                errors.extend(validate_args(sub, value[key], f"{where}.{key}"))
+        return errors
+
+    if expected == "string":
+        if not isinstance(value, str):
+            return [f"{where}: ожидалась строка"]
+        text = value.strip()
+        if len(text) < schema.get("minLength", 0):
+            errors.append(f"{where}: пустое значение")
+        if "maxLength" in schema and len(text) > schema["maxLength"]:
+            errors.append(f"{where}: длиннее {schema['maxLength']} символов")
+        if "pattern" in schema and not re.match(schema["pattern"], text):
+            errors.append(f"{where}: не похоже на {schema['pattern']}")
+        return errors
+
+    return errors
+
+
+def check_tool_call(tool: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Проверяет аргументы по схеме инструмента и возвращает их с обрезанными пробелами.
+    Бросает ToolArgumentsError.
+    """
+    spec = TOOL_SCHEMAS.get(tool)
+    if spec is None:
+        raise ToolArgumentsError(tool, ["неизвестный инструмент"])
+    errors = validate_args(spec["parameters"], args)
+    if errors:
+        raise ToolArgumentsError(tool, errors)
+    return {k: v.strip() if isinstance(v, str) else v for k, v in args.items()}
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ ТЕСТ
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import json
+
+    cases = [
+        ("create_book", {"author": "Арсен", "theme": "маленький пилот"}, True),
+        ("create_book", {"author": "Арсен"}, False),
+        ("add_feedback", {"book_id": "BKS-20251028-111405", "note": "фон теплее"}, True),
+        ("add_feedback", {"book_id": "BKS-1", "note": "фон теплее"}, False),
+        ("get_status", {"book_id": "BKS-20251028-111405", "extra": 1}, False),
+        ("ask_clarification", {"question": "Для кого книга?"}, True),
+    ]
+    failed = 0
+    for tool, args, should_pass in cases:
+        try:
+            check_tool_call(tool, args)
+            ok = True
+            reason = ""
+        except ToolArgumentsError as e:
+            ok = False
+            reason = str(e)
+        mark = "ok" if ok == should_pass else "✗"
+        failed += ok != should_pass
+        print(f"{mark:>2} {tool} {args} {reason}")
+
+    tools_json = json.dumps(openai_tools(), ensure_ascii=False, separators=(",", ":"))
+    print(f"\nописание инструментов: {len(tools_json)} символов")
+    raise SystemExit(1 if failed else 0)
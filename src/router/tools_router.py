@@ -15,58 +15,80 @@ if SRC_DIR not in sys.path:
     sys.path.insert(0, SRC_DIR)
 
 from router.main_router import BookSoulRouter
+from router.tool_schemas import check_tool_call, ToolArgumentsError
 
 
 class ToolRouter:
-    def __init__(self):
+    def __init__(self, router: BookSoulRouter = None):
         # инициализируем твой основной роутер фабрики
-        self.router = BookSoulRouter()
+        self.router = router or BookSoulRouter()
+        # имя инструмента -> обработчик; аргументы уже проверены по TOOL_SCHEMAS
+        self.handlers = {
+            "create_book": self._create_book,
+            "add_feedback": self._add_feedback,
+            "get_status": self._get_status,
+        }
 
     def execute(self, command: Dict[str, Any]) -> Dict[str, Any]:
         """
         Принимает словарь вида:
         {"action": "create_book", "author": "Арсен", "theme": "маленький пилот и волшебный самолёт"}
         Возвращает ответ в виде JSON.
+        Служебные ключи плана (начинаются с "_") в аргументы не попадают.
         """
         action = command.get("action")
-
-        if action == "create_book":
-            author = command.get("author", "Неизвестно")
-            theme = command.get("theme", "Без темы")
-            result = self.router.create_new_book(author, theme)
+        handler = self.handlers.get(action)
+        if handler is None:
             return {
-                "ok": True,
-                "action": "create_book",
-                "result": result,
-                "message": f"Книга создана для {author} с темой '{theme}'."
+                "ok": False,
+                "message": f"Неизвестное действие: {action}"
             }
 
-        elif action == "add_feedback":
-            book_id = command.get("book_id")
-            note = command.get("note")
-            result = self.router.add_feedback(book_id, note)
+        args = {k: v for k, v in command.items() if k != "action" and not k.startswith("_")}
+        try:
+            args = check_tool_call(action, args)
+        except ToolArgumentsError as e:
             return {
-                "ok": True,
-                "action": "add_feedback",
-                "message": f"Добавил заметку к книге {book_id}: {note}",
-                "result": result,
+                "ok": False,
+                "action": action,
+                "errors": e.errors,
+                "message": f"Некорректные аргументы для {action}: {'; '.join(e.errors)}"
             }
+        return handler(**args)
 
-        elif action == "get_status":
-            book_id = command.get("book_id")
-            result = self.router.get_status(book_id)
-            return {
-                "ok": True,
-                "action": "get_status",
-                "result": result,
-                "message": f"Статус книги {book_id}: {result.get('status')}"
-            }
+    def _create_book(self, author: str, theme: str) -> Dict[str, Any]:
+        result = self.router.create_new_book(author, theme)
+        return {
+            "ok": True,
+            "action": "create_book",
+            "result": result,
+            "message": f"Книга создана для {author} с темой '{theme}'."
+        }
+
+    def _add_feedback(self, book_id: str, note: str) -> Dict[str, Any]:
+        result = self.router.add_feedback(book_id, note)
+        return {
+            "ok": True,
+            "action": "add_feedback",
+            "message": f"Добавил заметку к книге {book_id}: {note}",
+            "result": result,
+        }
 
-        else:
+    def _get_status(self, book_id: str) -> Dict[str, Any]:
+        state = self.router.get_book_status(book_id)
+        if not state.get("ok"):
             return {
                 "ok": False,
-                "message": f"Неизвестное действие: {action}"
+                "action": "get_status",
+                "message": state.get("message", f"Книга {book_id} не найдена.")
             }
+        info = state["info"]
+        return {
+            "ok": True,
+            "action": "get_status",
+            "result": info,
+            "message": f"Статус книги {book_id}: {info.get('status')}"
+        }
 
 
 if __name__ == "__main__":
@@ -76,7 +98,8 @@ if __name__ == "__main__":
     demo_cmds = [
         {"action": "create_book", "author": "Арсен", "theme": "маленький пилот и волшебный самолёт"},
         {"action": "add_feedback", "book_id": "BKS-20251028-111405", "note": "Сделай фон теплее"},
-        {"action": "get_status", "book_id": "BKS-20251028-111405"}
+        {"action": "get_status", "book_id": "BKS-20251028-111405"},
+        {"action": "get_status", "book_id": "не-айди"},
     ]
 
     for cmd in demo_cmds:
@@ -0,0 +1,365 @@
+# src/scene_builder/background_library.py
+
+"""
+background_library.py — библиотека фонов для повторного использования между книгами.
+
+Фоны вроде "cozy bedroom at night" или "moonlit garden" повторяются из книги в книгу.
+Сцена с готовым фоном из библиотеки — один вызов (герой в фон), столько же, сколько
+сцена одной картинкой герой+фон, поэтому вызовов библиотека не сокращает: она держит
+повторяющиеся фоны одинаковыми между книгами. Отдельно нарисованный по ходу книги фон
+окупиться не может (+1 вызов, экономии ноль), поэтому:
+
+- промах — сцена рисуется одним вызовом герой+фон, в библиотеку ничего не попадает;
+- библиотеку наполняют явно: ImageEngine.add_background (общий набор фонов, вне книг)
+  или add() для уже нарисованной картинки;
+
+- сигнатура фона: промт без стиля и общего хвоста BACKGROUND_SUFFIX, слова в нижнем
+  регистре без стоп-слов, грубый стемминг, отсортированный набор — точное совпадение;
+- похожие фоны: TF-IDF (униграммы + биграммы) с косинусом, кандидаты — по инвертированному
+  индексу; фон переиспользуется, если сходство >= BG_SIMILARITY. Всё локально, без сети;
+- пространство фонов разделено по (стиль книги, провайдер:модель): акварельный фон
+  не подставится в книгу другого стиля;
+- картинки — backgrounds/<раздел>/<id>.png в хранилище файлов, индекс — коллекция
+  backgrounds в StorageBackend; в памяти процесса — раздел целиком, перечитывается раз в BG_INDEX_TTL_S.
+
+Бенчмарк:
+    python src/scene_builder/background_library.py --books 40
+"""
+
+from typing import Optional, Dict, Any, List, Set, Tuple
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/scene_builder
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend, utcnow
+from scene_builder.prompt_compiler import BACKGROUND_SUFFIX
+from utils.metrics import REGISTRY
+
+
+BACKGROUND_LIBRARY = os.getenv("BACKGROUND_LIBRARY", "false").lower() == "true"
+BG_SIMILARITY = float(os.getenv("BG_SIMILARITY", "0.8"))
+BG_INDEX_TTL_S = float(os.getenv("BG_INDEX_TTL_S", "300"))
+
+COLLECTION = "backgrounds"
+BLOB_PREFIX = "backgrounds"
+
+# слова, которые не отличают один фон от другого
+STOPWORDS = frozenset((
+    "a an the and or of in on at to with by for from into over under near very "
+    "some its it is are this that soft gentle"
+).split())
+
+_WORD_RE = re.compile(r"[a-zа-яё0-9]+")
+
+BG_LOOKUPS = REGISTRY.counter("booksoul_background_lookups_total", "Background library lookups by outcome")
+
+
+def _stem(word: str) -> str:
+    # грубо, но стабильно: gardens -> garden, trees -> tree, glass остаётся
+    if len(word) > 4 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def background_tokens(prompt: str, style: str = "") -> List[str]:
+    """Значимые слова фона в порядке промта (стиль и BACKGROUND_SUFFIX вырезаны)."""
+    text = (prompt or "").lower()
+    for boiler in (style.lower(), BACKGROUND_SUFFIX.lower()):
+        if boiler:
+            text = text.replace(boiler, " ")
+    return [_stem(w) for w in _WORD_RE.findall(text) if w not in STOPWORDS]
+
+
+def background_features(tokens: List[str]) -> Set[str]:
+    """Униграммы + биграммы: "night garden" и "garden at night" близки, но не одинаковы."""
+    feats = set(tokens)
+    feats.update(f"{a}_{b}" for a, b in zip(tokens, tokens[1:]))
+    return feats
+
+
+def background_signature(tokens: List[str]) -> str:
+    return " ".join(sorted(set(tokens)))
+
+
+def partition_key(style: str, model: str) -> str:
+    return hashlib.sha1(f"{style}|{model}".encode("utf-8")).hexdigest()[:12]
+
+
+class _Partition:
+    """Индекс одного раздела в памяти: записи, сигнатуры, инвертированный индекс, df."""
+
+    def __init__(self):
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.by_signature: Dict[str, str] = {}
+        self.postings: Dict[str, Set[str]] = {}
+        self.loaded_at = 0.0
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        if entry["id"] in self.entries:
+            return
+        entry["features"] = set(entry.get("features") or ())
+        self.entries[entry["id"]] = entry
+        self.by_signature[entry["signature"]] = entry["id"]
+        for f in entry["features"]:
+            self.postings.setdefault(f, set()).add(entry["id"])
+
+    def idf(self, feature: str) -> float:
+        return math.log((len(self.entries) + 1) / (len(self.postings.get(feature, ())) + 1)) + 1.0
+
+    def search(self, features: Set[str]) -> Tuple[Optional[Dict[str, Any]], float]:
+        """Лучший кандидат по косинусу TF-IDF (бинарный tf) и его сходство."""
+        if not features or not self.entries:
+            return None, 0.0
+        idf = {f: self.idf(f) for f in features}
+        dots: Dict[str, float] = {}
+        for f, w in idf.items():
+            for entry_id in self.postings.get(f, ()):
+                dots[entry_id] = dots.get(entry_id, 0.0) + w * w
+        if not dots:
+            return None, 0.0
+        q_norm = math.sqrt(sum(w * w for w in idf.values()))
+        best, best_score = None, 0.0
+        for entry_id, dot in dots.items():
+            entry = self.entries[entry_id]
+            d_norm = math.sqrt(sum(self.idf(f) ** 2 for f in entry["features"]))
+            score = dot / (q_norm * d_norm)
+            if score > best_score:
+                best, best_score = entry, score
+        return best, best_score
+
+
+class BackgroundLibrary:
+    """
+    BackgroundLibrary — поиск готового фона по промту и регистрация новых.
+    Методы синхронные: движок зовёт их через asyncio.to_thread.
+    """
+
+    def __init__(self, storage: StorageBackend, blobs, threshold: float = BG_SIMILARITY,
+                 ttl_s: float = BG_INDEX_TTL_S):
+        self.storage = storage
+        self.blobs = blobs
+        self.threshold = threshold
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._partitions: Dict[str, _Partition] = {}
+        self.exact = 0
+        self.similar = 0
+        self.misses = 0
+        self.added = 0
+        self.saved_seconds = 0.0
+
+    def _partition(self, partition: str) -> _Partition:
+        with self._lock:
+            part = self._partitions.get(partition)
+            fresh = part is not None and time.monotonic() - part.loaded_at < self.ttl_s
+        if fresh:
+            return part
+        # перечитываем раздел: новые фоны от других процессов
+        docs = self.storage.query_docs(COLLECTION, where=[("partition", "==", partition)])
+        with self._lock:
+            part = self._partitions.setdefault(partition, _Partition())
+            for doc in docs:
+                part.add(doc)
+            part.loaded_at = time.monotonic()
+        return part
+
+    def signature_id(self, prompt: str, style: str, partition: str) -> str:
+        sig = background_signature(background_tokens(prompt, style))
+        return hashlib.sha1(f"{partition}|{sig}".encode("utf-8")).hexdigest()[:20]
+
+    def blob_path(self, entry_id: str, partition: str) -> str:
+        return f"{BLOB_PREFIX}/{partition}/{entry_id}.png"
+
+    # ---------------------------------------------------------------------------------
+    # ПОИСК
+    # ---------------------------------------------------------------------------------
+
+    def find(self, prompt: str, style: str, partition: str) -> Optional[Dict[str, Any]]:
+        """
+        Готовый фон для промта или None. Результат: запись индекса + "score" + "match" (exact | similar).
+        """
+        tokens = background_tokens(prompt, style)
+        part = self._partition(partition)
+        with self._lock:
+            entry_id = part.by_signature.get(background_signature(tokens))
+            if entry_id is not None:
+                entry, score, match = part.entries[entry_id], 1.0, "exact"
+            else:
+                entry, score = part.search(background_features(tokens))
+                match = "similar"
+        if entry is None or score < self.threshold:
+            self._count("miss")
+            return None
+
+        self._count(match, float(entry.get("gen_seconds", 0.0)))
+        try:
+            self.storage.increment_docs([(COLLECTION, entry["id"], {"uses": 1}, {"last_used": utcnow()})])
+        except Exception as e:
+            print(f"[BackgroundLibrary] touch {entry['id']} error: {e!r}")
+        return {"id": entry["id"], "path": entry["path"], "prompt": entry.get("prompt", ""),
+                "score": round(score, 4), "match": match}
+
+    def _count(self, outcome: str, saved: float = 0.0) -> None:
+        with self._lock:
+            if outcome == "exact":
+                self.exact += 1
+            elif outcome == "similar":
+                self.similar += 1
+            else:
+                self.misses += 1
+            self.saved_seconds += saved
+        BG_LOOKUPS.inc(outcome=outcome)
+        deltas = {f"backgrounds.{outcome}": 1}
+        if saved:
+            deltas["backgrounds.saved_ms"] = int(saved * 1000)
+        try:
+            self.storage.metrics.incr_many(deltas)
+        except Exception as e:
+            print(f"[BackgroundLibrary] metrics error: {e!r}")
+
+    # ---------------------------------------------------------------------------------
+    # ЗАПИСЬ
+    # ---------------------------------------------------------------------------------
+
+    def add(self, prompt: str, style: str, partition: str, path: str, size: int = 0,
+            gen_seconds: float = 0.0) -> Dict[str, Any]:
+        """Регистрирует нарисованный фон (картинка уже лежит по path)."""
+        tokens = background_tokens(prompt, style)
+        entry_id = self.signature_id(prompt, style, partition)
+        now = utcnow()
+        doc = {
+            "partition": partition,
+            "signature": background_signature(tokens),
+            "features": sorted(background_features(tokens)),
+            "prompt": prompt,
+            "path": path,
+            "size": size,
+            "gen_seconds": round(gen_seconds, 3),
+            "uses": 0,
+            "created_at": now,
+            "last_used": now,
+        }
+        if self.storage.create_doc_once(COLLECTION, entry_id, doc):
+            with self._lock:
+                self.added += 1
+        part = self._partition(partition)
+        with self._lock:
+            part.add({**doc, "id": entry_id})
+        return {"id": entry_id, "path": path}
+
+    # ---------------------------------------------------------------------------------
+    # ОТЧЁТ
+    # ---------------------------------------------------------------------------------
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.exact + self.similar + self.misses
+        reused = self.exact + self.similar
+        return {
+            "lookups": lookups,
+            "exact": self.exact,
+            "similar": self.similar,
+            "misses": self.misses,
+            "reuse_rate": round(reused / lookups, 4) if lookups else 0.0,
+            "added": self.added,
+            "saved_seconds": round(self.saved_seconds, 3),
+            "entries": sum(len(p.entries) for p in self._partitions.values()),
+        }
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import asyncio
+    import random
+    import tempfile
+    from data_layer.memory_storage import MemoryStorage
+    from data_layer.gcs_client import LocalBlobStore
+    from router.main_router import BookSoulRouter
+    from scene_builder.prompt_compiler import BOOK_STYLE, PromptCompiler
+    from scene_builder.image_engine import ImageEngine, FakeImageProvider
+
+    parser = argparse.ArgumentParser(description="BookSoul background library benchmark")
+    parser.add_argument("--books", type=int, default=40)
+    parser.add_argument("--pages", type=int, default=12)
+    args = parser.parse_args()
+
+    random.seed(7)
+    places = ["cozy bedroom", "moonlit garden", "forest clearing", "sandy beach", "snowy village street",
+              "kitchen", "school classroom", "mountain meadow", "city park", "castle hall"]
+    times = ["at night", "in the morning", "at sunset", ""]
+    lights = ["warm lamp light", "soft moonlight", "golden sunlight", ""]
+    moods = ["calm", "magical", "cheerful"]
+
+    def run(with_library: bool) -> Tuple[int, int, Dict[str, Any]]:
+        store = MemoryStorage()
+        blobs = LocalBlobStore(tempfile.mkdtemp(prefix="booksoul_bg_"))
+        router = BookSoulRouter(storage=store)
+        compiler = PromptCompiler(store)
+        library = BackgroundLibrary(store, blobs) if with_library else None
+        provider = FakeImageProvider(0.0, 0.0)
+        engine = ImageEngine(store, blobs, provider, library=library)
+        rnd = random.Random(11)
+
+        async def seed() -> None:
+            # общий набор фонов: по одному на место, один раз на все книги
+            for place in places:
+                for time_of_day, light in zip(times, lights):
+                    setting = {"place": place, "time_of_day": time_of_day, "light": light, "atmosphere": "calm"}
+                    _, bg = compiler.compile_scene({}, {"hero": {}, "setting": setting})
+                    await engine.add_background(bg, BOOK_STYLE)
+
+        async def draw_all() -> None:
+            for i in range(args.books):
+                book_id = f"BKS-20251201-{i:06d}"
+                store.create_book(book_id, child_name="Аня", theme="лес", status="drawing")
+                book = store.get_book(book_id)
+                for page in range(1, args.pages + 1):
+                    setting = {"place": rnd.choice(places), "time_of_day": rnd.choice(times),
+                               "light": rnd.choice(lights), "atmosphere": rnd.choice(moods)}
+                    hero = {"action": f"action {page}", "emotion": "happy", "clothing": "pajamas", "toy_like": False}
+                    main, bg = compiler.compile_scene(book, {"hero": hero, "setting": setting})
+                    router.register_scene(book_id, page, f"Страница {page}", main, bg)
+                await engine.draw_book(book_id)
+
+        if library is not None:
+            asyncio.run(seed())
+        seeded = provider.calls
+        asyncio.run(draw_all())
+        return provider.calls - seeded, seeded, library.stats() if library else {}
+
+    calls_off, _, _ = run(with_library=False)
+    calls_on, seeded, stats = run(with_library=True)
+    scenes = args.books * args.pages
+    reused = stats["exact"] + stats["similar"]
+    print(json.dumps(stats, ensure_ascii=False))
+    print(f"{args.books} книг x {args.pages} страниц ({scenes} сцен)")
+    print(f"  без библиотеки (герой+фон одним вызовом): {calls_off} вызовов, "
+          f"{calls_off / args.books:.1f} на книгу")
+    print(f"  с библиотекой: {calls_on} вызовов, {calls_on / args.books:.1f} на книгу — "
+          f"{reused} сцен на общем фоне; набор фонов: {seeded} вызовов один раз на все книги")
+    assert calls_on <= calls_off, "библиотека не должна добавлять вызовов книгам"
+
+    # похожие формулировки
+    lib = BackgroundLibrary(MemoryStorage(), None)
+    p = partition_key("watercolor", "fake:fake-1")
+    lib.add("Cozy bedroom, at night, warm lamp light, calm atmosphere. watercolor. " + BACKGROUND_SUFFIX,
+            "watercolor", p, "x.png")
+    for q in ("cozy bedrooms at night, warm lamp light, calm atmosphere",
+              "Cozy bedroom at night, warm lamp light",
+              "moonlit garden at night, calm atmosphere"):
+        hit = lib.find(q, "watercolor", p)
+        print(f"{q!r}: {hit['match'] + ' ' + str(hit['score']) if hit else 'нет'}")
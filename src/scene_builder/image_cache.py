@@ -0,0 +1,330 @@
+# src/scene_builder/image_cache.py
+
+"""
+image_cache.py — кэш сгенерированных иллюстраций по содержимому запроса.
+
+Правка "перегенерить сцену 2" перезапускает рисование книги, ретрай задачи — страницу;
+сцены с теми же входами не должны снова оплачиваться генерацией. Ключ — sha256 от:
+    нормализованный prompt_main + prompt_background, хэш фото-референса, стиль, провайдер/модель.
+
+- картинка лежит в хранилище файлов: image_cache/<ключ[:2]>/<ключ>.png (GCS / локальная папка);
+- индекс — коллекция image_cache в StorageBackend (путь, размер, время генерации, хиты, last_used);
+- попадание копирует картинку в путь сцены (серверное копирование), так вытеснение из кэша
+  не ломает уже нарисованные книги;
+- вытеснение по размеру: суммарный объём сверх IMAGE_CACHE_MAX_MB -> самые давно
+  использованные записи удаляются до 90% бюджета;
+- хиты / промахи / сэкономленное время генерации — в метриках процесса и в роллапах
+  (image_cache.*), отчёт — ImageCache.report();
+- у записи есть phash (phash.py) — вторичный ключ: near(phash) находит почти одинаковые
+  картинки под разными промтами (дедупликация, разбор жалоб "опять та же картинка").
+
+Бенчмарк:
+    python src/scene_builder/image_cache.py
+"""
+
+from typing import Optional, Dict, Any, List
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/scene_builder
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend, utcnow
+from scene_builder.phash import HammingIndex, DUP_DISTANCE
+from utils.metrics import REGISTRY
+
+
+IMAGE_CACHE = os.getenv("IMAGE_CACHE", "true").lower() == "true"
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "20480"))
+
+INDEX_COLLECTION = "image_cache"
+META_COLLECTION = "image_cache_meta"
+BLOB_PREFIX = "image_cache"
+
+# после вытеснения объём опускается до этой доли бюджета (чтобы не вытеснять на каждой записи)
+EVICT_TO = 0.9
+EVICT_BATCH = 50
+# индекс phash в памяти перечитывается не чаще раза в N секунд
+NEAR_INDEX_TTL_S = 300.0
+
+_WS_RE = re.compile(r"\s+")
+
+CACHE_LOOKUPS = REGISTRY.counter("booksoul_image_cache_total", "Image cache lookups by outcome")
+CACHE_SAVED = REGISTRY.counter("booksoul_image_cache_saved_seconds_total", "Generation time saved by image cache hits")
+
+
+def normalize_prompt(prompt: str) -> str:
+    # пробелы/переносы и регистр не меняют картинку; пунктуация и слова — меняют
+    return _WS_RE.sub(" ", prompt or "").strip().lower()
+
+
+def reference_hash(data: Optional[bytes]) -> str:
+    return hashlib.sha1(data).hexdigest() if data else ""
+
+
+def image_cache_key(prompt_main: str, prompt_background: str, reference: str = "",
+                    style: str = "", model: str = "") -> str:
+    """
+    Ключ кэша. reference — reference_hash(фото), model — "<провайдер>:<модель>".
+    """
+    src = json.dumps([normalize_prompt(prompt_main), normalize_prompt(prompt_background),
+                      reference, style, model], ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(src.encode("utf-8")).hexdigest()
+
+
+def cache_blob_path(key: str, ext: str = "png") -> str:
+    return f"{BLOB_PREFIX}/{key[:2]}/{key}.{ext}"
+
+
+class ImageCache:
+    """
+    ImageCache — индекс в хранилище + картинки в хранилище файлов.
+    Все методы синхронные: движок зовёт их через asyncio.to_thread.
+    Ошибки кэша не ломают рисование — худший случай это промах.
+    """
+
+    def __init__(self, storage: StorageBackend, blobs, max_bytes: int = IMAGE_CACHE_MAX_MB * 1024 * 1024):
+        self.storage = storage
+        self.blobs = blobs
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.stored = 0
+        self.evicted = 0
+        self._near: Optional[HammingIndex] = None
+        self._near_loaded = 0.0
+
+    # ---------------------------------------------------------------------------------
+    # ЧТЕНИЕ
+    # ---------------------------------------------------------------------------------
+
+    def fetch(self, key: str, dest_path: str) -> Optional[Dict[str, Any]]:
+        """
+        Попадание — картинка скопирована в dest_path, возвращается
+        {"url", "phash", "dhash", "std"} (хэши — чтобы не считать их заново); промах — None.
+        """
+        entry = None
+        try:
+            entry = self.storage.get_doc(INDEX_COLLECTION, key)
+            if entry is not None:
+                url = self.blobs.copy(entry["path"], dest_path)
+        except Exception as e:
+            # запись индекса есть, а файла нет (удалён руками / гонка вытеснения) — промах
+            print(f"[ImageCache] fetch {key[:12]} error: {e!r}")
+            entry = None
+
+        if entry is None:
+            self._count(hit=False)
+            return None
+
+        saved = float(entry.get("gen_seconds", 0.0))
+        self._count(hit=True, saved=saved)
+        try:
+            self.storage.increment_docs([(INDEX_COLLECTION, key, {"hits": 1}, {"last_used": utcnow()})])
+        except Exception as e:
+            print(f"[ImageCache] touch {key[:12]} error: {e!r}")
+        return {"url": url, "phash": entry.get("phash", ""), "dhash": entry.get("dhash", ""),
+                "std": entry.get("std", 255.0)}
+
+    def near(self, phash: str, radius: int = DUP_DISTANCE) -> List[Dict[str, Any]]:
+        """
+        Записи кэша с pHash в пределах radius бит, ближние первыми: [{"key", "path", "distance"}].
+        """
+        with self._lock:
+            stale = self._near is None or time.monotonic() - self._near_loaded > NEAR_INDEX_TTL_S
+        if stale:
+            index = HammingIndex(radius=radius)
+            for doc in self.storage.query_docs(INDEX_COLLECTION):
+                if doc.get("phash"):
+                    index.add(int(doc["phash"], 16), (doc["id"], doc["path"]))
+            with self._lock:
+                self._near, self._near_loaded = index, time.monotonic()
+        return [{"key": key, "path": path, "distance": d}
+                for d, _, (key, path) in self._near.query(int(phash, 16), radius)]
+
+    def _count(self, hit: bool, saved: float = 0.0) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.saved_seconds += saved
+            else:
+                self.misses += 1
+        CACHE_LOOKUPS.inc(outcome="hit" if hit else "miss")
+        deltas = {"image_cache.hits": 1, "image_cache.saved_ms": int(saved * 1000)} if hit \
+            else {"image_cache.misses": 1}
+        if hit:
+            CACHE_SAVED.inc(saved)
+        try:
+            self.storage.metrics.incr_many(deltas)
+        except Exception as e:
+            print(f"[ImageCache] metrics error: {e!r}")
+
+    # ---------------------------------------------------------------------------------
+    # ЗАПИСЬ
+    # ---------------------------------------------------------------------------------
+
+    def put(self, key: str, src_path: str, size: int, gen_seconds: float,
+            content_type: str = "image/png", model: str = "",
+            hashes: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Кладёт нарисованную картинку сцены (src_path) в кэш под ключом.
+        hashes — image_hashes() картинки (вторичный ключ phash).
+        """
+        path = cache_blob_path(key)
+        try:
+            self.blobs.copy(src_path, path)
+            now = utcnow()
+            created = self.storage.create_doc_once(INDEX_COLLECTION, key, {
+                "path": path,
+                "size": size,
+                "content_type": content_type,
+                "model": model,
+                "gen_seconds": round(gen_seconds, 3),
+                "hits": 0,
+                "created_at": now,
+                "last_used": now,
+                **{k: hashes[k] for k in ("phash", "dhash", "std") if hashes and k in hashes},
+            })
+            if not created:
+                return
+            if hashes and hashes.get("phash"):
+                with self._lock:
+                    if self._near is not None:
+                        self._near.add(int(hashes["phash"], 16), (key, path))
+            self.storage.increment_docs([(META_COLLECTION, "totals", {"bytes": size, "entries": 1},
+                                          {"updated_at": now})])
+            with self._lock:
+                self.stored += 1
+        except Exception as e:
+            print(f"[ImageCache] put {key[:12]} error: {e!r}")
+            return
+        self.evict_if_needed()
+
+    def evict_if_needed(self) -> int:
+        """
+        Объём сверх max_bytes -> удаляем давно не использованные записи до EVICT_TO бюджета.
+        """
+        totals = self.storage.get_doc(META_COLLECTION, "totals") or {}
+        total = int(totals.get("bytes", 0))
+        if total <= self.max_bytes:
+            return 0
+
+        target = int(self.max_bytes * EVICT_TO)
+        removed = 0
+        while total > target:
+            batch = self.storage.query_docs(INDEX_COLLECTION, order_by="last_used", limit=EVICT_BATCH)
+            if not batch:
+                break
+            for entry in batch:
+                if total <= target:
+                    break
+                try:
+                    self.blobs.delete(entry["path"])
+                except Exception as e:
+                    print(f"[ImageCache] evict blob {entry['path']} error: {e!r}")
+                if self.storage.delete_docs(INDEX_COLLECTION, [entry["id"]]):
+                    size = int(entry.get("size", 0))
+                    total -= size
+                    removed += 1
+                    self.storage.increment_docs([(META_COLLECTION, "totals", {"bytes": -size, "entries": -1},
+                                                  {"updated_at": utcnow()})])
+        with self._lock:
+            self.evicted += removed
+        return removed
+
+    # ---------------------------------------------------------------------------------
+    # ОТЧЁТ
+    # ---------------------------------------------------------------------------------
+
+    def stats(self) -> Dict[str, Any]:
+        """Счётчики процесса."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+            "stored": self.stored,
+            "evicted": self.evicted,
+        }
+
+    def report(self, hours: int = 24) -> Dict[str, Any]:
+        """Доля попаданий и сэкономленное время за окно (роллапы) + объём кэша."""
+        counts = self.storage.metrics.summarize(hours=hours)["totals"].get("image_cache", {})
+        hits = counts.get("hits", 0)
+        misses = counts.get("misses", 0)
+        totals = self.storage.get_doc(META_COLLECTION, "totals") or {}
+        return {
+            "hours": hours,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "saved_seconds": round(counts.get("saved_ms", 0) / 1000.0, 1),
+            "entries": int(totals.get("entries", 0)),
+            "size_mb": round(int(totals.get("bytes", 0)) / 1024 / 1024, 2),
+            "max_mb": round(self.max_bytes / 1024 / 1024, 2),
+        }
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import asyncio
+    import tempfile
+    from data_layer.memory_storage import MemoryStorage
+    from data_layer.gcs_client import LocalBlobStore
+    from router.main_router import BookSoulRouter
+    from scene_builder.image_engine import ImageEngine, FakeImageProvider
+
+    pages = 24
+    store = MemoryStorage()
+    blobs = LocalBlobStore(tempfile.mkdtemp(prefix="booksoul_image_cache_"))
+    router = BookSoulRouter(storage=store)
+    cache = ImageCache(store, blobs)
+    provider = FakeImageProvider(0.2, 0.6)
+    engine = ImageEngine(store, blobs, provider, cache=cache)
+
+    book_id = "BKS-20251201-000001"
+    store.create_book(book_id, child_name="Аня", theme="лес", status="drawing")
+    for page in range(1, pages + 1):
+        router.register_scene(book_id, page, f"Страница {page}", f"hero {page}", f"forest {page}")
+
+    async def bench() -> None:
+        first = await engine.draw_book(book_id)
+        calls_first = provider.calls
+
+        # ретрай задач / правка одной сцены: все страницы снова в redo, входы у 23 из 24 те же
+        for scene in store.list_scenes(book_id):
+            store.update_scene_image_url(book_id, scene["id"], scene["image_url"], status="redo")
+        router.register_scene(book_id, 2, "Страница 2", "hero 2, now smiling", "forest 2")
+        second = await engine.draw_book(book_id)
+
+        print(f"первый проход: {first['wall_s']:.2f} с, вызовов провайдера {calls_first}")
+        print(f"перерисовка:   {second['wall_s']:.2f} с, вызовов провайдера {provider.calls - calls_first}")
+        print(json.dumps(cache.stats(), ensure_ascii=False))
+        print(json.dumps(cache.report(), ensure_ascii=False))
+        scene2 = store.get_doc(f"books/{book_id}/scenes", "scene_002") or {}
+        if scene2.get("phash"):
+            print(f"near(phash сцены 2): {[(n['key'][:12], n['distance']) for n in cache.near(scene2['phash'])]}")
+
+        # вытеснение: бюджет на 10 картинок
+        small = ImageCache(store, blobs, max_bytes=10 * store.get_doc(INDEX_COLLECTION, cache_key_any())["size"])
+        print(f"вытеснено при бюджете в 10 картинок: {small.evict_if_needed()}, "
+              f"осталось записей: {len(store.query_docs(INDEX_COLLECTION))}")
+
+    def cache_key_any() -> str:
+        return store.query_docs(INDEX_COLLECTION, limit=1)[0]["id"]
+
+    asyncio.run(bench())
@@ -0,0 +1,650 @@
+# src/scene_builder/image_engine.py
+
+"""
+image_engine.py — SceneBuilder: иллюстрации сцен книги (Nano Banana) по задачам "scene_generation".
+
+register_scene ставит по задаче на страницу; движок берёт все сцены книги без картинки
+и рисует их одновременно:
+- два предела: на книгу (IMAGE_BOOK_CONCURRENCY) и на процесс (IMAGE_GLOBAL_CONCURRENCY),
+  так одна большая книга не забирает весь лимит провайдера у остальных;
+- картинка от провайдера кусками уходит в хранилище (blobs.open_write, resumable upload),
+  ссылка — в сцену (update_scene: image_url, status="drawn"), задача сцены -> done;
+- временные ошибки (429 / 5xx / таймаут) — ретраи с экспоненциальной паузой и full jitter,
+  чтобы 24 упавшие разом страницы не били в провайдера снова синхронно;
+- перед провайдером — ImageCache (image_cache.py): те же промт, фото, стиль и модель не
+  оплачиваются второй раз; одинаковые страницы в одном проходе ждут одну генерацию;
+- с BackgroundLibrary (background_library.py) готовый фон из библиотеки переиспользуется
+  между книгами (герой дорисовывается в него), при промахе — одна картинка герой+фон; по
+  ходу книги фоны отдельно не рисуются — библиотеку наполняет add_background, вне книг;
+- IMAGE_QA: перцептивный хэш каждой картинки (phash.py) до публикации — пустой кадр не
+  сохраняется и идёт в ретрай; phash и флаги (near_duplicate внутри книги) — в документ сцены.
+
+Книга из 24 страниц рисуется примерно за время самой медленной страницы, а не за сумму.
+
+Провайдер заменяем: GeminiImageProvider (прод, GEMINI_API_KEY) / FakeImageProvider (тесты, бенчмарк).
+
+Бенчмарк:
+    python src/scene_builder/image_engine.py --pages 24
+"""
+
+from typing import Optional, Dict, Any, List, AsyncIterator, Tuple
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+
+import numpy as np
+
+try:
+    import httpx
+except Exception:
+    httpx = None
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/scene_builder
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend
+from scene_builder.background_library import BackgroundLibrary, partition_key
+from scene_builder.image_cache import ImageCache, image_cache_key, reference_hash
+from scene_builder.phash import ImageQA, image_hashes, is_blank
+from scene_builder.prompt_compiler import BOOK_STYLE
+from utils.metrics import REGISTRY
+
+
+IMAGE_PROVIDER = os.getenv("IMAGE_PROVIDER", "gemini")        # gemini | fake
+IMAGE_MODEL = os.getenv("IMAGE_MODEL", "gemini-2.5-flash-image")
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+
+IMAGE_BOOK_CONCURRENCY = int(os.getenv("IMAGE_BOOK_CONCURRENCY", "24"))
+IMAGE_GLOBAL_CONCURRENCY = int(os.getenv("IMAGE_GLOBAL_CONCURRENCY", "48"))
+IMAGE_MAX_ATTEMPTS = int(os.getenv("IMAGE_MAX_ATTEMPTS", "4"))
+IMAGE_BACKOFF_BASE_S = float(os.getenv("IMAGE_BACKOFF_BASE_S", "1.0"))
+IMAGE_BACKOFF_MAX_S = float(os.getenv("IMAGE_BACKOFF_MAX_S", "20.0"))
+IMAGE_TIMEOUT_S = float(os.getenv("IMAGE_TIMEOUT_S", "120"))
+IMAGE_QA = os.getenv("IMAGE_QA", "true").lower() == "true"
+
+# кусок потоковой записи в хранилище (GCS: кратно 256 KiB)
+IMAGE_CHUNK_SIZE = 256 * 1024
+
+JOB_TYPE = "scene_generation"
+
+# сцены в этих статусах уже нарисованы (redo — перерисовать)
+DRAWN_STATUSES = ("drawn", "approved")
+
+# секунды: от быстрой страницы до хвостов генерации с ретраями
+IMAGE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 15.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0, 180.0)
+
+IMAGE_SECONDS = REGISTRY.histogram("booksoul_image_seconds", "Scene image generation time incl. upload",
+                                   buckets=IMAGE_BUCKETS)
+IMAGE_BOOK_SECONDS = REGISTRY.histogram("booksoul_image_book_seconds", "Wall time to draw all pending scenes of a book",
+                                        buckets=IMAGE_BUCKETS)
+IMAGE_CALLS = REGISTRY.counter("booksoul_image_calls_total", "Image provider attempts by outcome")
+IMAGE_QA_FAILURES = REGISTRY.counter("booksoul_image_qa_rejected_total", "Generated images rejected by QA before upload")
+
+
+class ImageProviderError(RuntimeError):
+    """
+    Ошибка провайдера картинок. retryable — имеет смысл повторить (429 / 5xx / сеть),
+    retry_after — подсказка провайдера в секундах, если была.
+    """
+
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.attempts = 0
+
+
+# ---------------------------------------------------------------------------------
+# ПРОВАЙДЕРЫ
+# ---------------------------------------------------------------------------------
+#
+# Интерфейс провайдера:
+#   name: str
+#   model: str            — часть ключа кэша: другая модель = другая картинка
+#   content_type: str
+#   async def generate(request: Dict[str, Any]) -> AsyncIterator[bytes]   — куски картинки
+#
+# request: kind (scene | background), book_id, scene_id, page, prompt_main, prompt_background,
+#          reference (bytes | None — фото ребёнка), background (bytes | None — готовый фон для героя)
+
+class GeminiImageProvider:
+    """
+    Nano Banana (Gemini image) через REST generateContent.
+    Сцена: промт героя + фон одной картинкой (или герой в переданный готовый фон),
+    фото ребёнка — reference для FACE_LOCK. Фон: только prompt_main, без фото.
+    """
+
+    name = "gemini"
+    content_type = "image/png"
+    model = IMAGE_MODEL
+
+    def __init__(self, api_key: Optional[str] = None, model: str = IMAGE_MODEL, timeout_s: float = IMAGE_TIMEOUT_S):
+        if httpx is None:
+            raise RuntimeError("GeminiImageProvider: httpx не установлен.")
+        self.api_key = api_key or os.getenv("GEMINI_API_KEY", "")
+        if not self.api_key:
+            raise RuntimeError("GeminiImageProvider: GEMINI_API_KEY не задан.")
+        self.model = model
+        self._client = httpx.AsyncClient(timeout=timeout_s)
+
+    @staticmethod
+    def _prompt(request: Dict[str, Any]) -> str:
+        if request.get("background"):
+            return (f"{request['prompt_main']}\n"
+                    "Place the hero into the provided background image. Keep the background unchanged.")
+        background = request.get("prompt_background") or ""
+        if not background:
+            return request["prompt_main"]
+        return f"{request['prompt_main']}\nBackground: {background}"
+
+    async def generate(self, request: Dict[str, Any]) -> AsyncIterator[bytes]:
+        parts: List[Dict[str, Any]] = [{"text": self._prompt(request)}]
+        if request.get("reference"):
+            parts.append({"inline_data": {"mime_type": "image/jpeg",
+                                          "data": base64.b64encode(request["reference"]).decode("ascii")}})
+        if request.get("background"):
+            parts.append({"inline_data": {"mime_type": "image/png",
+                                          "data": base64.b64encode(request["background"]).decode("ascii")}})
+        body = {"contents": [{"parts": parts}], "generationConfig": {"responseModalities": ["IMAGE"]}}
+
+        try:
+            r = await self._client.post(f"{GEMINI_API_BASE}/models/{self.model}:generateContent",
+                                        params={"key": self.api_key}, json=body)
+        except httpx.HTTPError as e:
+            raise ImageProviderError(f"network: {e!r}") from e
+
+        if r.status_code != 200:
+            retry_after = r.headers.get("retry-after")
+            raise ImageProviderError(
+                f"HTTP {r.status_code}: {r.text[:200]}",
+                retryable=r.status_code == 429 or r.status_code >= 500,
+                retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+            )
+
+        data = None
+        for cand in r.json().get("candidates") or []:
+            for part in (cand.get("content") or {}).get("parts") or []:
+                inline = part.get("inlineData") or part.get("inline_data")
+                if inline and inline.get("data"):
+                    data = base64.b64decode(inline["data"])
+                    break
+            if data:
+                break
+        if not data:
+            # модель ответила текстом (отказ / фильтр) — повтор может помочь
+            raise ImageProviderError("no image in response")
+
+        for i in range(0, len(data), IMAGE_CHUNK_SIZE):
+            yield data[i:i + IMAGE_CHUNK_SIZE]
+
+
+def fake_png(seed: str, size: int = 64, blank: bool = False) -> bytes:
+    """
+    Валидный PNG без Pillow: цветные волны, частоты и фаза — из seed (разные seed — разные картинки).
+    blank — однотонный кадр, как неудачная генерация.
+    """
+    rnd = random.Random(zlib.crc32(seed.encode("utf-8")))
+    yy, xx = np.mgrid[0:size, 0:size] / size
+    planes = [127.5 + 127.5 * np.sin(2 * np.pi * (rnd.uniform(0.5, 3) * xx + rnd.uniform(0.5, 3) * yy)
+                                      + rnd.uniform(0, 2 * np.pi)) * (0 if blank else 1) for _ in range(3)]
+    rgb = np.stack(planes, axis=-1).astype(np.uint8)
+    raw = b"".join(b"\x00" + rgb[y].tobytes() for y in range(size))
+
+    def chunk(tag: bytes, payload: bytes) -> bytes:
+        return struct.pack(">I", len(payload)) + tag + payload + struct.pack(">I", zlib.crc32(tag + payload))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+
+class FakeImageProvider:
+    """
+    Стенд провайдера без сети: задержка страницы — равномерно в [latency_min_s, latency_max_s],
+    fail_rate — доля попыток с временной ошибкой (проверка ретраев),
+    blank_rate — доля однотонных кадров (проверка QA).
+    """
+
+    name = "fake"
+    content_type = "image/png"
+    model = "fake-1"
+
+    def __init__(self, latency_min_s: float = 0.2, latency_max_s: float = 0.6, fail_rate: float = 0.0,
+                 image_size: int = 64, blank_rate: float = 0.0):
+        self.latency_min_s = latency_min_s
+        self.latency_max_s = latency_max_s
+        self.fail_rate = fail_rate
+        self.image_size = image_size
+        self.blank_rate = blank_rate
+        self.calls = 0
+        self.calls_by_kind: Dict[str, int] = {}
+
+    async def generate(self, request: Dict[str, Any]) -> AsyncIterator[bytes]:
+        self.calls += 1
+        kind = request.get("kind", "scene")
+        self.calls_by_kind[kind] = self.calls_by_kind.get(kind, 0) + 1
+        await asyncio.sleep(random.uniform(self.latency_min_s, self.latency_max_s))
+        if random.random() < self.fail_rate:
+            raise ImageProviderError("injected 503")
+        seed = f"{request['book_id']}/{request['scene_id']}/{request.get('kind', 'scene')}"
+        data = fake_png(seed, self.image_size, blank=random.random() < self.blank_rate)
+        for i in range(0, len(data), IMAGE_CHUNK_SIZE):
+            yield data[i:i + IMAGE_CHUNK_SIZE]
+
+
+def get_image_provider(name: str = IMAGE_PROVIDER):
+    if name == "fake":
+        return FakeImageProvider()
+    if name == "gemini":
+        return GeminiImageProvider()
+    raise ValueError(f"unknown IMAGE_PROVIDER: {name}")
+
+
+# ---------------------------------------------------------------------------------
+# ДВИЖОК
+# ---------------------------------------------------------------------------------
+
+def backoff_delay(attempt: int, base_s: float = IMAGE_BACKOFF_BASE_S, max_s: float = IMAGE_BACKOFF_MAX_S,
+                  retry_after: Optional[float] = None) -> float:
+    """Full jitter: случайно в [0, min(max, base * 2^attempt)], но не меньше retry_after провайдера."""
+    delay = random.uniform(0, min(max_s, base_s * (2 ** attempt)))
+    return max(delay, retry_after or 0.0)
+
+
+# новая картинка сцены — прежняя стилизованная (style_corrector) к ней уже не относится;
+# страницы, которые style_corrector сейчас не правит, иначе ушли бы в PDF старыми
+STALE_STYLE = {"styled_url": "", "styled_hash": ""}
+
+
+def scene_blob_path(book_id: str, scene_id: str) -> str:
+    return f"books/{book_id}/scenes/{scene_id}.png"
+
+
+class ImageEngine:
+    """
+    ImageEngine — все недорисованные сцены книги одновременно, в пределах двух семафоров.
+    Один экземпляр на процесс: глобальный предел общий для всех книг.
+    Хранилище синхронное — его вызовы уходят в asyncio.to_thread и не держат цикл.
+    """
+
+    def __init__(self, storage: StorageBackend, blobs, provider,
+                 cache: Optional[ImageCache] = None,
+                 library: Optional[BackgroundLibrary] = None,
+                 book_limit: int = IMAGE_BOOK_CONCURRENCY,
+                 global_limit: int = IMAGE_GLOBAL_CONCURRENCY,
+                 max_attempts: int = IMAGE_MAX_ATTEMPTS,
+                 backoff_base_s: float = IMAGE_BACKOFF_BASE_S,
+                 timeout_s: float = IMAGE_TIMEOUT_S,
+                 qa: bool = IMAGE_QA):
+        self.fs = storage
+        self.blobs = blobs
+        self.provider = provider
+        self.cache = cache
+        self.library = library
+        self.book_limit = max(1, book_limit)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base_s = backoff_base_s
+        self.timeout_s = timeout_s
+        self.qa = qa
+        self._global = asyncio.Semaphore(max(1, global_limit))
+        self._active: Dict[str, asyncio.Task] = {}
+        # ключ кэша -> генерация в процессе (её ждут страницы с теми же входами)
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    # ---------------------------------------------------------------------------------
+    # КНИГА
+    # ---------------------------------------------------------------------------------
+
+    async def draw_book(self, book_id: str, force: bool = False) -> Dict[str, Any]:
+        """
+        Рисует сцены книги без картинки (и redo). force — перерисовать все, мимо кэша.
+        Повторный вызов для книги, которая уже рисуется, ждёт тот же проход.
+        """
+        task = self._active.get(book_id)
+        if task is None:
+            task = asyncio.ensure_future(self._draw_book(book_id, force))
+            self._active[book_id] = task
+            task.add_done_callback(lambda _: self._active.pop(book_id, None))
+        return await asyncio.shield(task)
+
+    async def _draw_book(self, book_id: str, force: bool) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        book = await asyncio.to_thread(self.fs.get_book, book_id)
+        if not book:
+            return {"book_id": book_id, "ok": False, "error": "book not found"}
+        scenes = await asyncio.to_thread(self.fs.list_scenes, book_id)
+        todo = [s for s in scenes
+                if force or s.get("status") == "redo"
+                or not (s.get("image_url") and s.get("status") in DRAWN_STATUSES)]
+
+        reference = await self._reference(book) if todo else None
+        style = book.get("style") or BOOK_STYLE
+        cache_parts = (reference_hash(reference), style, f"{self.provider.name}:{self.provider.model}")
+        book_sem = asyncio.Semaphore(self.book_limit)
+        # индекс почти-дублей: уже нарисованные страницы, которые не перерисовываем
+        redraw = {s["id"] for s in todo}
+        qa = ImageQA(s for s in scenes if s["id"] not in redraw) if self.qa else None
+        results = await asyncio.gather(*(self._draw_scene(book_id, s, reference, book_sem, cache_parts, force, qa)
+                                         for s in todo))
+        by_scene = {r["scene_id"]: r for r in results}
+        wall = time.perf_counter() - t0
+
+        await asyncio.to_thread(self._close_jobs, book_id, by_scene)
+
+        failed = [r for r in results if not r["ok"]]
+        drawn_all = not failed and all(s.get("image_url") or s["id"] in by_scene for s in scenes)
+        if todo and drawn_all and book.get("status") == "drawing":
+            await asyncio.to_thread(self.fs.update_book_status, book_id, "styling")
+        if todo:
+            IMAGE_BOOK_SECONDS.observe(wall, provider=self.provider.name)
+
+        page_times = [r["seconds"] for r in results]
+        return {
+            "book_id": book_id,
+            "ok": not failed,
+            "scenes": len(scenes),
+            "drawn": len(results) - len(failed),
+            "cached": sum(1 for r in results if r.get("cached")),
+            "backgrounds_reused": sum(1 for r in results if r.get("background_reused")),
+            "qa_flagged": [{"scene_id": r["scene_id"], "flags": r["qa_flags"]} for r in results if r.get("qa_flags")],
+            "failed": [{"scene_id": r["scene_id"], "error": r["error"]} for r in failed],
+            "attempts": sum(r["attempts"] for r in results),
+            "wall_s": round(wall, 3),
+            "slowest_page_s": round(max(page_times), 3) if page_times else 0.0,
+            "sum_pages_s": round(sum(page_times), 3),
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "library": self.library.stats() if self.library is not None else None,
+        }
+
+    async def _reference(self, book: Dict[str, Any]) -> Optional[bytes]:
+        """
+        Фото ребёнка для FACE_LOCK — один раз на проход draw_book (общее для всех его сцен).
+        photo_url: путь/gs:// в хранилище файлов, file:// или http(s). Между проходами не
+        кэшируется: сбой загрузки не оставляет следующие проходы без фото, память не растёт с книгами.
+        """
+        book_id = book["id"]
+        photo = book.get("photo_url") or ""
+        data = None
+        try:
+            if photo.startswith(("http://", "https://")) and httpx is not None:
+                async with httpx.AsyncClient(timeout=30) as client:
+                    r = await client.get(photo)
+                    r.raise_for_status()
+                    data = r.content
+            elif photo.startswith("gs://"):
+                data = await asyncio.to_thread(self.blobs.get_bytes, photo.split("/", 3)[3])
+            elif photo.startswith("file://"):
+                data = await asyncio.to_thread(lambda: open(photo[len("file://"):], "rb").read())
+            elif photo:
+                data = await asyncio.to_thread(self.blobs.get_bytes, photo)
+        except Exception as e:
+            print(f"[ImageEngine] reference photo for {book_id} not loaded: {e!r}")
+        return data
+
+    def _close_jobs(self, book_id: str, by_scene: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Закрывает pending-задачи scene_generation нарисованных сцен.
+        Старые задачи без scene_id закрываются, только если прошли все сцены.
+        """
+        if not by_scene:
+            return
+        all_ok = all(r["ok"] for r in by_scene.values())
+        for job in self.fs.list_jobs(job_type=JOB_TYPE, status="pending", book_id=book_id):
+            res = by_scene.get(job.get("scene_id") or "")
+            try:
+                if res is not None:
+                    self.fs.update_job_status(job["id"], "done" if res["ok"] else "error",
+                                              result_url=res.get("image_url") or None, job_type=JOB_TYPE)
+                elif not job.get("scene_id") and all_ok:
+                    self.fs.update_job_status(job["id"], "done", job_type=JOB_TYPE)
+            except Exception as e:
+                print(f"[ImageEngine] job {job['id']} update error: {e!r}")
+
+    # ---------------------------------------------------------------------------------
+    # СЦЕНА
+    # ---------------------------------------------------------------------------------
+
+    async def _draw_scene(self, book_id: str, scene: Dict[str, Any], reference: Optional[bytes],
+                          book_sem: asyncio.Semaphore, cache_parts: Tuple[str, str, str],
+                          force: bool = False, qa: Optional[ImageQA] = None) -> Dict[str, Any]:
+        scene_id = scene["id"]
+        request = {
+            "kind": "scene",
+            "book_id": book_id,
+            "scene_id": scene_id,
+            "page": scene.get("page"),
+            "prompt_main": scene.get("image_prompt_main") or scene.get("text") or "",
+            "prompt_background": scene.get("image_prompt_background") or "",
+            "reference": reference,
+        }
+        path = scene_blob_path(book_id, scene_id)
+        t0 = time.perf_counter()
+
+        key = None
+        if self.cache is not None:
+            key = image_cache_key(request["prompt_main"], request["prompt_background"], *cache_parts)
+            while not force:
+                # те же входы уже рисуются в этом процессе — ждём их и берём из кэша
+                pending = self._inflight.get(key)
+                if pending is not None:
+                    await asyncio.shield(pending)
+                hit = await asyncio.to_thread(self.cache.fetch, key, path)
+                if hit:
+                    fields = {**self._qa_fields(qa, scene_id, hit), **STALE_STYLE}
+                    await asyncio.to_thread(self.fs.update_scene, book_id, scene_id,
+                                            image_url=hit["url"], status="drawn", **fields)
+                    return {"scene_id": scene_id, "ok": True, "image_url": hit["url"], "attempts": 0, "cached": True,
+                            "qa_flags": fields.get("qa_flags"), "seconds": time.perf_counter() - t0, "error": ""}
+                if key not in self._inflight:
+                    break
+            if key in self._inflight:
+                key = None      # force, а те же входы уже рисуются — в кэш кладёт первая
+            else:
+                self._inflight[key] = asyncio.get_running_loop().create_future()
+
+        try:
+            return await self._generate_scene(book_id, scene, request, path, book_sem, key, t0, cache_parts[1], qa)
+        finally:
+            if key is not None:
+                self._inflight.pop(key).set_result(None)
+
+    async def _generate_scene(self, book_id: str, scene: Dict[str, Any], request: Dict[str, Any], path: str,
+                              book_sem: asyncio.Semaphore, key: Optional[str], t0: float,
+                              style: str, qa: Optional[ImageQA] = None) -> Dict[str, Any]:
+        scene_id = scene["id"]
+        bg = None
+        try:
+            if self.library is not None and request["prompt_background"]:
+                bg = await self._background(request, style)
+                if bg:
+                    request = {**request, "background": bg["data"]}
+            out = await self._generate_with_retries(request, path, book_sem)
+            fields = {**self._qa_fields(qa, scene_id, out["hashes"]), **STALE_STYLE}
+            if bg:
+                fields["background_url"] = bg["url"]
+            elif scene.get("background_url"):
+                # перерисована одной картинкой — прежний фон к ней уже не относится
+                fields["background_url"] = ""
+            await asyncio.to_thread(self.fs.update_scene, book_id, scene_id,
+                                    image_url=out["url"], status="drawn", **fields)
+            if key is not None:
+                await asyncio.to_thread(self.cache.put, key, path, out["size"], out["gen_seconds"],
+                                        self.provider.content_type, self.provider.model, out["hashes"])
+        except ImageProviderError as e:
+            seconds = time.perf_counter() - t0
+            IMAGE_SECONDS.observe(seconds, provider=self.provider.name, outcome="error")
+            print(f"[ImageEngine] {book_id}/{scene_id} failed after {e.attempts} attempts: {e}")
+            try:
+                await asyncio.to_thread(self.fs.update_scene_image_url, book_id, scene_id,
+                                        scene.get("image_url") or "", "redo")
+            except Exception as e2:
+                print(f"[ImageEngine] scene {scene_id} status error: {e2!r}")
+            return {"scene_id": scene_id, "ok": False, "image_url": "", "attempts": e.attempts,
+                    "seconds": seconds, "error": str(e)}
+
+        seconds = time.perf_counter() - t0
+        IMAGE_SECONDS.observe(seconds, provider=self.provider.name, outcome="ok")
+        return {"scene_id": scene_id, "ok": True, "image_url": out["url"],
+                "attempts": out["attempts"], "background_reused": bg is not None, "qa_flags": fields.get("qa_flags"),
+                "seconds": seconds, "error": ""}
+
+    @staticmethod
+    def _qa_fields(qa: Optional[ImageQA], scene_id: str, hashes: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        if qa is None or not hashes or not hashes.get("phash"):
+            return {}
+        return qa.check(scene_id, hashes)
+
+    async def _background(self, request: Dict[str, Any], style: str) -> Optional[Dict[str, Any]]:
+        """
+        Готовый фон сцены из библиотеки (точно или похожий) или None — тогда сцена рисуется одним
+        вызовом герой+фон. Промах ничего не рисует: фон в библиотеке стоит столько же вызовов,
+        сколько сцена целиком, и на пути книги окупиться не может.
+        """
+        prompt = request["prompt_background"]
+        partition = partition_key(style, f"{self.provider.name}:{self.provider.model}")
+        hit = await asyncio.to_thread(self.library.find, prompt, style, partition)
+        if not hit:
+            return None
+        try:
+            data = await asyncio.to_thread(self.blobs.get_bytes, hit["path"])
+        except Exception as e:
+            # запись есть, файла нет — сцена одной картинкой
+            print(f"[ImageEngine] background {hit['id']} unreadable: {e!r}")
+            return None
+        return {"url": self.blobs.url(hit["path"]), "data": data}
+
+    async def add_background(self, prompt: str, style: str) -> Dict[str, Any]:
+        """
+        Фон в библиотеку вне книги (подготовка общего набора фонов): один вызов провайдера,
+        картинка — backgrounds/<раздел>/<id>.png, запись — в индекс библиотеки.
+        """
+        partition = partition_key(style, f"{self.provider.name}:{self.provider.model}")
+        entry_id = self.library.signature_id(prompt, style, partition)
+        path = self.library.blob_path(entry_id, partition)
+        request = {"kind": "background", "book_id": "", "scene_id": entry_id, "page": None,
+                   "prompt_main": prompt, "prompt_background": "", "reference": None}
+        out = await self._generate_with_retries(request, path, asyncio.Semaphore(1))
+        return await asyncio.to_thread(self.library.add, prompt, style, partition, path,
+                                       out["size"], out["gen_seconds"])
+
+    async def _generate_with_retries(self, request: Dict[str, Any], path: str,
+                                     book_sem: asyncio.Semaphore) -> Dict[str, Any]:
+        """
+        Генерация с ретраями -> {url, size, hashes (если qa), gen_seconds, attempts}.
+        gen_seconds — удачная попытка. Не вышло — ImageProviderError с .attempts.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            # пауза ретрая — вне семафоров, слот отдаётся другим страницам
+            async with book_sem, self._global:
+                try:
+                    t_attempt = time.perf_counter()
+                    out = await asyncio.wait_for(self._generate_to_blob(request, path), self.timeout_s)
+                    IMAGE_CALLS.inc(provider=self.provider.name, outcome="ok")
+                    out["gen_seconds"] = time.perf_counter() - t_attempt
+                    out["attempts"] = attempt
+                    return out
+                except asyncio.TimeoutError:
+                    err = ImageProviderError(f"timeout after {self.timeout_s}s")
+                except ImageProviderError as e:
+                    err = e
+                except Exception as e:
+                    # хранилище / неожиданное — тоже временным считаем
+                    err = ImageProviderError(repr(e))
+            IMAGE_CALLS.inc(provider=self.provider.name, outcome="retry" if err.retryable else "error")
+            if not err.retryable or attempt >= self.max_attempts:
+                err.attempts = attempt
+                raise err
+            await asyncio.sleep(backoff_delay(attempt - 1, self.backoff_base_s, retry_after=err.retry_after))
+
+    async def _generate_to_blob(self, request: Dict[str, Any], path: str) -> Dict[str, Any]:
+        """
+        Куски от провайдера -> потоковая запись в хранилище. Оборвалось — временный объект выброшен.
+        Возвращает {url, size, hashes — если qa}.
+        С qa картинка хэшируется до публикации: пустой кадр не попадает в хранилище.
+        """
+        writer = await asyncio.to_thread(self.blobs.open_write, path, self.provider.content_type,
+                                         4 * IMAGE_CHUNK_SIZE)
+        size = 0
+        kept: List[bytes] = []
+        try:
+            async for chunk in self.provider.generate(request):
+                await asyncio.to_thread(writer.write, chunk)
+                size += len(chunk)
+                if self.qa:
+                    kept.append(chunk)
+            hashes = None
+            if self.qa:
+                try:
+                    hashes = await asyncio.to_thread(image_hashes, b"".join(kept))
+                except Exception as e:
+                    raise ImageProviderError(f"unreadable image: {e!r}") from e
+                if is_blank(hashes):
+                    IMAGE_QA_FAILURES.inc(provider=self.provider.name, reason="blank")
+                    raise ImageProviderError(f"blank image (std {hashes['std']})")
+            url = await asyncio.to_thread(writer.close)
+            return {"url": url, "size": size, "hashes": hashes}
+        except BaseException:
+            await asyncio.shield(asyncio.to_thread(writer.abort))
+            raise
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    import tempfile
+    from data_layer.memory_storage import MemoryStorage
+    from data_layer.gcs_client import LocalBlobStore
+    from router.main_router import BookSoulRouter
+
+    parser = argparse.ArgumentParser(description="BookSoul scene image engine benchmark")
+    parser.add_argument("--pages", type=int, default=24)
+    parser.add_argument("--latency-min", type=float, default=0.2)
+    parser.add_argument("--latency-max", type=float, default=0.6)
+    parser.add_argument("--fail-rate", type=float, default=0.1)
+    parser.add_argument("--blank-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    def seed(book_id: str) -> Tuple[MemoryStorage, str]:
+        store = MemoryStorage()
+        router = BookSoulRouter(storage=store)
+        store.create_book(book_id, child_name="Аня", theme="лес", status="drawing")
+        for page in range(1, args.pages + 1):
+            router.register_scene(book_id, page, f"Страница {page}", f"hero {page}", f"forest {page}")
+        return store, book_id
+
+    async def run(book_limit: int) -> Tuple[Dict[str, Any], MemoryStorage, int]:
+        store, book_id = seed("BKS-20251201-000001")
+        provider = FakeImageProvider(args.latency_min, args.latency_max, args.fail_rate, blank_rate=args.blank_rate)
+        blobs = LocalBlobStore(tempfile.mkdtemp(prefix="booksoul_images_"))
+        engine = ImageEngine(store, blobs, provider, book_limit=book_limit, backoff_base_s=0.05)
+        report = await engine.draw_book(book_id)
+        assert len(blobs.list("books/")) == report["drawn"]
+        return report, store, provider.calls
+
+    seq, _, _ = asyncio.run(run(book_limit=1))
+    conc, store, calls = asyncio.run(run(book_limit=IMAGE_BOOK_CONCURRENCY))
+
+    jobs = store.list_jobs(job_type=JOB_TYPE, book_id=conc["book_id"])
+    done = sum(1 for j in jobs if j["status"] == "done")
+    book = store.get_book(conc["book_id"])
+    print(json.dumps({k: v for k, v in conc.items() if k != "failed"}, ensure_ascii=False))
+    print(f"{args.pages} страниц, fail_rate={args.fail_rate}: последовательно {seq['wall_s']:.2f} с, "
+          f"параллельно {conc['wall_s']:.2f} с (самая медленная страница {conc['slowest_page_s']:.2f} с, "
+          f"сумма {conc['sum_pages_s']:.2f} с)")
+    print(f"попыток провайдера: {calls}, задач done: {done}/{len(jobs)}, статус книги: {book.get('status')}, "
+          f"пустых кадров отбраковано: {int(IMAGE_QA_FAILURES.value(provider='fake', reason='blank'))}")
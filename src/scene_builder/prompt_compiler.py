@@ -0,0 +1,409 @@
+# src/scene_builder/prompt_compiler.py
+
+"""
+prompt_compiler.py — промты Nano Banana (prompt_main / prompt_background) из структурных полей.
+
+Структура промта героя задана правилами ROUTER_SYSTEM_PROMPT и здесь не выдумывается моделью:
+    FACE_LOCK
+    Face description: <сухое описание лица — один раз на книгу>
+    Scene: <кто, что делает, эмоция, одежда, где, свет, атмосфера>
+    [toy-like]
+    FACE_LOCK
+
+- StoryWriter отдаёт по сцене только поля (hero / setting), а не готовый текст промта;
+- описание лица считается один раз на книгу и лежит в документе книги
+  (face_description + face_key), повторные сцены и перезапуски его не пересчитывают;
+- шаблоны разбираются один раз в список сегментов, рендер — склейка строк (микросекунды);
+- одинаковые промты разных сцен — один и тот же объект строки и один prompt_key,
+  так картинка по ним может переиспользоваться ниже по конвейеру.
+
+Бенчмарк:
+    python src/scene_builder/prompt_compiler.py
+"""
+
+from typing import Optional, Dict, Any, List, Tuple, Callable
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/scene_builder
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend
+from utils.metrics import llm_call
+
+
+FACE_LOCK = "Keep the same face as in the uploaded photo. Do not distort or change the face."
+TOY_LIKE = "Clearly toy-like, made of painted resin or plastic, not alive."
+
+BOOK_STYLE = os.getenv("BOOK_STYLE", "soft watercolor children's book illustration, warm palette")
+FACE_MODEL = os.getenv("FACE_MODEL", "gpt-4o-mini")
+
+# сколько книг держать в памяти процесса (описание лица + уже собранные промты)
+FACE_CACHE_BOOKS = int(os.getenv("FACE_CACHE_BOOKS", "256"))
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "4096"))
+# describer упал — нейтральное описание держим в памяти столько секунд, потом пробуем снова
+FACE_RETRY_S = float(os.getenv("FACE_RETRY_S", "300"))
+
+# поля описания лица в фиксированном порядке (порядок = порядок в промте)
+FACE_FIELDS = ("face_shape", "skin", "hair", "eyes", "nose", "lips", "expression")
+
+# Шаблоны: {поле} — подстановка, [ ... ] — необязательный кусок, выпадает целиком,
+# если хотя бы одно поле внутри пустое. Служебные поля: {face_lock}, {toy}, {style}.
+MAIN_TEMPLATE = (
+    "{face_lock}\n"
+    "Face description: {face}\n"
+    "Scene: {who}[, {action}][, {emotion} expression][, wearing {clothing}][, in {place}]"
+    "[, {light}][, {atmosphere} atmosphere]. {style}.[ {toy}]\n"
+    "{face_lock}"
+)
+# общий хвост всех фонов (background_library вырезает его из сигнатуры)
+BACKGROUND_SUFFIX = "Same lighting as the hero scene. No people."
+BACKGROUND_TEMPLATE = (
+    "{place}[, {time_of_day}][, {light}][, {atmosphere} atmosphere]. "
+    "{style}. " + BACKGROUND_SUFFIX
+)
+
+_WS_RE = re.compile(r"\s+")
+_TEMPLATE_RE = re.compile(r"\[([^\[\]]*)\]|\{(\w+)\}|([^\[\]{}]+)")
+
+
+# ---------------------------------------------------------------------------------
+# ШАБЛОНЫ
+# ---------------------------------------------------------------------------------
+
+def _clean(value: Any) -> str:
+    if value is None or value is False:
+        return ""
+    text = _WS_RE.sub(" ", str(value)).strip()
+    return text.rstrip(" .,;")
+
+
+def _capitalize(text: str) -> str:
+    return text[:1].upper() + text[1:]
+
+
+class CompiledTemplate:
+    """
+    Шаблон, разобранный один раз: кортеж сегментов.
+    Сегмент — ("lit", текст) | ("var", имя) | ("opt", ((тип, значение), ...)).
+    """
+
+    __slots__ = ("source", "segments", "fields")
+
+    def __init__(self, source: str):
+        self.source = source
+        self.segments = self._parse(source)
+        self.fields = tuple(sorted({name for name in self._names(self.segments)}))
+
+    @staticmethod
+    def _parse(source: str) -> Tuple[Tuple[str, Any], ...]:
+        out: List[Tuple[str, Any]] = []
+        for opt, var, lit in _TEMPLATE_RE.findall(source):
+            if opt:
+                out.append(("opt", CompiledTemplate._parse(opt)))
+            elif var:
+                out.append(("var", var))
+            elif lit:
+                out.append(("lit", lit))
+        return tuple(out)
+
+    @staticmethod
+    def _names(segments) -> List[str]:
+        names = []
+        for kind, value in segments:
+            if kind == "var":
+                names.append(value)
+            elif kind == "opt":
+                names.extend(CompiledTemplate._names(value))
+        return names
+
+    def render(self, fields: Dict[str, str]) -> str:
+        parts: List[str] = []
+        for kind, value in self.segments:
+            if kind == "lit":
+                parts.append(value)
+            elif kind == "var":
+                parts.append(fields.get(value, ""))
+            else:
+                chunk = []
+                for k2, v2 in value:
+                    if k2 == "lit":
+                        chunk.append(v2)
+                        continue
+                    v = fields.get(v2, "")
+                    if not v:
+                        chunk = None
+                        break
+                    chunk.append(v)
+                if chunk:
+                    parts.extend(chunk)
+        return "".join(parts)
+
+
+MAIN = CompiledTemplate(MAIN_TEMPLATE)
+BACKGROUND = CompiledTemplate(BACKGROUND_TEMPLATE)
+
+
+def prompt_key(prompt: str) -> str:
+    """Короткий отпечаток промта (одинаковый текст -> одинаковый ключ)."""
+    return hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+# ---------------------------------------------------------------------------------
+# ОПИСАНИЕ ЛИЦА
+# ---------------------------------------------------------------------------------
+
+FACE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {name: {"type": "string"} for name in FACE_FIELDS},
+    "required": list(FACE_FIELDS),
+    "additionalProperties": False,
+}
+
+FACE_PROMPT = (
+    "Describe the child's face in the photo for an illustrator. "
+    "Dry visual facts only, no emotions or poetry, 2-6 words per field, English."
+)
+
+
+def render_face(fields: Dict[str, Any]) -> str:
+    """Поля лица -> одна сухая строка в фиксированном порядке."""
+    parts = [_clean(fields.get(name)) for name in FACE_FIELDS]
+    text = ", ".join(p for p in parts if p)
+    return text or "exactly as in the uploaded photo"
+
+
+class OpenAIFaceDescriber:
+    """
+    Описание лица по фото ребёнка (book.photo_url) через Responses API, strict JSON.
+    Вызывается один раз на книгу — дальше работает кэш в документе книги.
+    """
+
+    def __init__(self, client, model: str = FACE_MODEL):
+        self.client = client
+        self.model = model
+
+    def __call__(self, book: Dict[str, Any]) -> Dict[str, str]:
+        photo = book.get("photo_url")
+        if not photo:
+            return {}
+        messages = [{"role": "user", "content": [
+            {"type": "input_text", "text": FACE_PROMPT},
+            {"type": "input_image", "image_url": photo},
+        ]}]
+        with llm_call("face_description", self.model, "responses"):
+            resp = self.client.responses.create(
+                model=self.model,
+                input=messages,
+                text={"format": {"type": "json_schema", "name": "face", "schema": FACE_SCHEMA, "strict": True}},
+                temperature=0.1,
+            )
+        return json.loads(getattr(resp, "output_text", "") or "{}")
+
+
+# ---------------------------------------------------------------------------------
+# КОМПИЛЯТОР
+# ---------------------------------------------------------------------------------
+
+class PromptCompiler:
+    """
+    PromptCompiler — prompt_main / prompt_background для сцен книги.
+    describer(book) -> поля лица; без него берутся book.face_fields (или нейтральное описание).
+    """
+
+    def __init__(self, storage: Optional[StorageBackend] = None,
+                 describer: Optional[Callable[[Dict[str, Any]], Dict[str, str]]] = None):
+        self.storage = storage
+        self.describer = describer
+        self._lock = threading.Lock()
+        self._books: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._prompts: "OrderedDict[tuple, Tuple[str, str]]" = OrderedDict()
+        self.renders = 0
+        self.hits = 0
+        self.face_computed = 0
+
+    # ---------------------------------------------------------------------------------
+    # КНИГА
+    # ---------------------------------------------------------------------------------
+
+    @staticmethod
+    def _face_key(book: Dict[str, Any]) -> str:
+        # меняется, только если поменялось фото или ручные поля лица
+        src = json.dumps([book.get("photo_url", ""), book.get("face_fields") or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(src.encode("utf-8")).hexdigest()[:12]
+
+    def book_fields(self, book: Dict[str, Any]) -> Dict[str, str]:
+        """
+        Общие для всех сцен книги поля: face, who, style.
+        Описание лица — из документа книги, если face_key совпадает; иначе считаем и сохраняем.
+        Если describer упал, нейтральное описание в документ не пишется, а в памяти живёт
+        FACE_RETRY_S секунд (face_retry_at) — потом describer вызывается снова.
+        """
+        book_id = book.get("id") or book.get("book_id") or ""
+        key = self._face_key(book)
+        with self._lock:
+            cached = self._books.get(book_id)
+            if (cached is not None and cached["face_key"] == key
+                    and time.monotonic() < cached.get("face_retry_at", float("inf"))):
+                self._books.move_to_end(book_id)
+                return cached
+
+        face = book.get("face_description") if book.get("face_key") == key else None
+        failed = False
+        if not face:
+            fields = dict(book.get("face_fields") or {})
+            if not fields and self.describer is not None:
+                try:
+                    fields = self.describer(book) or {}
+                except Exception as e:
+                    print(f"[PromptCompiler] face describer error: {e!r}")
+                    failed = True
+            face = render_face(fields)
+            self.face_computed += 1
+            if self.storage is not None and book_id and not failed:
+                try:
+                    self.storage.update_doc(self.storage.root_collection, book_id,
+                                            {"face_description": face, "face_key": key})
+                except Exception as e:
+                    print(f"[PromptCompiler] face cache write error: {e!r}")
+
+        age = book.get("child_age")
+        out = {
+            "face_key": key,
+            "face": face,
+            "who": f"{age}-year-old child" if age else "young child",
+            "style": _capitalize(_clean(book.get("style") or BOOK_STYLE)),
+        }
+        if failed:
+            out["face_retry_at"] = time.monotonic() + FACE_RETRY_S
+        with self._lock:
+            self._books[book_id] = out
+            self._books.move_to_end(book_id)
+            while len(self._books) > FACE_CACHE_BOOKS:
+                self._books.popitem(last=False)
+        return out
+
+    # ---------------------------------------------------------------------------------
+    # СЦЕНА
+    # ---------------------------------------------------------------------------------
+
+    def compile_scene(self, book: Dict[str, Any], scene: Dict[str, Any]) -> Tuple[str, str]:
+        """
+        scene: {"hero": {action, emotion, clothing, toy_like}, "setting": {place, time_of_day, light, atmosphere}}
+        Возвращает (prompt_main, prompt_background).
+        """
+        base = self.book_fields(book)
+        hero = scene.get("hero") or {}
+        setting = scene.get("setting") or {}
+        fields = {
+            "face_lock": FACE_LOCK,
+            "face": base["face"],
+            "who": base["who"],
+            "style": base["style"],
+            "action": _clean(hero.get("action")),
+            "emotion": _clean(hero.get("emotion")),
+            "clothing": _clean(hero.get("clothing")),
+            "toy": TOY_LIKE if hero.get("toy_like") else "",
+            "place": _clean(setting.get("place")) or "cozy fairy-tale place",
+            "time_of_day": _clean(setting.get("time_of_day")),
+            "light": _clean(setting.get("light")),
+            "atmosphere": _clean(setting.get("atmosphere")),
+        }
+        key = tuple(fields[name] for name in sorted(fields))
+        with self._lock:
+            self.renders += 1
+            hit = self._prompts.get(key)
+            if hit is not None:
+                self.hits += 1
+                self._prompts.move_to_end(key)
+                return hit
+
+        compiled = (MAIN.render(fields), BACKGROUND.render(fields))
+        with self._lock:
+            # гонка двух потоков — оставляем первый объект, чтобы дубли были одной строкой
+            compiled = self._prompts.setdefault(key, compiled)
+            while len(self._prompts) > PROMPT_CACHE_SIZE:
+                self._prompts.popitem(last=False)
+        return compiled
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "renders": self.renders,
+                "hits": self.hits,
+                "unique_prompts": len(self._prompts),
+                "books_cached": len(self._books),
+                "face_computed": self.face_computed,
+            }
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    from data_layer.memory_storage import MemoryStorage
+    from router.token_accounting import count_tokens
+
+    store = MemoryStorage()
+    store.create_book("BKS-20251201-000001", "Арсен", "маленький пилот")
+    book = store.get_book("BKS-20251201-000001")
+    book["child_age"] = 6
+
+    calls = []
+
+    def fake_describer(b):
+        calls.append(b["id"])
+        return {"face_shape": "round face", "skin": "light skin, freckles on nose", "hair": "short wavy brown hair",
+                "eyes": "big brown eyes", "nose": "small button nose", "lips": "thin lips",
+                "expression": "calm, slightly curious"}
+
+    book["photo_url"] = "gs://booksoul-bucket/photos/arsen.jpg"
+    compiler = PromptCompiler(store, describer=fake_describer)
+
+    places = ["kid's bedroom", "airfield", "night sky above the city", "kid's bedroom"]
+    scenes = [{
+        "hero": {"action": f"holding a paper plane {i % 3}", "emotion": "excited", "clothing": "pilot jacket",
+                 "toy_like": False},
+        "setting": {"place": places[i % 4], "time_of_day": "evening", "light": "warm golden light",
+                    "atmosphere": "cozy"},
+    } for i in range(12)]
+
+    main, bg = compiler.compile_scene(book, scenes[0])
+    print(main, "\n---\n" + bg + "\n")
+
+    n = 100_000
+    t0 = time.perf_counter()
+    for _ in range(n):
+        MAIN.render({"face_lock": FACE_LOCK, "face": "round face", "who": "6-year-old child", "style": BOOK_STYLE,
+                     "action": "running", "emotion": "happy", "clothing": "", "toy": "", "place": "park",
+                     "light": "", "atmosphere": "sunny"})
+    render_us = (time.perf_counter() - t0) / n * 1e6
+
+    compiler2 = PromptCompiler(store, describer=fake_describer)
+    book2 = store.get_book("BKS-20251201-000001")  # face_description уже в документе
+    book2.update({"child_age": 6, "photo_url": book["photo_url"]})
+    t0 = time.perf_counter()
+    pairs = [compiler2.compile_scene(book2, s) for s in scenes]
+    book_ms = (time.perf_counter() - t0) * 1000
+
+    uniq_main = len({id(m) for m, _ in pairs})
+    uniq_bg = len({b for _, b in pairs})
+    llm_prompt_tokens = sum(count_tokens(m) + count_tokens(b) for m, b in pairs)
+    field_tokens = sum(count_tokens(json.dumps(s, ensure_ascii=False)) for s in scenes)
+
+    print(f"рендер шаблона: {render_us:.2f} мкс")
+    print(f"книга из {len(scenes)} сцен: {book_ms:.3f} мс, уникальных prompt_main {uniq_main}, "
+          f"prompt_background {uniq_bg}")
+    print(f"описание лица: вызовов describer {len(calls)} (вторая сборка взяла его из документа книги)")
+    print(f"токены ответа StoryWriter на промты: {llm_prompt_tokens} (готовый текст) -> {field_tokens} (поля)")
+    print("stats:", compiler2.stats())
@@ -0,0 +1,777 @@
+# src/storywriter/story_engine.py
+
+"""
+story_engine.py — StoryWriter: история книги и сцены по задаче "storywriter" из jobs.
+
+Два режима на одном промте и одной схеме ответа:
+- интерактивный (StoryWriter.write) — один вызов Responses API на книгу, сразу;
+- пакетный (StoryBatchRunner) — для сезонных кампаний: pending-задачи собираются в один
+  JSONL для Batch API (вдвое дешевле, без давления на интерактивные rate limits),
+  результаты забираются опросом и раскладываются через BookSoulRouter.register_scene.
+
+Интерактивный режим по умолчанию стримит ответ (STORY_STREAM): каждая сцена, чей JSON-объект
+закрылся, сразу регистрируется и уходит художке — рисование идёт параллельно с письмом.
+
+Провайдер пакетов заменяем: OpenAIBatchProvider (прод) / LocalBatchProvider (тесты, бенчмарк).
+
+Жизненный цикл задачи в пакете:
+    pending -> batching (захвачена) -> batched (batch_id) -> done | pending (ретрай) | error
+
+Запуск:
+    python src/storywriter/story_engine.py --bench --books 200
+    python src/storywriter/story_engine.py --stream-bench
+    python src/storywriter/story_engine.py --submit / --poll      (прод, OPENAI_API_KEY)
+"""
+
+from typing import Optional, Dict, Any, List, Iterable, Callable
+import argparse
+import json
+import os
+import sys
+import time
+import random
+import uuid
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/storywriter
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import utcnow
+from router.main_router import BookSoulRouter
+from scene_builder.prompt_compiler import PromptCompiler, OpenAIFaceDescriber
+from router.prompts import STORY_USER_TEMPLATE, build_messages, prompt_cache_key
+from router.token_accounting import TokenLedger, usage_from_response, cost_micro_usd, BATCH_PRICE_FACTOR
+from utils.metrics import REGISTRY, llm_call, record_json_failure
+
+
+STORY_MODEL = os.getenv("STORY_MODEL", os.getenv("OPENAI_MODEL", "gpt-4o"))
+STORY_PAGES = int(os.getenv("STORY_PAGES", "12"))
+STORY_MAX_OUTPUT_TOKENS = int(os.getenv("STORY_MAX_OUTPUT_TOKENS", "4000"))
+STORY_STREAM = os.getenv("STORY_STREAM", "true").lower() == "true"
+
+# пакет имеет смысл от нескольких десятков книг; меньше — интерактивно
+STORY_BATCH_MIN = int(os.getenv("STORY_BATCH_MIN", "20"))
+STORY_BATCH_MAX = int(os.getenv("STORY_BATCH_MAX", "500"))
+STORY_MAX_ATTEMPTS = int(os.getenv("STORY_MAX_ATTEMPTS", "3"))
+
+JOB_TYPE = "storywriter"
+BATCH_COLLECTION = "story_batches"
+BATCH_ENDPOINT = "/v1/responses"
+
+# ответ модели: strict JSON Schema (text.format) — разбор без эвристик
+STORY_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "scenes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "page": {"type": "integer"},
+                    "text": {"type": "string"},
+                    # поля для prompt_compiler: готовый текст промтов собирается локально
+                    "hero": {
+                        "type": "object",
+                        "properties": {
+                            "action": {"type": "string"},
+                            "emotion": {"type": "string"},
+                            "clothing": {"type": "string"},
+                            "toy_like": {"type": "boolean"},
+                        },
+                        "required": ["action", "emotion", "clothing", "toy_like"],
+                        "additionalProperties": False,
+                    },
+                    "setting": {
+                        "type": "object",
+                        "properties": {
+                            "place": {"type": "string"},
+                            "time_of_day": {"type": "string"},
+                            "light": {"type": "string"},
+                            "atmosphere": {"type": "string"},
+                        },
+                        "required": ["place", "time_of_day", "light", "atmosphere"],
+                        "additionalProperties": False,
+                    },
+                },
+                "required": ["page", "text", "hero", "setting"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["title", "scenes"],
+    "additionalProperties": False,
+}
+
+# статусы Batch API, после которых результатов больше не будет
+_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+# время от запроса до первой сцены в очереди художки (стрим) / до всех сцен (без стрима)
+FIRST_SCENE_SECONDS = REGISTRY.histogram("booksoul_story_first_scene_seconds",
+                                         "Time from story request to first scene_generation job")
+
+
+class StoryFormatError(ValueError):
+    """Ответ модели не похож на историю по STORY_SCHEMA."""
+
+
+# ---------------------------------------------------------------------------------
+# ЗАПРОС / ОТВЕТ
+# ---------------------------------------------------------------------------------
+
+def build_story_request(book: Dict[str, Any], model: str = STORY_MODEL, pages: int = STORY_PAGES) -> Dict[str, Any]:
+    """
+    Тело запроса Responses API. Одинаково для интерактива и строки JSONL в Batch API:
+    статический STORY_SYSTEM_PROMPT первым (кэш префикса), данные книги — в конце.
+    """
+    user_text = STORY_USER_TEMPLATE.format(
+        child_name=book.get("child_name", ""),
+        theme=book.get("theme", ""),
+        language=book.get("language", "ru"),
+        pages=pages,
+    )
+    return {
+        "model": model,
+        "input": build_messages("story", user_text),
+        "text": {"format": {"type": "json_schema", "name": "story", "schema": STORY_SCHEMA, "strict": True}},
+        "max_output_tokens": STORY_MAX_OUTPUT_TOKENS,
+        "prompt_cache_key": prompt_cache_key("story"),
+    }
+
+
+def response_text(response: Any) -> str:
+    """Текст ответа из объекта SDK или из сырого тела (результаты Batch API)."""
+    if not isinstance(response, dict):
+        return (getattr(response, "output_text", "") or "").strip()
+    chunks = []
+    for item in response.get("output") or []:
+        if item.get("type") == "message":
+            for c in item.get("content") or []:
+                if c.get("type") == "output_text" and c.get("text"):
+                    chunks.append(c["text"])
+    return "\n".join(chunks).strip()
+
+
+def parse_story(text: str) -> Dict[str, Any]:
+    try:
+        story = json.loads(text)
+    except json.JSONDecodeError as e:
+        record_json_failure("story")
+        raise StoryFormatError(f"не JSON: {e}") from e
+    scenes = story.get("scenes") if isinstance(story, dict) else None
+    if not scenes or not all(isinstance(s, dict) and (s.get("text") or "").strip() for s in scenes):
+        raise StoryFormatError("нет сцен или пустой текст сцены")
+    story["scenes"] = sorted(scenes, key=lambda s: int(s.get("page") or 0))
+    return story
+
+
+class SceneStreamParser:
+    """
+    Инкрементальный разбор ответа по STORY_SCHEMA.
+    feed(кусок) возвращает сцены, чьи объекты в массиве "scenes" уже закрылись.
+    Один проход по каждому символу: глубина скобок + состояние строки/экранирования,
+    готовый объект сцены разбирается json.loads только по своему срезу.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._in_scenes = False
+        self._scene_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.text += chunk
+        t = self.text
+        out = []
+        for i in range(self._pos, len(t)):
+            ch = t[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                self._in_string = True
+            elif ch == "{" or ch == "[":
+                self._depth += 1
+                # {объект книги} -> [scenes] -> {сцена}: единственный массив схемы на глубине 2
+                if ch == "[" and self._depth == 2:
+                    self._in_scenes = True
+                elif ch == "{" and self._depth == 3 and self._in_scenes:
+                    self._scene_start = i
+            elif ch == "}" or ch == "]":
+                if ch == "}" and self._depth == 3 and self._scene_start is not None:
+                    scene = self._parse_scene(t[self._scene_start:i + 1])
+                    if scene is not None:
+                        out.append(scene)
+                    self._scene_start = None
+                elif ch == "]" and self._depth == 2:
+                    self._in_scenes = False
+                self._depth -= 1
+        self._pos = len(t)
+        return out
+
+    @staticmethod
+    def _parse_scene(raw: str) -> Optional[Dict[str, Any]]:
+        try:
+            scene = json.loads(raw)
+        except json.JSONDecodeError:
+            return None  # итоговый parse_story всё равно проверит ответ целиком
+        return scene if isinstance(scene, dict) and (scene.get("text") or "").strip() else None
+
+
+# ---------------------------------------------------------------------------------
+# STORYWRITER
+# ---------------------------------------------------------------------------------
+
+class StoryWriter:
+    """
+    StoryWriter — история для книги и раскладка сцен через BookSoulRouter.
+    client — openai.OpenAI (или совместимый объект с .responses.create), нужен только интерактиву.
+    Промты картинок собирает PromptCompiler из полей hero / setting сцены.
+    """
+
+    def __init__(self, router: Optional[BookSoulRouter] = None, client=None, model: str = STORY_MODEL,
+                 prompts: Optional[PromptCompiler] = None):
+        self.router = router or BookSoulRouter()
+        self.fs = self.router.fs
+        self.client = client
+        self.model = model
+        self.ledger = TokenLedger(self.fs)
+        self.prompts = prompts or PromptCompiler(
+            self.fs, describer=OpenAIFaceDescriber(client) if client is not None else None
+        )
+
+    def pending_jobs(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return self.fs.list_jobs(job_type=JOB_TYPE, status="pending", limit=limit)
+
+    def write(self, job: Dict[str, Any], stream: bool = STORY_STREAM) -> Dict[str, Any]:
+        """
+        Интерактивный режим: один вызов модели на книгу.
+        stream=True — сцены уходят художке по мере генерации, не дожидаясь конца истории.
+        """
+        book = self.fs.get_book(job["book_id"])
+        if book is None:
+            self.fs.update_job_status(job["id"], "error", job_type=JOB_TYPE)
+            return {"ok": False, "job_id": job["id"], "error": "book_not_found"}
+
+        body = build_story_request(book, model=self.model)
+        cache_key = body.pop("prompt_cache_key")
+        registered = self._registered_pages(job["book_id"])
+        t0 = time.perf_counter()
+        try:
+            if stream:
+                text, usage = self._stream_story(book, body, cache_key, registered, t0)
+            else:
+                with llm_call("story", self.model, "responses") as call:
+                    resp = self.client.responses.create(**body, extra_body={"prompt_cache_key": cache_key})
+                    text = response_text(resp)
+                    call.usage = usage = usage_from_response(resp, body["input"], completion_text=text)
+            story = parse_story(text)
+        except Exception as e:
+            print(f"[StoryWriter] {job['book_id']}: {e!r}")
+            self._retry_or_fail(job, str(e))
+            return {"ok": False, "job_id": job["id"], "error": str(e)}
+        if not stream:
+            FIRST_SCENE_SECONDS.observe(time.perf_counter() - t0, mode="blocking")
+        return self.apply(job, story, usage, kind="story", registered=registered, book=book)
+
+    def _stream_story(self, book: Dict[str, Any], body: Dict[str, Any], cache_key: str,
+                      registered: Dict[int, bool], t0: float) -> tuple:
+        """
+        Responses API stream=True: дельты текста -> SceneStreamParser -> register_scene сразу.
+        Возвращает (полный текст, usage).
+        """
+        parser = SceneStreamParser()
+        final = None
+        with llm_call("story", self.model, "responses_stream") as call:
+            stream = self.client.responses.create(**body, stream=True, extra_body={"prompt_cache_key": cache_key})
+            for event in stream:
+                etype = getattr(event, "type", "")
+                if etype == "response.output_text.delta":
+                    for scene in parser.feed(event.delta):
+                        first = not any(registered.values())
+                        self._register(book, scene, registered)
+                        if first:
+                            FIRST_SCENE_SECONDS.observe(time.perf_counter() - t0, mode="stream")
+                            self.router.advance_status(book["id"], "drawing")
+                elif etype == "response.completed":
+                    final = event.response
+                elif etype in ("response.failed", "response.incomplete", "error"):
+                    raise RuntimeError(f"stream {etype}")
+            text = parser.text.strip()
+            call.usage = usage_from_response(final, body["input"], completion_text=text)
+        return text, call.usage
+
+    def _registered_pages(self, book_id: str) -> Dict[int, bool]:
+        """
+        page -> True, если сцена уже ушла художке в этой попытке.
+        Страницы прошлых попыток (обрыв стрима) — False: их переписываем без новой задачи.
+        """
+        return {int(s.get("page") or 0): False for s in self.fs.list_scenes(book_id)}
+
+    def _register(self, book: Dict[str, Any], scene: Dict[str, Any], registered: Dict[int, bool],
+                  page: Optional[int] = None) -> Optional[str]:
+        page = int(scene.get("page") or page or len(registered) + 1)
+        if registered.get(page):
+            return None
+        book_id = book["id"]
+        if "hero" in scene or "setting" in scene:
+            prompt_main, prompt_background = self.prompts.compile_scene(book, scene)
+        else:
+            # старый формат ответа: промты готовым текстом
+            prompt_main = (scene.get("prompt_main") or "").strip()
+            prompt_background = (scene.get("prompt_background") or "").strip()
+        fields = dict(
+            page_number=page,
+            text=scene["text"].strip(),
+            prompt_main=prompt_main,
+            prompt_background=prompt_background,
+        )
+        if page in registered:
+            # сцена от оборвавшейся попытки: задача художке уже стоит, обновляем только текст/промты
+            scene_id = f"scene_{page:03d}"
+            self.fs.add_scene(book_id=book_id, scene_id=scene_id, **fields)
+        else:
+            scene_id = self.router.register_scene(book_id=book_id, **fields)["scene_id"]
+        registered[page] = True
+        return scene_id
+
+    def run_pending(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Интерактивно по очереди — для обычного потока, когда пакет не набирается."""
+        return [self.write(job) for job in self.pending_jobs(limit=limit)]
+
+    def apply(self, job: Dict[str, Any], story: Dict[str, Any], usage: Dict[str, Any],
+              kind: str = "story", price_factor: float = 1.0,
+              registered: Optional[Dict[int, bool]] = None,
+              book: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Сцены -> register_scene (каждая ставит задачу художке), книга -> drawing, задача -> done.
+        registered — страницы, уже отправленные стримом: они не регистрируются повторно.
+        """
+        book_id = job["book_id"]
+        if registered is None:
+            registered = self._registered_pages(book_id)
+        book = book or self.fs.get_book(book_id) or {"id": book_id}
+        scene_ids = []
+        for i, scene in enumerate(story["scenes"], start=1):
+            self._register(book, scene, registered, page=i)
+            scene_ids.append(f"scene_{int(scene.get('page') or i):03d}")
+
+        book = self.fs.get_book(book_id) or {}
+        title = (story.get("title") or "").strip()
+        if title and book.get("title", "").startswith("История для "):
+            self.fs.update_doc(self.fs.root_collection, book_id, {"title": title})
+        if book.get("status") != "drawing":
+            self.router.advance_status(book_id, "drawing")
+        self.fs.update_job_status(job["id"], "done", job_type=JOB_TYPE)
+        self.ledger.record(self.model, usage, kind=kind, book_id=book_id, price_factor=price_factor)
+        return {"ok": True, "job_id": job["id"], "book_id": book_id, "scenes": scene_ids}
+
+    def _retry_or_fail(self, job: Dict[str, Any], error: str) -> None:
+        attempts = int(job.get("attempts") or 0) + 1
+        if attempts >= STORY_MAX_ATTEMPTS:
+            self.fs.update_doc("jobs", job["id"], {"attempts": attempts, "error": error[:500]})
+            self.fs.update_job_status(job["id"], "error", job_type=JOB_TYPE)
+        else:
+            self.fs.update_doc("jobs", job["id"], {"status": "pending", "attempts": attempts,
+                                                   "error": error[:500], "batch_id": None})
+
+
+# ---------------------------------------------------------------------------------
+# ПРОВАЙДЕРЫ ПАКЕТОВ
+# ---------------------------------------------------------------------------------
+
+class OpenAIBatchProvider:
+    """
+    OpenAI Batch API: JSONL-файл (purpose=batch) -> batch на /v1/responses, окно 24h.
+    """
+
+    def __init__(self, client=None):
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI()
+        self.client = client
+
+    def submit(self, lines: List[Dict[str, Any]], metadata: Optional[Dict[str, str]] = None) -> str:
+        payload = "\n".join(json.dumps(l, ensure_ascii=False, separators=(",", ":")) for l in lines)
+        f = self.client.files.create(file=("stories.jsonl", payload.encode("utf-8")), purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=f.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+            metadata=metadata or {},
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        b = self.client.batches.retrieve(batch_id)
+        counts = getattr(b, "request_counts", None)
+        return {
+            "status": b.status,
+            "output_file_id": b.output_file_id,
+            "error_file_id": b.error_file_id,
+            "counts": {
+                "total": getattr(counts, "total", 0),
+                "completed": getattr(counts, "completed", 0),
+                "failed": getattr(counts, "failed", 0),
+            },
+        }
+
+    def results(self, batch_id: str) -> Iterable[Dict[str, Any]]:
+        st = self.status(batch_id)
+        for file_id in (st["output_file_id"], st["error_file_id"]):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+def fake_story_body(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Тело ответа Responses API с правдоподобной историей — для LocalBatchProvider
+    и интерактивного бенчмарка. Токены — локальная оценка по запросу и ответу.
+    """
+    user = request["input"][-1]["content"]
+    fields = dict(line.split(": ", 1) for line in user.splitlines() if ": " in line)
+    name = fields.get("Имя ребёнка", "Герой")
+    pages = int(fields.get("Сцен", STORY_PAGES))
+    story = {
+        "title": f"{name} и {fields.get('Тема', 'чудо')}",
+        "scenes": [{
+            "page": p,
+            "text": f"{name} делает шаг {p}. Вокруг тепло и тихо, и рядом друг. "
+                    f"Всё получится, если не спешить.",
+            "hero": {"action": f"looking at the map, step {p}", "emotion": "curious", "clothing": "yellow raincoat",
+                     "toy_like": False},
+            "setting": {"place": ["kid's bedroom", "old forest", "night sky"][p % 3],
+                        "time_of_day": "evening", "light": "soft warm light", "atmosphere": "cozy"},
+        } for p in range(1, pages + 1)],
+    }
+    text = json.dumps(story, ensure_ascii=False)
+    usage = usage_from_response(None, request["input"], completion_text=text)
+    return {
+        "id": f"resp_{uuid.uuid4().hex[:12]}",
+        "object": "response",
+        "status": "completed",
+        "model": request.get("model"),
+        "output": [{"type": "message", "role": "assistant",
+                    "content": [{"type": "output_text", "text": text, "annotations": []}]}],
+        "usage": {
+            "input_tokens": usage["prompt_tokens"],
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": usage["completion_tokens"],
+        },
+    }
+
+
+class LocalBatchProvider:
+    """
+    Стенд Batch API без сети: результат готов через turnaround_s после submit,
+    fail_rate — доля строк с ошибкой (проверка ретраев).
+    """
+
+    def __init__(self, turnaround_s: float = 0.0, fail_rate: float = 0.0,
+                 generate: Callable[[Dict[str, Any]], Dict[str, Any]] = fake_story_body):
+        self.turnaround_s = turnaround_s
+        self.fail_rate = fail_rate
+        self.generate = generate
+        self._batches: Dict[str, Dict[str, Any]] = {}
+
+    def submit(self, lines: List[Dict[str, Any]], metadata: Optional[Dict[str, str]] = None) -> str:
+        batch_id = f"batch_local_{uuid.uuid4().hex[:10]}"
+        self._batches[batch_id] = {"lines": list(lines), "ready_at": time.monotonic() + self.turnaround_s}
+        return batch_id
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        b = self._batches[batch_id]
+        done = time.monotonic() >= b["ready_at"]
+        n = len(b["lines"])
+        return {"status": "completed" if done else "in_progress", "output_file_id": None, "error_file_id": None,
+                "counts": {"total": n, "completed": n if done else 0, "failed": 0}}
+
+    def results(self, batch_id: str) -> Iterable[Dict[str, Any]]:
+        for line in self._batches[batch_id]["lines"]:
+            if random.random() < self.fail_rate:
+                yield {"custom_id": line["custom_id"], "response": None,
+                       "error": {"code": "server_error", "message": "injected failure"}}
+                continue
+            yield {"custom_id": line["custom_id"],
+                   "response": {"status_code": 200, "body": self.generate(line["body"])}, "error": None}
+
+
+# ---------------------------------------------------------------------------------
+# ПАКЕТНЫЙ РЕЖИМ
+# ---------------------------------------------------------------------------------
+
+class StoryBatchRunner:
+    """
+    StoryBatchRunner — pending storywriter-задачи -> один batch -> опрос -> раскладка сцен.
+    Состояние пакетов — в story_batches/{batch_id}, поэтому submit и poll можно звать
+    из разных процессов (Cloud Scheduler дёргает воркер).
+    """
+
+    def __init__(self, writer: StoryWriter, provider):
+        self.writer = writer
+        self.fs = writer.fs
+        self.provider = provider
+
+    def submit_pending(self, limit: int = STORY_BATCH_MAX, min_jobs: int = STORY_BATCH_MIN) -> Optional[Dict[str, Any]]:
+        """
+        Захватывает до limit pending-задач и отправляет их одним пакетом.
+        None — задач меньше min_jobs (их берёт интерактивный путь).
+        """
+        jobs = self.writer.pending_jobs(limit=limit)
+        if len(jobs) < max(1, min_jobs):
+            return None
+
+        claim = uuid.uuid4().hex[:12]
+        lines, claimed = [], []
+        for job in jobs:
+            book = self.fs.get_book(job["book_id"])
+            if book is None:
+                self.fs.update_job_status(job["id"], "error", job_type=JOB_TYPE)
+                continue
+            self.fs.update_doc("jobs", job["id"], {"status": "batching", "claim": claim})
+            lines.append({"custom_id": job["id"], "method": "POST", "url": BATCH_ENDPOINT,
+                          "body": build_story_request(book, model=self.writer.model)})
+            claimed.append(job["id"])
+        if not lines:
+            return None
+
+        try:
+            batch_id = self.provider.submit(lines, metadata={"kind": "storywriter", "claim": claim})
+        except Exception as e:
+            print(f"[StoryBatchRunner] submit error: {e!r}")
+            for job_id in claimed:
+                self.fs.update_doc("jobs", job_id, {"status": "pending", "claim": None})
+            raise
+
+        for job_id in claimed:
+            self.fs.update_doc("jobs", job_id, {"status": "batched", "batch_id": batch_id})
+        doc = {
+            "status": "submitted",
+            "job_ids": claimed,
+            "model": self.writer.model,
+            "submitted_at": utcnow(),
+            "created_at": self.fs.server_timestamp(),
+        }
+        self.fs.set_doc(BATCH_COLLECTION, batch_id, doc)
+        print(f"[StoryBatchRunner] batch {batch_id}: {len(claimed)} книг")
+        return {"batch_id": batch_id, **doc}
+
+    def poll(self) -> List[Dict[str, Any]]:
+        """
+        Проверяет открытые пакеты; готовые раскладывает. Возвращает сводку по каждому.
+        """
+        out = []
+        for batch in self.fs.query_docs(BATCH_COLLECTION, where=[("status", "==", "submitted")]):
+            st = self.provider.status(batch["id"])
+            if st["status"] not in _FINAL_STATUSES:
+                out.append({"batch_id": batch["id"], "status": st["status"], "counts": st["counts"]})
+                continue
+            out.append(self._ingest(batch, st))
+        return out
+
+    def _ingest(self, batch: Dict[str, Any], st: Dict[str, Any]) -> Dict[str, Any]:
+        batch_id = batch["id"]
+        done = failed = 0
+        seen = set()
+        usage_total = {"prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+        for row in self.provider.results(batch_id):
+            job = self.fs.get_job(row.get("custom_id") or "")
+            # повторный опрос / чужой пакет — задача уже не наша
+            if job is None or job.get("status") != "batched" or job.get("batch_id") != batch_id:
+                continue
+            seen.add(job["id"])
+            response = row.get("response") or {}
+            body = response.get("body") if response.get("status_code") == 200 else None
+            try:
+                if body is None:
+                    raise StoryFormatError(json.dumps(row.get("error") or response, ensure_ascii=False)[:300])
+                text = response_text(body)
+                story = parse_story(text)
+            except StoryFormatError as e:
+                self.writer._retry_or_fail(job, str(e))
+                failed += 1
+                continue
+            usage = usage_from_response(body, completion_text=text)
+            for k in usage_total:
+                usage_total[k] += usage.get(k, 0)
+            self.writer.apply(job, story, usage, kind="story_batch", price_factor=BATCH_PRICE_FACTOR)
+            done += 1
+
+        # строки без результата (expired / cancelled) — обратно в очередь
+        for job_id in batch.get("job_ids", []):
+            if job_id in seen:
+                continue
+            job = self.fs.get_job(job_id)
+            if job and job.get("status") == "batched" and job.get("batch_id") == batch_id:
+                self.writer._retry_or_fail(job, f"batch {st['status']}: нет результата")
+                failed += 1
+
+        cost = int(round(cost_micro_usd(batch.get("model", STORY_MODEL), usage_total) * BATCH_PRICE_FACTOR))
+        summary = {
+            "status": st["status"],
+            "done": done,
+            "failed": failed,
+            "completed_at": utcnow(),
+            "usage": usage_total,
+            "cost_micro_usd": cost,
+        }
+        self.fs.update_doc(BATCH_COLLECTION, batch_id, summary)
+        print(f"[StoryBatchRunner] batch {batch_id} {st['status']}: done={done} failed={failed}")
+        return {"batch_id": batch_id, **summary}
+
+    def run(self, poll_interval_s: float = 30.0, timeout_s: float = 86400.0, **submit_kwargs) -> List[Dict[str, Any]]:
+        """submit + опрос до готовности всех открытых пакетов (CLI / бенчмарк)."""
+        self.submit_pending(**submit_kwargs)
+        deadline = time.monotonic() + timeout_s
+        results = []
+        while time.monotonic() < deadline:
+            polled = self.poll()
+            results.extend(r for r in polled if r["status"] in _FINAL_STATUSES)
+            if all(r["status"] in _FINAL_STATUSES for r in polled):
+                break
+            time.sleep(poll_interval_s)
+        return results
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК / ЗАПУСК
+# -----------------------------------------------------------------------------
+
+class _LocalResponses:
+    """
+    Интерактивный стенд: ответ генерируется latency_s, как живая модель.
+    stream=True — те же байты дельтами по ~4 символа, равномерно за latency_s.
+    """
+
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+        self.responses = self
+
+    def create(self, extra_body=None, stream: bool = False, **body):
+        resp = fake_story_body(body)
+        if not stream:
+            time.sleep(self.latency_s)
+            return resp
+        return self._events(resp)
+
+    def _events(self, resp: Dict[str, Any]):
+        from types import SimpleNamespace
+        text = response_text(resp)
+        chunks = [text[i:i + 4] for i in range(0, len(text), 4)]
+        step = self.latency_s / max(1, len(chunks))
+        t0 = time.perf_counter()
+        for i, c in enumerate(chunks, start=1):
+            # темп по общему дедлайну, а не sleep(step): мелкие sleep копят перебор
+            delay = t0 + i * step - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            yield SimpleNamespace(type="response.output_text.delta", delta=c)
+        yield SimpleNamespace(type="response.completed", response=resp)
+
+
+def _seed_books(router: BookSoulRouter, n: int) -> None:
+    # make_trace_id секундный — для сотни книг подряд даём свои ID того же формата
+    names = ["Арсен", "Алиса", "Мира", "Тимур", "Ева", "Лев", "Соня", "Марк"]
+    themes = ["маленький пилот", "подводный город", "добрый дракон", "звёздный робот"]
+    for i in range(n):
+        book_id = f"BKS-20251201-{i:06d}"
+        router.fs.create_book(book_id, names[i % len(names)], themes[i % len(themes)])
+        router.fs.create_job(book_id=book_id, job_type=JOB_TYPE, status="pending")
+
+
+def _bench(books: int, latency_s: float, turnaround_s: float) -> None:
+    from data_layer.memory_storage import MemoryStorage
+
+    rows = []
+    for mode in ("interactive", "batch"):
+        router = BookSoulRouter(storage=MemoryStorage())
+        _seed_books(router, books)
+        writer = StoryWriter(router, client=_LocalResponses(latency_s))
+        t0 = time.perf_counter()
+        if mode == "interactive":
+            while writer.pending_jobs(limit=1):
+                writer.run_pending(limit=50)
+        else:
+            StoryBatchRunner(writer, LocalBatchProvider(turnaround_s=turnaround_s)).run(
+                poll_interval_s=min(0.05, turnaround_s or 0.05), min_jobs=1)
+        wall = time.perf_counter() - t0
+        rep = writer.ledger.report(hours=1)
+        kind = "story" if mode == "interactive" else "story_batch"
+        scenes = sum(len(router.fs.list_scenes(j["book_id"]))
+                     for j in router.fs.list_jobs(job_type=JOB_TYPE, status="done"))
+        rows.append((mode, wall, rep["cost_by_kind_usd"].get(kind, 0.0), scenes))
+
+    model_calls = books
+    print(f"книг: {books}, модель: {STORY_MODEL}, интерактивный вызов ~{latency_s}s, "
+          f"пакет готов через ~{turnaround_s}s (стенд)")
+    for mode, wall, cost, scenes in rows:
+        print(f"  {mode:>11}: {wall:7.2f}s, {books / wall:7.1f} книг/с, сцен {scenes}, "
+              f"${cost:.4f} всего, ${cost / model_calls:.5f} за книгу")
+    print("  (в проде пакет отвечает за минуты–часы: выигрыш — цена и разгрузка интерактивных лимитов, "
+          "а не задержка одной книги)")
+
+
+def _stream_bench(books: int, latency_s: float) -> None:
+    """Время до первой задачи художке: стрим против ожидания полной истории."""
+    from data_layer.memory_storage import MemoryStorage
+
+    for stream in (False, True):
+        router = BookSoulRouter(storage=MemoryStorage())
+        _seed_books(router, books)
+        writer = StoryWriter(router, client=_LocalResponses(latency_s))
+        first, done = [], []
+        original = router.register_scene
+
+        def timed_register(**kw):
+            book_first.setdefault(kw["book_id"], time.perf_counter())
+            return original(**kw)
+
+        router.register_scene = timed_register
+        for job in writer.pending_jobs():
+            book_first = {}
+            t0 = time.perf_counter()
+            writer.write(job, stream=stream)
+            first.append(book_first[job["book_id"]] - t0)
+            done.append(time.perf_counter() - t0)
+        jobs = len(router.fs.list_jobs(job_type="scene_generation"))
+        print(f"  {'stream' if stream else 'blocking':>8}: первая сцена художке через {sum(first) / len(first):.3f}s, "
+              f"история целиком {sum(done) / len(done):.3f}s, задач художке {jobs}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="StoryWriter: интерактивный и пакетный режим")
+    parser.add_argument("--bench", action="store_true", help="сравнить режимы на локальном стенде")
+    parser.add_argument("--books", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка интерактивного вызова на стенде, с")
+    parser.add_argument("--turnaround", type=float, default=0.5, help="время готовности пакета на стенде, с")
+    parser.add_argument("--stream-bench", action="store_true", help="время до первой сцены: стрим / без стрима")
+    parser.add_argument("--submit", action="store_true", help="отправить pending-задачи пакетом (OpenAI)")
+    parser.add_argument("--poll", action="store_true", help="забрать готовые пакеты (OpenAI)")
+    args = parser.parse_args()
+
+    if args.bench:
+        _bench(args.books, args.latency, args.turnaround)
+    elif args.stream_bench:
+        print(f"книг: {min(args.books, 10)}, генерация истории ~{args.latency}s (стенд)")
+        _stream_bench(min(args.books, 10), args.latency)
+    else:
+        runner = StoryBatchRunner(StoryWriter(), OpenAIBatchProvider())
+        if args.submit:
+            print(json.dumps(runner.submit_pending(), ensure_ascii=False, default=str, indent=2))
+        if args.poll:
+            print(json.dumps(runner.poll(), ensure_ascii=False, default=str, indent=2))
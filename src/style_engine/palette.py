@@ -0,0 +1,487 @@
+# src/style_engine/palette.py
+
+"""
+palette.py — подпись стиля каждой иллюстрации и ранжирование "выбившихся" страниц книги.
+
+Зачем: стиль-проход (style_corrector) не должен трогать страницы, которые и так в тоне книги —
+каждая лишняя коррекция это пересжатие и риск испортить удачную картинку. Нужна дешёвая
+подпись страницы и оценка, насколько она отличается от остальной книги.
+
+Подпись страницы (по миниатюре REF_SIDE, в LAB):
+- палитра: PALETTE_K цветов mini-batch k-means (Sculley): центры сдвигаются к среднему
+  случайной пачки из PALETTE_BATCH пикселей, шаг 1/счётчик центра; всё векторно, без
+  прохода по всем пикселям на каждой итерации. Старт — k-means++ по выборке, в конце —
+  PALETTE_REFINE шагов Ллойда по миниатюре;
+- яркость (среднее L), контраст (L p95 - p5), насыщенность (среднее sqrt(a^2 + b^2));
+- статистики lab_stats (квантили L, среднее/разброс a/b) — те же, что у style_corrector,
+  поэтому эталон книги в стиль-проходе строится из подписей, без повторного чтения картинок.
+
+Кэш подписей:
+- в документе сцены (scene.style_sig) с хэшем содержимого картинки (sha256) и её phash;
+  если у сцены тот же image_url и тот же phash (image_engine пишет его при каждой отрисовке),
+  подпись берётся без скачивания картинки;
+- иначе картинка скачивается и сверяется sha256: совпал — подпись из документа, нет —
+  из локального LRU процесса (PALETTE_CACHE_SIZE), и только потом считается заново.
+
+Ранжирование книги: эталон — медианы подписей, палитра книги — взвешенный k-means по палитрам
+страниц. По каждой страницы — отклонения яркости, контраста, среднего a/b и палитры (ΔE76),
+каждое в робастных z (медиана/MAD, с нижним порогом масштаба — на ровной книге крошечный MAD
+не должен раздувать шум). Итог — наибольший z; от STYLE_OUTLIER_SCORE — страница в стиль-проход.
+
+Бенчмарк:
+    python src/style_engine/palette.py --pages 24
+"""
+
+from typing import Optional, Dict, Any, List, Tuple
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/style_engine
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from style_engine.style_corrector import A5_300DPI, REF_SIDE, decode, lab_stats, rgb_to_lab, thumbnail
+from utils.metrics import REGISTRY
+
+
+PALETTE_K = int(os.getenv("PALETTE_K", "6"))
+PALETTE_BATCH = 1024
+PALETTE_ITERS = 40
+PALETTE_REFINE = 2
+# выборка для k-means++ старта
+PALETTE_INIT_SAMPLE = 4096
+PALETTE_CACHE_SIZE = int(os.getenv("PALETTE_CACHE_SIZE", "4096"))
+STYLE_OUTLIER_SCORE = float(os.getenv("STYLE_OUTLIER_SCORE", "3.0"))
+
+# версия подписи: меняется формула — старые подписи в сценах пересчитываются
+SIG_VERSION = 1
+
+# нижние пороги масштаба для робастных z (единицы LAB): разница меньше — глазом не видна
+SCALE_FLOOR = {"brightness": 3.0, "contrast": 5.0, "ab": 3.0, "palette": 4.0}
+
+SIG_LOOKUPS = REGISTRY.counter("booksoul_style_sig_total", "Style signature lookups by source")
+
+
+# ---------------------------------------------------------------------------------
+# MINI-BATCH K-MEANS
+# ---------------------------------------------------------------------------------
+
+def _sq_dist(x: np.ndarray, c: np.ndarray) -> np.ndarray:
+    """(N, 3), (K, 3) -> (N, K) квадраты расстояний: |x|^2 - 2xc + |c|^2 одной матричной операцией."""
+    d = (x * x).sum(1)[:, None] - 2 * x @ c.T + (c * c).sum(1)[None, :]
+    return np.maximum(d, 0)
+
+
+def _kmeans_pp(x: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Жадный k-means++ по выборке: на каждом шаге несколько кандидатов, берётся лучший —
+    палитра меньше зависит от сида.
+    """
+    sample = x[rng.choice(len(x), min(len(x), PALETTE_INIT_SAMPLE), replace=False)]
+    tries = 2 + int(np.log(k))
+    centers = [sample[rng.integers(len(sample))]]
+    d2 = ((sample - centers[0]) ** 2).sum(1)
+    for _ in range(1, k):
+        total = d2.sum()
+        if total <= 0:
+            centers.append(sample[rng.integers(len(sample))])
+            continue
+        cand = rng.choice(len(sample), size=tries, p=d2 / total)
+        cand_d2 = np.minimum(d2[None, :], _sq_dist(sample[cand], sample))
+        best = int(cand_d2.sum(1).argmin())
+        centers.append(sample[cand[best]])
+        d2 = cand_d2[best]
+    return np.array(centers, dtype=np.float32)
+
+
+def minibatch_kmeans(x: np.ndarray, k: int = PALETTE_K, batch: int = PALETTE_BATCH,
+                     iters: int = PALETTE_ITERS, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (N, 3) точки -> (центры (K, 3), доли пикселей (K,)), по убыванию доли.
+    """
+    rng = np.random.default_rng(seed)
+    centers = _kmeans_pp(x, k, rng)
+    counts = np.zeros(k, dtype=np.float64)
+    for _ in range(iters):
+        b = x[rng.integers(0, len(x), batch)]
+        nearest = _sq_dist(b, centers).argmin(1)
+        n = np.bincount(nearest, minlength=k)
+        sums = np.stack([np.bincount(nearest, weights=b[:, ch], minlength=k) for ch in range(3)], axis=1)
+        counts += n
+        moved = n > 0
+        # пачечный аналог шага 1/count на каждую точку: к среднему пачки с весом n/count
+        centers[moved] += ((sums[moved] - n[moved, None] * centers[moved]) / counts[moved, None]).astype(np.float32)
+    # доводка: пара шагов Ллойда по всем точкам миниатюры (их десятки тысяч — дёшево)
+    for _ in range(PALETTE_REFINE):
+        nearest = _sq_dist(x, centers).argmin(1)
+        n = np.bincount(nearest, minlength=k)
+        for ch in range(3):
+            s = np.bincount(nearest, weights=x[:, ch], minlength=k)
+            centers[:, ch] = np.where(n > 0, s / np.maximum(n, 1), centers[:, ch])
+    weights = np.bincount(_sq_dist(x, centers).argmin(1), minlength=k) / len(x)
+    order = np.argsort(-weights)
+    return centers[order], weights[order]
+
+
+def weighted_kmeans(points: np.ndarray, weights: np.ndarray, k: int, iters: int = 20, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Ллойд с весами на малом наборе (палитры страниц -> палитра книги)."""
+    rng = np.random.default_rng(seed)
+    k = min(k, len(points))
+    centers = points[rng.choice(len(points), k, replace=False, p=weights / weights.sum())].copy()
+    for _ in range(iters):
+        nearest = _sq_dist(points, centers).argmin(1)
+        w = np.bincount(nearest, weights=weights, minlength=k)
+        for ch in range(3):
+            s = np.bincount(nearest, weights=weights * points[:, ch], minlength=k)
+            centers[:, ch] = np.where(w > 0, s / np.maximum(w, 1e-12), centers[:, ch])
+    w = np.bincount(_sq_dist(points, centers).argmin(1), weights=weights, minlength=k)
+    return centers, w / w.sum()
+
+
+def inertia(x: np.ndarray, centers: np.ndarray) -> float:
+    """Средний квадрат расстояния пикселя до ближайшего центра — качество палитры."""
+    return float(_sq_dist(x, centers).min(1).mean())
+
+
+# ---------------------------------------------------------------------------------
+# ПОДПИСЬ СТРАНИЦЫ
+# ---------------------------------------------------------------------------------
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def signature_from_lab(lab: np.ndarray, seed: int = 0) -> Dict[str, Any]:
+    flat = lab.reshape(-1, 3).astype(np.float32)
+    centers, weights = minibatch_kmeans(flat, seed=seed)
+    st = lab_stats(lab)
+    p5, p95 = np.quantile(flat[:, 0], [0.05, 0.95])
+    return {
+        "v": SIG_VERSION,
+        "palette": [[round(float(c), 2) for c in row] for row in centers],
+        "weights": [round(float(w), 4) for w in weights],
+        "brightness": round(float(flat[:, 0].mean()), 2),
+        "contrast": round(float(p95 - p5), 2),
+        "chroma": round(float(np.hypot(flat[:, 1], flat[:, 2]).mean()), 2),
+        "l_q": [round(float(v), 2) for v in st["l_q"]],
+        "ab_mean": [round(float(v), 3) for v in st["ab_mean"]],
+        "ab_std": [round(float(v), 3) for v in st["ab_std"]],
+    }
+
+
+def signature_task(data: bytes) -> Dict[str, Any]:
+    """
+    Задача пула (верхний уровень модуля — для spawn-процессов): байты -> подпись с хэшем.
+    Сид k-means из хэша: одна и та же картинка -> одна и та же палитра.
+    """
+    h = content_hash(data)
+    sig = signature_from_lab(rgb_to_lab(thumbnail(data)), seed=int(h[:8], 16))
+    sig["hash"] = h
+    return sig
+
+
+def sig_stats(sig: Dict[str, Any]) -> Dict[str, Any]:
+    """Подпись -> статистики в формате lab_stats (для book_reference/correct_task)."""
+    return {
+        "l_q": np.asarray(sig["l_q"], dtype=np.float32),
+        "ab_mean": np.asarray(sig["ab_mean"], dtype=np.float32),
+        "ab_std": np.asarray(sig["ab_std"], dtype=np.float32),
+    }
+
+
+# ---------------------------------------------------------------------------------
+# РАНЖИРОВАНИЕ КНИГИ
+# ---------------------------------------------------------------------------------
+
+def _palette_distance(c: np.ndarray, w: np.ndarray, ref_c: np.ndarray, ref_w: np.ndarray) -> float:
+    """Симметричное взвешенное расстояние до ближайшего цвета другой палитры (ΔE76)."""
+    d = np.sqrt(_sq_dist(c, ref_c))
+    return float(0.5 * ((w * d.min(1)).sum() + (ref_w * d.min(0)).sum()))
+
+
+def _robust_z(values: np.ndarray, floor: float, one_sided: bool = False) -> np.ndarray:
+    med = np.median(values)
+    scale = max(1.4826 * float(np.median(np.abs(values - med))), floor)
+    z = (values - med) / scale
+    return np.maximum(z, 0) if one_sided else np.abs(z)
+
+
+def rank_signatures(sigs: List[Dict[str, Any]], threshold: float = STYLE_OUTLIER_SCORE) -> List[Dict[str, Any]]:
+    """
+    Подписи страниц книги -> [{index, score, z, outlier}] по убыванию score.
+    """
+    n = len(sigs)
+    if n == 0:
+        return []
+    brightness = np.array([s["brightness"] for s in sigs])
+    contrast = np.array([s["contrast"] for s in sigs])
+    ab = np.array([s["ab_mean"] for s in sigs])
+    ab_dev = np.linalg.norm(ab - np.median(ab, axis=0), axis=1)
+
+    pal = [np.asarray(s["palette"], dtype=np.float32) for s in sigs]
+    pw = [np.asarray(s["weights"], dtype=np.float64) for s in sigs]
+    book_c, book_w = weighted_kmeans(np.concatenate(pal), np.concatenate(pw) / n, PALETTE_K)
+    pal_dev = np.array([_palette_distance(c, w, book_c, book_w) for c, w in zip(pal, pw)])
+
+    z = {
+        "brightness": _robust_z(brightness, SCALE_FLOOR["brightness"]),
+        "contrast": _robust_z(contrast, SCALE_FLOOR["contrast"]),
+        # отклонения a/b и палитры уже >= 0: выбивается только "дальше обычного"
+        "ab": _robust_z(ab_dev, SCALE_FLOOR["ab"], one_sided=True),
+        "palette": _robust_z(pal_dev, SCALE_FLOOR["palette"], one_sided=True),
+    }
+    # худшее из отклонений: страница, выбившаяся только цветом, не разбавляется ровной яркостью
+    score = np.stack(list(z.values())).max(axis=0)
+    ranking = [{
+        "index": i,
+        "score": round(float(score[i]), 2),
+        "z": {k: round(float(v[i]), 2) for k, v in z.items()},
+        "outlier": bool(score[i] >= threshold),
+    } for i in range(n)]
+    ranking.sort(key=lambda r: -r["score"])
+    return ranking
+
+
+# ---------------------------------------------------------------------------------
+# КЭШ ПОДПИСЕЙ И КНИГА
+# ---------------------------------------------------------------------------------
+
+class _LRU:
+    def __init__(self, size: int):
+        self.size = size
+        self._data: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+
+_local = _LRU(PALETTE_CACHE_SIZE)
+
+
+class PaletteIndex:
+    """
+    PaletteIndex — подписи сцен книги с кэшем (scene.style_sig + LRU процесса) и ранжирование.
+    pool=None — подписи считаются в текущем процессе.
+    """
+
+    def __init__(self, storage, blobs, pool: Optional[ProcessPoolExecutor] = None,
+                 threshold: float = STYLE_OUTLIER_SCORE):
+        self.fs = storage
+        self.blobs = blobs
+        self.pool = pool
+        self.threshold = threshold
+
+    def signatures(self, book_id: str, scenes: List[Dict[str, Any]], path_of) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+        """
+        Подписи сцен (в том же порядке) + счётчики источников: doc / hash / local / computed.
+        path_of(url) -> путь картинки в хранилище файлов.
+        """
+        sigs: List[Optional[Dict[str, Any]]] = [None] * len(scenes)
+        sources = {"doc": 0, "hash": 0, "local": 0, "computed": 0}
+        pending: List[Tuple[int, bytes]] = []
+
+        for i, scene in enumerate(scenes):
+            stored = scene.get("style_sig") or {}
+            if stored.get("v") != SIG_VERSION:
+                stored = {}
+            # та же картинка по ссылке и phash — без скачивания
+            if stored and stored.get("url") == scene["image_url"] and scene.get("phash") \
+                    and stored.get("phash") == scene.get("phash"):
+                sigs[i] = stored
+                sources["doc"] += 1
+                continue
+            data = self.blobs.get_bytes(path_of(scene["image_url"]))
+            h = content_hash(data)
+            cached = _local.get(h)
+            if stored.get("hash") == h:
+                sigs[i] = stored
+                sources["hash"] += 1
+            elif cached is not None:
+                sigs[i] = dict(cached)
+                sources["local"] += 1
+            else:
+                pending.append((i, data))
+                continue
+            self._remember(book_id, scene, sigs[i])
+
+        if pending:
+            datas = [d for _, d in pending]
+            computed = list(self.pool.map(signature_task, datas)) if self.pool else list(map(signature_task, datas))
+            del datas
+            for (i, _), sig in zip(pending, computed):
+                _local.put(sig["hash"], sig)
+                sigs[i] = dict(sig)
+                self._remember(book_id, scenes[i], sigs[i])
+                sources["computed"] += 1
+
+        for source, count in sources.items():
+            if count:
+                SIG_LOOKUPS.inc(count, source=source)
+        return sigs, sources
+
+    def _remember(self, book_id: str, scene: Dict[str, Any], sig: Dict[str, Any]) -> None:
+        """Подпись -> scene.style_sig, с привязкой к текущей картинке сцены."""
+        if sig.get("url") == scene["image_url"] and sig.get("phash") == scene.get("phash") \
+                and scene.get("style_sig") == sig:
+            return
+        sig["url"] = scene["image_url"]
+        sig["phash"] = scene.get("phash") or ""
+        if self.fs is not None:
+            self.fs.update_scene(book_id, scene["id"], style_sig=sig)
+
+    def rank_book(self, book_id: str, path_of) -> Dict[str, Any]:
+        """
+        Ранжирование нарисованных сцен книги: кто выбивается из стиля.
+        """
+        scenes = [s for s in self.fs.list_scenes(book_id) if s.get("image_url")]
+        sigs, sources = self.signatures(book_id, scenes, path_of)
+        ranking = rank_signatures(sigs, self.threshold)
+        for r in ranking:
+            r["scene_id"] = scenes[r["index"]]["id"]
+            r["page"] = scenes[r["index"]].get("page")
+        return {"book_id": book_id, "scenes": scenes, "signatures": sigs,
+                "ranking": ranking, "sources": sources}
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+def _full_res_lloyd(data: bytes, k: int = PALETTE_K, iters: int = 10) -> np.ndarray:
+    """Как было бы "в лоб": LAB полного кадра и Ллойд по всем пикселям."""
+    x = rgb_to_lab(decode(data)).reshape(-1, 3)
+    centers = _kmeans_pp(x, k, np.random.default_rng(0))
+    for _ in range(iters):
+        nearest = _sq_dist(x, centers).argmin(1)
+        for ch in range(3):
+            s = np.bincount(nearest, weights=x[:, ch], minlength=k)
+            n = np.bincount(nearest, minlength=k)
+            centers[:, ch] = np.where(n > 0, s / np.maximum(n, 1), centers[:, ch])
+    return centers
+
+
+# палитра "книги": фон, небо, трава, кожа, тёмные контуры
+_BOOK_COLORS = np.array([[0.96, 0.92, 0.82], [0.55, 0.75, 0.92], [0.45, 0.70, 0.35],
+                         [0.93, 0.72, 0.58], [0.25, 0.22, 0.30]], dtype=np.float32)
+
+
+def _book_page(seed: int, gain: float = 1.0, tint: Tuple[float, float, float] = (1, 1, 1),
+               size: Tuple[int, int] = A5_300DPI) -> bytes:
+    """
+    Страница книги в одной палитре: пятна из _BOOK_COLORS в своей раскладке, лёгкий разнобой тона.
+    gain / tint — выбившаяся страница (темнее / с цветовым сдвигом).
+    """
+    r = np.random.default_rng(seed)
+    w, h = size
+    sw, sh = w // 8, h // 8
+    yy, xx = np.mgrid[0:sh, 0:sw] / max(sw, sh)
+    img = np.tile(_BOOK_COLORS[0], (sh, sw, 1))
+    for _ in range(10):
+        cx, cy, rad = r.random(3)
+        mask = np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (0.005 + rad * 0.03))[..., None]
+        img = img * (1 - mask) + _BOOK_COLORS[r.integers(1, len(_BOOK_COLORS))] * mask
+    img = img * r.uniform(0.95, 1.05) * (1 + r.uniform(-0.03, 0.03, 3))
+    img = img * gain * np.asarray(tint, dtype=np.float32)
+    small = Image.fromarray(np.clip(img * 255, 0, 255).astype(np.uint8))
+    big = np.asarray(small.resize((w, h), Image.BICUBIC)).astype(np.int16)
+    big = np.clip(big + r.integers(-6, 7, big.shape, dtype=np.int16), 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(big).save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+if __name__ == "__main__":
+    from data_layer.memory_storage import MemoryStorage
+    from data_layer.gcs_client import LocalBlobStore
+    from style_engine.style_corrector import StyleCorrector
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="BookSoul palette / style outlier benchmark")
+    parser.add_argument("--pages", type=int, default=24)
+    args = parser.parse_args()
+
+    # книга в одной палитре + 3 выбившиеся страницы: тёмная, "синяя", "тёплая"
+    odd = {3: dict(gain=0.7), 11: dict(tint=(0.85, 0.92, 1.2)), args.pages - 2: dict(tint=(1.15, 1.0, 0.8))}
+    pages = [_book_page(i, **odd.get(i, {})) for i in range(args.pages)]
+
+    t0 = time.perf_counter()
+    for p in pages[:2]:
+        _full_res_lloyd(p)
+    full = (time.perf_counter() - t0) / 2
+    print(f"Ллойд по полному кадру (10 итераций): {full:.2f} с на страницу -> ~{full * args.pages:.0f} с на книгу")
+
+    t0 = time.perf_counter()
+    sigs = [signature_task(p) for p in pages]
+    mb = (time.perf_counter() - t0) / args.pages
+    print(f"подпись (миниатюра {REF_SIDE}, mini-batch k-means): {mb * 1000:.0f} мс на страницу "
+          f"-> {mb * args.pages:.1f} с на книгу")
+
+    x = rgb_to_lab(thumbnail(pages[0])).reshape(-1, 3)
+    c_mb = np.asarray(sigs[0]["palette"], dtype=np.float32)
+    c_full = _full_res_lloyd(pages[0])
+    print(f"качество палитры (инерция на миниатюре): mini-batch {inertia(x, c_mb):.1f}, "
+          f"Ллойд по полному кадру {inertia(x, c_full):.1f}")
+
+    ranking = rank_signatures(sigs)
+    flagged = sorted(r["index"] for r in ranking if r["outlier"])
+    print(f"выбились (порог {STYLE_OUTLIER_SCORE}): {flagged}, ожидались {sorted(odd)}")
+    for r in ranking[:5]:
+        print(f"  стр. {r['index']:2d}  score {r['score']:5.2f}  {json.dumps(r['z'])}")
+
+    # кэш в документе сцены: второй проход — без скачивания и без k-means
+    fs = MemoryStorage()
+    blobs = LocalBlobStore(tempfile.mkdtemp(prefix="booksoul_palette_"))
+    book_id = "BKS-20251201-000001"
+    fs.create_book(book_id, child_name="Мия", theme="лес", status="styling")
+    for i, data in enumerate(pages):
+        path = f"books/{book_id}/scenes/s{i:02d}.png"
+        url = blobs.put_bytes(path, data, "image/png")
+        fs.add_scene(book_id, f"s{i:02d}", page_number=i + 1, text="", prompt_main="", prompt_background="")
+        fs.update_scene(book_id, f"s{i:02d}", image_url=url, phash=f"{i:016x}", status="drawn")
+
+    corrector = StyleCorrector(fs, blobs)
+    index = PaletteIndex(fs, blobs)
+    for label in ("холодный кэш", "подписи из сцен"):
+        t0 = time.perf_counter()
+        rep = index.rank_book(book_id, corrector._path)
+        print(f"{label}: {time.perf_counter() - t0:.2f} с, источники {rep['sources']}")
+
+    _local._data.clear()
+    fs.update_scene(book_id, "s00", phash="")
+    t0 = time.perf_counter()
+    rep = index.rank_book(book_id, corrector._path)
+    print(f"без phash у s00 (сверка sha256): {time.perf_counter() - t0:.2f} с, источники {rep['sources']}")
+
+    t0 = time.perf_counter()
+    res = corrector.run_book(book_id, only_outliers=True)
+    print(f"стиль-проход только по выбившимся: {time.perf_counter() - t0:.1f} с, "
+          f"исправлено {res['corrected']} из {res['pages']}")
@@ -0,0 +1,407 @@
+# src/style_engine/style_corrector.py
+
+"""
+style_corrector.py — Style Engine: все иллюстрации книги к единому тону и цвету.
+
+Книга — 12–24 страницы A5 300 DPI (1748 x 2480, ~4.3 Мп каждая). Попиксельно в Pillow это минуты,
+поэтому всё векторно в NumPy и по процессам:
+
+1. эталон книги: каждая картинка -> миниатюра (REF_SIDE) -> LAB пачкой;
+   профиль яркости = медиана по страницам квантильных функций L (65 точек),
+   палитра = медианы средних и разбросов a/b. Медиана, а не среднее: одна "выбившаяся"
+   страница не тянет эталон на себя;
+2. коррекция каждой страницы в полном разрешении, в пуле процессов (STYLE_WORKERS):
+   L — гистограммное сопоставление квантилей к профилю книги, a/b — перенос среднего и
+   разброса (Reinhard) в LAB; сила STYLE_STRENGTH — доля сдвига (1.0 — полностью к эталону);
+   картинка обрабатывается полосами по STRIPE_ROWS строк, память процесса — не весь кадр во float;
+   сжатые байты страниц уходят воркерам через shared memory (utils.shm_pool, бюджет SHM_BUDGET_MB),
+   а не пиклингом по pipe; распаковка — в воркере, родитель страниц не распаковывает;
+3. результат — books/<id>/styled/<scene_id>.jpg, ссылка — scene.styled_url (и sha256 — styled_hash,
+   по нему layout_engine узнаёт неизменившиеся страницы), задача style_pass.
+   JPEG q95 без субдискретизации цвета: кодируется в ~15 раз быстрее PNG, и ReportLab кладёт
+   JPEG в PDF как есть (DCTDecode), без перекодирования.
+
+STYLE_ONLY_OUTLIERS: статистики шага 1 берутся из подписей palette.py (кэш в документе сцены),
+а в шаг 2 идут только страницы, выбившиеся из стиля книги.
+
+sRGB <-> LAB: гамма через таблицы (LUT) вместо pow на каждом пикселе.
+
+Бенчмарк (24 страницы A5 300 DPI):
+    python src/style_engine/style_corrector.py --pages 24
+"""
+
+from typing import Optional, Dict, Any, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+try:
+    from PIL import Image
+except Exception:
+    Image = None
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/style_engine
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from utils.shm_pool import ShmPool
+
+
+STYLE_STRENGTH = float(os.getenv("STYLE_STRENGTH", "0.7"))
+STYLE_WORKERS = int(os.getenv("STYLE_WORKERS", "0")) or (os.cpu_count() or 1)
+# только страницы, выбившиеся из стиля книги (palette.py); false — все
+STYLE_ONLY_OUTLIERS = os.getenv("STYLE_ONLY_OUTLIERS", "true").lower() == "true"
+
+# сторона миниатюры для эталона и статистик страницы
+REF_SIDE = 256
+# точки квантильной функции яркости
+PROFILE_POINTS = 65
+STRIPE_ROWS = 256
+STYLE_JPEG_QUALITY = int(os.getenv("STYLE_JPEG_QUALITY", "95"))
+# синтетические страницы бенчмарка: PNG со сжатием 1 (быстрее, чем 6)
+PNG_COMPRESS = 1
+
+JOB_TYPE = "style_pass"
+
+A5_300DPI = (1748, 2480)
+
+
+# ---------------------------------------------------------------------------------
+# ЦВЕТ: sRGB <-> LAB (D65)
+# ---------------------------------------------------------------------------------
+
+_EPS = 216 / 24389
+_KAPPA = 24389 / 27
+_WHITE = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+_RGB2XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                     [0.2126729, 0.7151522, 0.0721750],
+                     [0.0193339, 0.1191920, 0.9503041]], dtype=np.float32)
+# нормировка на белую точку сразу в матрице
+_RGB2XYZN = (_RGB2XYZ / _WHITE[:, None]).T.astype(np.float32)
+_XYZN2RGB = np.linalg.inv(_RGB2XYZ / _WHITE[:, None]).T.astype(np.float32)
+
+_c = np.arange(256, dtype=np.float64) / 255.0
+_SRGB_TO_LINEAR = np.where(_c <= 0.04045, _c / 12.92, ((_c + 0.055) / 1.055) ** 2.4).astype(np.float32)
+_LUT_LEVELS = 4096
+_l = np.arange(_LUT_LEVELS, dtype=np.float64) / (_LUT_LEVELS - 1)
+_LINEAR_TO_SRGB = np.clip(np.round(255 * np.where(_l <= 0.0031308, _l * 12.92,
+                                                 1.055 * _l ** (1 / 2.4) - 0.055)), 0, 255).astype(np.uint8)
+del _c, _l
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """(..., 3) uint8 sRGB -> (..., 3) float32 LAB."""
+    xyz = _SRGB_TO_LINEAR[rgb] @ _RGB2XYZN
+    f = np.where(xyz > _EPS, np.cbrt(xyz), (_KAPPA * xyz + 16) / 116)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def lab_to_rgb(lab: np.ndarray) -> np.ndarray:
+    """(..., 3) float32 LAB -> (..., 3) uint8 sRGB."""
+    f = np.empty_like(lab)
+    f[..., 1] = (lab[..., 0] + 16) / 116
+    f[..., 0] = f[..., 1] + lab[..., 1] / 500
+    f[..., 2] = f[..., 1] - lab[..., 2] / 200
+    f3 = f * f * f
+    xyz = np.where(f3 > _EPS, f3, (116 * f - 16) / _KAPPA)
+    lin = np.clip(xyz @ _XYZN2RGB, 0.0, 1.0)
+    return _LINEAR_TO_SRGB[(lin * (_LUT_LEVELS - 1) + 0.5).astype(np.int32)]
+
+
+# ---------------------------------------------------------------------------------
+# СТАТИСТИКИ И ЭТАЛОН
+# ---------------------------------------------------------------------------------
+
+_P = np.linspace(0, 1, PROFILE_POINTS)
+
+
+def decode(data: bytes) -> np.ndarray:
+    if Image is None:
+        raise RuntimeError("style_corrector: Pillow не установлен.")
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+
+
+def thumbnail(data: bytes, side: int = REF_SIDE) -> np.ndarray:
+    img = Image.open(io.BytesIO(data))
+    img.draft("RGB", (side, side))
+    img = img.convert("RGB")
+    img.thumbnail((side, side), Image.BILINEAR)
+    return np.asarray(img)
+
+
+def lab_stats(lab: np.ndarray) -> Dict[str, Any]:
+    """
+    Статистики страницы по LAB миниатюры: квантили L, среднее и разброс a/b.
+    """
+    flat = lab.reshape(-1, 3)
+    return {
+        "l_q": np.quantile(flat[:, 0], _P).astype(np.float32),
+        "ab_mean": flat[:, 1:].mean(axis=0),
+        "ab_std": flat[:, 1:].std(axis=0) + 1e-3,
+    }
+
+
+def book_reference(stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Эталон книги: поэлементные медианы по страницам.
+    Квантильная функция после медианы остаётся монотонной принудительно.
+    """
+    l_q = np.median(np.stack([s["l_q"] for s in stats]), axis=0)
+    return {
+        "l_q": np.maximum.accumulate(l_q).astype(np.float32),
+        "ab_mean": np.median(np.stack([s["ab_mean"] for s in stats]), axis=0).astype(np.float32),
+        "ab_std": np.median(np.stack([s["ab_std"] for s in stats]), axis=0).astype(np.float32),
+    }
+
+
+def correct_lab(lab: np.ndarray, src: Dict[str, Any], ref: Dict[str, Any], strength: float) -> np.ndarray:
+    """Сдвиг страницы к эталону (in-place на полосе LAB)."""
+    L = lab[..., 0]
+    # квантили страницы должны строго расти для interp — плато раздвигаем на эпсилон
+    src_q = src["l_q"] + np.arange(PROFILE_POINTS, dtype=np.float32) * 1e-4
+    mapped = np.interp(L, src_q, ref["l_q"]).astype(np.float32)
+    L += strength * (mapped - L)
+    scale = ref["ab_std"] / src["ab_std"]
+    for ch in (1, 2):
+        c = lab[..., ch]
+        target = (c - src["ab_mean"][ch - 1]) * scale[ch - 1] + ref["ab_mean"][ch - 1]
+        c += strength * (target - c)
+    return lab
+
+
+# ---------------------------------------------------------------------------------
+# ЗАДАЧИ ПУЛА (верхний уровень модуля — чтобы работали в spawn-процессах)
+# ---------------------------------------------------------------------------------
+
+# data — байты PNG/JPEG или те же байты uint8-массивом поверх shared memory (ShmPool)
+
+def page_stats_task(data: bytes) -> Dict[str, Any]:
+    """Фаза 1: миниатюра -> LAB -> статистики страницы."""
+    return lab_stats(rgb_to_lab(thumbnail(data)))
+
+
+def correct_task(data: bytes, src: Dict[str, Any], ref: Dict[str, Any], strength: float) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Фаза 2: полное разрешение, полосами. Возвращает (JPEG, статистики результата).
+    """
+    rgb = decode(data)
+    out = np.empty_like(rgb)
+    for y in range(0, rgb.shape[0], STRIPE_ROWS):
+        stripe = rgb_to_lab(rgb[y:y + STRIPE_ROWS])
+        out[y:y + STRIPE_ROWS] = lab_to_rgb(correct_lab(stripe, src, ref, strength))
+    buf = io.BytesIO()
+    img = Image.fromarray(out)
+    img.save(buf, format="JPEG", quality=STYLE_JPEG_QUALITY, subsampling=0)
+    img.thumbnail((REF_SIDE, REF_SIDE), Image.BILINEAR)
+    return buf.getvalue(), lab_stats(rgb_to_lab(np.asarray(img)))
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_pool(workers: int = STYLE_WORKERS) -> ProcessPoolExecutor:
+    """
+    Пул процессов на весь процесс сервиса (spawn: безопасно рядом с потоками uvicorn).
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def spread(stats: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Насколько страницы расходятся: разброс медианы L и средних a/b между страницами."""
+    med_l = np.array([s["l_q"][PROFILE_POINTS // 2] for s in stats])
+    ab = np.stack([s["ab_mean"] for s in stats])
+    return {"l_median_std": round(float(med_l.std()), 2), "ab_mean_std": round(float(np.linalg.norm(ab.std(axis=0))), 2)}
+
+
+# ---------------------------------------------------------------------------------
+# КНИГА
+# ---------------------------------------------------------------------------------
+
+class StyleCorrector:
+    """
+    StyleCorrector — стиль-проход книги: эталон по всем сценам, коррекция каждой сцены.
+    pool=None — всё в текущем процессе (тесты, одноядерная машина); с пулом страницы идут
+    воркерам через ShmPool поверх того же пула.
+    """
+
+    def __init__(self, storage, blobs, pool: Optional[ProcessPoolExecutor] = None,
+                 strength: float = STYLE_STRENGTH):
+        self.fs = storage
+        self.blobs = blobs
+        self.pool = pool
+        self.shm = ShmPool(executor=pool) if pool is not None else None
+        self.strength = strength
+
+    def _map(self, fn, images: List[bytes], *args, per_item: Optional[List[Tuple[Any, ...]]] = None) -> List[Any]:
+        """fn(байты страницы, *per_item[i], *args) по всем страницам, порядок — как у images."""
+        if self.shm is None:
+            return [fn(data, *(per_item[i] if per_item else ()), *args) for i, data in enumerate(images)]
+        return self.shm.map(fn, [np.frombuffer(data, dtype=np.uint8) for data in images], *args, per_item=per_item)
+
+    def correct_images(self, images: List[bytes], stats: Optional[List[Dict[str, Any]]] = None,
+                       targets: Optional[List[int]] = None) -> Tuple[List[bytes], Dict[str, Any]]:
+        """
+        Ядро без хранилища: байты картинок -> байты скорректированных + отчёт.
+        stats — готовые статистики страниц (подписи palette.py): эталон без чтения картинок.
+        targets — индексы страниц для коррекции; images тогда — только их байты, по порядку.
+        """
+        t0 = time.perf_counter()
+        before = stats if stats is not None else self._map(page_stats_task, images)
+        ref = book_reference(before)
+        t_ref = time.perf_counter() - t0
+
+        targets = list(range(len(before))) if targets is None else targets
+        n = len(targets)
+        results = self._map(correct_task, images, ref, self.strength, per_item=[(before[i],) for i in targets])
+        out = [r[0] for r in results]
+        after = list(before)
+        for i, r in zip(targets, results):
+            after[i] = r[1]
+        return out, {
+            "pages": len(before),
+            "corrected": n,
+            "reference_s": round(t_ref, 3),
+            "total_s": round(time.perf_counter() - t0, 3),
+            "before": spread(before),
+            "after": spread(after),
+            "reference": {"l_median": round(float(ref["l_q"][PROFILE_POINTS // 2]), 2),
+                          "ab_mean": [round(float(x), 2) for x in ref["ab_mean"]],
+                          "ab_std": [round(float(x), 2) for x in ref["ab_std"]]},
+        }
+
+    def run_book(self, book_id: str, only_outliers: bool = STYLE_ONLY_OUTLIERS) -> Dict[str, Any]:
+        """
+        Нарисованные сцены книги -> styled/<scene_id>.jpg, scene.styled_url, задача style_pass.
+        only_outliers — эталон по подписям всех сцен (palette.py, из кэша), исправляются только
+        выбившиеся; остальные остаются как нарисованы.
+        """
+        from style_engine.palette import PaletteIndex, content_hash, sig_stats
+
+        job_id = self.fs.create_job(book_id, JOB_TYPE, status="running")
+        try:
+            ranked = PaletteIndex(self.fs, self.blobs, pool=self.pool).rank_book(book_id, self._path)
+            scenes = ranked["scenes"]
+            if not scenes:
+                self.fs.update_job_status(job_id, "error", job_type=JOB_TYPE)
+                return {"book_id": book_id, "ok": False, "error": "no drawn scenes"}
+            if only_outliers:
+                targets = sorted(r["index"] for r in ranked["ranking"] if r["outlier"])
+            else:
+                targets = list(range(len(scenes)))
+            scenes_out = [scenes[i] for i in targets]
+            images = [self.blobs.get_bytes(self._path(s["image_url"])) for s in scenes_out]
+            out, report = self.correct_images(images, stats=[sig_stats(s) for s in ranked["signatures"]],
+                                              targets=targets)
+            del images
+            report["signatures"] = ranked["sources"]
+            report["outliers"] = [{"scene_id": r["scene_id"], "page": r["page"], "score": r["score"]}
+                                  for r in ranked["ranking"] if r["outlier"]]
+            for scene, data in zip(scenes_out, out):
+                url = self.blobs.put_bytes(f"books/{book_id}/styled/{scene['id']}.jpg", data, "image/jpeg")
+                # styled_hash — точный ключ картинки для кэша вёрстки (файл перезаписывается по тому же url)
+                self.fs.update_scene(book_id, scene["id"], styled_url=url, styled_hash=content_hash(data))
+        except Exception:
+            self.fs.update_job_status(job_id, "error", job_type=JOB_TYPE)
+            raise
+        self.fs.update_job_status(job_id, "done", result_url=f"books/{book_id}/styled/", job_type=JOB_TYPE)
+        book = self.fs.get_book(book_id) or {}
+        if book.get("status") == "styling":
+            self.fs.update_book_status(book_id, "cover")
+        return {"book_id": book_id, "ok": True, **report}
+
+    def _path(self, url: str) -> str:
+        """URL из сцены -> путь в хранилище файлов."""
+        if url.startswith("gs://"):
+            return url.split("/", 3)[3]
+        if url.startswith("file://"):
+            return os.path.relpath(url[len("file://"):], self.blobs.root_dir).replace(os.sep, "/")
+        return url
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+def _synthetic_page(seed: int, size: Tuple[int, int] = A5_300DPI) -> bytes:
+    """Страница с плавными пятнами и своим сдвигом тона/цвета — как разнобой генерации."""
+    r = np.random.default_rng(seed)
+    w, h = size
+    sw, sh = w // 8, h // 8
+    yy, xx = np.mgrid[0:sh, 0:sw] / max(sw, sh)
+    img = np.zeros((sh, sw, 3), dtype=np.float32)
+    for _ in range(8):
+        cx, cy, rad = r.random(3)
+        img += np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (0.01 + rad * 0.05))[..., None] * r.random(3)
+    img = img / img.max()
+    img = img ** r.uniform(0.6, 1.6) * r.uniform(0.7, 1.0) + r.uniform(0, 0.2)     # тон
+    img = img * (1 + r.uniform(-0.25, 0.25, 3))                                        # цветовой сдвиг
+    small = Image.fromarray(np.clip(img * 255, 0, 255).astype(np.uint8))
+    big = np.asarray(small.resize((w, h), Image.BICUBIC)).astype(np.int16)
+    big = np.clip(big + r.integers(-6, 7, big.shape, dtype=np.int16), 0, 255).astype(np.uint8)  # зерно
+    buf = io.BytesIO()
+    Image.fromarray(big).save(buf, format="PNG", compress_level=PNG_COMPRESS)
+    return buf.getvalue()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BookSoul style corrector benchmark")
+    parser.add_argument("--pages", type=int, default=24)
+    parser.add_argument("--workers", type=int, default=STYLE_WORKERS)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    pages = [_synthetic_page(i) for i in range(args.pages)]
+    print(f"{args.pages} страниц A5 300 DPI ({A5_300DPI[0]}x{A5_300DPI[1]}): сгенерированы за "
+          f"{time.perf_counter() - t0:.1f} с, PNG в среднем {sum(map(len, pages)) / len(pages) / 1e6:.1f} МБ")
+
+    # попиксельная коррекция на чистом Python — замер на 20 000 пикселях, экстраполяция на книгу
+    rgb = decode(pages[0])[:10, :2000].reshape(-1, 3)
+    ref = book_reference([page_stats_task(p) for p in pages[:4]])
+    src = page_stats_task(pages[0])
+    t0 = time.perf_counter()
+    for px in rgb:
+        lab = rgb_to_lab(px[None])
+        lab_to_rgb(correct_lab(lab, src, ref, STYLE_STRENGTH))
+    per_px = (time.perf_counter() - t0) / len(rgb)
+    book_px = A5_300DPI[0] * A5_300DPI[1] * args.pages
+    print(f"попиксельно: {per_px * 1e6:.1f} мкс на пиксель -> ~{per_px * book_px / 60:.0f} мин на книгу")
+
+    single = StyleCorrector(None, None, pool=None)
+    _, rep1 = single.correct_images(pages)
+    print(f"векторно, 1 процесс: {rep1['total_s']:.1f} с ({rep1['total_s'] / args.pages:.2f} с на страницу), "
+          f"эталон {rep1['reference_s']:.2f} с")
+
+    pool = get_pool(args.workers)
+    list(pool.map(page_stats_task, pages[:args.workers]))   # прогрев: spawn + импорт numpy/PIL
+    pooled = StyleCorrector(None, None, pool=pool)
+    _, rep = pooled.correct_images(pages)
+    print(f"векторно, пул из {args.workers} процессов (ядер: {os.cpu_count()}): {rep['total_s']:.1f} с")
+    # передача страниц воркерам на лёгкой фазе 1: пиклинг байтов по pipe против shared memory
+    t0 = time.perf_counter()
+    list(pool.map(page_stats_task, pages))
+    t_pickled = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    pooled._map(page_stats_task, pages)
+    t_shm = time.perf_counter() - t0
+    print(f"статистики страниц в пуле: пиклинг {t_pickled:.2f} с, shared memory {t_shm:.2f} с "
+          f"(пик сегментов {pooled.shm.peak / 2 ** 20:.0f} МБ из {pooled.shm.budget / 2 ** 20:.0f})")
+    print(f"разброс между страницами до:    {rep['before']}")
+    print(f"разброс между страницами после: {rep['after']}  (STYLE_STRENGTH={STYLE_STRENGTH})")
+    print(json.dumps(rep["reference"], ensure_ascii=False))
+    pool.shutdown()
@@ -0,0 +1,299 @@
+# src/utils/metrics.py
+
+from typing import Optional, Dict, Any, List, Tuple
+import bisect
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/utils
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+# Важно:
+# - это метрики процесса (in-memory), для /metrics в формате Prometheus text 0.0.4;
+#   долгие окна "за N часов" остаются в data_layer.metrics_rollup и TokenLedger
+# - без prometheus_client: счётчик = словарь под одним локом, гистограмма = bisect по
+#   фиксированным бакетам. На горячем пути — perf_counter, один lock и пара сложений
+# - каждый LLM-вызов фабрики оборачивается в llm_call(...): модель, эндпоинт, задержка,
+#   токены, стоимость, исход (ok / error / cancelled) и класс ошибки
+# - построчный лог вызовов — сэмплированный (LLM_LOG_SAMPLE), ошибки пишутся всегда
+#
+# Метрики:
+#   booksoul_llm_calls_total{kind,model,endpoint,outcome}
+#   booksoul_llm_errors_total{kind,model,endpoint,error}
+#   booksoul_llm_latency_seconds{kind,model,endpoint}            (histogram)
+#   booksoul_llm_tokens_total{kind,model,type=prompt|cached|completion}
+#   booksoul_llm_cost_usd_total{kind,model}
+#   booksoul_llm_fallbacks_total{kind,reason}
+#   booksoul_llm_json_failures_total{kind}
+
+LLM_LOG_SAMPLE = float(os.getenv("LLM_LOG_SAMPLE", "0.05"))
+
+# секунды: от быстрого пути gpt-4o-mini до хвостов gpt-5
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+# ---------------------------------------------------------------------------------
+# ТИПЫ МЕТРИК
+# ---------------------------------------------------------------------------------
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, v in items:
+            lines.append(f"{self.name}{_fmt_labels(key)} {_fmt_value(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # key -> [счётчики по бакетам (не кумулятивные) + overflow, sum, count]
+        self._values: Dict[LabelKey, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            row[0][idx] += 1
+            row[1] += value
+            row[2] += 1
+
+    def count(self, **labels) -> int:
+        row = self._values.get(_label_key(labels))
+        return row[2] if row else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, (list(r[0]), r[1], r[2])) for k, r in self._values.items())
+        for key, (counts, total, n) in items:
+            cumulative = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, ('le', _fmt_value(le)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {n}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help_text: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._get(Counter, name, help_text)
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        lines: List[str] = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# тип ответа для /metrics
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# ---------------------------------------------------------------------------------
+# LLM
+# ---------------------------------------------------------------------------------
+
+LLM_CALLS = REGISTRY.counter("booksoul_llm_calls_total", "LLM calls by outcome")
+LLM_ERRORS = REGISTRY.counter("booksoul_llm_errors_total", "LLM call errors by exception class")
+LLM_LATENCY = REGISTRY.histogram("booksoul_llm_latency_seconds", "LLM call latency")
+LLM_TOKENS = REGISTRY.counter("booksoul_llm_tokens_total", "LLM tokens (prompt / cached / completion)")
+LLM_COST = REGISTRY.counter("booksoul_llm_cost_usd_total", "LLM cost in USD")
+LLM_FALLBACKS = REGISTRY.counter("booksoul_llm_fallbacks_total", "Fallback paths taken")
+LLM_JSON_FAILURES = REGISTRY.counter("booksoul_llm_json_failures_total", "LLM output that failed to parse as JSON")
+
+
+class LLMCall:
+    """
+    Замер одного LLM-вызова. Вызывающий код заполняет usage (и при желании extra)
+    до выхода из блока; всё остальное llm_call считает сам.
+    """
+
+    __slots__ = ("kind", "model", "endpoint", "usage", "extra", "t0")
+
+    def __init__(self, kind: str, model: str, endpoint: str):
+        self.kind = kind
+        self.model = model
+        self.endpoint = endpoint
+        self.usage: Optional[Dict[str, Any]] = None
+        self.extra: Optional[Dict[str, Any]] = None
+        self.t0 = time.perf_counter()
+
+    def __enter__(self) -> "LLMCall":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        elapsed = time.perf_counter() - self.t0
+        if exc_type is None:
+            outcome = "ok"
+        elif issubclass(exc_type, (GeneratorExit, KeyboardInterrupt)) or exc_type.__name__ == "CancelledError":
+            outcome = "cancelled"
+        else:
+            outcome = "error"
+        record_llm_call(self.kind, self.model, self.endpoint, elapsed, outcome,
+                        usage=self.usage, error=exc_type.__name__ if outcome == "error" else None,
+                        extra=self.extra)
+        return False
+
+
+def llm_call(kind: str, model: str, endpoint: str) -> LLMCall:
+    """
+    with llm_call("plan", model, "responses") as call:
+        resp = client.responses.create(...)
+        call.usage = usage_from_response(resp, ...)
+    """
+    return LLMCall(kind, model, endpoint)
+
+
+def record_llm_call(
+    kind: str,
+    model: str,
+    endpoint: str,
+    seconds: float,
+    outcome: str = "ok",
+    usage: Optional[Dict[str, Any]] = None,
+    error: Optional[str] = None,
+    extra: Optional[Dict[str, Any]] = None,
+) -> None:
+    LLM_CALLS.inc(kind=kind, model=model, endpoint=endpoint, outcome=outcome)
+    LLM_LATENCY.observe(seconds, kind=kind, model=model, endpoint=endpoint)
+    if error:
+        LLM_ERRORS.inc(kind=kind, model=model, endpoint=endpoint, error=error)
+    cost = 0
+    if usage:
+        # импорт здесь: token_accounting тянет data_layer, а utils должен грузиться без него
+        from router.token_accounting import cost_micro_usd
+        cost = cost_micro_usd(model, usage)
+        for t in ("prompt", "cached", "completion"):
+            n = usage.get(f"{t}_tokens", 0)
+            if n:
+                LLM_TOKENS.inc(n, kind=kind, model=model, type=t)
+        LLM_COST.inc(cost / 1e6, kind=kind, model=model)
+
+    if error or random.random() < LLM_LOG_SAMPLE:
+        entry = {
+            "kind": kind,
+            "model": model,
+            "endpoint": endpoint,
+            "latency_ms": round(seconds * 1000.0, 1),
+            "outcome": outcome,
+        }
+        if error:
+            entry["error"] = error
+        if usage:
+            entry["tokens"] = [usage.get("prompt_tokens", 0), usage.get("cached_tokens", 0),
+                               usage.get("completion_tokens", 0)]
+            entry["cost_micro_usd"] = cost
+        if extra:
+            entry.update(extra)
+        print("[llm] " + json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+
+
+def record_fallback(kind: str, reason: str) -> None:
+    LLM_FALLBACKS.inc(kind=kind, reason=reason)
+
+
+def record_json_failure(kind: str) -> None:
+    LLM_JSON_FAILURES.inc(kind=kind)
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    n = 200_000
+    usage = {"prompt_tokens": 900, "cached_tokens": 768, "completion_tokens": 120}
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        pass
+    base = time.perf_counter() - t0
+
+    LLM_LOG_SAMPLE = 0.0
+    t0 = time.perf_counter()
+    for i in range(n):
+        with llm_call("bench", "gpt-4o-mini", "responses") as call:
+            call.usage = usage
+    spent = time.perf_counter() - t0 - base
+
+    record_fallback("plan", "tool_calling_unavailable")
+    record_json_failure("plan_json")
+    print(render())
+    print(f"накладные расходы llm_call: {spent / n * 1e6:.2f} мкс на вызов ({n} вызовов)")
@@ -0,0 +1,319 @@
+# src/utils/shm_pool.py
+
+from typing import Optional, Dict, Any, List, Tuple, Callable, NamedTuple, Sequence
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import argparse
+import multiprocessing
+import os
+import pickle
+import sys
+import threading
+import time
+
+import numpy as np
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/utils
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+# Важно:
+# - пул процессов для тяжёлых стадий с картинками (style engine, обложка, подготовка вёрстки):
+#   RGB-кадр A5 300 DPI — 13 МБ; через обычный ProcessPoolExecutor он пиклится, идёт по pipe
+#   и распаковывается — три копии и сериализация в одном потоке родителя на каждую задачу
+# - здесь массив один раз кладётся в multiprocessing.shared_memory, в задачу уходит только
+#   ShmSpec (имя сегмента, форма, dtype) — ~100 байт; воркер открывает сегмент и видит тот же
+#   буфер как np.ndarray без копии. Результат-картинка — так же: выходной буфер выделяет
+#   родитель (ShmPool.empty / map(out=True)), воркер пишет в него на месте
+# - бюджет памяти SHM_BUDGET_MB на все живые сегменты пула: share/empty ждут, пока задачи
+#   не освободят место. Один буфер больше всего бюджета пропускается, только когда пул пуст —
+#   иначе он не дождался бы никогда
+# - map раздаёт задачи от больших картинок к меньшим (LPT): крупная в конце очереди — это
+#   хвост, в который упирается вся пачка; заодно большие берут бюджет, пока он свободен
+# - spawn-контекст: безопасно рядом с потоками uvicorn; функции задач — верхнего уровня модуля
+# - функция задачи не должна возвращать view на входной/выходной буфер: после задачи воркер
+#   закрывает сегменты. Маленький результат (байты JPEG, статистики) возвращается как обычно
+# - вход — любой np.ndarray, в том числе сжатые байты страницы (np.frombuffer(png, np.uint8)):
+#   так style_corrector отдаёт страницы пулу — распаковка остаётся в воркере, а не в родителе
+# - executor — готовый ProcessPoolExecutor (например, пул style_corrector, общий с palette.py):
+#   ShmPool тогда только раздаёт задачи и держит бюджет, close() пул не закрывает
+#
+# Бенчмарк (shared memory против пиклинга):
+#   python src/utils/shm_pool.py
+
+SHM_WORKERS = int(os.getenv("SHM_WORKERS", "0")) or (os.cpu_count() or 1)
+SHM_BUDGET_MB = int(os.getenv("SHM_BUDGET_MB", "1024"))
+
+
+class ShmSpec(NamedTuple):
+    """То, что уходит в процесс вместо массива."""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+def _attach(spec: ShmSpec) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    shm = shared_memory.SharedMemory(name=spec.name)
+    return shm, np.ndarray(spec.shape, dtype=spec.dtype, buffer=shm.buf)
+
+
+def _call(fn: Callable, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Any:
+    """
+    Обёртка в воркере: ShmSpec в аргументах -> np.ndarray поверх общего сегмента.
+    """
+    opened: List[shared_memory.SharedMemory] = []
+
+    def resolve(value):
+        if isinstance(value, ShmSpec):
+            shm, arr = _attach(value)
+            opened.append(shm)
+            return arr
+        return value
+
+    args = tuple(resolve(a) for a in args)
+    kwargs = {k: resolve(v) for k, v in kwargs.items()}
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        del args, kwargs
+        for shm in opened:
+            shm.close()
+
+
+class SharedArray:
+    """
+    Сегмент shared memory, которым владеет родитель: .array — view, .spec — для задачи.
+    release() возвращает байты в бюджет пула; повторный вызов — без эффекта.
+    """
+
+    def __init__(self, pool: "ShmPool", shape: Tuple[int, ...], dtype):
+        self.pool = pool
+        dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+        self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.nbytes = nbytes
+        self.spec = ShmSpec(self._shm.name, tuple(int(x) for x in shape), dtype.str)
+        self.array: Optional[np.ndarray] = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+
+    def copy(self) -> np.ndarray:
+        return np.array(self.array, copy=True)
+
+    def release(self) -> None:
+        # зовут и callback задачи, и родитель после map — освобождает тот, кто успел первым
+        with self.pool._cond:
+            shm, self._shm = self._shm, None
+        if shm is None:
+            return
+        self.array = None
+        try:
+            shm.close()
+        except BufferError:
+            # снаружи ещё живёт view: сегмент освободится вместе с ним, имя убираем сейчас
+            pass
+        shm.unlink()
+        self.pool._give_back(self.nbytes)
+
+
+class ShmPool:
+    """
+    ShmPool — пул процессов с передачей массивов через shared memory и бюджетом памяти.
+    """
+
+    def __init__(self, workers: int = SHM_WORKERS, budget_bytes: int = SHM_BUDGET_MB * 1024 * 1024,
+                 executor: Optional[ProcessPoolExecutor] = None):
+        self.workers = workers
+        self.budget = budget_bytes
+        self._own = executor is None
+        self.executor = executor or ProcessPoolExecutor(max_workers=workers,
+                                                        mp_context=multiprocessing.get_context("spawn"))
+        self._cond = threading.Condition()
+        self._used = 0
+        self.peak = 0
+
+    # --- бюджет ---
+
+    def _take(self, nbytes: int) -> None:
+        with self._cond:
+            while self._used and self._used + nbytes > self.budget:
+                self._cond.wait()
+            self._used += nbytes
+            self.peak = max(self.peak, self._used)
+
+    def _give_back(self, nbytes: int) -> None:
+        with self._cond:
+            self._used -= nbytes
+            self._cond.notify_all()
+
+    @property
+    def used(self) -> int:
+        return self._used
+
+    # --- буферы ---
+
+    def empty(self, shape: Tuple[int, ...], dtype=np.uint8) -> SharedArray:
+        """Новый буфер в shared memory (ждёт места в бюджете)."""
+        self._take(max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+        try:
+            return SharedArray(self, shape, dtype)
+        except Exception:
+            self._give_back(max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+            raise
+
+    def share(self, array: np.ndarray) -> SharedArray:
+        """Копия массива в shared memory — единственная копия на всём пути до воркера."""
+        buf = self.empty(array.shape, array.dtype)
+        buf.array[...] = array
+        return buf
+
+    # --- задачи ---
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Как ProcessPoolExecutor.submit; SharedArray в аргументах уходит как ShmSpec.
+        Освобождать буферы — вызывающему (после результата).
+        """
+        conv = lambda v: v.spec if isinstance(v, SharedArray) else v
+        return self.executor.submit(_call, fn, tuple(conv(a) for a in args), {k: conv(v) for k, v in kwargs.items()})
+
+    def map(self, fn: Callable, arrays: Sequence[np.ndarray], *args, out: bool = False,
+            copy_out: bool = True, per_item: Optional[Sequence[Tuple[Any, ...]]] = None) -> List[Any]:
+        """
+        fn(image, *args) по каждой картинке — или fn(image, out_buffer, *args) при out=True.
+        per_item — свои аргументы каждой картинки (кортежи), идут перед args.
+        Порядок запуска — от больших к меньшим, порядок результатов — как у arrays.
+        out=True: результат — выходной буфер (копия, если copy_out, иначе SharedArray —
+        освободить самому) и то, что вернула fn: (array, value).
+        """
+        order = sorted(range(len(arrays)), key=lambda i: -arrays[i].nbytes)
+        results: List[Any] = [None] * len(arrays)
+        errors: List[BaseException] = []
+        left = [len(arrays)]
+        finished = threading.Condition()
+
+        def done(i: int, src: SharedArray, dst: Optional[SharedArray], fut: Future) -> None:
+            # сразу по готовности задачи: место в бюджете — следующим картинкам
+            try:
+                src.release()
+                if fut.exception() is not None:
+                    errors.append(fut.exception())
+                    if dst is not None:
+                        dst.release()
+                elif dst is None:
+                    results[i] = fut.result()
+                elif copy_out:
+                    results[i] = (dst.copy(), fut.result())
+                    dst.release()
+                else:
+                    results[i] = (dst, fut.result())
+            finally:
+                with finished:
+                    left[0] -= 1
+                    finished.notify_all()
+
+        for i in order:
+            # вход и выход берут бюджет вместе: иначе вход без места под выход держал бы очередь
+            arr = arrays[i]
+            extra = tuple(per_item[i]) + args if per_item is not None else args
+            if out:
+                self._take(2 * arr.nbytes)
+                src = SharedArray(self, arr.shape, arr.dtype)
+                dst = SharedArray(self, arr.shape, arr.dtype)
+                src.array[...] = arr
+                fut = self.executor.submit(_call, fn, (src.spec, dst.spec) + extra, {})
+            else:
+                src = self.share(arr)
+                dst = None
+                fut = self.executor.submit(_call, fn, (src.spec,) + extra, {})
+            fut.add_done_callback(lambda f, i=i, s=src, d=dst: done(i, s, d, f))
+
+        # ждём callback'и, а не задачи: result() отпускает ожидающих раньше, чем они выполнятся
+        with finished:
+            finished.wait_for(lambda: left[0] == 0)
+        if errors:
+            for r in results:
+                if r is not None and isinstance(r[0], SharedArray):
+                    r[0].release()
+            raise errors[0]
+        return results
+
+    def close(self) -> None:
+        if self._own:
+            self.executor.shutdown()
+
+    def __enter__(self) -> "ShmPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+def _bench_mean(image: np.ndarray) -> float:
+    """Лёгкая задача: стоимость передачи доминирует."""
+    return float(image[::4, ::4].mean())
+
+
+def _bench_invert(image: np.ndarray, out: np.ndarray) -> int:
+    np.subtract(255, image, out=out)
+    return int(out.shape[0])
+
+
+def _bench_invert_pickled(image: np.ndarray) -> np.ndarray:
+    return 255 - image
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BookSoul shared-memory pool benchmark")
+    parser.add_argument("--images", type=int, default=24)
+    parser.add_argument("--workers", type=int, default=SHM_WORKERS)
+    parser.add_argument("--budget-mb", type=int, default=160)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # A5 300 DPI, плюс часть — разворот и обложка (больше), как в реальной пачке
+    sizes = [(2480, 1748)] * (args.images - 4) + [(2480, 3496)] * 2 + [(3600, 5200)] * 2
+    images = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for h, w in sizes]
+    total = sum(a.nbytes for a in images)
+    print(f"{len(images)} картинок, {total / 1e6:.0f} МБ RGB; воркеров {args.workers} (ядер: {os.cpu_count()})")
+
+    t0 = time.perf_counter()
+    pickled = sum(len(pickle.dumps(a, protocol=pickle.HIGHEST_PROTOCOL)) for a in images)
+    print(f"пиклинг одних только входов в родителе: {time.perf_counter() - t0:.2f} с, {pickled / 1e6:.0f} МБ")
+
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx) as naive:
+        list(naive.map(_bench_mean, images[:args.workers]))    # прогрев
+        t0 = time.perf_counter()
+        list(naive.map(_bench_mean, images))
+        t_naive_in = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        list(naive.map(_bench_invert_pickled, images))
+        t_naive_io = time.perf_counter() - t0
+
+    with ShmPool(workers=args.workers, budget_bytes=args.budget_mb * 1024 * 1024) as pool:
+        list(pool.executor.map(_bench_mean, [np.zeros((4, 4, 3))] * args.workers))   # прогрев
+        t0 = time.perf_counter()
+        pool.map(_bench_mean, images)
+        t_shm_in = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        res = pool.map(_bench_invert, images, out=True)
+        t_shm_io = time.perf_counter() - t0
+        assert all(np.array_equal(r[0], 255 - a) for r, a in zip(res[:2], images[:2]))
+        del res
+        print(f"бюджет {args.budget_mb} МБ: пик живых сегментов {pool.peak / 2 ** 20:.0f} МБ, "
+              f"после пачки {pool.used} байт")
+
+    print(f"вход -> среднее:   пиклинг {t_naive_in:.2f} с, shared memory {t_shm_in:.2f} с "
+          f"(x{t_naive_in / t_shm_in:.1f})")
+    print(f"вход -> картинка:  пиклинг {t_naive_io:.2f} с, shared memory {t_shm_io:.2f} с "
+          f"(x{t_naive_io / t_shm_io:.1f})")
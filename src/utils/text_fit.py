@@ -0,0 +1,331 @@
+# src/utils/text_fit.py
+
+from typing import Optional, Dict, Any, List, Tuple, Callable, NamedTuple, Sequence
+import argparse
+import os
+import sys
+import threading
+import time
+
+try:
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+    from reportlab.pdfbase.ttfonts import TTFont
+except Exception:
+    pdfmetrics = None
+
+# --- путь к проекту, чтобы работали импорты при локальном запуске ---
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))      # .../src/utils
+SRC_DIR = os.path.dirname(CURRENT_DIR)                         # .../src
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+# Важно:
+# - подбор кегля: "крупный дружелюбный шрифт, текст не налезает на арт" — наибольший кегль, при
+#   котором текст, разбитый по словам, влезает в свободный от арта прямоугольник. В лоб это цикл
+#   по кеглям, и на каждом — перенос строк с stringWidth на каждое слово и строку
+# - здесь ширины считаются в единицах 1/1000 кегля: ширина символа от кегля не зависит, поэтому
+#   таблица символов строится один раз на шрифт (основной набор — сразу, при создании), ширина
+#   слова — сумма символов (ReportLab не кернит, TTF/CID — сумма advance), кэшируется
+# - перенос на кегле size при ширине w — жадный перенос с пределом w * 1000 / size; для текста
+#   кэшируются ширины его слов (разбор один раз), для (текст, предел) — готовые строки
+# - кегль — двоичный поиск по сетке min..max с шагом step: число строк при большем кегле не
+#   меньше (жадный перенос монотонен), высота растёт — условие "влезает" монотонно
+# - несколько прямоугольников (например, полоса над героем и под ним) — берётся тот, где кегль
+#   больше; при равенстве — первый. Не влезает нигде — min_size в первом, fits=False
+# - единицы прямоугольников — любые (пункты PDF, пиксели обложки), лишь бы как у кегля
+# - шрифт по умолчанию — settings.reportlab_font (REPORTLAB_FONT): путь к TTF или имя
+#   CID-/стандартного шрифта. config читается лениво (default_font), не при импорте: модуль
+#   импортируют spawn-воркеры пулов, им баннер и предупреждения config ни к чему — шрифт
+#   им передаёт вызывающий
+#
+# Бенчмарк (подбор кегля для страниц книги и заголовка обложки, против цикла по кеглям):
+#   python src/utils/text_fit.py
+
+CID_FONTS = ("HeiseiMin-W3", "HeiseiKakuGo-W5", "STSong-Light", "MSung-Light", "HYSMyeongJo-Medium")
+
+# основной набор символов книги: таблица ширин строится сразу
+PRELOAD_CHARS = ("".join(chr(c) for c in range(0x20, 0x7F)) + "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ"
+                 "абвгдеёжзийклмнопрстуфхцчшщъыьэюя" + "«»„“”’—–…№")
+
+FIT_CACHE_SIZE = 4096
+
+
+class Fit(NamedTuple):
+    """Результат подбора: кегль, строки, прямоугольник (x, y, w, h), влез ли текст."""
+    size: float
+    lines: List[str]
+    rect: Tuple[float, float, float, float]
+    fits: bool
+
+
+def _remember(memo: Dict[Any, Any], key, value, limit: int = FIT_CACHE_SIZE):
+    """
+    Запись в кэш-словарь. Переполнился — очищается целиком: LRU с замком на каждое слово
+    стоил бы дороже самого подсчёта; отдельные get/set словаря атомарны под GIL.
+    """
+    if len(memo) >= limit:
+        memo.clear()
+    memo[key] = value
+    return value
+
+
+# ---------------------------------------------------------------------------------
+# МЕТРИКИ ШРИФТА
+# ---------------------------------------------------------------------------------
+
+class FontMetrics:
+    """
+    FontMetrics — ширины символов шрифта в единицах 1/1000 кегля, кэш слов и переносов.
+    width_fn(ch) -> ширина символа при кегле 1000 (ReportLab stringWidth, PIL getlength).
+    """
+
+    def __init__(self, name: str, width_fn: Callable[[str], float], preload: str = PRELOAD_CHARS):
+        self.name = name
+        self._width_fn = width_fn
+        self._chars: Dict[str, float] = {ch: float(width_fn(ch)) for ch in preload}
+        self._words: Dict[str, float] = {}
+        self._texts: Dict[str, Any] = {}
+        self._wraps: Dict[Tuple[str, float], Any] = {}
+        self._fits: Dict[Any, Fit] = {}
+        self.space = self.char(" ")
+
+    def char(self, ch: str) -> float:
+        w = self._chars.get(ch)
+        if w is None:
+            w = self._chars[ch] = float(self._width_fn(ch))
+        return w
+
+    def word(self, word: str) -> float:
+        w = self._words.get(word)
+        if w is None:
+            w = _remember(self._words, word, sum(self.char(ch) for ch in word), FIT_CACHE_SIZE * 4)
+        return w
+
+    def width(self, text: str, size: float) -> float:
+        """Ширина строки при кегле size (в единицах кегля)."""
+        return sum(self.char(ch) for ch in text) * size / 1000
+
+    # --- перенос ---
+
+    def _parse(self, text: str) -> List[List[Tuple[str, float]]]:
+        """Текст -> абзацы -> слова с ширинами (один раз на текст)."""
+        parsed = self._texts.get(text)
+        if parsed is None:
+            parsed = _remember(self._texts, text,
+                               [[(w, self.word(w)) for w in para.split()] for para in text.split("\n")])
+        return parsed
+
+    def wrap_units(self, text: str, limit: float) -> Tuple[List[str], float]:
+        """
+        Жадный перенос по словам при пределе ширины limit (единицы 1/1000 кегля).
+        Возвращает строки и ширину самой широкой (слово длиннее предела — отдельной строкой).
+        """
+        key = (text, round(limit, 3))
+        cached = self._wraps.get(key)
+        if cached is not None:
+            return cached
+        lines: List[str] = []
+        widest = 0.0
+        for para in self._parse(text):
+            line: List[str] = []
+            cur = 0.0
+            for word, w in para:
+                if line and cur + self.space + w <= limit:
+                    line.append(word)
+                    cur += self.space + w
+                    continue
+                if line:
+                    lines.append(" ".join(line))
+                    widest = max(widest, cur)
+                line, cur = [word], w
+            lines.append(" ".join(line))
+            widest = max(widest, cur)
+        return _remember(self._wraps, key, (lines, widest))
+
+    def wrap(self, text: str, size: float, max_width: float) -> List[str]:
+        return self.wrap_units(text, max_width * 1000 / size)[0]
+
+    # --- подбор кегля ---
+
+    def _fits_in(self, text: str, size: float, w: float, h: float, leading: float) -> Optional[List[str]]:
+        limit = w * 1000 / size
+        lines, widest = self.wrap_units(text, limit)
+        if widest > limit or len(lines) * size * leading > h:
+            return None
+        return lines
+
+    def fit(self, text: str, rects: Sequence[Tuple[float, float, float, float]], max_size: float,
+            min_size: float, leading: float = 1.2, step: float = 0.5) -> Fit:
+        """
+        Наибольший кегль из min_size..max_size (шаг step), при котором текст влезает
+        в один из прямоугольников (x, y, w, h).
+        """
+        rects = [tuple(float(v) for v in r) for r in rects]
+        key = (text, tuple(rects), max_size, min_size, leading, step)
+        cached = self._fits.get(key)
+        if cached is not None:
+            return cached
+        best: Optional[Fit] = None
+        steps = max(0, int((max_size - min_size) / step + 1e-9))
+        for rect in rects:
+            _, _, w, h = rect
+            if w <= 0 or h <= 0:
+                continue
+            lo, hi, found = 0, steps, None
+            # двоичный поиск по сетке: found — наибольший шаг, на котором влезает
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                size = min_size + mid * step
+                lines = self._fits_in(text, size, w, h, leading)
+                if lines is not None:
+                    found = (size, lines)
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+            if found and (best is None or found[0] > best.size):
+                best = Fit(found[0], found[1], rect, True)
+        if best is None:
+            rect = rects[0] if rects else (0.0, 0.0, 0.0, 0.0)
+            best = Fit(min_size, self.wrap(text, min_size, max(rect[2], 1e-6)), rect, False)
+        return _remember(self._fits, key, best)
+
+
+# ---------------------------------------------------------------------------------
+# ШРИФТЫ REPORTLAB
+# ---------------------------------------------------------------------------------
+
+_registered: Dict[str, str] = {}
+_metrics: Dict[str, FontMetrics] = {}
+_lock = threading.Lock()
+
+
+def default_font() -> str:
+    """settings.reportlab_font (REPORTLAB_FONT) — config импортируется при первом вызове."""
+    from config import settings
+    return settings.reportlab_font
+
+
+def register_font(font: Optional[str] = None) -> str:
+    """REPORTLAB_FONT -> имя шрифта для canvas (TTF регистрируется один раз на процесс)."""
+    font = font or default_font()
+    if font in _registered:
+        return _registered[font]
+    if font.lower().endswith((".ttf", ".otf")):
+        name = os.path.splitext(os.path.basename(font))[0]
+        pdfmetrics.registerFont(TTFont(name, font))
+    elif font in CID_FONTS:
+        name = font
+        pdfmetrics.registerFont(UnicodeCIDFont(font))
+    else:
+        name = font                     # стандартный шрифт PDF (Helvetica и т.п.)
+    _registered[font] = name
+    return name
+
+
+def get_metrics(font: Optional[str] = None) -> FontMetrics:
+    """Метрики шрифта ReportLab (путь к TTF или имя) — одни на процесс."""
+    name = register_font(font)
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = FontMetrics(name, lambda ch: pdfmetrics.stringWidth(ch, name, 1000))
+        return _metrics[name]
+
+
+def fit(text: str, rects: Sequence[Tuple[float, float, float, float]], max_size: float, min_size: float,
+        leading: float = 1.2, step: float = 0.5, font: Optional[str] = None) -> Fit:
+    """Подбор кегля шрифтом ReportLab (см. FontMetrics.fit)."""
+    return get_metrics(font).fit(text, rects, max_size, min_size, leading, step)
+
+
+# -----------------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ БЕНЧМАРК
+# -----------------------------------------------------------------------------
+
+BENCH_TEXTS = [
+    "Лейла открыла старую дверь в саду, и золотой кот тихо мяукнул: «Идём, я покажу тебе место, где живут звёзды».",
+    "Они шли по тропинке из светлячков, и каждый шаг звенел, как колокольчик. Луна смотрела на них сквозь листья.",
+    "— Ты не боишься? — спросил кот. — Немножко, — честно ответила Лейла и крепче сжала его тёплую лапу.",
+    "За холмом, где кончалась тропинка, стоял домик из облаков. В окошке горел мягкий свет, пахло булочками.",
+    "Звёзды спустились пониже, чтобы послушать, как Лейла рассказывает им про маму, папу и своего щенка Бублика.",
+    "Утром Лейла проснулась в своей кровати. На подушке лежало маленькое золотое пёрышко — подарок от звёзд.",
+]
+
+
+def _naive_fit(text: str, font: str, w: float, h: float, max_size: float, min_size: float,
+               leading: float, step: float) -> Tuple[float, List[str]]:
+    """Как в лоб: от max_size вниз, на каждом кегле перенос с stringWidth по строкам."""
+    from reportlab.lib.utils import simpleSplit
+    size = max_size
+    while True:
+        lines = simpleSplit(text, font, size, w)
+        if len(lines) * size * leading <= h or size <= min_size:
+            return size, lines
+        size -= step
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BookSoul text fitting benchmark")
+    parser.add_argument("--font", default=None)
+    parser.add_argument("--pages", type=int, default=24)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    # полоса текста страницы A5 (pdf_maker.text_box) в пунктах и заголовок обложки в пикселях
+    page_rect = (42.5, 34.0, 385.5, 124.7)
+    texts = [BENCH_TEXTS[i % len(BENCH_TEXTS)] + " " * (i // len(BENCH_TEXTS)) for i in range(args.pages)]
+
+    args.font = args.font or default_font()
+    t0 = time.perf_counter()
+    name = register_font(args.font)
+    metrics = get_metrics(args.font)
+    print(f"шрифт {args.font} ({name}): таблица {len(PRELOAD_CHARS)} символов за "
+          f"{(time.perf_counter() - t0) * 1e3:.1f} мс")
+
+    t0 = time.perf_counter()
+    for _ in range(args.rounds):
+        naive = [_naive_fit(t, name, page_rect[2], page_rect[3], 20, 11, 1.3, 0.5) for t in texts]
+    t_naive = (time.perf_counter() - t0) / (args.rounds * len(texts))
+
+    t_cold = t_edit = 0.0
+    for r in range(args.rounds):
+        # холодный кэш: новые метрики (таблица символов — вне замера), все тексты впервые
+        cold = FontMetrics(name, lambda ch: pdfmetrics.stringWidth(ch, name, 1000))
+        t0 = time.perf_counter()
+        fits = [cold.fit(t, [page_rect], 20, 11, 1.3, 0.5) for t in texts]
+        t_cold += time.perf_counter() - t0
+        # правка: новые тексты из уже знакомых слов
+        edited = [t.replace("Лейла", "Айша" if r % 2 else "Мила") for t in texts]
+        t0 = time.perf_counter()
+        for t in edited:
+            cold.fit(t, [page_rect], 20, 11, 1.3, 0.5)
+        t_edit += time.perf_counter() - t0
+    t_cold /= args.rounds * len(texts)
+    t_edit /= args.rounds * len(texts)
+    t0 = time.perf_counter()
+    for _ in range(args.rounds):
+        fits = [cold.fit(t, [page_rect], 20, 11, 1.3, 0.5) for t in texts]
+    t_warm = (time.perf_counter() - t0) / (args.rounds * len(texts))
+
+    same = sum(1 for (ns, nl), f in zip(naive, fits) if ns == f.size and nl == f.lines)
+    print(f"страница ({len(texts)} текстов, 20..11 pt, шаг 0.5):")
+    print(f"  цикл по кеглям + simpleSplit: {t_naive * 1e6:8.0f} мкс на текст")
+    print(f"  text_fit, холодный кэш:       {t_cold * 1e6:8.0f} мкс (x{t_naive / t_cold:.0f})")
+    print(f"  text_fit, правка текста:      {t_edit * 1e6:8.0f} мкс (x{t_naive / t_edit:.0f})")
+    print(f"  text_fit, повторная вёрстка:  {t_warm * 1e6:8.1f} мкс (x{t_naive / t_warm:.0f})")
+    print(f"  совпало с циклом по кеглям: {same} из {len(texts)} (кегль и строки)")
+
+    # заголовок обложки: пиксели, шаг 1 px, две полосы без арта — над героем и под ним
+    title = "Лейла и золотой кот, который знал дорогу к звёздам"
+    rects = [(64, 180, 1565, 640), (64, 2300, 1565, 200)]
+    t0 = time.perf_counter()
+    for _ in range(args.rounds):
+        naive_title = max((_naive_fit(title, name, r[2], r[3], 357, 90, 1.2, 1) for r in rects), key=lambda x: x[0])
+    t_title_naive = (time.perf_counter() - t0) / args.rounds
+    t0 = time.perf_counter()
+    res = metrics.fit(title, rects, 357, 90, 1.2, 1)
+    t_title = time.perf_counter() - t0
+    print(f"заголовок обложки (2 полосы, 357..90 px, шаг 1): цикл по кеглям {t_title_naive * 1e6:.0f} мкс, "
+          f"text_fit {t_title * 1e6:.0f} мкс (x{t_title_naive / t_title:.0f}); кегль {res.size:.0f} px "
+          f"(цикл: {naive_title[0]:.0f}), строк {len(res.lines)}, полоса y={res.rect[1]:.0f}")
@@ -4,11 +4,21 @@
 # Приветствия и статусы оформлены в стиле ⚡ Неоновый цифровой.
 
 from __future__ import annotations
-import os, time, asyncio
+import os, sys, time, asyncio, hashlib
 from datetime import datetime, timezone, timedelta
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
-from google.cloud import firestore
+from fastapi.responses import JSONResponse, Response
+
+# --- src в sys.path, чтобы подключать data_layer ---
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import get_storage
+from router.token_accounting import TokenLedger
+from router.conversation_memory import ConversationMemory, make_summarizer, MEMORY_SUMMARIZER
+from router.model_router import ModelRouter, choose_tier
+from utils import metrics
 
 # --- HTTP (Telegram) ---
 try:
@@ -18,16 +28,23 @@ except Exception:
 
 # --- OpenAI SDK ---
 try:
-    from openai import OpenAI
+    from openai import OpenAI, AsyncOpenAI
 except Exception:
     OpenAI = None
+    AsyncOpenAI = None
 
 app = FastAPI()
-db = firestore.Client()  # ADC (Cloud Run SA)
+store = get_storage()  # BOOKSOUL_STORAGE: firestore (ADC, Cloud Run SA) | memory | sqlite
+ledger = TokenLedger(store)  # токены/стоимость LLM по чатам
+memory = ConversationMemory(store)  # окно последних реплик + сводка в chats/{chat_id}
+_router_llm = None  # ModelRouter, создаётся лениво (_model_router)
+_summarizer = None  # сводка памяти чата, один синхронный клиент на процесс (_memory_summarizer)
 
 # -------- ENV ----------
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
-TELEGRAM_API = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}" if TELEGRAM_BOT_TOKEN else ""
+# TELEGRAM_API_BASE — переопределение базы (прокси / локальный стенд), как в worker
+TELEGRAM_API_BASE = (os.getenv("TELEGRAM_API_BASE", "") or "https://api.telegram.org").rstrip("/")
+TELEGRAM_API = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}" if TELEGRAM_BOT_TOKEN else ""
 
 # Логотип (предпочтительно file_id, иначе URL)
 LOGO_FILE_ID = os.getenv("LOGO_FILE_ID", "")
@@ -36,19 +53,29 @@ LOGO_URL = os.getenv("LOGO_URL", "")
 # Включение баннеров (перво-контакт/ре-контакт)
 SEND_ACK_BANNER = os.getenv("SEND_ACK_BANNER", "true").lower() == "true"
 
+# Что хранить из сырого апдейта в inbox: projected (по умолчанию) | full | none
+INBOX_RAW_MODE = os.getenv("INBOX_RAW_MODE", "projected").lower()
+
+# Память диалога: окно + сводка под MEMORY_BUDGET_TOKENS (false — каждое сообщение отдельно)
+CHAT_MEMORY = os.getenv("CHAT_MEMORY", "true").lower() == "true"
+
 # Паузы
 RECONNECT_HOURS = int(os.getenv("RECONNECT_HOURS", "24"))   # мягкое приветствие
 SESSION_WAIT_HOURS = int(os.getenv("SESSION_WAIT_HOURS", "1"))  # статус ожидания
 
 # OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
-OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")  # ярус main; fast — OPENAI_MODEL_FAST (router/model_router.py)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "1"))  # ретраи SDK; хедж/fallback — в ModelRouter
 SYSTEM_PROMPT = (
     "You are the Director (Технолог) of BookSoul Factory. "
     "Отвечай кратко и по делу о создании детской книги. "
     "Если данных не хватает — задай один уточняющий вопрос. "
     "Тон: технологичный, уверенный, дружелюбный."
 )
+# статический префикс запроса: один и тот же объект на каждый вызов, динамика (текст) — в конце
+_PROMPT_PREFIX = ({"role": "system", "content": SYSTEM_PROMPT},)
+_PROMPT_CACHE_KEY = "booksoul:webhook:" + hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:12]
 
 # Debug
 DEBUG_ROUTER = os.getenv("DEBUG_ROUTER", "false").lower() == "true"
@@ -56,12 +83,29 @@ def _dlog(*args):
     if DEBUG_ROUTER:
         try: print("[router]", *args)
         except Exception: pass
+
+def _metric(**deltas):
+    """Шардированные счётчики; ошибки метрик не должны ломать обработку."""
+    try:
+        store.metrics.incr_many(deltas)
+    except Exception as e:
+        _dlog("metrics error", repr(e))
 # -----------------------
 
 @app.get("/")
 def health():
     return {"status": "ok", "service": "booksoul-webhook2"}
 
+@app.get("/metrics")
+def prometheus_metrics():
+    """Счётчики и гистограммы процесса в формате Prometheus (LLM-вызовы — booksoul_llm_*)."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/router_stats")
+def router_stats():
+    """p50/p95/p99, хеджи и стоимость по ярусам моделей (с момента старта процесса)."""
+    return {"ok": True, "tiers": _router_llm.report() if _router_llm is not None else {}}
+
 # ---------- utils ----------
 def _utcnow() -> datetime:
     return datetime.now(timezone.utc)
@@ -73,23 +117,53 @@ def _hours_ago(dt_iso: str | None, hours: int) -> bool:
     except Exception:
         return True
 
-def _chat_ref(chat_id: int):
-    return db.collection("chats").document(str(chat_id))
-
 def _get_chat_profile(chat_id: int) -> dict:
     try:
-        snap = _chat_ref(chat_id).get()
-        return snap.to_dict() if snap.exists else {}
+        return store.get_chat(chat_id) or {}
     except Exception as e:
         _dlog("chat profile read error", repr(e))
         return {}
 
 def _update_chat_profile(chat_id: int, **fields):
     try:
-        _chat_ref(chat_id).set(fields, merge=True)
+        store.update_chat(chat_id, **fields)
     except Exception as e:
         _dlog("chat profile write error", repr(e))
 
+def _project_raw(payload: dict) -> dict:
+    """
+    Проекция Telegram-апдейта для inbox: только то, что нужно для разбора и replay.
+    Полный raw (entities, фото всех размеров, пересланные сообщения) раздувает каждый документ.
+    """
+    message = payload.get("message") or payload.get("edited_message") or {}
+    chat = message.get("chat") or {}
+    sender = message.get("from") or {}
+    out = {
+        "update_id": payload.get("update_id"),
+        "kind": "edited_message" if payload.get("edited_message") else "message",
+        "message_id": message.get("message_id"),
+        "date": message.get("date"),
+        "chat": {"id": chat.get("id"), "type": chat.get("type")},
+        "from": {k: sender.get(k) for k in ("id", "is_bot", "username", "language_code") if k in sender},
+    }
+    if message.get("caption"):
+        out["caption"] = message["caption"]
+    if message.get("photo"):
+        # Telegram шлёт несколько размеров; храним только самый большой
+        best = max(message["photo"], key=lambda p: p.get("file_size") or p.get("width", 0))
+        out["photo"] = {k: best.get(k) for k in ("file_id", "file_unique_id", "width", "height")}
+    if message.get("document"):
+        doc = message["document"]
+        out["document"] = {k: doc.get(k) for k in ("file_id", "file_unique_id", "file_name", "mime_type")}
+    if (message.get("reply_to_message") or {}).get("message_id"):
+        out["reply_to_message_id"] = message["reply_to_message"]["message_id"]
+    return out
+
+def _inbox_raw(payload: dict):
+    if INBOX_RAW_MODE == "full": return payload
+    if INBOX_RAW_MODE == "none": return None
+    return _project_raw(payload)
+
 # ---------- Telegram ----------
 async def _tg_send_text(chat_id: int, text: str):
     if not (TELEGRAM_API and httpx): return
@@ -148,10 +222,9 @@ async def _send_brand_banner(chat_id: int):
     await _tg_send_photo(chat_id)           # логотип
     await _tg_send_text(chat_id, BRAND_TEXT)
     try:
-        db.collection("events").add({
+        store.log_event({
             "type": "brand_banner",
             "chat_id": chat_id,
-            "created_at": firestore.SERVER_TIMESTAMP,
             "stage": "brand_banner",
         })
     except Exception as e:
@@ -160,10 +233,9 @@ async def _send_brand_banner(chat_id: int):
 async def _send_reconnect_then_brand(chat_id: int):
     try:
         await _tg_send_text(chat_id, "Снова на связи ⚡")
-        db.collection("events").add({
+        store.log_event({
             "type": "reconnect_banner",
             "chat_id": chat_id,
-            "created_at": firestore.SERVER_TIMESTAMP,
             "stage": "reconnect_banner",
         })
     except Exception as e:
@@ -204,10 +276,9 @@ async def _maybe_send_session_wait_banner(chat_id: int):
     if _hours_ago(last_msg_iso, SESSION_WAIT_HOURS) and not _hours_ago(last_msg_iso, RECONNECT_HOURS):
         await _tg_send_text(chat_id, SESSION_WAIT_TEXT)
         try:
-            db.collection("events").add({
+            store.log_event({
                 "type": "session_wait_banner",
                 "chat_id": chat_id,
-                "created_at": firestore.SERVER_TIMESTAMP,
                 "stage": "session_wait_banner",
             })
         except Exception as e:
@@ -224,60 +295,73 @@ def _openai_client():
         _dlog("OpenAI init error", repr(e))
         return None
 
-async def _router_answer(user_text: str) -> str:
+def _memory_summarizer():
+    """Суммаризатор памяти: LLM-клиент создаётся один раз, не на каждое сообщение."""
+    global _summarizer
+    if MEMORY_SUMMARIZER != "llm":
+        return None
+    if _summarizer is None:
+        client = _openai_client()
+        if client is None:
+            return None
+        _summarizer = make_summarizer(client, ledger)
+    return _summarizer
+
+def _model_router():
+    """AsyncOpenAI + ярусы/хеджирование; один клиент на процесс (пул соединений)."""
+    global _router_llm
+    if _router_llm is None:
+        if not OPENAI_API_KEY or AsyncOpenAI is None:
+            _dlog("async openai skipped", {"key": bool(OPENAI_API_KEY), "sdk": AsyncOpenAI is not None})
+            return None
+        try:
+            _router_llm = ModelRouter(AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=OPENAI_MAX_RETRIES))
+        except Exception as e:
+            _dlog("AsyncOpenAI init error", repr(e))
+            return None
+    return _router_llm
+
+async def _router_answer(user_text: str, chat_id=None, update_id=None) -> str:
     if not OPENAI_API_KEY:
         return "Техническая пауза ядра. Повторим чуть позже."
-    client = _openai_client()
-    if client is None:
+    router_llm = _model_router()
+    if router_llm is None:
         return "Временная недоступность мозгового центра. Давай повторим запрос позже."
 
-    # 1) Responses API
-    try:
-        _dlog("responses.create", {"model": OPENAI_MODEL})
-        resp = client.responses.create(
-            model=OPENAI_MODEL,
-            input=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_text},
-            ],
-            temperature=0.2,
-            max_output_tokens=700,
-        )
-        text = (getattr(resp, "output_text", "") or "").strip()
-        if text: return text
-        _dlog("responses empty")
-    except Exception as e:
-        _dlog("responses error", repr(e))
+    # память чата: сводка + окно; текущий update уже в events — исключаем, он идёт последним
+    history = []
+    if CHAT_MEMORY and chat_id is not None:
+        try:
+            # хранилище и сводка (LLM) синхронные — в поток, чтобы не держать цикл событий
+            ctx = await asyncio.to_thread(memory.build, chat_id, exclude_update_id=update_id,
+                                          summarizer=_memory_summarizer())
+            history = memory.as_messages(ctx)
+            _dlog("memory", ctx["stats"])
+        except Exception as e:
+            _dlog("memory error", repr(e))
+    messages = [*_PROMPT_PREFIX, *history, {"role": "user", "content": user_text}]
 
-    # 2) Chat Completions (fallback)
+    # ярус по тексту: короткое/простое -> fast, творческое/редакторское -> main;
+    # Responses API основным, Chat Completions — хедж при медленном ответе или сразу при ошибке
+    tier, reason = choose_tier(user_text)
     try:
-        _dlog("chat.completions.create", {"model": OPENAI_MODEL})
-        ch = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_text},
-            ],
-            temperature=0.2,
-            max_tokens=700,
-        )
-        text = (ch.choices[0].message.content if ch and ch.choices else "" or "").strip()
-        if text: return text
-        _dlog("chat empty")
+        res = await router_llm.answer(messages, tier=tier, cache_key=_PROMPT_CACHE_KEY, kind=f"webhook_{tier}")
+        _dlog("llm", {k: res[k] for k in ("tier", "model", "endpoint", "latency_ms", "hedged", "fallback")}, reason)
+        ledger.record(res["model"], res["usage"], kind=f"webhook_{tier}", chat_id=chat_id)
+        return res["text"]
     except Exception as e:
-        _dlog("chat error", repr(e))
+        _dlog("llm error", tier, repr(e))
 
+    _metric(errors=1, **{"errors_by_stage.router_llm": 1})
     return "Я на связи, но сейчас техническое окно. Повтори, пожалуйста, мысль — проверю цепочку."
 
 # ---------- Processing pipeline ----------
 async def _process_update(chat_id: int, update_id: int, user_text: str):
     out_id = f"{chat_id}:{update_id}"
-    out_ref = db.collection("outbox").document(out_id)
 
     # уже отвечали на этот update?
     try:
-        snap = out_ref.get()
-        if snap.exists and snap.to_dict().get("sent") is True:
+        if (store.get_outbox(out_id) or {}).get("sent") is True:
             _dlog("outbox skip", out_id)
             return
     except Exception as e:
@@ -286,44 +370,46 @@ async def _process_update(chat_id: int, update_id: int, user_text: str):
     # session-wait баннер при паузе >1h (и <24h)
     asyncio.create_task(_maybe_send_session_wait_banner(chat_id))
 
+    # счётчик сообщений: один инкремент на update (дубли отсечены outbox-ом выше)
+    _metric(messages=1)
+
     # журнал: старт роутера
     try:
-        db.collection("events").document(f"{out_id}:start").set({
+        store.log_event({
             "type": "router_start",
             "chat_id": chat_id,
             "update_id": update_id,
             "user_text": user_text,
-            "created_at": firestore.SERVER_TIMESTAMP,
             "stage": "router_start",
-        }, merge=True)
+        }, event_id=f"{out_id}:start")
     except Exception as e:
         _dlog("events router_start error", repr(e))
 
     # ответ технолога
-    answer = await _router_answer(user_text)
+    answer = await _router_answer(user_text, chat_id, update_id)
 
     # отправка ответа
     try:
         await _tg_send_text(chat_id, answer)
     except Exception as e:
         _dlog("telegram send error", repr(e))
+        _metric(errors=1, **{"errors_by_stage.telegram_send": 1})
 
     # журнал: отправлен
     try:
-        db.collection("events").document(f"{out_id}:sent").set({
+        store.log_event({
             "type": "router_sent",
             "chat_id": chat_id,
             "update_id": update_id,
             "answer": answer,
-            "created_at": firestore.SERVER_TIMESTAMP,
             "stage": "router_sent",
-        }, merge=True)
+        }, event_id=f"{out_id}:sent")
     except Exception as e:
         _dlog("events router_sent error", repr(e))
 
     # отметка в outbox
     try:
-        out_ref.set({"sent": True, "sent_at": firestore.SERVER_TIMESTAMP}, merge=True)
+        store.mark_outbox_sent(out_id)
     except Exception as e:
         _dlog("outbox set error", repr(e))
 
@@ -347,44 +433,34 @@ async def telegram_webhook(req: Request):
 
     # inbox идемпотентно
     inbox_id = f"{chat_id}:{update_id}"
-    inbox_ref = db.collection("inbox").document(inbox_id)
 
-    @firestore.transactional
-    def _create_inbox_once(tx: firestore.Transaction):
-        snap = inbox_ref.get(transaction=tx)
-        if snap.exists: return False
+    created = False
+    try:
         now = _utcnow()
-        tx.set(inbox_ref, {
+        created = store.create_inbox_once(inbox_id, {
             "chat_id": chat_id,
             "update_id": update_id,
             "text": user_text,
-            "raw": payload,  # при желании выключить позже
-            "created_at": firestore.SERVER_TIMESTAMP,
+            "raw": _inbox_raw(payload),  # проекция; INBOX_RAW_MODE=full вернёт сырой апдейт
             "created_at_iso_utc": now.isoformat(),
             "created_at_epoch": int(time.time()),
             "status": "received",
             "source": "telegram",
         })
-        return True
-
-    tx = db.transaction()
-    created = False
-    try:
-        created = _create_inbox_once(tx)
     except Exception as e:
         _dlog("inbox write error", repr(e))
+        _metric(errors=1, **{"errors_by_stage.inbox_write": 1})
 
     # журнал входящего
     try:
-        db.collection("events").document(inbox_id).set({
+        store.log_event({
             "type": "incoming_message",
             "chat_id": chat_id,
             "update_id": update_id,
             "text": user_text,
             "source": "telegram",
-            "created_at": firestore.SERVER_TIMESTAMP,
             "stage": "incoming",
-        }, merge=True)
+        }, event_id=inbox_id)
     except Exception as e:
         _dlog("events incoming error", repr(e))
 
@@ -2,13 +2,22 @@
 from __future__ import annotations
 
 import os
+import sys
 import logging
 from typing import Any, Dict, Optional
 
 import httpx
 from fastapi import FastAPI, Body
-from fastapi.responses import JSONResponse
-from google.cloud import firestore
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+# --- src в sys.path, чтобы подключать data_layer ---
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from data_layer.storage import StorageBackend, get_storage
+from utils import metrics
 
 # ---- ЛОГИ ----
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -31,15 +40,46 @@ def telegram_api_base() -> str:
 def telegram_token() -> Optional[str]:
     return env("TELEGRAM_BOT_TOKEN")
 
-# ---- LAZY FIRESTORE ----
-_db: Optional[firestore.Client] = None
+# ---- LAZY STORAGE ----
+_store: Optional[StorageBackend] = None
+
+def get_store() -> StorageBackend:
+    global _store
+    if _store is None:
+        _store = get_storage()  # BOOKSOUL_STORAGE: firestore | memory | sqlite
+        log.info("Storage initialized: %s", type(_store).__name__)
+    return _store
+
+# ---- LAZY IMAGE ENGINE ----
+# один на процесс: глобальный предел IMAGE_GLOBAL_CONCURRENCY общий для всех книг
+_image_engine = None
+
+def get_image_engine():
+    global _image_engine
+    if _image_engine is None:
+        from data_layer.gcs_client import get_blob_store
+        from scene_builder.background_library import BackgroundLibrary, BACKGROUND_LIBRARY
+        from scene_builder.image_cache import ImageCache, IMAGE_CACHE
+        from scene_builder.image_engine import ImageEngine, get_image_provider
+        blobs = get_blob_store()
+        cache = ImageCache(get_store(), blobs) if IMAGE_CACHE else None
+        library = BackgroundLibrary(get_store(), blobs) if BACKGROUND_LIBRARY else None
+        _image_engine = ImageEngine(get_store(), blobs, get_image_provider(), cache=cache, library=library)
+        log.info("Image engine initialized: %s", _image_engine.provider.name)
+    return _image_engine
 
-def get_db() -> firestore.Client:
-    global _db
-    if _db is None:
-        _db = firestore.Client()
-        log.info("Firestore client initialized.")
-    return _db
+# ---- LAZY COVER ENGINE ----
+# один на процесс: кэш слоёв обложек и фоновая печать живут между запросами
+_cover_engine = None
+
+def get_cover_engine():
+    global _cover_engine
+    if _cover_engine is None:
+        from data_layer.gcs_client import get_blob_store
+        from cover_builder.cover_engine import CoverEngine
+        _cover_engine = CoverEngine(get_store(), get_blob_store())
+        log.info("Cover engine initialized (font: %s)", _cover_engine.font_path or "default")
+    return _cover_engine
 
 # ---- HTTP HELPERS ----
 def tg_request(method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
@@ -67,11 +107,35 @@ def tg_request(method: str, payload: Dict[str, Any]) -> Dict[str, Any]:
             data = {"ok": False, "status_code": r.status_code, "text": r.text}
         return data if isinstance(data, dict) else {"ok": False, "status_code": r.status_code, "raw": data}
 
+def tg_send_photo(chat_id: Any, photo: bytes, caption: str = "") -> Dict[str, Any]:
+    """
+    sendPhoto файлом (multipart) — превью, которого ещё нет по публичной ссылке.
+    """
+    token = telegram_token()
+    if not token:
+        raise RuntimeError("TELEGRAM_BOT_TOKEN not set")
+
+    base = telegram_api_base().rstrip("/")
+    url = f"{base}/{token}/sendPhoto" if token.startswith("bot") else f"{base}/bot{token}/sendPhoto"
+    with httpx.Client(timeout=10) as client:
+        r = client.post(url, data={"chat_id": str(chat_id), "caption": caption},
+                        files={"photo": ("cover.jpg", photo, "image/jpeg")})
+        try:
+            data = r.json()
+        except Exception:
+            data = {"ok": False, "status_code": r.status_code, "text": r.text}
+        return data if isinstance(data, dict) else {"ok": False, "status_code": r.status_code, "raw": data}
+
 # ---- ROUTES ----
 @app.get("/")
 def health() -> Dict[str, Any]:
     return {"status": "ok", "service": "booksoul-worker"}
 
+@app.get("/metrics")
+def prometheus_metrics():
+    """Счётчики и гистограммы процесса в формате Prometheus (LLM-вызовы — booksoul_llm_*)."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.get("/tg_self")
 def tg_self():
     """
@@ -108,23 +172,17 @@ def tick():
     3) Обновляем статус на "done".
     Никаких транзакций/локов — всё максимально просто и устойчиво.
     """
-    db = get_db()
+    store = get_store()
 
     try:
-        docs = (
-            db.collection("jobs_inbox")
-            .where("status", "==", "pending")
-            .limit(5)
-            .get()
-        )
+        docs = store.query_docs("jobs_inbox", where=[("status", "==", "pending")], limit=5)
     except Exception as e:
-        log.exception("Firestore query failed: %s", e)
+        log.exception("Storage query failed: %s", e)
         return {"processed_jobs": 0, "error": str(e)}
 
     processed = 0
-    for snap in docs:
-        data = snap.to_dict() or {}
-        doc_id = snap.id
+    for data in docs:
+        doc_id = data["id"]
         chat_id = data.get("chat_id")
         user_text = data.get("user_text") or ""
         log.info("Picked job %s (chat_id=%s, text=%s)", doc_id, chat_id, user_text[:60])
@@ -149,9 +207,142 @@ def tick():
 
         # 2) Отмечаем заявкой как обработанную
         try:
-            db.collection("jobs_inbox").document(doc_id).update({"status": "done"})
+            store.update_doc("jobs_inbox", doc_id, {"status": "done"})
             processed += 1
         except Exception as e:
             log.exception("Failed to update job %s to done: %s", doc_id, e)
 
     return {"processed_jobs": processed}
+
+@app.get("/compact")
+def compact(days: Optional[int] = None, dry_run: bool = False):
+    """
+    Ретенция из Cloud Scheduler (раз в сутки).
+    inbox / events / outbox старше N дней -> сжатые дневные архивы в GCS + manifest.json,
+    затем пакетное удаление из хранилища.
+    """
+    from data_layer.compaction import CompactionJob, RETENTION_DAYS
+    from data_layer.gcs_client import get_blob_store
+
+    try:
+        job = CompactionJob(get_store(), get_blob_store(), retention_days=days or RETENTION_DAYS)
+        summary = job.run(dry_run=dry_run)
+    except Exception as e:
+        log.exception("Compaction failed: %s", e)
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+    log.info("Compaction done: %s", {c: v["archived"] for c, v in summary["collections"].items()})
+    return {"ok": True, **summary}
+
+@app.get("/story_batch")
+def story_batch(submit: bool = True):
+    """
+    Пакетный StoryWriter из Cloud Scheduler (раз в 10–30 минут).
+    1) Забираем готовые пакеты Batch API и раскладываем сцены по книгам.
+    2) Если pending storywriter-задач набралось >= STORY_BATCH_MIN — отправляем новый пакет.
+    """
+    from router.main_router import BookSoulRouter
+    from storywriter.story_engine import StoryWriter, StoryBatchRunner, OpenAIBatchProvider
+
+    try:
+        runner = StoryBatchRunner(StoryWriter(BookSoulRouter(storage=get_store())), OpenAIBatchProvider())
+        polled = runner.poll()
+        submitted = runner.submit_pending() if submit else None
+    except Exception as e:
+        log.exception("Story batch failed: %s", e)
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+    return JSONResponse(jsonable_encoder({"ok": True, "polled": polled, "submitted": submitted}))
+
+@app.get("/draw")
+async def draw(book_id: Optional[str] = None, force: bool = False, books: int = 4):
+    """
+    SceneBuilder: иллюстрации сцен.
+    book_id задан — рисуем эту книгу; иначе — до N книг с pending scene_generation-задачами.
+    Книги рисуются одновременно, страницы внутри книги — тоже (в пределах IMAGE_*_CONCURRENCY).
+    """
+    import asyncio
+
+    try:
+        engine = get_image_engine()
+        if book_id:
+            book_ids = [book_id]
+        else:
+            jobs = await asyncio.to_thread(get_store().list_jobs, job_type="scene_generation", status="pending")
+            book_ids = list(dict.fromkeys(j["book_id"] for j in jobs))[:books]
+        reports = await asyncio.gather(*(engine.draw_book(b, force=force) for b in book_ids))
+    except Exception as e:
+        log.exception("Draw failed: %s", e)
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+    return {"ok": all(r["ok"] for r in reports), "books": reports}
+
+@app.get("/style")
+def style(book_id: str, all_pages: bool = False):
+    """
+    Style Engine: нарисованные сцены книги к единому тону и цвету (styled_url у сцены).
+    По умолчанию (STYLE_ONLY_OUTLIERS) — только выбившиеся из стиля; all_pages=true — все.
+    Тяжёлая часть — в пуле процессов (STYLE_WORKERS), эндпоинт синхронный и идёт в threadpool.
+    """
+    from data_layer.gcs_client import get_blob_store
+    from style_engine.style_corrector import STYLE_ONLY_OUTLIERS, StyleCorrector, get_pool
+
+    try:
+        corrector = StyleCorrector(get_store(), get_blob_store(), pool=get_pool())
+        report = corrector.run_book(book_id, only_outliers=STYLE_ONLY_OUTLIERS and not all_pages)
+    except Exception as e:
+        log.exception("Style pass failed: %s", e)
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+    return report
+
+@app.get("/layout")
+def layout(book_id: str):
+    """
+    Layout Engine: PDF книги из готовых сцен (styled_url или image_url) -> pdf_url книги.
+    Страницы рисуются диапазонами в пуле процессов (PDF_WORKERS) и склеиваются по порядку —
+    память не растёт с числом страниц. После правки сцены рисуются только изменившиеся страницы
+    (кэш фрагментов по ключу страницы). Задача layout: running -> done / error.
+    """
+    from data_layer.gcs_client import get_blob_store
+    from layout_engine.pdf_maker import PdfMaker, get_pool
+
+    try:
+        report = PdfMaker(get_store(), get_blob_store(), pool=get_pool()).build(book_id)
+    except Exception as e:
+        log.exception("Layout failed: %s", e)
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+    return report
+
+@app.get("/cover")
+def cover(book_id: str, feedback: str = "", chat_id: Optional[str] = None, hero_url: Optional[str] = None):
+    """
+    Cover Builder: правка словами ("обложку сделать светлее") -> превью в Telegram сразу,
+    печатная версия (300 DPI) — в фоне; перерисовываются только изменившиеся слои.
+    hero_url — отдельный кадр героя (gs://... / file://...): без него обложка — фон + заголовок,
+    и правки героя ("ребёнка крупнее") возвращаются в unsupported без новой ревизии.
+    """
+    try:
+        engine = get_cover_engine()
+        if hero_url:
+            engine.setup(book_id, hero_url=hero_url)
+        res = engine.proof(book_id, feedback=feedback)
+    except Exception as e:
+        log.exception("Cover proof failed: %s", e)
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+    proof = res.pop("proof")
+    if proof is None:
+        return {"ok": False, "error": "no hero layer: set hero_url to edit the hero", **res}
+    chat_id = chat_id or (get_store().get_doc("covers", book_id) or {}).get("chat_id")
+    if chat_id and telegram_token():
+        try:
+            resp = tg_send_photo(chat_id, proof, caption=f"Обложка, версия {res['revision']}")
+            if not resp.get("ok"):
+                log.error("Telegram sendPhoto failed for cover %s: %s", book_id, resp)
+            res["sent"] = bool(resp.get("ok"))
+        except Exception as e:
+            log.exception("Telegram sendPhoto failed for cover %s: %s", book_id, e)
+            res["sent"] = False
+    return {"ok": True, **res}